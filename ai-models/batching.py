@@ -0,0 +1,371 @@
+"""
+Dynamic micro-batching in front of the generation engine
+Requests arriving within a short window share forward passes, and sequences join or
+leave the running batch between decode steps (continuous batching)
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Dict, Any, Optional, Callable
+
+import numpy as np
+import logging
+
+from generation import GenerationEngine, DecodeState
+from sampling import token_logprobs
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationRequest:
+    """One sequence waiting for or going through decoding"""
+
+    __slots__ = ("prompt", "max_new_tokens", "future", "submitted_at", "started_at",
+                 "first_token_at", "tokens", "stop_check", "on_token", "prefix", "on_prefill",
+                 "logprob_total", "scored")
+
+    def __init__(self, prompt: List[int], max_new_tokens: int,
+                 stop_check: Optional[Callable[[], bool]] = None,
+                 on_token: Optional[Callable[[int], None]] = None,
+                 prefix: Optional[DecodeState] = None,
+                 on_prefill: Optional[Callable[[DecodeState, int], None]] = None):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.future: Future = Future()
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.first_token_at = None
+        self.tokens: List[int] = []
+        self.stop_check = stop_check
+        self.on_token = on_token
+        self.prefix = prefix
+        self.on_prefill = on_prefill
+        self.logprob_total = 0.0
+        self.scored = 0
+
+
+class BatchScheduler:
+    """
+    Collects concurrent generation requests into shared forward passes
+
+    A single background thread owns the engine. New requests are gathered for up to
+    max_wait_ms (or until max_batch_size), prefilled together as one left-padded batch,
+    then merged into the running decode batch. Every decode step serves all active
+    sequences; finished ones are resolved and removed without stopping the others.
+    """
+
+    def __init__(self, engine: GenerationEngine, max_batch_size: int = 8, max_wait_ms: float = 10,
+                 select_tokens: Optional[Callable[[np.ndarray, DecodeState], np.ndarray]] = None):
+        """
+        Initialize the scheduler
+
+        Args:
+            engine: Generation engine to drive
+            max_batch_size: Maximum number of sequences decoded together
+            max_wait_ms: How long the first request of an idle batch waits for company
+            select_tokens: Token selector shared by the batch (greedy by default)
+        """
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.select_tokens = select_tokens
+        self.queue: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self.thread = None
+        self.running = False
+        self.closing = False
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "completed": 0,
+            "failed": 0,
+            "forward_passes": 0,
+            "batched_sequences": 0,
+            "max_batch_size": 0,
+            "queue_wait_total": 0.0,
+            "queue_wait_max": 0.0,
+            "padded_positions": 0,
+            "total_positions": 0
+        }
+
+    def start(self):
+        """Start the scheduling thread"""
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name="batch-scheduler", daemon=True)
+            self.thread.start()
+
+    def close(self):
+        """Stop accepting work and wait until queued and running sequences are finished"""
+        self.closing = True
+        self.running = False
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+
+    def submit(self, prompt: List[int], max_new_tokens: int,
+               stop_check: Optional[Callable[[], bool]] = None,
+               on_token: Optional[Callable[[int], None]] = None,
+               prefix: Optional[DecodeState] = None,
+               on_prefill: Optional[Callable[[DecodeState, int], None]] = None) -> Future:
+        """
+        Queue a prompt for generation
+
+        Args:
+            prompt: Prompt token ids
+            max_new_tokens: Token budget
+            stop_check: Polled between steps; returning True ends the sequence early
+            on_token: Called from the scheduler thread with each generated token
+            prefix: Cached KV of the start of the prompt (see GenerationEngine.start)
+            on_prefill: Called from the scheduler thread with (state, row) once the
+                prompt is processed
+
+        Returns:
+            Future resolving to a result dictionary shaped like GenerationEngine.generate,
+            plus the mean log-probability of the chosen tokens (EOS included)
+
+        Raises:
+            ValueError: If the prompt leaves no room under the engine's max_length
+        """
+        if self.closing:
+            raise RuntimeError("Batch scheduler is shutting down")
+        # Same bound as GenerationEngine.generate: prompt + generated <= max_length
+        max_new_tokens = min(max_new_tokens, self.engine.max_length - len(prompt))
+        if max_new_tokens < 1:
+            raise ValueError(f"Prompt of {len(prompt)} tokens leaves no room under "
+                             f"max_length={self.engine.max_length}")
+        if not self.running:
+            self.start()
+        request = GenerationRequest(list(prompt), max_new_tokens, stop_check, on_token, prefix, on_prefill)
+        with self.lock:
+            self.counters["requests"] += 1
+        self.queue.put(request)
+        return request.future
+
+    def generate(self, prompt: List[int], max_new_tokens: int,
+                 stop_check: Optional[Callable[[], bool]] = None,
+                 prefix: Optional[DecodeState] = None,
+                 on_prefill: Optional[Callable[[DecodeState, int], None]] = None) -> Dict[str, Any]:
+        """Blocking convenience wrapper around submit()"""
+        return self.submit(prompt, max_new_tokens, stop_check, prefix=prefix, on_prefill=on_prefill).result()
+
+    def collect(self, block: bool, limit: int, requests: List[GenerationRequest]) -> List[GenerationRequest]:
+        """
+        Gather up to limit queued requests, waiting up to max_wait for the first batch
+
+        Requests are appended to the caller's list as they leave the queue, so the
+        caller can fail them if anything goes wrong before they join the batch.
+        """
+        deadline = None
+        while len(requests) < limit:
+            try:
+                if block and not requests:
+                    request = self.queue.get()
+                    deadline = time.perf_counter() + self.max_wait
+                elif deadline is not None:
+                    request = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                else:
+                    request = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                break
+            if request.future.set_running_or_notify_cancel():
+                requests.append(request)
+        return requests
+
+    def run(self):
+        """Scheduling loop: admit, step, retire"""
+        state: Optional[DecodeState] = None
+        active: List[GenerationRequest] = []
+        logits = None
+
+        while self.running or active or not self.queue.empty():
+            joining: List[GenerationRequest] = []
+            try:
+                free = self.max_batch_size - len(active)
+                if free > 0:
+                    self.collect(block=not active and self.running, limit=free, requests=joining)
+                if joining:
+                    new_state, new_logits = self.prefill(joining)
+                    if active:
+                        state = self.engine.repack([(state, np.arange(len(active))),
+                                                    (new_state, np.arange(len(joining)))],
+                                                   self.extra_capacity(active + joining))
+                        logits = np.concatenate([logits, new_logits])
+                    else:
+                        state, logits = new_state, new_logits
+                    active = active + joining
+
+                if not active:
+                    continue
+
+                if self.select_tokens is None:
+                    next_tokens = np.argmax(logits, axis=-1).astype(np.int64)
+                else:
+                    next_tokens = np.asarray(self.select_tokens(logits, state), dtype=np.int64)
+                scores = token_logprobs(logits, next_tokens)
+
+                now = time.perf_counter()
+                keep = []
+                for row, request in enumerate(active):
+                    token = int(next_tokens[row])
+                    request.logprob_total += float(scores[row])
+                    request.scored += 1
+                    if request.first_token_at is None:
+                        request.first_token_at = now
+                    if token == self.engine.eos_token_id:
+                        self.finish(request, "eos")
+                        continue
+                    request.tokens.append(token)
+                    if request.on_token is not None:
+                        request.on_token(token)
+                    if len(request.tokens) >= request.max_new_tokens:
+                        self.finish(request, "length")
+                    elif request.stop_check is not None and request.stop_check():
+                        self.finish(request, "stopped")
+                    else:
+                        keep.append(row)
+
+                if not keep:
+                    state, active, logits = None, [], None
+                    continue
+                if len(keep) < len(active):
+                    rows = np.array(keep)
+                    active = [active[row] for row in keep]
+                    state = self.engine.repack([(state, rows)], self.extra_capacity(active))
+                    next_tokens = next_tokens[rows]
+
+                if state.length >= state.capacity:
+                    state = self.engine.repack([(state, np.arange(len(active)))],
+                                               self.extra_capacity(active))
+                self.record_pass(state.attention_mask[:, :state.length], len(active))
+                logits = self.engine.step(state, next_tokens)
+
+            except Exception as e:
+                logger.error(f"Batch decoding failed: {e}")
+                # Requests taken from the queue but not merged yet (a failed prefill or
+                # repack) are not in active and would otherwise never be resolved
+                failed = 0
+                for request in active + joining:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                        failed += 1
+                with self.lock:
+                    self.counters["failed"] += failed
+                state, active, logits = None, [], None
+
+    def extra_capacity(self, requests: List[GenerationRequest]) -> int:
+        """Positions still needed by the longest remaining budget"""
+        return max((r.max_new_tokens - len(r.tokens) for r in requests), default=0) + 1
+
+    def prefill(self, requests: List[GenerationRequest]):
+        """
+        Left-pad the new prompts into one batch and run a single prefill pass
+
+        Prompts with a cached prefix are prefilled on their own from it and merged in;
+        requests is reordered (plain prompts first) to match the rows of the result.
+        """
+        now = time.perf_counter()
+        with self.lock:
+            for request in requests:
+                request.started_at = now
+                wait = now - request.submitted_at
+                self.counters["queue_wait_total"] += wait
+                self.counters["queue_wait_max"] = max(self.counters["queue_wait_max"], wait)
+
+        requests.sort(key=lambda request: request.prefix is not None)
+        plain = [request for request in requests if request.prefix is None]
+        parts = []
+        if plain:
+            width = max(len(r.prompt) for r in plain)
+            input_ids = np.full((len(plain), width), self.engine.pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros((len(plain), width), dtype=np.int64)
+            for row, request in enumerate(plain):
+                input_ids[row, width - len(request.prompt):] = request.prompt
+                attention_mask[row, width - len(request.prompt):] = 1
+            parts.append(self.engine.start(input_ids, attention_mask,
+                                           max(r.max_new_tokens for r in plain)))
+            self.record_pass(attention_mask, 0)
+        for request in requests[len(plain):]:
+            cached = request.prefix.length
+            state, logits = self.engine.start(np.array([request.prompt], dtype=np.int64),
+                                              max_new_tokens=request.max_new_tokens, prefix=request.prefix)
+            request.prefix = None
+            parts.append((state, logits))
+            self.record_pass(state.attention_mask[:, :cached], len(request.prompt) - cached)
+
+        row = 0
+        for state, _ in parts:
+            for offset in range(state.batch_size):
+                request = requests[row + offset]
+                if request.on_prefill is not None:
+                    request.on_prefill(state, offset)
+            row += state.batch_size
+
+        if len(parts) == 1:
+            return parts[0]
+        state = self.engine.repack([(state, np.arange(state.batch_size)) for state, _ in parts],
+                                   self.extra_capacity(requests))
+        return state, np.concatenate([logits for _, logits in parts])
+
+    def record_pass(self, mask: np.ndarray, new_positions: int):
+        """
+        Account one forward pass
+
+        Args:
+            mask: Attention mask of the positions already in the batch
+            new_positions: Valid positions appended by this pass (one per row when decoding)
+        """
+        batch_size = len(mask)
+        with self.lock:
+            self.counters["forward_passes"] += 1
+            self.counters["batched_sequences"] += batch_size
+            self.counters["max_batch_size"] = max(self.counters["max_batch_size"], batch_size)
+            self.counters["total_positions"] += mask.size + new_positions
+            self.counters["padded_positions"] += mask.size - int(mask.sum())
+
+    def finish(self, request: GenerationRequest, reason: str):
+        """Resolve a request's future with its generation result"""
+        end = time.perf_counter()
+        tokens = np.array([request.tokens], dtype=np.int64)
+        generated = len(request.tokens)
+        total_time = end - request.submitted_at
+        request.future.set_result({
+            "tokens": tokens,
+            "lengths": np.array([generated]),
+            "finish_reason": [reason],
+            "prompt_tokens": len(request.prompt),
+            "generated_tokens": generated,
+            "queue_wait": request.started_at - request.submitted_at,
+            "prefill_time": request.first_token_at - request.started_at,
+            "decode_time": end - request.first_token_at,
+            "total_time": total_time,
+            "tokens_per_second": generated / total_time if total_time > 0 else 0.0,
+            "mean_logprob": request.logprob_total / request.scored if request.scored else None
+        })
+        with self.lock:
+            self.counters["completed"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Batch size, queue wait and padding waste metrics"""
+        with self.lock:
+            counters = dict(self.counters)
+        passes = counters["forward_passes"]
+        started = counters["requests"] - self.queue.qsize()
+        return {
+            "requests": counters["requests"],
+            "completed": counters["completed"],
+            "failed": counters["failed"],
+            "queued": self.queue.qsize(),
+            "forward_passes": passes,
+            "mean_batch_size": counters["batched_sequences"] / passes if passes else 0.0,
+            "max_batch_size": counters["max_batch_size"],
+            "mean_queue_wait_ms": 1000 * counters["queue_wait_total"] / started if started > 0 else 0.0,
+            "max_queue_wait_ms": 1000 * counters["queue_wait_max"],
+            "padding_waste": (counters["padded_positions"] / counters["total_positions"]
+                              if counters["total_positions"] else 0.0)
+        }
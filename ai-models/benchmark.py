@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Service latency and throughput benchmark
+Drives LightweightAIModel through the cache, knowledge base and model paths, batched
+and concurrent load, using a locally built tiny decoder so runs need no download and
+are comparable from one commit to the next
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable
+
+import numpy as np
+
+from tiny_model import build_tiny_decoder
+
+logger = logging.getLogger(__name__)
+
+# Format version of the results file
+RESULTS_VERSION = 1
+
+# Compared metrics and the direction that counts as better
+COMPARED_METRICS = {
+    "p50_ms": "lower",
+    "p95_ms": "lower",
+    "p99_ms": "lower",
+    "throughput_rps": "higher",
+    "peak_rss_mb": "lower",
+    "startup_s": "lower"
+}
+
+# Cascade stages whose answers come from a model call
+MODEL_STAGES = ("model", "large_model")
+
+# Services and question templates of the synthetic knowledge base
+SERVICES = [
+    ("livret de famille", "دفتر الحالة المدنية"),
+    ("passeport biométrique", "جواز السفر البيومتري"),
+    ("acte de naissance", "عقد الازدياد"),
+    ("permis de conduire", "رخصة السياقة"),
+    ("certificat de résidence", "شهادة السكنى"),
+    ("extrait de casier judiciaire", "السجل العدلي"),
+    ("carte grise", "البطاقة الرمادية"),
+    ("registre de commerce", "السجل التجاري")
+]
+QUESTION_TEMPLATES = [
+    ("Comment obtenir {fr} ?", "كيف أحصل على {ar}؟"),
+    ("Quels documents faut-il pour {fr} ?", "ما هي الوثائق المطلوبة ل{ar}؟"),
+    ("Quel est le délai pour {fr} ?", "ما هي مدة {ar}؟")
+]
+
+
+def build_knowledge_base() -> Dict[str, List[Dict[str, Any]]]:
+    """Deterministic FAQ entries: one per service and question template"""
+    knowledge_base = {}
+    for fr, ar in SERVICES:
+        category = fr.split()[0].lower()
+        knowledge_base[category] = [{
+            "question_fr": question_fr.format(fr=fr),
+            "question_ar": question_ar.format(ar=ar),
+            "answer_fr": f"Pour {fr}, présentez-vous au guichet compétent avec les pièces demandées.",
+            "answer_ar": f"بالنسبة ل{ar}، توجه إلى الشباك المختص مع الوثائق المطلوبة.",
+            "keywords": fr.split()
+        } for question_fr, question_ar in QUESTION_TEMPLATES]
+    return knowledge_base
+
+
+def knowledge_base_questions() -> List[str]:
+    return [template.format(fr=fr) for fr, _ in SERVICES for template, _ in QUESTION_TEMPLATES]
+
+
+# Parts of the open questions: no two share enough words to be near-duplicates, and
+# none names a service of the knowledge base
+OPEN_TEMPLATES = [
+    "Que dois-je faire pour {subject} {detail} ?",
+    "Qui contacter concernant {subject} {detail} ?",
+    "Est-il possible de régulariser {subject} {detail} ?",
+    "Combien coûte le traitement pour {subject} {detail} ?",
+    "Où signaler un problème avec {subject} {detail} ?",
+    "Pourquoi ma réclamation pour {subject} reste bloquée {detail} ?"
+]
+OPEN_SUBJECTS = [
+    "une bourse universitaire", "un héritage familial", "une pension de retraite",
+    "un contrat de location", "une association sportive", "un chantier de rénovation",
+    "une adoption internationale", "un stage rémunéré", "une subvention agricole",
+    "un compteur électrique", "une licence de taxi", "un terrain constructible"
+]
+OPEN_DETAILS = [
+    "depuis l'étranger", "après un divorce", "sans justificatif", "en urgence",
+    "pendant le ramadan", "avec un mandataire", "suite à un décès", "malgré un refus"
+]
+OPEN_QUESTION_COUNT = len(OPEN_TEMPLATES) * len(OPEN_SUBJECTS) * len(OPEN_DETAILS)
+
+
+def open_questions(count: int, offset: int = 0) -> List[str]:
+    """
+    Questions outside the knowledge base, worded differently enough that neither the
+    knowledge base nor the exact and semantic caches answer them
+    """
+    if offset + count > OPEN_QUESTION_COUNT:
+        raise ValueError(f"Only {OPEN_QUESTION_COUNT} open questions are available")
+    questions = []
+    for index in range(offset, offset + count):
+        index, template = divmod(index, len(OPEN_TEMPLATES))
+        detail, subject = divmod(index, len(OPEN_SUBJECTS))
+        questions.append(OPEN_TEMPLATES[template].format(subject=OPEN_SUBJECTS[subject],
+                                                          detail=OPEN_DETAILS[detail]))
+    return questions
+
+
+def scenario_config(name: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    """Service configuration of a scenario"""
+    config = {
+        "model": {
+            "loading": "eager",
+            "graph_cache_dir": None,
+            "do_sample": False,
+            "seed": 0,
+            "max_new_tokens": settings["max_new_tokens"],
+            "intra_op_num_threads": settings["threads"]
+        },
+        "knowledge_base": {"source": "json", "watch_interval": 0},
+        "knowledge_base_path": os.path.join(settings["workdir"], "knowledge_base.json"),
+        "conversation": {"enabled": False},
+        "cache": {"disk_path": None},
+        "metrics": {"dir": None},
+        # Every model answer is served, whatever its confidence with random weights
+        "cascade": {"thresholds": {"model": 0.0}}
+    }
+    if name == "knowledge_base":
+        config["cascade"]["stages"] = ["knowledge_base", "model"]
+    elif name in ("model", "batch"):
+        config["cascade"]["stages"] = ["model"]
+    if name == "batch":
+        config["batching"] = {"enabled": True, "max_batch_size": settings["concurrency"], "max_wait_ms": 5}
+    return config
+
+
+def timed_requests(model, messages: List[str], concurrency: int = 1) -> Dict[str, Any]:
+    """Send messages (from concurrency threads) and time each response"""
+    def send(message):
+        start = time.perf_counter()
+        response = model.generate_response(message, "fr")
+        return time.perf_counter() - start, response
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(send, messages))
+    else:
+        results = [send(message) for message in messages]
+    wall_time = time.perf_counter() - start
+    return {
+        "latencies": [latency for latency, _ in results],
+        "wall_time": wall_time,
+        "answered_by": Counter(response.get("cascade", {}).get("stage") or response.get("source", "unknown")
+                               for _, response in results),
+        # Answers replayed from a cache carry the token count of the call that produced them
+        "generated_tokens": sum(response.get("generated_tokens", 0) for _, response in results
+                                if response.get("cascade", {}).get("stage") in MODEL_STAGES)
+    }
+
+
+def run_cache_hit(model, settings: Dict[str, Any]) -> Dict[str, Any]:
+    questions = knowledge_base_questions()
+    for question in questions:
+        model.generate_response(question, "fr")
+    model.metrics.reset()
+    return timed_requests(model, [questions[i % len(questions)] for i in range(settings["requests"])])
+
+
+def run_knowledge_base(model, settings: Dict[str, Any]) -> Dict[str, Any]:
+    questions = knowledge_base_questions()
+    return timed_requests(model, [questions[i % len(questions)] for i in range(settings["requests"])])
+
+
+def run_model(model, settings: Dict[str, Any]) -> Dict[str, Any]:
+    return timed_requests(model, open_questions(settings["model_requests"]))
+
+
+def run_batch(model, settings: Dict[str, Any]) -> Dict[str, Any]:
+    return timed_requests(model, open_questions(settings["model_requests"]), settings["concurrency"])
+
+
+def run_concurrent(model, settings: Dict[str, Any]) -> Dict[str, Any]:
+    """Mixed traffic: mostly repeated questions, some knowledge base ones, a few open ones"""
+    questions = knowledge_base_questions()
+    for question in questions[:4]:
+        model.generate_response(question, "fr")
+    model.metrics.reset()
+    rng = np.random.default_rng(0)
+    kinds = rng.choice(["cache", "knowledge_base", "model"], size=settings["requests"], p=[0.6, 0.3, 0.1])
+    messages, opened = [], 0
+    for i, kind in enumerate(kinds):
+        if kind == "cache":
+            messages.append(questions[i % 4])
+        elif kind == "knowledge_base":
+            messages.append(questions[4 + i % (len(questions) - 4)])
+        else:
+            messages.extend(open_questions(1, opened))
+            opened += 1
+    return timed_requests(model, messages, settings["concurrency"])
+
+
+SCENARIOS: Dict[str, Callable[[Any, Dict[str, Any]], Dict[str, Any]]] = {
+    "cache_hit": run_cache_hit,
+    "knowledge_base": run_knowledge_base,
+    "model": run_model,
+    "batch": run_batch,
+    "concurrent": run_concurrent
+}
+
+
+def run_scenario(name: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run one scenario in this (fresh) process
+
+    Startup and peak memory only mean something per scenario when each one starts
+    from an empty process, so run() calls this through a spawned worker.
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    from model_service import LightweightAIModel
+    from metrics import process_stats
+
+    config_path = os.path.join(settings["workdir"], f"config-{name}.json")
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(scenario_config(name, settings), f, indent=2)
+
+    start = time.perf_counter()
+    model = LightweightAIModel(settings["model_path"], config_path)
+    startup = time.perf_counter() - start
+    startup_rss = process_stats().get("process_resident_bytes", 0)
+    try:
+        # Warm up the session and caches of the tokenizer outside the measurement, with
+        # the last open questions so the scenarios' own are not cached yet
+        for message in open_questions(settings["warmup"], offset=OPEN_QUESTION_COUNT - settings["warmup"]):
+            model.generate_response(message, "fr")
+        model.metrics.reset()
+        result = SCENARIOS[name](model, settings)
+        stages = {stage: round(1000 * histogram.quantile(0.5), 3)
+                  for stage, histogram in sorted(model.metrics.histograms.items())}
+    finally:
+        model.close()
+
+    latencies = 1000 * np.array(result["latencies"])
+    wall_time = result["wall_time"]
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "mean_ms": round(float(latencies.mean()), 3),
+        "throughput_rps": round(len(latencies) / wall_time, 2) if wall_time else 0.0,
+        "tokens_per_second": round(result["generated_tokens"] / wall_time, 2) if wall_time else 0.0,
+        "peak_rss_mb": round(process_stats()["process_peak_resident_bytes"] / 2 ** 20, 1),
+        "startup_rss_mb": round(startup_rss / 2 ** 20, 1),
+        "startup_s": round(startup, 4),
+        "startup_phases": {phase: round(seconds, 4) for phase, seconds in model.startup_times.items()},
+        "answered_by": dict(result["answered_by"]),
+        "stage_p50_ms": stages
+    }
+
+
+def environment() -> Dict[str, Any]:
+    """What the numbers depend on besides the code"""
+    import onnxruntime as ort
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "onnxruntime": ort.__version__,
+        "numpy": np.__version__
+    }
+
+
+def run(args) -> Dict[str, Any]:
+    """Build the model and knowledge base, then run each scenario in its own process"""
+    with tempfile.TemporaryDirectory(prefix="moussadar-bench-") as workdir:
+        workdir = args.workdir or workdir
+        os.makedirs(os.path.join(workdir, "models"), exist_ok=True)
+        model_options = {"hidden_size": args.hidden_size, "num_heads": args.heads,
+                         "num_layers": args.layers, "seed": args.seed}
+        model_path = build_tiny_decoder(os.path.join(workdir, "models", "tiny-decoder.onnx"), **model_options)
+        with open(os.path.join(workdir, "knowledge_base.json"), 'w', encoding='utf-8') as f:
+            json.dump(build_knowledge_base(), f, ensure_ascii=False, indent=2)
+
+        settings = {
+            "workdir": workdir,
+            "model_path": model_path,
+            "requests": args.requests,
+            "model_requests": args.model_requests,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "max_new_tokens": args.max_new_tokens,
+            "threads": args.threads
+        }
+        results = {"version": RESULTS_VERSION, "environment": environment(),
+                   "settings": dict({key: value for key, value in settings.items()
+                                     if key not in ("workdir", "model_path")}, model=model_options),
+                   "scenarios": {}}
+        context = multiprocessing.get_context("spawn")
+        for name in args.scenarios:
+            logger.info(f"Running scenario {name}")
+            with context.Pool(1) as pool:
+                results["scenarios"][name] = pool.apply(run_scenario, (name, settings))
+    return results
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = 0.1,
+            min_delta_ms: float = 1.0) -> Dict[str, Any]:
+    """
+    Compare results against a baseline
+
+    A metric regresses when it is worse than the baseline by more than threshold
+    (relative); latencies must also be worse by min_delta_ms, so sub-millisecond
+    jitter on the cache paths doesn't fail a run.
+
+    Returns:
+        Per-scenario changes and the list of regressions
+    """
+    comparisons, regressions = {}, []
+    for name, base in baseline["scenarios"].items():
+        result = current["scenarios"].get(name)
+        if result is None:
+            regressions.append({"scenario": name, "metric": None, "reason": "missing"})
+            continue
+        comparisons[name] = {}
+        for metric, better in COMPARED_METRICS.items():
+            if metric not in base or metric not in result:
+                continue
+            before, after = base[metric], result[metric]
+            change = (after - before) / before if before else 0.0
+            worse = change > threshold if better == "lower" else change < -threshold
+            if worse and metric.endswith("_ms") and after - before < min_delta_ms:
+                worse = False
+            comparisons[name][metric] = {"baseline": before, "current": after, "change": round(change, 4)}
+            if worse:
+                regressions.append({"scenario": name, "metric": metric, "baseline": before,
+                                    "current": after, "change": round(change, 4)})
+    return {
+        "threshold": threshold,
+        "environment_matches": baseline.get("environment") == current.get("environment"),
+        "regressions": regressions,
+        "scenarios": comparisons
+    }
+
+
+def main():
+    """Run the benchmark and/or compare results against a baseline"""
+    parser = argparse.ArgumentParser(description="Benchmark the AI service on a locally built tiny model")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the scenarios and print JSON results")
+    run_parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    run_parser.add_argument("--requests", type=int, default=500, help="Requests per cache/knowledge base scenario")
+    run_parser.add_argument("--model-requests", type=int, default=32, help="Requests per model scenario")
+    run_parser.add_argument("--warmup", type=int, default=2, help="Model requests before measuring")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="Client threads of batch/concurrent")
+    run_parser.add_argument("--max-new-tokens", type=int, default=32)
+    run_parser.add_argument("--threads", type=int, default=1, help="ONNX Runtime intra-op threads")
+    run_parser.add_argument("--hidden-size", type=int, default=128)
+    run_parser.add_argument("--heads", type=int, default=4)
+    run_parser.add_argument("--layers", type=int, default=4)
+    run_parser.add_argument("--seed", type=int, default=0, help="Model weight seed")
+    run_parser.add_argument("--workdir", help="Keep the model, knowledge base and configs here")
+    run_parser.add_argument("--output", help="Also write the results to this file")
+    run_parser.add_argument("--baseline", help="Compare against these results; exit 1 on regression")
+    run_parser.add_argument("--threshold", type=float, default=0.1, help="Tolerated relative regression")
+    run_parser.add_argument("--min-delta-ms", type=float, default=1.0)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two results files; exit 1 on regression")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Tolerated relative regression")
+    compare_parser.add_argument("--min-delta-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "run":
+        current = run(args)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(current, f, indent=2)
+        baseline_path = args.baseline
+    else:
+        with open(args.current, 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        baseline_path = args.baseline
+
+    if not baseline_path:
+        json.dump(current, sys.stdout, indent=2)
+        print()
+        return
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    report = compare(baseline, current, args.threshold, args.min_delta_ms)
+    if not report["environment_matches"]:
+        logger.warning("Baseline was recorded on a different environment, comparison may be meaningless")
+    json.dump(report if args.command == "compare" else dict(current, comparison=report), sys.stdout, indent=2)
+    print()
+    if report["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
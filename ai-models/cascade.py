@@ -0,0 +1,198 @@
+"""
+Tiered answer cascade
+Answer sources are tried cheapest first and a request stops at the first one confident
+enough; slow stages are skipped when the remaining latency budget can't cover them
+"""
+
+import json
+import math
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Every stage, cheapest first
+STAGES = ("exact_cache", "semantic_cache", "knowledge_base", "model", "large_model")
+
+# Stages whose expected latency is checked against the budget before they run
+MODEL_STAGES = ("model", "large_model")
+
+
+def calibrate(confidence: float, scale: float = 1.0, bias: float = 0.0) -> float:
+    """
+    Platt scaling of a raw score in logit space
+
+    sigmoid(scale * logit(p) + bias); (1, 0) leaves the score unchanged. Fit scale and
+    bias per stage on traced traffic (raw score vs. whether the answer was right).
+    """
+    p = min(max(confidence, 1e-6), 1.0 - 1e-6)
+    return 1.0 / (1.0 + math.exp(-(scale * math.log(p / (1.0 - p)) + bias)))
+
+
+class CascadeTrace:
+    """What one request went through: time, confidence and outcome of each stage"""
+
+    __slots__ = ("started", "deadline", "stages", "answered_by", "confident", "best", "best_stage",
+                 "degraded")
+
+    def __init__(self, budget: Optional[float] = None):
+        """
+        Start tracing a request
+
+        Args:
+            budget: Seconds the request may take (None for no limit)
+        """
+        self.started = time.perf_counter()
+        self.deadline = self.started + budget if budget else None
+        self.stages: List[Dict[str, Any]] = []
+        # Stage whose answer is returned, and whether it reached that stage's threshold
+        self.answered_by = None
+        self.confident = False
+        # Best answer that didn't reach its stage's threshold, in case nothing does
+        self.best = None
+        self.best_stage = None
+        # A stage was skipped or cut short, so the answer may be worse than usual
+        self.degraded = None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left in the budget (None without a budget)"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.perf_counter()
+
+    def record(self, stage: str, elapsed: float, outcome: str,
+               confidence: Optional[float] = None, raw: Optional[float] = None):
+        """
+        Note a stage's result
+
+        Args:
+            stage: Stage name
+            elapsed: Seconds spent in the stage
+            outcome: answered, below_threshold, miss, skipped, unavailable or deadline
+            confidence: Calibrated confidence of the stage's answer
+            raw: The score it was calibrated from
+        """
+        self.stages.append({"stage": stage, "ms": round(1000 * elapsed, 3), "outcome": outcome,
+                            "confidence": None if confidence is None else round(confidence, 4),
+                            "raw": None if raw is None else round(raw, 4)})
+
+    def offer(self, stage: str, response: Dict[str, Any]):
+        """Keep a below-threshold answer if its (calibrated) confidence beats the best one so far"""
+        if self.best is None or response["confidence"] > self.best["confidence"]:
+            self.best, self.best_stage = response, stage
+
+    def summary(self) -> Dict[str, Any]:
+        """Answering stage and per-stage timings, as attached to responses"""
+        return {
+            "stage": self.answered_by,
+            "confident": self.confident,
+            "total_ms": round(1000 * (time.perf_counter() - self.started), 3),
+            "stages": [dict(stage) for stage in self.stages]
+        }
+
+
+class CascadeStats:
+    """
+    Per-stage aggregates and expected latencies across requests
+
+    The expected latency of a stage is an exponential moving average of the time it
+    took when it ran. With a trace path, every request's trace is also appended as a
+    JSON line, the raw material for fitting thresholds and calibration offline.
+    """
+
+    def __init__(self, trace_path: Optional[str] = None, smoothing: float = 0.2):
+        """
+        Initialize the aggregates
+
+        Args:
+            trace_path: JSONL file receiving one trace per request (None to disable)
+            smoothing: Weight of the newest observation in the moving averages
+        """
+        self.trace_path = trace_path
+        self.smoothing = smoothing
+        self.trace_file = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.fallbacks = 0
+        self.latency: Dict[str, float] = {}
+        self.stages = {stage: {"attempts": 0, "answered": 0, "served": 0, "below_threshold": 0, "miss": 0,
+                               "skipped": 0, "unavailable": 0, "deadline": 0,
+                               "time_total": 0.0, "confidence_total": 0.0, "scored": 0}
+                       for stage in STAGES}
+
+    def reopen(self):
+        """Reset the lock and trace file handle after fork"""
+        self.lock = threading.Lock()
+        self.trace_file = None
+
+    def close(self):
+        """Close the trace file"""
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.close()
+                self.trace_file = None
+
+    def expected_latency(self, stage: str) -> Optional[float]:
+        """Smoothed seconds the stage takes (None until it has run)"""
+        return self.latency.get(stage)
+
+    def observe_latency(self, stage: str, elapsed: float):
+        """Fold one run of a stage into its expected latency"""
+        with self.lock:
+            previous = self.latency.get(stage)
+            self.latency[stage] = elapsed if previous is None else (
+                (1.0 - self.smoothing) * previous + self.smoothing * elapsed)
+
+    def observe(self, trace: CascadeTrace, lang: str):
+        """Account a finished request"""
+        summary = trace.summary()
+        with self.lock:
+            self.requests += 1
+            if trace.answered_by in self.stages:
+                self.stages[trace.answered_by]["served"] += 1
+            else:
+                self.fallbacks += 1
+            for stage in trace.stages:
+                counters = self.stages[stage["stage"]]
+                counters[stage["outcome"]] += 1
+                if stage["outcome"] in ("skipped", "unavailable"):
+                    continue
+                counters["attempts"] += 1
+                counters["time_total"] += stage["ms"]
+                if stage["confidence"] is not None:
+                    counters["confidence_total"] += stage["confidence"]
+                    counters["scored"] += 1
+            if self.trace_path:
+                self.write_trace(dict(summary, lang=lang, degraded=trace.degraded))
+
+    def write_trace(self, record: Dict[str, Any]):
+        """Append one trace line (lock held); tracing problems never fail a request"""
+        try:
+            if self.trace_file is None:
+                self.trace_file = open(self.trace_path, 'a', encoding='utf-8', buffering=1)
+            self.trace_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.warning(f"Cascade trace disabled, cannot write {self.trace_path}: {e}")
+            self.trace_path = None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Per stage: confident exits (answered), answers returned (served, including
+        best-effort ones), skips, mean time and mean confidence
+        """
+        with self.lock:
+            requests, fallbacks = self.requests, self.fallbacks
+            stages = {stage: dict(counters) for stage, counters in self.stages.items()}
+            latency = dict(self.latency)
+        for stage, counters in stages.items():
+            time_total = counters.pop("time_total")
+            confidence_total = counters.pop("confidence_total")
+            scored = counters.pop("scored")
+            counters["answer_share"] = counters["answered"] / requests if requests else 0.0
+            counters["mean_ms"] = time_total / counters["attempts"] if counters["attempts"] else 0.0
+            counters["mean_confidence"] = confidence_total / scored if scored else None
+            counters["expected_ms"] = 1000 * latency[stage] if stage in latency else None
+        return {"requests": requests, "fallbacks": fallbacks, "stages": stages}
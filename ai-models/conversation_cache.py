@@ -0,0 +1,177 @@
+"""
+Per-conversation prefix KV cache
+Keeps the decoder state of each conversation's last prompt so the next turn only runs
+its new tokens through the model instead of re-encoding the whole history
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+import logging
+
+from generation import DecodeState
+
+logger = logging.getLogger(__name__)
+
+
+def prefix_key(tokens: List[int]) -> str:
+    """Digest of a token prefix"""
+    return hashlib.blake2b(np.asarray(tokens, dtype=np.int64).tobytes(), digest_size=16).hexdigest()
+
+
+class ConversationState:
+    """KV state of one processed prompt"""
+
+    __slots__ = ("tokens", "state", "nbytes", "last_used")
+
+    def __init__(self, tokens: Tuple[int, ...], state: DecodeState):
+        self.tokens = tokens
+        self.state = state
+        self.nbytes = state.nbytes()
+        self.last_used = time.monotonic()
+
+
+class ConversationCache:
+    """
+    LRU of prompt KV states, bounded by bytes and idle time
+
+    Entries are addressed by the digest of their tokens, so no session id is needed:
+    a follow-up turn's prompt starts with the previous turn's prompt (history, user
+    message, assistant header), and the longest such prefix found is reused. States
+    are read-only once stored; GenerationEngine.start() copies them.
+    """
+
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, idle_timeout: Optional[float] = 900):
+        """
+        Initialize the cache
+
+        Args:
+            max_bytes: Budget for the stored KV states
+            idle_timeout: Seconds after which an unused conversation is dropped (None to keep)
+        """
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.entries: "OrderedDict[str, ConversationState]" = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "reused_tokens": 0
+        }
+
+    def start(self):
+        """Start the thread dropping idle conversations"""
+        if not self.idle_timeout or self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.sweep, name="conversation-sweep", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Stop the sweeper and release every state"""
+        self.running = False
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def sweep(self):
+        """Expire idle conversations periodically"""
+        interval = max(self.idle_timeout / 4, 1.0)
+        while self.running:
+            time.sleep(interval)
+            with self.lock:
+                self._expire(time.monotonic())
+
+    def lookup(self, tokens: List[int], boundaries: List[int]) -> Optional[Tuple[str, DecodeState]]:
+        """
+        Find the longest cached prefix of a prompt
+
+        Args:
+            tokens: Prompt token ids
+            boundaries: Prompt offsets where an earlier turn's prompt may have ended
+
+        Returns:
+            (key, state) of the cached prefix, or None
+        """
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            for boundary in sorted(boundaries, reverse=True):
+                if not 0 < boundary < len(tokens):
+                    continue
+                key = prefix_key(tokens[:boundary])
+                entry = self.entries.get(key)
+                if entry is not None and entry.tokens == tuple(tokens[:boundary]):
+                    entry.last_used = now
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    self.counters["reused_tokens"] += boundary
+                    return key, entry.state
+            self.counters["misses"] += 1
+        return None
+
+    def store(self, tokens: List[int], state: DecodeState, replaces: Optional[str] = None):
+        """
+        Remember the state of a processed prompt
+
+        Args:
+            tokens: Prompt token ids the state covers
+            state: State from GenerationEngine.snapshot()
+            replaces: Key of the prefix this prompt extended; the conversation has moved
+                past it, so it is dropped
+        """
+        entry = ConversationState(tuple(tokens), state)
+        if entry.nbytes > self.max_bytes:
+            return
+        key = prefix_key(tokens)
+        with self.lock:
+            if replaces is not None and replaces in self.entries:
+                self._remove(replaces)
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.current_bytes += entry.nbytes
+            self.counters["stores"] += 1
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.counters["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters and occupancy"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["conversations"] = len(self.entries)
+            stats["bytes"] = self.current_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _expire(self, now: float):
+        """Drop conversations idle for longer than idle_timeout (lock held)"""
+        if not self.idle_timeout:
+            return
+        # Recency order is last-use order, so idle entries are at the front
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry.last_used < self.idle_timeout:
+                break
+            self._remove(key)
+            self.counters["expirations"] += 1
+
+    def _remove(self, key: str):
+        """Remove an entry (lock held)"""
+        self.current_bytes -= self.entries.pop(key).nbytes
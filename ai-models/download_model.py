@@ -4,10 +4,16 @@ Download script for AI models
 Downloads SmolLM2 model and converts to ONNX format
 """
 
+import argparse
 import os
 import sys
 import requests
 import json
+import hashlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import logging
 
@@ -22,94 +28,465 @@ MODEL_CONFIG = {
         "model_file": "model.safetensors",
         "onnx_file": "smollm2-135m.onnx",
         "quantized_file": "smollm2-135m-q4.onnx",
+        "stem": "smollm2-135m",
+        "checkpoint_files": ["config.json", "generation_config.json", "tokenizer.json",
+                             "tokenizer_config.json", "special_tokens_map.json", "model.safetensors"],
         "size_mb": 70,
         "url": "https://huggingface.co/HuggingFaceTB/SmolLM2-135M/resolve/main/model.safetensors"
     }
 }
 
-def download_file(url, destination, chunk_size=8192):
-    """Download file with progress indication"""
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
+# Parallel download settings: bytes per Range request, concurrent requests, retries
+# per chunk and block size of the response stream
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 5
+STREAM_BLOCK_SIZE = 256 * 1024
+
+# Completed chunks waiting for the whole-file hash to reach them are kept in memory up
+# to this many bytes, past that they are read back from disk when their turn comes
+HASH_BUFFER_BYTES = 64 * 1024 * 1024
+
+HUGGINGFACE_URL = "https://huggingface.co"
+
+
+class DownloadError(Exception):
+    """A download that can't complete or doesn't match its manifest"""
+
+
+class OrderedHasher:
+    """
+    sha256 of a file whose chunks complete out of order
+    
+    Chunks are fed as they finish and hashed in file order. A chunk that finishes
+    ahead of its turn waits in memory, within HASH_BUFFER_BYTES, so the file is hashed
+    while it downloads instead of in a second pass over it.
+    """
+    
+    def __init__(self, path, chunk_size, max_buffered=HASH_BUFFER_BYTES):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.max_buffered = max_buffered
+        self.sha256 = hashlib.sha256()
+        self.next_index = 0
+        # index -> chunk bytes, or None to read it back from the file
+        self.pending = {}
+        self.buffered = 0
+        self.read_back = 0
+        self.lock = threading.Lock()
+    
+    def add(self, index, data=None):
+        """Hand over a finished chunk (None: it is on disk only)"""
+        with self.lock:
+            if data is not None and index != self.next_index and self.buffered + len(data) > self.max_buffered:
+                data = None
+            self.pending[index] = data
+            if data is not None:
+                self.buffered += len(data)
+            while self.next_index in self.pending:
+                data = self.pending.pop(self.next_index)
+                if data is None:
+                    with open(self.path, 'rb') as f:
+                        f.seek(self.next_index * self.chunk_size)
+                        data = f.read(self.chunk_size)
+                    self.read_back += len(data)
+                else:
+                    self.buffered -= len(data)
+                self.sha256.update(data)
+                self.next_index += 1
+    
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class ChunkedDownload:
+    """
+    Resumable download over concurrent HTTP Range requests
+    
+    The data goes into a preallocated "<destination>.part" file, each chunk written at
+    its offset. Finished chunks are recorded in "<destination>.part.json", so an
+    interrupted download resumes with the missing chunks only. The server's ETag (or
+    Last-Modified) is recorded with them and sent as If-Range, so a file changed on
+    the server is never stitched together with chunks of the old one. Every chunk is hashed
+    while it streams in and checked against the manifest's chunk digests when there
+    are any (a corrupt chunk is fetched again, not the file); the whole-file sha256 is
+    built alongside by OrderedHasher. The file only gets its final name once it
+    matches the manifest.
+    
+    Servers without Range support get a single verified stream, restarted on retry.
+    """
+    
+    def __init__(self, url, destination, expected=None, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 workers=DOWNLOAD_WORKERS, retries=DOWNLOAD_RETRIES, timeout=(10, 60)):
+        """
+        Prepare a download
         
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
+        Args:
+            url: File URL
+            destination: Final path
+            expected: Manifest entry: size, sha256, and chunk_size + chunks (per-chunk
+                sha256) for chunk-level verification; any may be missing
+            chunk_size: Bytes per Range request (the manifest's when it has chunk digests)
+            workers: Concurrent requests
+            retries: Attempts per chunk (or per stream) before giving up
+            timeout: (connect, read) timeouts in seconds
+        """
+        self.url = url
+        self.destination = str(destination)
+        self.part_path = self.destination + ".part"
+        self.state_path = self.destination + ".part.json"
+        self.expected = expected or {}
+        self.chunk_size = self.expected.get("chunk_size") if self.expected.get("chunks") else chunk_size
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.size = None
+        self.validator = None
+        self.done = set()
+        self.hasher = None
+        self.downloaded = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+    
+    def session(self):
+        """One requests session (and connection pool) per worker thread"""
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+    
+    def run(self):
+        """
+        Download and verify the file
         
-        with open(destination, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    
-                    if total_size > 0:
-                        progress = (downloaded / total_size) * 100
-                        print(f"\r📥 Downloading: {progress:.1f}%", end='', flush=True)
+        Returns:
+            sha256 of the file
+        """
+        size, validator, ranges = self.probe()
+        if self.expected.get("size") is not None and size is not None and size != self.expected["size"]:
+            raise DownloadError(f"{self.url} is {size} bytes, the manifest expects {self.expected['size']}")
+        if not ranges or not size:
+            return self.run_stream()
+        
+        self.size, self.validator = size, validator
+        self.load_state()
+        self.preallocate()
+        self.hasher = OrderedHasher(self.part_path, self.chunk_size)
+        for index in sorted(self.done):
+            # Chunks from an earlier run join the whole-file hash from disk
+            self.hasher.add(index)
+        
+        pending = [index for index in range(self.num_chunks()) if index not in self.done]
+        if self.done:
+            print(f"↩️  Resuming {os.path.basename(self.destination)}: "
+                  f"{len(self.done)}/{self.num_chunks()} chunks already downloaded")
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for future in as_completed([executor.submit(self.fetch_chunk, index) for index in pending]):
+                future.result()
+        finally:
+            # On failure, stop queued chunks; finished ones are already recorded
+            executor.shutdown(wait=True, cancel_futures=True)
+        print()
         
-        print(f"\n✅ Downloaded: {destination}")
+        digest = self.hasher.hexdigest()
+        self.finish(digest)
+        return digest
+    
+    def num_chunks(self):
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+    
+    def probe(self):
+        """Size, validator and Range support, from a one-byte range request"""
+        response = self.session().get(self.url, headers={"Range": "bytes=0-0"}, stream=True,
+                                      timeout=self.timeout)
+        try:
+            response.raise_for_status()
+            validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+            if response.status_code == 206:
+                total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                if total.isdigit():
+                    return int(total), validator, True
+            length = response.headers.get("Content-Length")
+            return (int(length) if length and response.status_code == 200 else None), validator, False
+        finally:
+            response.close()
+    
+    def load_state(self):
+        """Pick up the chunks an earlier run finished, unless the remote file changed"""
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+        if (state and os.path.exists(self.part_path) and state.get("url") == self.url
+                and state.get("size") == self.size and state.get("validator") == self.validator
+                and state.get("chunk_size") == self.chunk_size):
+            self.done = set(state["done"])
+        else:
+            self.done = set()
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+        self.downloaded = sum(self.chunk_length(index) for index in self.done)
+    
+    def save_state(self):
+        """Record finished chunks (lock held); replaced atomically so a crash never leaves it torn"""
+        state = {"url": self.url, "size": self.size, "validator": self.validator,
+                 "chunk_size": self.chunk_size, "done": sorted(self.done)}
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+    
+    def preallocate(self):
+        """Reserve the whole file up front, so chunks land at their offsets and the disk can't fill midway"""
+        Path(self.part_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.part_path, 'ab') as f:
+            if os.fstat(f.fileno()).st_size == self.size:
+                return
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(f.fileno(), 0, self.size)
+            else:
+                f.truncate(self.size)
+    
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+    
+    def fetch_chunk(self, index):
+        """Download one chunk, retrying with backoff on errors and digest mismatches"""
+        start = index * self.chunk_size
+        end = start + self.chunk_length(index) - 1
+        expected_digest = self.expected["chunks"][index] if self.expected.get("chunks") else None
+        headers = {"Range": f"bytes={start}-{end}"}
+        if self.validator:
+            # A changed file comes back whole (200) instead of mixing two versions
+            headers["If-Range"] = self.validator
+        
+        for attempt in range(1, self.retries + 1):
+            received = 0
+            try:
+                response = self.session().get(self.url, headers=headers, stream=True, timeout=self.timeout)
+                with response:
+                    if response.status_code == 200:
+                        raise DownloadError(f"{self.url} changed on the server or ignores ranges")
+                    response.raise_for_status()
+                    if response.status_code != 206 or not response.headers.get(
+                            "Content-Range", "").startswith(f"bytes {start}-{end}/"):
+                        raise IOError(f"unexpected range response {response.status_code} "
+                                      f"{response.headers.get('Content-Range')}")
+                    
+                    sha256 = hashlib.sha256()
+                    blocks = []
+                    fd = os.open(self.part_path, os.O_WRONLY)
+                    try:
+                        for block in response.iter_content(chunk_size=STREAM_BLOCK_SIZE):
+                            if received + len(block) > end - start + 1:
+                                raise IOError("server sent more than the requested range")
+                            os.pwrite(fd, block, start + received)
+                            sha256.update(block)
+                            blocks.append(block)
+                            received += len(block)
+                            self.progress(len(block))
+                    finally:
+                        os.close(fd)
+                
+                if received != end - start + 1:
+                    raise IOError(f"chunk {index} truncated at {received} of {end - start + 1} bytes")
+                if expected_digest and sha256.hexdigest() != expected_digest:
+                    raise IOError(f"chunk {index} does not match the manifest")
+                
+                self.hasher.add(index, b"".join(blocks))
+                with self.lock:
+                    self.done.add(index)
+                    self.save_state()
+                return
+            
+            except DownloadError:
+                raise
+            except (requests.RequestException, IOError) as e:
+                self.progress(-received)
+                if attempt == self.retries:
+                    raise DownloadError(f"chunk {index} of {self.url} failed after {attempt} attempts: {e}")
+                delay = min(30.0, 0.5 * 2 ** (attempt - 1)) * (0.5 + random.random())
+                logger.warning(f"Chunk {index} attempt {attempt} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+    
+    def progress(self, count):
+        """Count downloaded bytes and redraw the progress line"""
+        with self.lock:
+            self.downloaded += count
+            if self.size:
+                print(f"\r📥 Downloading: {100 * self.downloaded / self.size:.1f}%", end='', flush=True)
+    
+    def run_stream(self):
+        """Single-stream download for servers without Range support"""
+        for attempt in range(1, self.retries + 1):
+            sha256 = hashlib.sha256()
+            received = 0
+            try:
+                response = self.session().get(self.url, stream=True, timeout=self.timeout)
+                with response:
+                    response.raise_for_status()
+                    length = response.headers.get("Content-Length")
+                    self.size = int(length) if length else None
+                    Path(self.part_path).parent.mkdir(parents=True, exist_ok=True)
+                    with open(self.part_path, 'wb') as f:
+                        for block in response.iter_content(chunk_size=STREAM_BLOCK_SIZE):
+                            f.write(block)
+                            sha256.update(block)
+                            received += len(block)
+                            self.progress(len(block))
+                if self.size is not None and received != self.size:
+                    raise IOError(f"stream truncated at {received} of {self.size} bytes")
+                print()
+                digest = sha256.hexdigest()
+                self.finish(digest)
+                return digest
+            except (requests.RequestException, IOError) as e:
+                self.progress(-received)
+                if attempt == self.retries:
+                    raise DownloadError(f"{self.url} failed after {attempt} attempts: {e}")
+                delay = min(30.0, 0.5 * 2 ** (attempt - 1)) * (0.5 + random.random())
+                logger.warning(f"Download attempt {attempt} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+    
+    def finish(self, digest):
+        """Check the whole file against the manifest and move it into place"""
+        size = os.path.getsize(self.part_path)
+        expected_size = self.expected.get("size")
+        expected_digest = self.expected.get("sha256")
+        if (expected_size is not None and size != expected_size) or (expected_digest and digest != expected_digest):
+            # Nothing tells which chunk is wrong, so start over next time
+            for path in (self.part_path, self.state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise DownloadError(f"{self.destination} does not match the manifest "
+                                f"(sha256 {digest}, {size} bytes)")
+        with open(self.part_path, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(self.part_path, self.destination)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+
+def file_sha256(path, block_size=STREAM_BLOCK_SIZE):
+    """sha256 of a local file"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def build_manifest(paths, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Manifest entries for files about to be published
+    
+    Returns:
+        {"files": {name: {"size", "sha256", "chunk_size", "chunks"}}}
+    """
+    files = {}
+    for path in paths:
+        sha256 = hashlib.sha256()
+        chunks = []
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha256.update(chunk)
+                chunks.append(hashlib.sha256(chunk).hexdigest())
+        files[os.path.basename(path)] = {"size": os.path.getsize(path), "sha256": sha256.hexdigest(),
+                                         "chunk_size": chunk_size, "chunks": chunks}
+    return {"files": files}
+
+
+def verify_file(path, expected):
+    """Whether an existing file matches its manifest entry (size, then sha256)"""
+    if not os.path.exists(path):
+        return False
+    if expected.get("size") is not None and os.path.getsize(path) != expected["size"]:
+        return False
+    return not expected.get("sha256") or file_sha256(path) == expected["sha256"]
+
+
+def download_file(url, destination, expected=None, workers=DOWNLOAD_WORKERS, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Download a file with parallel, resumable, verified Range requests
+    
+    Args:
+        url: File URL
+        destination: Final path
+        expected: Manifest entry to verify against (see ChunkedDownload)
+        workers: Concurrent requests
+        chunk_size: Bytes per request
+    """
+    try:
+        if expected and verify_file(destination, expected):
+            print(f"✅ Already downloaded: {destination}")
+            return True
+        digest = ChunkedDownload(url, destination, expected, chunk_size=chunk_size, workers=workers).run()
+        print(f"✅ Downloaded: {destination} (sha256 {digest})")
         return True
         
     except Exception as e:
         logger.error(f"Failed to download {url}: {e}")
         return False
 
-def download_huggingface_model(repo_id, local_dir):
-    """Download model from Hugging Face Hub"""
+def huggingface_manifest(repo_id, revision="main"):
+    """
+    Manifest of a Hugging Face repository from its file listing
+    
+    Weight files are stored with LFS, whose object id is the file's sha256; other
+    files are checked by size only.
+    """
+    response = requests.get(f"{HUGGINGFACE_URL}/api/models/{repo_id}/tree/{revision}",
+                            params={"recursive": "true"}, timeout=30)
+    response.raise_for_status()
+    files = {}
+    for item in response.json():
+        if item.get("type") != "file":
+            continue
+        entry = {"size": item.get("size")}
+        if item.get("lfs"):
+            entry = {"size": item["lfs"]["size"], "sha256": item["lfs"]["oid"]}
+        files[item["path"]] = entry
+    return {"files": files}
+
+def download_huggingface_model(repo_id, local_dir, revision="main", workers=DOWNLOAD_WORKERS, files=None):
+    """
+    Download model from Hugging Face Hub
+    
+    Files (all of the repository's, or the given names) are fetched one by one, each
+    resumable and verified against the repository's manifest; files already present
+    and intact are kept.
+    """
     try:
-        from huggingface_hub import snapshot_download
         print(f"📦 Downloading {repo_id} from Hugging Face...")
-        
-        snapshot_download(
-            repo_id=repo_id,
-            local_dir=local_dir,
-            local_dir_use_symlinks=False,
-            resume_download=True
-        )
-        return True
-        
-    except ImportError:
-        logger.warning("huggingface_hub not installed, falling back to direct download")
-        return False
+        manifest = huggingface_manifest(repo_id, revision)
     except Exception as e:
-        logger.error(f"Hugging Face download failed: {e}")
+        logger.error(f"Hugging Face listing failed: {e}")
         return False
+    
+    failed = [name for name in files or () if name not in manifest["files"]]
+    for name, expected in manifest["files"].items():
+        if files is not None and name not in files:
+            continue
+        url = f"{HUGGINGFACE_URL}/{repo_id}/resolve/{revision}/{name}"
+        if not download_file(url, os.path.join(local_dir, name), expected, workers=workers):
+            failed.append(name)
+    if failed:
+        # Finished files stay, partial ones resume on the next run
+        logger.error(f"Hugging Face download incomplete, missing: {', '.join(failed)}")
+        return False
+    return True
 
 def create_dummy_model(destination):
-    """Create a dummy ONNX model for testing when real model is not available"""
+    """Create a small random-weight decoder for testing when the real model is not available"""
     print("🔧 Creating dummy ONNX model for testing...")
     
     try:
-        import onnx
-        import numpy as np
-        
-        # Create a simple dummy model
-        # This is a minimal valid ONNX model
-        model = onnx.ModelProto()
+        from tiny_model import build_tiny_decoder
         
-        # Set basic model properties
-        model.ir_version = onnx.IR_VERSION
-        model.opset_import.add().version = 13
-        
-        # Create a simple graph (placeholder)
-        graph = model.graph
-        graph.name = "dummy_model"
-        
-        # Add inputs
-        input_tensor = graph.input.add()
-        input_tensor.name = "input"
-        input_tensor.type.tensor_type.elem_type = onnx.TensorProto.FLOAT
-        input_tensor.type.tensor_type.shape.dim.add().dim_value = 1
-        input_tensor.type.tensor_type.shape.dim.add().dim_value = 512
-        
-        # Add outputs
-        output_tensor = graph.output.add()
-        output_tensor.name = "output"
-        output_tensor.type.tensor_type.elem_type = onnx.TensorProto.FLOAT
-        output_tensor.type.tensor_type.shape.dim.add().dim_value = 1
-        output_tensor.type.tensor_type.shape.dim.add().dim_value = 512
-        
-        # Save the model
-        onnx.save(model, destination)
+        # Same inputs/outputs and KV cache layout as the exported model, so the
+        # service generates end to end (with the byte-level fallback tokenizer)
+        build_tiny_decoder(destination)
         print(f"✅ Dummy model created: {destination}")
         return True
         
@@ -120,57 +497,73 @@ def create_dummy_model(destination):
         logger.error(f"Failed to create dummy model: {e}")
         return False
 
-def create_quantized_model(input_path, output_path):
-    """Create quantized version of the model"""
-    print("📊 Creating quantized model (INT4)...")
+def create_quantized_model(input_path, output_path, bits=4):
+    """Create the block-wise INT4 (bits=4) or dynamic INT8 (bits=8) version of the model"""
+    print(f"📊 Creating quantized model (INT{bits})...")
     
     try:
-        import onnx
-        from onnxruntime.quantization import quantize_dynamic, QuantType
-        
-        # Quantize the model
-        quantize_dynamic(
-            input_path,
-            output_path,
-            weight_type=QuantType.QInt8  # Use QInt8 as it's more widely supported
-        )
+        from model_build import quantize_int4, quantize_int8
         
+        if bits == 4:
+            quantize_int4(input_path, output_path)
+        else:
+            quantize_int8(input_path, output_path)
         print(f"✅ Quantized model created: {output_path}")
         return True
         
     except Exception as e:
         logger.error(f"Quantization failed: {e}")
-        # If quantization fails, just copy the original
-        import shutil
-        shutil.copy(input_path, output_path)
-        print(f"⚠️  Using original model instead: {output_path}")
-        return True
+        # Never leave the fp32 model (or half a file) under the quantized name
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return False
 
-def download_small_llm_model(destination_dir):
-    """Download a small LLM model suitable for our needs"""
-    print("🔍 Looking for small language models...")
-    
-    # Try to download a smaller, compatible model
-    model_urls = [
-        {
-            "name": "DistilGPT-2 (small)",
-            "url": "https://huggingface.co/distilgpt2/resolve/main/pytorch_model.bin",
-            "size_mb": 300
-        }
-    ]
-    
-    for model_info in model_urls:
-        print(f"📦 Attempting to download {model_info['name']}...")
-        
-        model_path = Path(destination_dir) / "pytorch_model.bin"
-        if download_file(model_info['url'], str(model_path)):
-            print(f"✅ Downloaded {model_info['name']}")
-            return str(model_path)
+def download_checkpoint(model_config, checkpoint_dir, manifest, workers, chunk_size):
+    """Download the checkpoint files one by one from their direct URLs"""
+    base_url = f"{HUGGINGFACE_URL}/{model_config['huggingface_repo']}/resolve/main"
+    for name in model_config["checkpoint_files"]:
+        if not download_file(f"{base_url}/{name}", os.path.join(checkpoint_dir, name),
+                             manifest["files"].get(name), workers=workers, chunk_size=chunk_size):
+            return False
+    return True
+
+def build_model_variants(models_dir, stem, checkpoint_dir=None, source=None):
+    """Export (or take) the fp32 model, quantize it, evaluate the variants and write the manifest"""
+    from model_build import build, host_key, select_variant
     
-    return None
+    print("🔧 Building model variants (fp32, INT8, INT4) and evaluating them on this CPU...")
+    manifest = build(str(models_dir), stem, checkpoint_dir=checkpoint_dir, source=source)
+    evaluation = manifest["evaluations"].get(host_key(), {})
+    for variant, result in evaluation.get("results", {}).items():
+        status = "✅" if result["passed"] else "❌"
+        print(f"  {status} {variant}: {result['ms_per_token']:.2f} ms/token, KL {result['kl']:.4f}, "
+              f"top-1 agreement {result['top1_agreement']:.1%}")
+    variant, reason = select_variant(manifest, host_key())
+    print(f"✅ Selected variant: {variant} ({reason})")
+    return manifest, variant
 
 def main():
     """Main download function"""
+    parser = argparse.ArgumentParser(description="Download and prepare the AI models")
+    parser.add_argument("--manifest", help="JSON manifest (size, sha256, chunk digests) to verify direct downloads")
+    parser.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS, help="Concurrent range requests")
+    parser.add_argument("--chunk-mb", type=int, default=DOWNLOAD_CHUNK_SIZE // (1024 * 1024),
+                        help="Size of each range request")
+    parser.add_argument("--build-manifest", nargs="+", metavar="FILE",
+                        help="Print a manifest for local files (to publish next to them) and exit")
+    args = parser.parse_args()
+    chunk_size = args.chunk_mb * 1024 * 1024
+    
+    if args.build_manifest:
+        json.dump(build_manifest(args.build_manifest, chunk_size), sys.stdout, indent=2)
+        print()
+        return
+    
+    manifest = {"files": {}}
+    if args.manifest:
+        with open(args.manifest, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    
     print("🚀 Starting model download...")
     
     # Get the script directory
@@ -184,73 +577,55 @@ def main():
     # Configuration
     model_config = MODEL_CONFIG["smollm2_135m"]
     model_name = model_config["name"]
+    stem = model_config["stem"]
+    checkpoint_dir = models_dir / "original"
     
     print(f"🔍 Looking for {model_name}...")
     
     # Try Hugging Face first
     print("📦 Trying Hugging Face Hub...")
-    hf_success = download_huggingface_model(
+    downloaded = download_huggingface_model(
         model_config["huggingface_repo"],
-        str(models_dir / "original")
+        str(checkpoint_dir),
+        workers=args.workers,
+        files=model_config["checkpoint_files"]
     )
     
-    if hf_success:
-        print("✅ Model downloaded from Hugging Face")
-        original_model = models_dir / "original" / "model.safetensors"
-    else:
-        # Fallback to direct download
+    if not downloaded:
+        # Fallback to direct download of the files the export needs
         print("📥 Trying direct download...")
-        original_model = models_dir / "original_model.safetensors"
-        
-        if not download_file(model_config["url"], str(original_model)):
-            print("❌ Direct download failed")
-            
-            # Try smaller alternative
-            print("🔍 Trying smaller alternative model...")
-            alt_model = download_small_llm_model(str(models_dir))
-            
-            if alt_model:
-                print("✅ Alternative model downloaded")
-                # Convert to ONNX (simplified)
-                onnx_model = models_dir / "model.onnx"
-                create_dummy_model(str(onnx_model))  # Placeholder for now
-            else:
-                # Final fallback: create dummy model
-                print("🔧 Creating dummy model for development...")
-                onnx_model = models_dir / "smollm2-135m.onnx"
-                create_dummy_model(str(onnx_model))
-                
-                # Create quantized version
-                quantized_model = models_dir / "smollm2-135m-q4.onnx"
-                create_quantized_model(str(onnx_model), str(quantized_model))
-                
-                print("✅ Development model ready")
-                print("⚠️  Note: This is a dummy model for testing. Replace with real model for production.")
-                return
+        downloaded = download_checkpoint(model_config, str(checkpoint_dir), manifest, args.workers, chunk_size)
     
-    # Create ONNX version (simplified for now)
-    print("🔧 Converting to ONNX format...")
-    onnx_model = models_dir / "smollm2-135m.onnx"
+    built = None
+    if downloaded:
+        print("✅ Checkpoint downloaded")
+        try:
+            built = build_model_variants(models_dir, stem, checkpoint_dir=str(checkpoint_dir))
+        except Exception as e:
+            logger.error(f"Export failed: {e}")
+    else:
+        print("❌ Checkpoint download failed")
     
-    # For now, create a dummy ONNX model
-    # In production, you would use proper conversion tools
-    create_dummy_model(str(onnx_model))
+    if built is None:
+        # Final fallback: a tiny random-weight model with the same interface
+        print("🔧 Creating dummy model for development...")
+        dummy_model = models_dir / "dummy-fp32.onnx"
+        if not create_dummy_model(str(dummy_model)):
+            sys.exit(1)
+        built = build_model_variants(models_dir, stem, source=str(dummy_model))
+        dummy_model.unlink()
+        print("⚠️  Note: This is a dummy model for testing. Replace with real model for production.")
     
-    # Create quantized version
-    print("📊 Creating quantized version...")
-    quantized_model = models_dir / "smollm2-135m-q4.onnx"
-    create_quantized_model(str(onnx_model), str(quantized_model))
+    variants_manifest, variant = built
+    variants = variants_manifest["variants"]
     
     # Create configuration file
     config = {
         "model_name": model_name,
-        "model_path": str(quantized_model),
-        "original_path": str(onnx_model),
-        "vocab_size": 32000,
-        "max_sequence_length": 512,
-        "embedding_dim": 512,
-        "num_layers": 6,
-        "num_heads": 8
+        "model_path": str(models_dir / variants[variant]["path"]),
+        "original_path": str(models_dir / variants["fp32"]["path"]),
+        "variant": variant,
+        "manifest": str(models_dir / "model_manifest.json")
     }
     
     config_path = models_dir / "model_config.json"
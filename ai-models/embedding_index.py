@@ -0,0 +1,225 @@
+"""
+Dense semantic retrieval for the knowledge base
+Question embeddings live in a memory-mapped .npy matrix so every worker shares one copy
+"""
+
+import hashlib
+import json
+import os
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+import logging
+
+from session_store import open_session
+from tokenizer import BPETokenizer
+
+logger = logging.getLogger(__name__)
+
+# Rows per knowledge base entry: one per question language
+EMBEDDING_LANGUAGES = ["fr", "ar"]
+
+
+def encoder_tokenizer_path(encoder_path: str) -> str:
+    """The encoder's own tokenizer.json, shipped in the encoder's directory"""
+    return os.path.join(os.path.dirname(encoder_path) or ".", "tokenizer.json")
+
+
+class OnnxSentenceEncoder:
+    """
+    Sentence encoder backed by an ONNX session
+    Texts go through the encoder's own tokenizer, not the generation model's: the
+    embedding table only knows its own vocabulary. Token states are mean-pooled with
+    the attention mask and the result is L2-normalized.
+    """
+
+    def __init__(self, model_path: str, tokenizer_path: Optional[str] = None,
+                 max_length: int = 256, intra_op_num_threads: Optional[int] = None,
+                 weights: str = "mmap", cache_dir: Optional[str] = None):
+        """
+        Initialize the encoder
+
+        Args:
+            model_path: Path to the ONNX encoder
+            tokenizer_path: The encoder's tokenizer.json (default: next to model_path)
+            max_length: Longest token sequence fed to the encoder
+            intra_op_num_threads: Optional thread cap for the encoder session
+            weights: Weight handling mode (see session_store.WEIGHT_MODES)
+            cache_dir: Where an externalized copy of an encoder with inline weights goes
+        """
+        self.model_path = model_path
+        self.tokenizer_path = tokenizer_path or encoder_tokenizer_path(model_path)
+        self.max_length = max_length
+        self.weights = weights
+        self.cache_dir = cache_dir
+        self.session = None
+        # No byte-level fallback: ids from another vocabulary give meaningless vectors
+        self.tokenizer = BPETokenizer.from_file(self.tokenizer_path)
+        self.load_model(intra_op_num_threads)
+
+    def load_model(self, intra_op_num_threads: Optional[int] = None):
+        """Load the ONNX encoder"""
+        import onnxruntime as ort
+        try:
+            sess_options = ort.SessionOptions()
+            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if intra_op_num_threads:
+                sess_options.intra_op_num_threads = intra_op_num_threads
+
+            self.session = open_session(self.model_path, sess_options, weights=self.weights,
+                                        cache_dir=self.cache_dir, name="encoder")
+            self.input_names = {i.name for i in self.session.get_inputs()}
+            logger.info(f"Encoder loaded from {self.model_path}")
+
+        except Exception as e:
+            logger.error(f"Failed to load encoder: {e}")
+            raise
+
+    def tokenize(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Right-padded (input_ids, attention_mask) for a batch of texts"""
+        return self.tokenizer.encode_batch(texts, max_length=self.max_length,
+                                           padding_side="right", truncation_side="right")
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        """
+        Encode texts into unit-norm float32 vectors
+
+        Returns:
+            Array of shape [len(texts), dim]
+        """
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            input_ids, attention_mask = self.tokenize(texts[start:start + batch_size])
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self.input_names:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+            feeds = {name: value for name, value in feeds.items() if name in self.input_names}
+
+            hidden = self.session.run(None, feeds)[0]
+            if hidden.ndim == 3:
+                mask = attention_mask[:, :, None].astype(np.float32)
+                hidden = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1.0)
+            batches.append(hidden.astype(np.float32))
+
+        if not batches:
+            return np.zeros((0, 0), dtype=np.float32)
+        return normalize_rows(np.concatenate(batches))
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows, leaving all-zero rows untouched"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def questions_fingerprint(questions: List[str], encoder_path: str,
+                          tokenizer_path: Optional[str] = None) -> str:
+    """Fingerprint of the embedded texts, encoder and tokenizer, used to detect a stale matrix"""
+    digest = hashlib.sha256()
+    digest.update(os.path.basename(encoder_path).encode('utf-8'))
+    if os.path.exists(encoder_path):
+        stat = os.stat(encoder_path)
+        digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+    # Hashed by content: a retrained vocabulary often keeps the file size
+    tokenizer_path = tokenizer_path or encoder_tokenizer_path(encoder_path)
+    if os.path.exists(tokenizer_path):
+        with open(tokenizer_path, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).hexdigest().encode('utf-8'))
+    for question in questions:
+        digest.update(question.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class EmbeddingIndex:
+    """
+    Read-only question embedding matrix, memory-mapped from disk
+    Rows are laid out entry by entry, one row per language in EMBEDDING_LANGUAGES
+    """
+
+    def __init__(self, path: str):
+        """
+        Map the embedding matrix
+
+        Args:
+            path: Path to the .npy file written by build()
+        """
+        self.path = path
+        self.matrix = np.load(path, mmap_mode='r')
+        self.rows_per_entry = len(EMBEDDING_LANGUAGES)
+        self.num_entries = self.matrix.shape[0] // self.rows_per_entry
+        logger.info(f"Embedding index mapped from {path}: {self.matrix.shape}")
+
+    @staticmethod
+    def entry_questions(entries: List[Dict[str, Any]]) -> List[str]:
+        """Texts to embed, in matrix row order"""
+        return [entry.get(f"question_{lang}", "") or ""
+                for entry in entries for lang in EMBEDDING_LANGUAGES]
+
+    @staticmethod
+    def metadata_path(path: str) -> str:
+        """Sidecar JSON holding the fingerprint the matrix was built from"""
+        return os.path.splitext(path)[0] + ".json"
+
+    @classmethod
+    def is_current(cls, path: str, fingerprint: str) -> bool:
+        """Check that the matrix on disk was built from the same questions and encoder"""
+        try:
+            with open(cls.metadata_path(path), 'r', encoding='utf-8') as f:
+                return json.load(f).get("fingerprint") == fingerprint and os.path.exists(path)
+        except (FileNotFoundError, ValueError):
+            return False
+
+    @classmethod
+    def build(cls, encoder: OnnxSentenceEncoder, entries: List[Dict[str, Any]],
+              path: str, fingerprint: str) -> "EmbeddingIndex":
+        """Encode every entry question, write the matrix atomically and map it"""
+        questions = cls.entry_questions(entries)
+        vectors = encoder.encode([q for q in questions if q])
+
+        matrix = np.zeros((len(questions), vectors.shape[1] if len(vectors) else 0), dtype=np.float32)
+        present = np.fromiter((bool(q) for q in questions), dtype=bool, count=len(questions))
+        matrix[present] = vectors
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npy"
+        np.save(tmp_path, matrix)
+        os.replace(tmp_path, path)
+        with open(cls.metadata_path(path), 'w', encoding='utf-8') as f:
+            json.dump({"fingerprint": fingerprint, "shape": list(matrix.shape)}, f)
+
+        logger.info(f"Embedding index built: {matrix.shape} -> {path}")
+        return cls(path)
+
+    def similarities(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarity of a batch of unit-norm queries to every entry
+
+        Returns:
+            Array of shape [num_queries, num_entries], best language row per entry
+        """
+        # One BLAS call for the whole batch
+        similarities = queries @ self.matrix.T
+        return similarities.reshape(len(queries), self.num_entries, self.rows_per_entry).max(axis=2)
+
+    def search(self, queries: np.ndarray, top_k: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the nearest entries for a batch of unit-norm query vectors
+
+        Args:
+            queries: Array of shape [num_queries, dim]
+            top_k: Number of entries per query
+
+        Returns:
+            (entry_ids, similarities), both [num_queries, k], best first
+        """
+        similarities = self.similarities(queries)
+        k = min(top_k, self.num_entries)
+        if k == 0:
+            empty = np.zeros((len(queries), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
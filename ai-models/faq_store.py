@@ -0,0 +1,181 @@
+"""
+Knowledge base backed by the backend's SQLite faq table
+Entries are kept as __slots__ records and pulled incrementally by updated_at
+"""
+
+import hashlib
+import sqlite3
+from contextlib import closing
+from typing import List, Dict, Any, Optional, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+FAQ_COLUMNS = ("id", "category", "question_fr", "question_ar", "answer_fr", "answer_ar",
+               "tags", "updated_at")
+
+
+class FaqEntry:
+    """
+    One FAQ row
+
+    Read through get() like the JSON knowledge base entries, without a dict per entry.
+    """
+
+    __slots__ = ("id", "category", "question_fr", "question_ar", "answer_fr", "answer_ar",
+                 "keywords", "updated_at")
+
+    def __init__(self, row: Tuple):
+        (self.id, category, self.question_fr, self.question_ar, self.answer_fr, self.answer_ar,
+         tags, self.updated_at) = row
+        self.category = category or "general"
+        self.keywords = tuple(tag.strip() for tag in (tags or "").split(",") if tag.strip())
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Field access with the same semantics as dict.get"""
+        if key in FaqEntry.__slots__:
+            return getattr(self, key)
+        return default
+
+    def matches(self, row: Tuple) -> bool:
+        """Whether a freshly read row carries the same content"""
+        return FaqEntry(row).key() == self.key()
+
+    def key(self) -> Tuple:
+        """Every field, for change detection"""
+        return (self.id, self.category, self.question_fr, self.question_ar, self.answer_fr,
+                self.answer_ar, self.keywords, self.updated_at)
+
+
+def group_by_category(entries: Dict[int, FaqEntry]) -> Dict[str, List[FaqEntry]]:
+    """Entries grouped by category, in id order"""
+    knowledge_base: Dict[str, List[FaqEntry]] = {}
+    for entry_id in sorted(entries):
+        entry = entries[entry_id]
+        knowledge_base.setdefault(entry.category, []).append(entry)
+    return knowledge_base
+
+
+def entries_fingerprint(entries: Dict[int, FaqEntry]) -> str:
+    """Changes whenever an entry is added, edited or removed"""
+    digest = hashlib.sha256()
+    for entry_id in sorted(entries):
+        digest.update(repr(entries[entry_id].key()).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class FaqSync:
+    """
+    Changes pulled by FaqStore.sync(), not yet applied to the store
+
+    entries is the table as of this sync (unchanged rows are the store's own
+    objects); last_updated is the watermark the next sync starts from once this
+    one is committed.
+    """
+
+    __slots__ = ("changed", "removed", "entries", "last_updated")
+
+    def __init__(self, changed: List[int], removed: List[int], entries: Dict[int, FaqEntry], last_updated: str):
+        self.changed = changed
+        self.removed = removed
+        self.entries = entries
+        self.last_updated = last_updated
+
+    def knowledge_base(self) -> Dict[str, List[FaqEntry]]:
+        """Entries grouped by category, in id order"""
+        return group_by_category(self.entries)
+
+    def fingerprint(self) -> str:
+        """Fingerprint the store will have once this sync is committed"""
+        return entries_fingerprint(self.entries)
+
+
+class FaqStore:
+    """
+    In-memory mirror of the faq table
+
+    The database is opened read-only for each sync. A sync reads only the rows whose
+    updated_at is at or after the newest timestamp already seen (plus the id list, to
+    notice deletions), so an edit costs one row, not a reload of the whole table.
+    The backend bumps updated_at on content edits (see the faq_touch trigger).
+    A sync only takes effect once committed, after whatever was built from it is in
+    service; until then the next sync reads the same changes again.
+    """
+
+    def __init__(self, db_path: str):
+        """
+        Initialize the store
+
+        Args:
+            db_path: Path of the SQLite database maintained by the Node backend
+        """
+        self.db_path = db_path
+        self.entries: Dict[int, FaqEntry] = {}
+        self.last_updated = ""
+        self.checked_wal = False
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a read-only connection"""
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, isolation_level=None)
+        if not self.checked_wal:
+            # Readers and the backend's writer only run concurrently in WAL mode
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+            if mode.lower() != "wal":
+                logger.warning(f"{self.db_path} is in {mode} mode; FAQ syncs may wait on backend writes")
+            self.checked_wal = True
+        return conn
+
+    def sync(self) -> FaqSync:
+        """
+        Pull changes since the last committed sync, leaving the store as it is
+
+        Returns:
+            The changed and removed ids, the resulting entries and watermark
+        """
+        with closing(self.connect()) as conn:
+            # One read transaction: the delta and the id list come from the same snapshot
+            conn.execute("BEGIN")
+            rows = conn.execute(f"SELECT {', '.join(FAQ_COLUMNS)} FROM faq "
+                                f"WHERE updated_at >= ? OR updated_at IS NULL",
+                                (self.last_updated,)).fetchall()
+            ids = {row[0] for row in conn.execute("SELECT id FROM faq")}
+            conn.execute("COMMIT")
+
+        entries = dict(self.entries)
+        last_updated = self.last_updated
+        changed = []
+        for row in rows:
+            entry = entries.get(row[0])
+            # Rows stamped in the same second as the last sync come back; skip identical ones
+            if entry is not None and entry.matches(row):
+                continue
+            entries[row[0]] = FaqEntry(row)
+            changed.append(row[0])
+            if row[-1] and row[-1] > last_updated:
+                last_updated = row[-1]
+
+        removed = [entry_id for entry_id in entries if entry_id not in ids]
+        for entry_id in removed:
+            del entries[entry_id]
+        return FaqSync(changed, removed, entries, last_updated)
+
+    def commit(self, sync: FaqSync):
+        """Make a sync the store's state once what was built from it is served"""
+        self.entries = sync.entries
+        self.last_updated = sync.last_updated
+
+    def knowledge_base(self) -> Dict[str, List[FaqEntry]]:
+        """Entries grouped by category, in id order"""
+        return group_by_category(self.entries)
+
+    def fingerprint(self) -> str:
+        """Changes whenever an entry is added, edited or removed"""
+        return entries_fingerprint(self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, entry_id: int) -> Optional[FaqEntry]:
+        """Entry by database id"""
+        return self.entries.get(entry_id)
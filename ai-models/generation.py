@@ -0,0 +1,417 @@
+"""
+Autoregressive decoding over an ONNX causal language model
+Feeds the present key/values back as past key/values so each new token costs one
+incremental forward pass
+"""
+
+import re
+import time
+from typing import List, Dict, Any, Optional, Callable, Iterator, Tuple
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+PAST_PATTERN = re.compile(r'^past_key_values\.(\d+)\.(key|value)$|^past_(\d+)_(key|value)$')
+
+ONNX_DTYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(double)": np.float64
+}
+
+
+class DecodeState:
+    """
+    Per-batch decoding state
+
+    KV buffers are allocated once for the whole capacity. Each layer owns two flat
+    buffers used alternately: the present key/values of step t are written straight
+    into one of them and read back as past at step t + 1, so decoding allocates no
+    KV memory per step.
+    """
+
+    __slots__ = ("batch_size", "capacity", "length", "input_ids", "attention_mask",
+                 "next_positions", "buffers", "current", "past")
+
+    def __init__(self, batch_size: int, capacity: int):
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.length = 0
+        self.input_ids = np.zeros((batch_size, capacity), dtype=np.int64)
+        self.attention_mask = np.zeros((batch_size, capacity), dtype=np.int64)
+        self.next_positions = np.zeros(batch_size, dtype=np.int64)
+        self.buffers: List[List[np.ndarray]] = []
+        self.current = 0
+        self.past: List[np.ndarray] = []
+
+    def nbytes(self) -> int:
+        """Memory held by the state"""
+        return (self.input_ids.nbytes + self.attention_mask.nbytes
+                + sum(buffer.nbytes for pair in self.buffers for buffer in pair))
+
+
+class TokenDecoder:
+    """
+    Token-by-token decoding loop over start() and step()
+
+    Subclasses provide the forward passes: a local session (GenerationEngine) or the
+    worker processes of an inference pool.
+    """
+
+    def __init__(self, eos_token_id: int, pad_token_id: Optional[int] = None, max_length: int = 2048):
+        """
+        Initialize the decoder
+
+        Args:
+            eos_token_id: Token that ends a sequence
+            pad_token_id: Token used for padding (defaults to eos)
+            max_length: Upper bound on prompt + generated tokens
+        """
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = eos_token_id if pad_token_id is None else pad_token_id
+        self.max_length = max_length
+
+    def start(self, input_ids: np.ndarray, attention_mask: Optional[np.ndarray] = None,
+              max_new_tokens: int = 0, prefix=None) -> Tuple[Any, np.ndarray]:
+        """Prefill a prompt batch; returns (state, last position logits [batch, vocab])"""
+        raise NotImplementedError
+
+    def step(self, state, tokens: np.ndarray) -> np.ndarray:
+        """Append one token per row; returns the next logits [batch, vocab]"""
+        raise NotImplementedError
+
+    def iter_tokens(self, input_ids: np.ndarray, attention_mask: Optional[np.ndarray] = None,
+                    max_new_tokens: int = 64,
+                    select_tokens: Optional[Callable[[np.ndarray, DecodeState], np.ndarray]] = None,
+                    stop_check: Optional[Callable[[], bool]] = None,
+                    prefix: Optional[DecodeState] = None,
+                    on_prefill: Optional[Callable[[DecodeState, int], None]] = None) -> Iterator[np.ndarray]:
+        """
+        Decode token by token
+
+        Args:
+            input_ids: Prompt batch, left-padded
+            attention_mask: Prompt mask
+            max_new_tokens: Token budget per sequence
+            select_tokens: Maps ([batch, vocab] logits, state) to next token ids (greedy by default)
+            stop_check: Called between steps; returning True stops decoding
+            prefix: Cached KV of the start of the prompt (see start())
+            on_prefill: Called with (state, row) for every row once the prompt is processed
+
+        Yields:
+            Next token ids, shape [batch]; finished rows yield the pad token
+        """
+        state, logits = self.start(input_ids, attention_mask, max_new_tokens, prefix)
+        if on_prefill is not None:
+            for row in range(state.batch_size):
+                on_prefill(state, row)
+        finished = np.zeros(state.batch_size, dtype=bool)
+        budget = min(max_new_tokens, state.capacity - state.length)
+
+        for step in range(budget):
+            if select_tokens is None:
+                next_tokens = np.argmax(logits, axis=-1).astype(np.int64)
+            else:
+                next_tokens = np.asarray(select_tokens(logits, state), dtype=np.int64)
+            next_tokens[finished] = self.pad_token_id
+            finished |= next_tokens == self.eos_token_id
+            yield next_tokens
+
+            if finished.all() or step == budget - 1 or (stop_check is not None and stop_check()):
+                break
+            logits = self.step(state, next_tokens)
+
+    def generate(self, input_ids: np.ndarray, attention_mask: Optional[np.ndarray] = None,
+                 max_new_tokens: int = 64,
+                 select_tokens: Optional[Callable[[np.ndarray, DecodeState], np.ndarray]] = None,
+                 stop_check: Optional[Callable[[], bool]] = None,
+                 prefix: Optional[DecodeState] = None,
+                 on_prefill: Optional[Callable[[DecodeState, int], None]] = None) -> Dict[str, Any]:
+        """
+        Generate up to max_new_tokens per sequence (prefix and on_prefill as in iter_tokens)
+
+        Returns:
+            Dictionary with the generated ids ([batch, n], padded after EOS), per-row
+            lengths (EOS excluded), timings and throughput
+        """
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        start_time = time.perf_counter()
+        first_token_time = None
+        steps = []
+
+        for next_tokens in self.iter_tokens(input_ids, attention_mask, max_new_tokens,
+                                            select_tokens, stop_check, prefix, on_prefill):
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+            steps.append(next_tokens)
+        end_time = time.perf_counter()
+
+        batch_size = input_ids.shape[0]
+        tokens = np.stack(steps, axis=1) if steps else np.zeros((batch_size, 0), dtype=np.int64)
+        is_eos = tokens == self.eos_token_id
+        hit_eos = is_eos.any(axis=1)
+        lengths = np.where(hit_eos, is_eos.argmax(axis=1), tokens.shape[1])
+
+        generated = int(lengths.sum())
+        decode_time = end_time - (first_token_time or end_time)
+        return {
+            "tokens": tokens,
+            "lengths": lengths,
+            "finish_reason": ["eos" if eos else "length" for eos in hit_eos],
+            "prompt_tokens": int(input_ids.shape[1]),
+            "generated_tokens": generated,
+            "prefill_time": (first_token_time or end_time) - start_time,
+            "decode_time": decode_time,
+            "total_time": end_time - start_time,
+            "tokens_per_second": generated / (end_time - start_time) if end_time > start_time else 0.0
+        }
+
+
+class GenerationEngine(TokenDecoder):
+    """
+    Incremental decoding engine wrapping an onnxruntime InferenceSession
+
+    Supports decoder exports with past_key_values.N.key/value inputs (Optimum naming)
+    and falls back to re-running the full sequence for models without a KV cache.
+    """
+
+    def __init__(self, session, eos_token_id: int, pad_token_id: Optional[int] = None,
+                 num_kv_heads: Optional[int] = None, head_dim: Optional[int] = None,
+                 max_length: int = 2048):
+        """
+        Initialize the engine
+
+        Args:
+            session: onnxruntime InferenceSession of a causal LM
+            eos_token_id: Token that ends a sequence
+            pad_token_id: Token used for padding (defaults to eos)
+            num_kv_heads: KV heads, if not fixed in the model's input shapes
+            head_dim: Head size, if not fixed in the model's input shapes
+            max_length: Upper bound on prompt + generated tokens
+        """
+        super().__init__(eos_token_id, pad_token_id, max_length)
+        self.session = session
+
+        inputs = {i.name: i for i in session.get_inputs()}
+        outputs = [o.name for o in session.get_outputs()]
+        self.input_names = set(inputs)
+        self.has_position_ids = "position_ids" in inputs
+        self.logits_name = "logits" if "logits" in outputs else outputs[0]
+
+        self.past_names = [name for name in inputs if PAST_PATTERN.match(name)]
+        self.present_names = [self.present_name(name, outputs) for name in self.past_names]
+        self.use_cache = bool(self.past_names)
+
+        self.kv_dtype = np.float32
+        self.num_kv_heads = num_kv_heads
+        self.head_dim = head_dim
+        if self.use_cache:
+            past = inputs[self.past_names[0]]
+            self.kv_dtype = ONNX_DTYPES.get(past.type, np.float32)
+            if isinstance(past.shape[1], int):
+                self.num_kv_heads = past.shape[1]
+            if isinstance(past.shape[3], int):
+                self.head_dim = past.shape[3]
+            if not self.num_kv_heads or not self.head_dim:
+                raise ValueError("KV cache shape is dynamic; set model.num_kv_heads and model.head_dim")
+
+        logger.info(f"Generation engine ready: {len(self.past_names) // 2} cached layers, "
+                    f"kv_heads={self.num_kv_heads}, head_dim={self.head_dim}")
+
+    @staticmethod
+    def present_name(past_name: str, outputs: List[str]) -> str:
+        """Map a past input name to the matching present output name"""
+        for candidate in (past_name.replace("past_key_values", "present"),
+                          past_name.replace("past_", "present_")):
+            if candidate in outputs:
+                return candidate
+        raise ValueError(f"No present output matches {past_name}")
+
+    def start(self, input_ids: np.ndarray, attention_mask: Optional[np.ndarray] = None,
+              max_new_tokens: int = 0,
+              prefix: Optional[DecodeState] = None) -> Tuple[DecodeState, np.ndarray]:
+        """
+        Run the prefill pass over a (left-padded) prompt batch
+
+        Args:
+            input_ids: Prompt batch
+            attention_mask: Prompt mask
+            max_new_tokens: Positions to reserve for generation
+            prefix: State from snapshot() holding the KV of the first prompt tokens of a
+                single unpadded prompt; only the remaining tokens are run
+
+        Returns:
+            (state, logits) with logits of the last prompt position, shape [batch, vocab]
+        """
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        if attention_mask is None:
+            attention_mask = np.ones_like(input_ids)
+        batch_size, prompt_length = input_ids.shape
+
+        capacity = min(prompt_length + max_new_tokens, self.max_length) if max_new_tokens else prompt_length
+        capacity = max(capacity, prompt_length)
+        state = self.allocate(batch_size, capacity)
+
+        if prefix is not None and self.use_cache and batch_size == 1 and prefix.length < prompt_length:
+            cached = prefix.length
+            state.input_ids[:, :cached] = prefix.input_ids[:, :cached]
+            state.attention_mask[:, :cached] = 1
+            state.past = []
+            for past, pair in zip(prefix.past, state.buffers):
+                view = self.kv_view(pair[0], 1, cached)
+                view[...] = past
+                state.past.append(view)
+            state.length = cached
+            state.next_positions[:] = cached
+            return state, self.step(state, input_ids[:, cached:])
+
+        state.attention_mask[:, :prompt_length] = attention_mask
+        positions = np.maximum(np.cumsum(attention_mask, axis=1) - 1, 0)
+        logits = self.forward(state, input_ids, positions, mask_new=False)
+        state.next_positions[:] = attention_mask.sum(axis=1)
+        return state, logits
+
+    def snapshot(self, state: DecodeState, row: int = 0) -> DecodeState:
+        """
+        Copy one row of a freshly prefilled state, padding stripped, for use as a prefix
+
+        The copy holds a single KV buffer per layer sized to its positions; it is only
+        read from (by start()), never decoded into.
+        """
+        valid = int(state.attention_mask[row, :state.length].sum())
+        first = state.length - valid
+        copy = DecodeState(1, valid)
+        copy.length = valid
+        copy.input_ids[0] = state.input_ids[row, first:state.length]
+        copy.attention_mask[0] = 1
+        copy.next_positions[0] = state.next_positions[row]
+        for past in state.past:
+            buffer = np.empty(self.num_kv_heads * valid * self.head_dim, dtype=self.kv_dtype)
+            view = self.kv_view(buffer, 1, valid)
+            view[0] = past[row, :, first:state.length, :]
+            copy.buffers.append([buffer])
+            copy.past.append(view)
+        return copy
+
+    def allocate(self, batch_size: int, capacity: int) -> DecodeState:
+        """Create a state with KV buffers sized for capacity positions"""
+        state = DecodeState(batch_size, capacity)
+        if self.use_cache:
+            size = batch_size * self.num_kv_heads * capacity * self.head_dim
+            state.buffers = [[np.empty(size, dtype=self.kv_dtype), np.empty(size, dtype=self.kv_dtype)]
+                             for _ in self.past_names]
+            state.past = [self.kv_view(pair[0], batch_size, 0) for pair in state.buffers]
+        return state
+
+    def kv_view(self, buffer: np.ndarray, batch_size: int, length: int) -> np.ndarray:
+        """Contiguous [batch, heads, length, head_dim] view over the head of a flat buffer"""
+        size = batch_size * self.num_kv_heads * length * self.head_dim
+        return buffer[:size].reshape(batch_size, self.num_kv_heads, length, self.head_dim)
+
+    def step(self, state: DecodeState, tokens: np.ndarray) -> np.ndarray:
+        """
+        Append tokens ([batch] or [batch, n]) and run one incremental forward pass
+
+        Returns:
+            Logits of the last new position, shape [batch, vocab]
+        """
+        tokens = np.asarray(tokens, dtype=np.int64)
+        if tokens.ndim == 1:
+            tokens = tokens[:, None]
+        positions = state.next_positions[:, None] + np.arange(tokens.shape[1])
+        logits = self.forward(state, tokens, positions, mask_new=True)
+        state.next_positions += tokens.shape[1]
+        return logits
+
+    def forward(self, state: DecodeState, tokens: np.ndarray, positions: np.ndarray,
+                mask_new: bool) -> np.ndarray:
+        """Forward the new tokens against the cached prefix and advance the state"""
+        batch_size, num_new = tokens.shape
+        start, end = state.length, state.length + num_new
+        if end > state.capacity:
+            raise ValueError(f"Sequence length {end} exceeds state capacity {state.capacity}")
+
+        state.input_ids[:, start:end] = tokens
+        if mask_new:
+            state.attention_mask[:, start:end] = 1
+        attention_mask = np.ascontiguousarray(state.attention_mask[:, :end])
+
+        if not self.use_cache:
+            # No KV cache in the graph: re-run the whole sequence
+            feeds = {"input_ids": state.input_ids[:, :end], "attention_mask": attention_mask}
+            if self.has_position_ids:
+                feeds["position_ids"] = np.maximum(np.cumsum(attention_mask, axis=1) - 1, 0)
+            feeds = {name: value for name, value in feeds.items() if name in self.input_names}
+            logits = self.session.run([self.logits_name], feeds)[0]
+            state.length = end
+            return np.array(logits[:, -1, :], dtype=np.float32)
+
+        binding = self.session.io_binding()
+        binding.bind_cpu_input("input_ids", tokens)
+        if "attention_mask" in self.input_names:
+            binding.bind_cpu_input("attention_mask", attention_mask)
+        if self.has_position_ids:
+            binding.bind_cpu_input("position_ids", np.ascontiguousarray(positions, dtype=np.int64))
+
+        target = 1 - state.current
+        presents = []
+        for past_name, present_name, past, pair in zip(self.past_names, self.present_names,
+                                                        state.past, state.buffers):
+            binding.bind_input(past_name, 'cpu', 0, self.kv_dtype, list(past.shape), past.ctypes.data)
+            present = self.kv_view(pair[target], batch_size, end)
+            binding.bind_output(present_name, 'cpu', 0, self.kv_dtype, list(present.shape), present.ctypes.data)
+            presents.append(present)
+        binding.bind_output(self.logits_name, 'cpu')
+
+        self.session.run_with_iobinding(binding)
+        logits = binding.get_outputs()[-1].numpy()
+
+        state.past = presents
+        state.current = target
+        state.length = end
+        return np.array(logits[:, -1, :], dtype=np.float32)
+
+    def repack(self, sources: List[Tuple[DecodeState, np.ndarray]], extra_capacity: int) -> DecodeState:
+        """
+        Build a new state from selected rows of one or more states
+
+        Used by continuous batching: sequences joining a running batch are merged in,
+        finished sequences are dropped. Rows are right-aligned on a common length so
+        the newest token of every row sits in the last column; columns that are padding
+        for every kept row are trimmed.
+
+        Args:
+            sources: (state, row indices) pairs, in output row order
+            extra_capacity: Positions to reserve after the common length
+        """
+        spans = []
+        for state, rows in sources:
+            mask = state.attention_mask[rows, :state.length]
+            first_valid = int(np.argmax(mask.any(axis=0))) if mask.any() else state.length
+            spans.append(state.length - first_valid)
+        length = max(spans, default=0)
+        batch_size = sum(len(rows) for _, rows in sources)
+
+        merged = self.allocate(batch_size, length + extra_capacity)
+        merged.length = length
+        if self.use_cache:
+            merged.past = []
+            for layer in range(len(self.past_names)):
+                past = self.kv_view(merged.buffers[layer][0], batch_size, length)
+                past.fill(0)
+                merged.past.append(past)
+
+        row = 0
+        for (state, rows), span in zip(sources, spans):
+            count = len(rows)
+            start = state.length - span
+            target = slice(row, row + count)
+            merged.input_ids[target, length - span:length] = state.input_ids[rows, start:state.length]
+            merged.attention_mask[target, length - span:length] = state.attention_mask[rows, start:state.length]
+            merged.next_positions[target] = state.next_positions[rows]
+            for layer, past in enumerate(state.past):
+                merged.past[layer][target, :, length - span:length, :] = past[rows, :, start:state.length, :]
+            row += count
+        return merged
@@ -0,0 +1,84 @@
+"""
+Gunicorn configuration for the AI model service
+
+    gunicorn -c gunicorn.conf.py server:app
+
+The model, tokenizer and knowledge base are loaded once in the master before workers
+are forked, so every worker shares those pages copy-on-write instead of holding its own
+copy. Cores are split between workers: each gets cores / workers intra-op threads.
+"""
+
+import gc
+import logging
+import os
+import sys
+
+try:
+    CPU_COUNT = len(os.sched_getaffinity(0))
+except AttributeError:
+    CPU_COUNT = os.cpu_count() or 1
+
+bind = os.environ.get("AI_SERVICE_BIND", "0.0.0.0:5000")
+
+# Defaults to one worker per core with a single intra-op thread each, which keeps the
+# preloaded session (and its weights) shared by all workers
+workers = int(os.environ.get("AI_WORKERS", CPU_COUNT))
+intra_op_threads = max(1, CPU_COUNT // workers)
+os.environ.setdefault("AI_INTRA_OP_THREADS", str(intra_op_threads))
+# Background or lazy loading would create the session in each worker after fork
+os.environ.setdefault("AI_MODEL_LOADING", "eager")
+
+# Request threads per worker; model runs inside a worker are serialized or batched
+worker_class = "gthread"
+threads = int(os.environ.get("AI_WORKER_THREADS", 4))
+
+preload_app = True
+timeout = int(os.environ.get("AI_WORKER_TIMEOUT", 120))
+# On SIGTERM/SIGHUP old workers stop accepting, finish in-flight requests (including
+# streams) and drain the batch scheduler before exiting
+graceful_timeout = int(os.environ.get("AI_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+max_requests = int(os.environ.get("AI_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+
+
+def when_ready(server):
+    """Load the model in the master, before any worker is forked"""
+    from model_service import get_ai_model
+
+    model = get_ai_model()
+    # Workers watch the knowledge base from after_fork; a watcher here would reload
+    # the master's copy, and could be mid-reload (SQLite handle open) at fork time
+    model.stop_knowledge_base_watch()
+    # Keep the collector from touching (and so copying) the preloaded objects' pages
+    gc.freeze()
+    server.log.info(f"Model preloaded: {workers} workers x {os.environ['AI_INTRA_OP_THREADS']} intra-op threads")
+
+
+def post_fork(server, worker):
+    from model_service import get_ai_model
+
+    get_ai_model().after_fork()
+
+
+def worker_exit(server, worker):
+    """
+    Drain the worker's model, then leave without interpreter teardown
+
+    onnxruntime is not fork-safe at shutdown: a child that inherited it hangs or aborts
+    while its static state is destroyed, so the worker exits straight away with the
+    status gunicorn was about to use.
+    """
+    import model_service
+
+    if model_service.ai_model is not None:
+        model_service.ai_model.close()
+
+    exc = sys.exc_info()[1]
+    code = exc.code if isinstance(exc, SystemExit) and isinstance(exc.code, int) else 0
+    logging.shutdown()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
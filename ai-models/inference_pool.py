@@ -0,0 +1,557 @@
+"""
+Multi-process inference pool
+Worker processes each own an onnxruntime session pinned to a subset of cores; tensors
+travel through per-worker shared memory slot rings, only small control tuples through pipes
+"""
+
+import itertools
+import os
+import queue
+import threading
+import time
+import weakref
+import multiprocessing as mp
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from multiprocessing import shared_memory
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+import logging
+
+from generation import GenerationEngine, TokenDecoder
+from session_store import open_session, session_stats
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerCrashed(RuntimeError):
+    """The worker holding a call or a sequence died or was restarted"""
+
+
+class SlotRing:
+    """
+    Fixed-size slots in one shared memory block
+
+    Each in-flight call owns one slot: the caller writes its inputs there, the worker
+    overwrites them with the logits, and the caller copies the logits out before
+    handing the slot back.
+    """
+
+    def __init__(self, slots: int, slot_bytes: int, name: Optional[str] = None):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+    def view(self, slot: int, shape: Tuple[int, ...], dtype, offset: int = 0) -> np.ndarray:
+        """Array over part of a slot"""
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        if offset + size > self.slot_bytes:
+            raise ValueError(f"{size} bytes at offset {offset} exceed the {self.slot_bytes} byte slot")
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf,
+                          offset=slot * self.slot_bytes + offset)
+
+    def close(self):
+        """Detach, and free the block if this process created it"""
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def worker_main(index: int, model_path: str, optimized: bool, cores: List[int], ring_name: str,
+                slots: int, slot_bytes: int, conn, engine_options: Dict[str, Any], weights: str = "mmap",
+                cache_dir: Optional[str] = None):
+    """
+    Worker process loop
+
+    Keeps the decode state of every sequence started on it; requests are
+    (op, call_id, slot, args) tuples answered with (call_id, status, value).
+    """
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    import onnxruntime as ort
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = (ort.GraphOptimizationLevel.ORT_DISABLE_ALL if optimized
+                                             else ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    sess_options.intra_op_num_threads = max(len(cores), 1)
+    sess_options.inter_op_num_threads = 1
+    # With mapped weights every worker shares the page cache copy of the optimized graph's data
+    session = open_session(model_path, sess_options, weights=weights, cache_dir=cache_dir, name=f"pool-{index}")
+    engine = GenerationEngine(session, **engine_options)
+
+    # Spawned workers share the front process' resource tracker, which unlinks the block
+    ring = SlotRing(slots, slot_bytes, name=ring_name)
+    states = {}
+    conn.send(("ready", os.getpid(), session_stats()))
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        op, call_id, slot, args = message
+        try:
+            if op == "start":
+                sequence, shape, max_new_tokens = args
+                input_ids = ring.view(slot, shape, np.int64)
+                attention_mask = ring.view(slot, shape, np.int64, offset=input_ids.nbytes)
+                state, logits = engine.start(input_ids, attention_mask, max_new_tokens)
+                states[sequence] = state
+            elif op == "step":
+                sequence, shape = args
+                logits = engine.step(states[sequence], ring.view(slot, shape, np.int64))
+            elif op == "release":
+                states.pop(args, None)
+                continue
+            elif op == "ping":
+                conn.send((call_id, "ok", len(states)))
+                continue
+            else:
+                raise ValueError(f"Unknown operation {op}")
+
+            ring.view(slot, logits.shape, np.float32)[...] = logits
+            conn.send((call_id, "ok", logits.shape))
+        except Exception as e:
+            conn.send((call_id, "error", f"{type(e).__name__}: {e}"))
+
+    ring.shm.close()
+
+
+class PoolWorker:
+    """Front-side handle of one worker process"""
+
+    def __init__(self, index: int, cores: List[int], ring: SlotRing):
+        self.index = index
+        self.cores = cores
+        self.ring = ring
+        self.process = None
+        self.conn = None
+        self.generation = 0
+        self.send_lock = threading.Lock()
+        # Guards pending, generation and healthy: a call is registered with the
+        # incarnation it was meant for, or not at all
+        self.lock = threading.Lock()
+        self.pending: Dict[int, Future] = {}
+        self.free_slots = None
+        self.sequences = 0
+        self.calls = 0
+        self.restarts = 0
+        self.healthy = False
+        self.sessions = []
+
+    @property
+    def load(self) -> int:
+        """Open sequences plus calls in flight"""
+        return self.sequences + len(self.pending)
+
+
+class InferencePool:
+    """
+    Pool of inference processes with least-loaded dispatch
+
+    A sequence is placed on the healthy worker with the fewest open sequences and
+    in-flight calls, and all its steps then go to that worker (its KV cache lives
+    there). A reader thread per worker resolves calls; a monitor thread pings workers
+    and restarts any that died or stopped answering, and a call left unanswered for
+    call_timeout restarts its worker. Calls and sequences of a restarted worker fail
+    with WorkerCrashed.
+    """
+
+    def __init__(self, model_path: str, engine_options: Dict[str, Any],
+                 num_workers: Optional[int] = None, cores_per_worker: int = 2,
+                 slots: int = 4, slot_bytes: int = 8 * 1024 * 1024,
+                 health_interval: float = 5.0, ping_timeout: float = 10.0,
+                 call_timeout: float = 60.0, start_timeout: float = 120.0, optimized: bool = False,
+                 weights: str = "mmap", cache_dir: Optional[str] = None):
+        """
+        Initialize the pool (worker processes start on first use)
+
+        Args:
+            model_path: ONNX model loaded by every worker
+            engine_options: GenerationEngine keyword arguments (eos/pad ids, KV shape, max_length)
+            num_workers: Worker processes (default: available cores / cores_per_worker)
+            cores_per_worker: Cores each worker is pinned to (its intra-op threads)
+            slots: Concurrent calls per worker (shared memory slots)
+            slot_bytes: Size of a slot; must hold the prompt ids + mask and a [batch, vocab] logits block
+            health_interval: Seconds between health checks
+            ping_timeout: Seconds a worker may take to answer a ping before it is restarted
+            call_timeout: Seconds a worker may take to run a prefill or step before it is restarted
+            start_timeout: Seconds to wait for a worker to load the model
+            optimized: model_path is an already optimized graph (loaded without re-optimizing)
+            weights: Weight handling mode of the worker sessions (see session_store.WEIGHT_MODES)
+            cache_dir: Where an externalized copy of a model with inline weights goes
+        """
+        if hasattr(os, "sched_getaffinity"):
+            available = sorted(os.sched_getaffinity(0))
+        else:
+            available = list(range(os.cpu_count() or 1))
+        cores_per_worker = max(1, min(cores_per_worker, len(available)))
+        if num_workers is None:
+            num_workers = max(1, len(available) // cores_per_worker)
+
+        self.model_path = model_path
+        self.optimized = optimized
+        self.weights = weights
+        self.cache_dir = cache_dir
+        self.engine_options = engine_options
+        self.num_workers = num_workers
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.health_interval = health_interval
+        self.ping_timeout = ping_timeout
+        self.call_timeout = call_timeout
+        self.start_timeout = start_timeout
+        self.context = mp.get_context("spawn")
+        self.call_ids = itertools.count()
+        self.sequence_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.started = False
+        self.closed = False
+        self.monitor = None
+
+        # Round-robin core subsets; workers share cores only when there are more workers than subsets
+        subsets = [available[i:i + cores_per_worker]
+                   for i in range(0, len(available) - cores_per_worker + 1, cores_per_worker)] or [available]
+        self.workers = [PoolWorker(index, subsets[index % len(subsets)], None) for index in range(num_workers)]
+
+    def start(self):
+        """Spawn the worker processes and the monitor thread"""
+        with self.lock:
+            if self.started:
+                return
+            if self.closed:
+                raise RuntimeError("Inference pool is closed")
+            try:
+                for worker in self.workers:
+                    worker.ring = SlotRing(self.slots, self.slot_bytes)
+                    self.spawn(worker)
+            except Exception:
+                for worker in self.workers:
+                    if worker.process is not None and worker.process.is_alive():
+                        worker.process.kill()
+                    if worker.ring is not None:
+                        worker.ring.close()
+                        worker.ring = None
+                    worker.process = None
+                    worker.healthy = False
+                raise
+            self.monitor = threading.Thread(target=self.watch, name="pool-monitor", daemon=True)
+            self.started = True
+            self.monitor.start()
+        logger.info(f"Inference pool ready: {self.num_workers} workers on cores "
+                    f"{[worker.cores for worker in self.workers]}")
+
+    def spawn(self, worker: PoolWorker):
+        """Start (or restart) one worker process and its reader thread"""
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=worker_main, name=f"inference-{worker.index}", daemon=True,
+            args=(worker.index, self.model_path, self.optimized, worker.cores, worker.ring.name, self.slots,
+                  self.slot_bytes, child_conn, self.engine_options, self.weights,
+                  self.cache_dir))
+        process.start()
+        child_conn.close()
+
+        if not parent_conn.poll(self.start_timeout):
+            process.kill()
+            raise RuntimeError(f"Inference worker {worker.index} did not start in {self.start_timeout}s")
+        try:
+            _, _, sessions = parent_conn.recv()
+        except EOFError:
+            raise RuntimeError(f"Inference worker {worker.index} failed to load {self.model_path}")
+
+        free_slots = queue.Queue()
+        for slot in range(self.slots):
+            free_slots.put(slot)
+
+        with worker.lock:
+            worker.process = process
+            worker.conn = parent_conn
+            worker.free_slots = free_slots
+            worker.generation += 1
+            worker.sequences = 0
+            worker.sessions = sessions
+            worker.healthy = True
+        threading.Thread(target=self.read, args=(worker, parent_conn, worker.generation),
+                         name=f"pool-reader-{worker.index}", daemon=True).start()
+
+    def read(self, worker: PoolWorker, conn, generation: int):
+        """Resolve the calls of one worker incarnation until its pipe closes"""
+        while True:
+            try:
+                call_id, status, value = conn.recv()
+            except (EOFError, OSError):
+                break
+            future = worker.pending.pop(call_id, None)
+            if future is None:
+                continue
+            if status == "ok":
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+        if worker.generation == generation and not self.closed:
+            self.restart(worker, "pipe closed", generation)
+
+    def restart(self, worker: PoolWorker, reason: str, generation: Optional[int] = None):
+        """
+        Replace a dead or stuck worker, failing whatever it was doing
+
+        With a generation, only that incarnation is restarted: a later one already
+        replaced it.
+        """
+        with self.lock:
+            with worker.lock:
+                if self.closed or not worker.healthy:
+                    return
+                if generation is not None and worker.generation != generation:
+                    return
+                worker.healthy = False
+                pending, worker.pending = worker.pending, {}
+            logger.warning(f"Restarting inference worker {worker.index} (pid {worker.process.pid}): {reason}")
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.process.join(timeout=5)
+            worker.conn.close()
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(WorkerCrashed(f"Inference worker {worker.index} {reason}"))
+            worker.restarts += 1
+            try:
+                self.spawn(worker)
+            except Exception as e:
+                logger.error(f"Inference worker {worker.index} could not be restarted: {e}")
+
+    def watch(self):
+        """Health checks: restart workers that exited or don't answer pings"""
+        while not self.closed:
+            time.sleep(self.health_interval)
+            for worker in self.workers:
+                if self.closed:
+                    return
+                if not worker.healthy:
+                    # A failed restart is retried on the next round
+                    with self.lock:
+                        if not self.closed and worker.process is not None and not worker.healthy:
+                            try:
+                                self.spawn(worker)
+                            except Exception as e:
+                                logger.error(f"Inference worker {worker.index} could not be restarted: {e}")
+                    continue
+                if not worker.process.is_alive():
+                    self.restart(worker, f"exited with code {worker.process.exitcode}")
+                    continue
+                generation = worker.generation
+                try:
+                    self.call(worker, generation, "ping", None, None).result(timeout=self.ping_timeout)
+                except WorkerCrashed:
+                    pass
+                except Exception as e:
+                    self.restart(worker, f"failed health check ({type(e).__name__})", generation)
+
+    def call(self, worker: PoolWorker, generation: int, op: str, slot: Optional[int], args) -> Future:
+        """Send one request to an incarnation of a worker"""
+        future = Future()
+        call_id = next(self.call_ids)
+        # Registered under the worker lock, so a concurrent restart either fails
+        # this future with the others or is seen here and refused
+        with worker.lock:
+            current = worker.healthy and worker.generation == generation
+            if current:
+                worker.pending[call_id] = future
+        if not current:
+            future.set_exception(WorkerCrashed(f"Inference worker {worker.index} was restarted"))
+            return future
+        try:
+            with worker.send_lock:
+                worker.conn.send((op, call_id, slot, args))
+        except (OSError, ValueError) as e:
+            with worker.lock:
+                worker.pending.pop(call_id, None)
+            if not future.done():
+                future.set_exception(WorkerCrashed(f"Inference worker {worker.index} unreachable: {e}"))
+        worker.calls += 1
+        return future
+
+    def least_loaded(self) -> PoolWorker:
+        """Healthy worker with the least work"""
+        healthy = [worker for worker in self.workers if worker.healthy]
+        if not healthy:
+            raise WorkerCrashed("No healthy inference worker")
+        return min(healthy, key=lambda worker: (worker.load, worker.calls))
+
+    def run(self, worker: PoolWorker, generation: int, op: str, inputs: List[np.ndarray], args) -> np.ndarray:
+        """Write inputs into a free slot, run the call and copy the logits out"""
+        if worker.generation != generation:
+            raise WorkerCrashed(f"Inference worker {worker.index} was restarted")
+        slot_queue = worker.free_slots
+        slot = slot_queue.get()
+        try:
+            if worker.generation != generation:
+                raise WorkerCrashed(f"Inference worker {worker.index} was restarted")
+            offset = 0
+            for array in inputs:
+                worker.ring.view(slot, array.shape, array.dtype, offset)[...] = array
+                offset += array.nbytes
+            future = self.call(worker, generation, op, slot, args)
+            try:
+                shape = future.result(timeout=self.call_timeout)
+            except FutureTimeout:
+                self.restart(worker, f"{op} call timed out after {self.call_timeout}s", generation)
+                raise WorkerCrashed(f"Inference worker {worker.index} did not answer in {self.call_timeout}s")
+            return np.array(worker.ring.view(slot, shape, np.float32))
+        finally:
+            slot_queue.put(slot)
+
+    def start_sequence(self, input_ids: np.ndarray, attention_mask: np.ndarray,
+                       max_new_tokens: int) -> Tuple[Tuple[PoolWorker, int, int], np.ndarray]:
+        """
+        Prefill a prompt batch on the least-loaded worker
+
+        Returns:
+            (handle, logits); the handle routes later steps to the same worker
+        """
+        if not self.started:
+            self.start()
+        worker = self.least_loaded()
+        generation = worker.generation
+        sequence = next(self.sequence_ids)
+        worker.sequences += 1
+        try:
+            logits = self.run(worker, generation, "start", [input_ids, attention_mask],
+                              (sequence, input_ids.shape, max_new_tokens))
+        except Exception:
+            self.release((worker, generation, sequence))
+            raise
+        return (worker, generation, sequence), logits
+
+    def step(self, handle: Tuple[PoolWorker, int, int], tokens: np.ndarray) -> np.ndarray:
+        """One incremental forward pass of a started sequence"""
+        worker, generation, sequence = handle
+        return self.run(worker, generation, "step", [tokens], (sequence, tokens.shape))
+
+    def release(self, handle: Tuple[PoolWorker, int, int]):
+        """Drop a sequence's state on its worker"""
+        worker, generation, sequence = handle
+        if worker.generation != generation or self.closed:
+            return
+        worker.sequences = max(worker.sequences - 1, 0)
+        try:
+            with worker.send_lock:
+                worker.conn.send(("release", None, None, sequence))
+        except (OSError, ValueError):
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-worker liveness, load, restart counts and session memory as of the worker's start"""
+        return {
+            "workers": [{
+                "index": worker.index,
+                "pid": worker.process.pid if worker.process is not None else None,
+                "healthy": worker.healthy,
+                "cores": worker.cores,
+                "sequences": worker.sequences,
+                "in_flight": len(worker.pending),
+                "calls": worker.calls,
+                "restarts": worker.restarts,
+                "sessions": worker.sessions
+            } for worker in self.workers],
+            "started": self.started
+        }
+
+    def close(self):
+        """Stop the workers and free the shared memory"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                with worker.send_lock:
+                    worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.conn.close()
+            worker.ring.close()
+
+
+class RemoteState:
+    """
+    Front-side view of a sequence decoded in a pool worker
+
+    Mirrors the token history so samplers can read input_ids/attention_mask like on a
+    DecodeState; the worker-side state is released when this object goes away.
+    """
+
+    __slots__ = ("batch_size", "capacity", "length", "input_ids", "attention_mask",
+                 "handle", "__weakref__")
+
+    def __init__(self, batch_size: int, capacity: int):
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.length = 0
+        self.input_ids = np.zeros((batch_size, capacity), dtype=np.int64)
+        self.attention_mask = np.zeros((batch_size, capacity), dtype=np.int64)
+        self.handle = None
+
+
+class PooledEngine(TokenDecoder):
+    """
+    Decoder whose forward passes run in an InferencePool
+
+    start() and step() go to the workers, so iter_tokens(), generate() and token
+    selection work as with a local GenerationEngine. The KV cache stays in the worker
+    holding the sequence, so there is no snapshot() or repack(): the service keeps
+    micro-batching, prompt prefixes and the conversation cache off with a pool.
+    """
+
+    def __init__(self, pool: InferencePool, eos_token_id: int, pad_token_id: Optional[int] = None,
+                 max_length: int = 2048):
+        super().__init__(eos_token_id, pad_token_id, max_length)
+        self.pool = pool
+
+    def start(self, input_ids: np.ndarray, attention_mask: Optional[np.ndarray] = None,
+              max_new_tokens: int = 0, prefix=None) -> Tuple[RemoteState, np.ndarray]:
+        """Prefill on the least-loaded worker (KV prefixes live in-process, so prefix is ignored)"""
+        input_ids = np.ascontiguousarray(input_ids, dtype=np.int64)
+        if attention_mask is None:
+            attention_mask = np.ones_like(input_ids)
+        attention_mask = np.ascontiguousarray(attention_mask, dtype=np.int64)
+        batch_size, prompt_length = input_ids.shape
+
+        capacity = min(prompt_length + max_new_tokens, self.max_length) if max_new_tokens else prompt_length
+        state = RemoteState(batch_size, max(capacity, prompt_length))
+        state.input_ids[:, :prompt_length] = input_ids
+        state.attention_mask[:, :prompt_length] = attention_mask
+        state.length = prompt_length
+
+        state.handle, logits = self.pool.start_sequence(input_ids, attention_mask, max_new_tokens)
+        weakref.finalize(state, self.pool.release, state.handle)
+        return state, logits
+
+    def step(self, state: RemoteState, tokens: np.ndarray) -> np.ndarray:
+        """One incremental pass on the sequence's worker"""
+        tokens = np.asarray(tokens, dtype=np.int64)
+        if tokens.ndim == 1:
+            tokens = tokens[:, None]
+        end = state.length + tokens.shape[1]
+        if end > state.capacity:
+            raise ValueError(f"Sequence length {end} exceeds state capacity {state.capacity}")
+        logits = self.pool.step(state.handle, np.ascontiguousarray(tokens))
+        state.input_ids[:, state.length:end] = tokens
+        state.attention_mask[:, state.length:end] = 1
+        state.length = end
+        return logits
@@ -0,0 +1,382 @@
+"""
+Knowledge base indexes for the lightweight AI service
+Compiles keywords into a multi-pattern automaton so a message is matched in one pass,
+and the entry texts into a BM25 index for ranked retrieval
+"""
+
+import math
+import re
+import time
+from collections import deque, Counter
+from typing import List, Dict, Any, Optional, Tuple, Callable, Iterator
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'\w\w+')
+
+# Term frequency multipliers per entry field (a cheap BM25F)
+FIELD_WEIGHTS = {
+    "question": 2.0,
+    "keywords": 2.0,
+    "answer": 1.0
+}
+
+
+def top_entries(confidence: np.ndarray, top_k: int) -> np.ndarray:
+    """Ids of the top_k positive entries, best first (ties broken by entry order)"""
+    candidates = np.flatnonzero(confidence > 0)
+    if len(candidates) > top_k:
+        best = np.argpartition(-confidence[candidates], top_k - 1)[:top_k]
+        candidates = candidates[best]
+    return candidates[np.lexsort((candidates, -confidence[candidates]))]
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over a fixed set of keywords
+    Finds every keyword occurrence in O(len(text) + matches)
+    """
+
+    def __init__(self, patterns: List[str]):
+        """
+        Build the automaton
+
+        Args:
+            patterns: Normalized keywords, indexed by position
+        """
+        self.patterns = patterns
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Tuple[int, ...]] = [()]
+
+        for pattern_id, pattern in enumerate(patterns):
+            if pattern:
+                self._add_pattern(pattern, pattern_id)
+        self._build_failure_links()
+
+    def _add_pattern(self, pattern: str, pattern_id: int):
+        """Insert a pattern into the trie"""
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+            state = next_state
+        self.output[state] += (pattern_id,)
+
+    def _build_failure_links(self):
+        """Compute failure links breadth-first and merge output sets"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def find(self, text: str) -> Iterator[Tuple[int, int]]:
+        """
+        Scan text once and yield every match
+
+        Yields:
+            (end_position, pattern_id) pairs, end_position being exclusive
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern_id in output[state]:
+                yield position + 1, pattern_id
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a fixed document set
+    Per-posting term weights are precomputed at build time into CSR arrays,
+    so scoring a query is a single weighted bincount
+    """
+
+    def __init__(self, documents: List[Counter], k1: float = 1.2, b: float = 0.75):
+        """
+        Build the index
+
+        Args:
+            documents: Weighted term frequencies per document
+            k1: Term frequency saturation
+            b: Document length normalization
+        """
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(documents)
+
+        postings: Dict[str, List[Tuple[int, float]]] = {}
+        doc_lengths = np.zeros(self.num_docs, dtype=np.float32)
+        for doc_id, terms in enumerate(documents):
+            doc_lengths[doc_id] = sum(terms.values())
+            for term, tf in terms.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+
+        self.vocabulary: Dict[str, int] = {term: i for i, term in enumerate(postings)}
+        self.offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        self.doc_ids = np.empty(sum(len(p) for p in postings.values()), dtype=np.int32)
+        self.weights = np.empty(len(self.doc_ids), dtype=np.float32)
+        self.idf = np.empty(len(postings), dtype=np.float32)
+
+        avg_length = float(doc_lengths.mean()) if self.num_docs else 0.0
+        length_norm = k1 * (1.0 - b + b * doc_lengths / max(avg_length, 1e-6))
+
+        position = 0
+        for term_id, entries in enumerate(postings.values()):
+            docs = np.fromiter((doc_id for doc_id, _ in entries), dtype=np.int32, count=len(entries))
+            tfs = np.fromiter((tf for _, tf in entries), dtype=np.float32, count=len(entries))
+            idf = self.compute_idf(len(entries))
+            self.idf[term_id] = idf
+            end = position + len(entries)
+            self.doc_ids[position:end] = docs
+            self.weights[position:end] = idf * tfs * (k1 + 1.0) / (tfs + length_norm[docs])
+            self.offsets[term_id + 1] = end
+            position = end
+
+    def compute_idf(self, doc_freq: int) -> float:
+        """BM25 inverse document frequency (always positive)"""
+        return math.log(1.0 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def reference_score(self) -> float:
+        """Maximum score of a query made of a single term unique to one document"""
+        return self.compute_idf(1) * (self.k1 + 1.0)
+
+    def score(self, query_terms: List[str]) -> Tuple[np.ndarray, float]:
+        """
+        Score every document against the query
+
+        Returns:
+            (scores, max_score) where max_score is the score a document would get
+            if it saturated every query term, used to calibrate confidence
+        """
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        max_score = 0.0
+        slices = []
+        for term in set(query_terms):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                max_score += self.compute_idf(0) * (self.k1 + 1.0)
+                continue
+            max_score += float(self.idf[term_id]) * (self.k1 + 1.0)
+            slices.append((self.offsets[term_id], self.offsets[term_id + 1]))
+
+        if slices and self.num_docs:
+            docs = np.concatenate([self.doc_ids[start:end] for start, end in slices])
+            weights = np.concatenate([self.weights[start:end] for start, end in slices])
+            scores = np.bincount(docs, weights=weights, minlength=self.num_docs).astype(np.float32)
+        return scores, max_score
+
+
+class KnowledgeIndex:
+    """
+    Compiled, read-only view of the knowledge base
+    Holds the flattened entries, a keyword automaton and a keyword -> entries inverted index
+    """
+
+    def __init__(self, knowledge_base: Dict[str, List[Dict[str, Any]]],
+                 normalize: Callable[[str], str],
+                 k1: float = 1.2, b: float = 0.75,
+                 previous: Optional["KnowledgeIndex"] = None):
+        """
+        Compile the knowledge base
+
+        Args:
+            knowledge_base: Mapping of category to list of entries
+            normalize: Text normalization applied to keywords and messages alike
+            k1: BM25 term frequency saturation
+            b: BM25 document length normalization
+            previous: Index of an earlier version; entry objects it already holds reuse
+                its analysis instead of being normalized and tokenized again
+        """
+        self.normalize = normalize
+        self.entries: List[Tuple[str, Dict[str, Any]]] = []
+        self.keyword_index: Dict[str, List[int]] = {}
+        self.documents: List[Counter] = []
+        self.entry_keywords: List[List[str]] = []
+        self.reused = 0
+        # Identity lookup is safe: the previous index keeps its entry objects alive
+        previous_ids = ({id(entry): i for i, (_, entry) in enumerate(previous.entries)}
+                        if previous is not None else {})
+
+        for category, entries in knowledge_base.items():
+            for entry in entries:
+                entry_id = len(self.entries)
+                self.entries.append((category, entry))
+
+                index = previous_ids.get(id(entry))
+                if index is not None and previous.entries[index][1] is entry:
+                    terms, keywords = previous.documents[index], previous.entry_keywords[index]
+                    self.reused += 1
+                else:
+                    terms = self.analyze_entry(entry)
+                    keywords = [keyword for keyword in map(normalize, entry.get('keywords', [])) if keyword]
+                self.documents.append(terms)
+                self.entry_keywords.append(keywords)
+
+                for keyword in keywords:
+                    postings = self.keyword_index.setdefault(keyword, [])
+                    if not postings or postings[-1] != entry_id:
+                        postings.append(entry_id)
+
+        self.keywords = list(self.keyword_index)
+        self.automaton = KeywordAutomaton(self.keywords)
+        self.bm25 = BM25Index(self.documents, k1=k1, b=b)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def analyze(self, text: str, normalized: bool = False) -> List[str]:
+        """Split text into index terms using the shared normalization"""
+        return TOKEN_PATTERN.findall(text if normalized else self.normalize(text))
+
+    def analyze_entry(self, entry: Dict[str, Any]) -> Counter:
+        """Weighted term frequencies of an entry over both languages"""
+        terms = Counter()
+        fields = {
+            "question": [entry.get("question_fr", ""), entry.get("question_ar", "")],
+            "answer": [entry.get("answer_fr", ""), entry.get("answer_ar", "")],
+            "keywords": entry.get("keywords", [])
+        }
+        for field, texts in fields.items():
+            weight = FIELD_WEIGHTS[field]
+            for text in texts:
+                for term in self.analyze(text or ""):
+                    terms[term] += weight
+        return terms
+
+    def score_entries(self, text: str,
+                      keyword_weight: float = 0.5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Score every entry against the (already normalized) text
+
+        Args:
+            text: Normalized message
+            keyword_weight: How much full keyword coverage lifts confidence
+
+        Returns:
+            (scores, confidence) arrays over all entries. The confidence is the BM25
+            score relative to the query's maximum attainable score, damped for queries
+            carrying less information than one distinctive term (e.g. "comment"),
+            then lifted by the keyword coverage of the entry
+        """
+        scores, max_score = self.bm25.score(self.analyze(text, normalized=True) if text else [])
+        if max_score <= 0:
+            return scores, np.zeros_like(scores)
+        confidence = scores / max_score
+        confidence *= min(1.0, max_score / self.bm25.reference_score())
+        np.minimum(confidence, 1.0, out=confidence)
+
+        for entry_id, coverage in self.match_keywords(text):
+            confidence[entry_id] += (1.0 - confidence[entry_id]) * keyword_weight * coverage
+        return scores, confidence
+
+    def search(self, text: str, top_k: int = 3,
+               keyword_weight: float = 0.5) -> List[Tuple[int, float, float]]:
+        """
+        Rank entries against the (already normalized) text
+
+        Returns:
+            (entry_id, score, confidence) triples sorted best first
+        """
+        if not text or not self.entries:
+            return []
+        scores, confidence = self.score_entries(text, keyword_weight)
+        return [(int(i), float(scores[i]), float(confidence[i]))
+                for i in top_entries(confidence, top_k)]
+
+    def match_keywords(self, text: str) -> List[Tuple[int, float]]:
+        """
+        Find all entries whose keywords occur in the (already normalized) text
+
+        Returns:
+            (entry_id, coverage) pairs sorted best first, coverage being the
+            fraction of the text covered by the entry's matched keywords
+        """
+        if not text or not self.keywords:
+            return []
+
+        spans: Dict[int, List[Tuple[int, int]]] = {}
+        for end, keyword_id in self.automaton.find(text):
+            start = end - len(self.keywords[keyword_id])
+            for entry_id in self.keyword_index[self.keywords[keyword_id]]:
+                spans.setdefault(entry_id, []).append((start, end))
+
+        ranked = []
+        for entry_id, entry_spans in spans.items():
+            covered = 0
+            current_start, current_end = -1, -1
+            for start, end in sorted(entry_spans):
+                if start > current_end:
+                    covered += current_end - current_start
+                    current_start, current_end = start, end
+                elif end > current_end:
+                    current_end = end
+            covered += current_end - current_start
+            ranked.append((entry_id, covered / len(text), len(entry_spans)))
+
+        ranked.sort(key=lambda item: (-item[1], -item[2], item[0]))
+        return [(entry_id, coverage) for entry_id, coverage, _ in ranked]
+
+
+class KnowledgeSnapshot:
+    """
+    One version of the knowledge base with everything derived from it
+
+    The entries and indexes are never modified once built. A reload builds a new
+    snapshot and swaps the reference; requests that already took the previous one
+    finish on it.
+    """
+
+    __slots__ = ("knowledge_base", "index", "embeddings", "fingerprint", "signature",
+                 "loaded_at", "generation", "source_sync")
+
+    def __init__(self, knowledge_base: Dict[str, List[Any]], index: KnowledgeIndex,
+                 embeddings: Any, fingerprint: str, signature: Any, generation: int,
+                 source_sync: Any = None):
+        """
+        Args:
+            knowledge_base: Entries grouped by category
+            index: Lexical index over the entries
+            embeddings: Dense EmbeddingIndex, or None
+            fingerprint: Content digest of the entries
+            signature: State of the source (file stats) the snapshot was read from
+            generation: Reload counter, 1 for the startup snapshot
+            source_sync: Source changes the snapshot was built from (a FaqSync), to be
+                committed to the source once the snapshot is served
+        """
+        self.knowledge_base = knowledge_base
+        self.index = index
+        self.embeddings = embeddings
+        self.fingerprint = fingerprint
+        self.signature = signature
+        self.loaded_at = time.time()
+        self.generation = generation
+        self.source_sync = source_sync
+
+    def changed_categories(self, previous: Optional["KnowledgeSnapshot"]) -> List[str]:
+        """
+        Categories whose entries differ from the previous snapshot
+
+        Unchanged entries are carried over as the same objects, so comparing
+        identities is enough.
+        """
+        if previous is None:
+            return sorted(self.knowledge_base)
+        categories = set(self.knowledge_base) | set(previous.knowledge_base)
+        return sorted(category for category in categories
+                      if [id(entry) for entry in self.knowledge_base.get(category, [])] !=
+                      [id(entry) for entry in previous.knowledge_base.get(category, [])])
@@ -0,0 +1,457 @@
+"""
+Lightweight instrumentation for the AI model service
+Monotonic-clock spans feeding log-linear latency histograms, labelled counters, and
+Prometheus text exposition merged across gunicorn workers
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Iterator, Tuple, Callable
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Metric name prefix
+NAMESPACE = "moussadar_ai"
+
+# Bucket bounds (seconds) of the exported Prometheus histograms
+EXPORT_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+EXPORT_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class LatencyHistogram:
+    """
+    Log-linear (HDR-style) histogram of durations in microseconds
+
+    Values below 2**sub_bucket_bits get a bucket each; above that every power of two
+    is split into 2**(sub_bucket_bits - 1) equal buckets, so any recorded value is
+    known within 2 / 2**sub_bucket_bits of itself (3% with the default 6 bits).
+    Recording is a bit_length and a dict increment; histograms from different
+    processes merge exactly by adding counts.
+    """
+
+    def __init__(self, sub_bucket_bits: int = 6):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.half_count = self.sub_bucket_count >> 1
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0
+
+    def index(self, value: int) -> int:
+        """Bucket of a value in microseconds"""
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self.half_count + (value >> shift) - self.half_count
+
+    def bounds(self, index: int) -> Tuple[int, int]:
+        """[lower, upper) microseconds of a bucket"""
+        if index < self.sub_bucket_count:
+            return index, index + 1
+        shift = (index - self.sub_bucket_count) // self.half_count + 1
+        mantissa = (index - self.sub_bucket_count) % self.half_count + self.half_count
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def record(self, seconds: float):
+        """Add one duration"""
+        value = max(int(seconds * 1e6), 0)
+        index = self.index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "LatencyHistogram"):
+        """Add another histogram's counts to this one"""
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """Value (seconds) below which a fraction q of the recorded durations fall"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                lower, upper = self.bounds(index)
+                return min((lower + upper) / 2, self.max) / 1e6
+        return self.max / 1e6
+
+    def cumulative(self, bounds_seconds: Tuple[float, ...]) -> List[int]:
+        """Counts at or below each bound, bucket-attributed by upper bound"""
+        ordered = sorted(self.counts.items())
+        result = []
+        position, seen = 0, 0
+        for bound in bounds_seconds:
+            limit = bound * 1e6
+            while position < len(ordered) and self.bounds(ordered[position][0])[1] <= limit:
+                seen += ordered[position][1]
+                position += 1
+            result.append(seen)
+        return result
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"counts": self.counts, "count": self.count, "total": self.total, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], sub_bucket_bits: int = 6) -> "LatencyHistogram":
+        histogram = cls(sub_bucket_bits)
+        histogram.counts = {int(index): count for index, count in data["counts"].items()}
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.max = data["max"]
+        return histogram
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler that keeps the stacks of slow requests only
+
+    While enabled, a thread samples the stacks of the request threads in flight every
+    interval. When a request ends under the threshold its samples are dropped;
+    otherwise they are written as collapsed stacks ("frame;frame;frame count" lines,
+    the input of flamegraph.pl and speedscope). Work handed to other threads (batch
+    scheduler, inference pool) shows up as the request thread waiting.
+    """
+
+    def __init__(self, slow_seconds: float, interval: float = 0.01,
+                 directory: str = "cache/profiles", keep: int = 20):
+        """
+        Initialize the profiler
+
+        Args:
+            slow_seconds: Requests at least this long are kept
+            interval: Seconds between samples
+            directory: Where profiles are written
+            keep: Newest profiles kept in the directory
+        """
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.directory = directory
+        self.keep = keep
+        self.active: Dict[int, Counter] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.written = 0
+
+    def start(self):
+        """Start the sampling thread"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.sample, name="slow-request-profiler", daemon=True)
+        self.thread.start()
+
+    def reset(self):
+        """Forget the state inherited through fork (the sampler thread did not survive it)"""
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def begin(self):
+        """Start collecting samples for the calling thread's request"""
+        with self.lock:
+            self.active[threading.get_ident()] = Counter()
+
+    def end(self, elapsed: float, label: str) -> Optional[str]:
+        """
+        Stop collecting for the calling thread
+
+        Returns:
+            Path of the written profile if the request was slow
+        """
+        with self.lock:
+            samples = self.active.pop(threading.get_ident(), None)
+        if not samples or elapsed < self.slow_seconds:
+            return None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+                                                f"-{int(elapsed * 1000)}ms-{label}.folded")
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            self.written += 1
+            self.prune()
+            return path
+        except OSError as e:
+            logger.warning(f"Could not write slow request profile: {e}")
+            return None
+
+    def prune(self):
+        """Drop the oldest profiles beyond keep"""
+        profiles = sorted(name for name in os.listdir(self.directory) if name.endswith(".folded"))
+        for name in profiles[:-self.keep]:
+            os.remove(os.path.join(self.directory, name))
+
+    def sample(self):
+        """Sampling loop"""
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for ident, samples in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    samples[";".join(reversed(stack))] += 1
+
+
+class Metrics:
+    """
+    Per-process histograms and counters
+
+    With a directory, each process writes its snapshot there every flush_interval;
+    render() merges the live processes' snapshots so any gunicorn worker answering the
+    scrape reports the whole service. Histograms merge exactly; counters of a worker
+    that exits disappear with it (seen by Prometheus as a counter reset).
+    """
+
+    def __init__(self, enabled: bool = True, directory: Optional[str] = None,
+                 flush_interval: float = 5.0, gauges: Optional[Callable[[], Dict[str, float]]] = None):
+        """
+        Initialize the metrics
+
+        Args:
+            enabled: False turns every recording call into a no-op
+            directory: Where per-process snapshots are shared (None for this process only)
+            flush_interval: Seconds between snapshot writes
+            gauges: Returns this process's point-in-time values (memory, threads, caches)
+        """
+        self.enabled = enabled
+        self.gauges = gauges
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.counters: Dict[Tuple[str, str], float] = {}
+        self.lock = threading.Lock()
+        self.flush_thread = None
+        self.running = False
+
+    def observe(self, stage: str, seconds: float):
+        """Record a duration for a stage"""
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.record(seconds)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """Time a block on the monotonic clock"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name: str, value: float = 1, **labels: str):
+        """Increment a counter, e.g. count("responses", source="knowledge_base")"""
+        if not self.enabled:
+            return
+        key = (name, ",".join(f'{label}="{labels[label]}"' for label in sorted(labels)))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self):
+        """
+        Start from zero in a forked worker
+
+        The master's numbers are its own; the lock and the flush thread do not
+        survive fork either.
+        """
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.flush_thread = None
+        self.running = False
+
+    def start(self):
+        """Start sharing this process's snapshot with the other workers"""
+        if not self.enabled or not self.directory or self.running:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"Metrics directory unavailable, reporting this worker only: {e}")
+            return
+        self.running = True
+        self.flush_thread = threading.Thread(target=self.flush_loop, name="metrics-flush", daemon=True)
+        self.flush_thread.start()
+
+    def close(self):
+        """Stop sharing and remove this process's snapshot"""
+        if not self.running:
+            return
+        self.running = False
+        try:
+            os.remove(self.snapshot_path(os.getpid()))
+        except OSError:
+            pass
+
+    def snapshot_path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """This process's numbers as plain data"""
+        gauges = self.gauges() if self.gauges is not None else {}
+        with self.lock:
+            histograms = {stage: histogram.to_dict() for stage, histogram in self.histograms.items()}
+            counters = [[name, label, value] for (name, label), value in self.counters.items()]
+        return {"pid": os.getpid(), "histograms": histograms, "counters": counters, "gauges": gauges}
+
+    def flush(self):
+        """Write this process's snapshot for the other workers"""
+        path = self.snapshot_path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def flush_loop(self):
+        while self.running:
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f"Failed to share metrics snapshot: {e}")
+            time.sleep(self.flush_interval)
+
+    def collect(self) -> List[Dict[str, Any]]:
+        """This process's snapshot plus those of the other live workers"""
+        snapshots = [self.snapshot()]
+        if not self.running:
+            return snapshots
+        pid = os.getpid()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json") or name == f"{pid}.json":
+                continue
+            other = int(name[:-5])
+            try:
+                os.kill(other, 0)
+            except ProcessLookupError:
+                # Exited worker
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self) -> str:
+        """Prometheus text exposition of the whole service"""
+        return render_prometheus(self.collect())
+
+
+def render_prometheus(snapshots: List[Dict[str, Any]]) -> str:
+    """
+    Merge process snapshots into Prometheus text format
+
+    Durations become one histogram family plus quantile gauges computed from the
+    merged log-linear histograms; counters are summed; gauges keep a pid label.
+    """
+    histograms: Dict[str, LatencyHistogram] = {}
+    counters: Dict[Tuple[str, str], float] = {}
+    for snapshot in snapshots:
+        for stage, data in snapshot["histograms"].items():
+            histogram = LatencyHistogram.from_dict(data)
+            if stage in histograms:
+                histograms[stage].merge(histogram)
+            else:
+                histograms[stage] = histogram
+        for name, label, value in snapshot["counters"]:
+            counters[(name, label)] = counters.get((name, label), 0) + value
+
+    lines = []
+    family = f"{NAMESPACE}_stage_duration_seconds"
+    lines.append(f"# HELP {family} Time spent per request stage")
+    lines.append(f"# TYPE {family} histogram")
+    for stage in sorted(histograms):
+        histogram = histograms[stage]
+        for bound, count in zip(EXPORT_BOUNDS, histogram.cumulative(EXPORT_BOUNDS)):
+            lines.append(f'{family}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'{family}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+        lines.append(f'{family}_sum{{stage="{stage}"}} {histogram.total:.6f}')
+        lines.append(f'{family}_count{{stage="{stage}"}} {histogram.count}')
+
+    family = f"{NAMESPACE}_stage_duration_quantile_seconds"
+    lines.append(f"# HELP {family} Stage duration quantiles from the merged high-resolution histograms")
+    lines.append(f"# TYPE {family} gauge")
+    for stage in sorted(histograms):
+        for q in EXPORT_QUANTILES:
+            lines.append(f'{family}{{stage="{stage}",quantile="{q}"}} {histograms[stage].quantile(q):.6f}')
+
+    names = sorted({name for name, _ in counters})
+    for name in names:
+        family = f"{NAMESPACE}_{name}_total"
+        lines.append(f"# TYPE {family} counter")
+        for (counter, labels), value in sorted(counters.items()):
+            if counter == name:
+                lines.append(f'{family}{{{labels}}} {value:g}' if labels else f'{family} {value:g}')
+
+    gauge_names = sorted({name for snapshot in snapshots for name in snapshot["gauges"]})
+    for name in gauge_names:
+        family = f"{NAMESPACE}_{name}"
+        lines.append(f"# TYPE {family} gauge")
+        for snapshot in snapshots:
+            if name in snapshot["gauges"]:
+                lines.append(f'{family}{{pid="{snapshot["pid"]}"}} {snapshot["gauges"][name]:g}')
+
+    lines.append(f"# TYPE {NAMESPACE}_workers gauge")
+    lines.append(f"{NAMESPACE}_workers {len(snapshots)}")
+    return "\n".join(lines) + "\n"
+
+
+def process_stats() -> Dict[str, float]:
+    """Resident and peak memory and OS thread count of this process"""
+    stats = {}
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "VmRSS":
+                    stats["process_resident_bytes"] = int(value.split()[0]) * 1024
+                elif key == "VmHWM":
+                    stats["process_peak_resident_bytes"] = int(value.split()[0]) * 1024
+                elif key == "Threads":
+                    stats["process_threads"] = int(value)
+    except OSError:
+        import resource
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats["process_peak_resident_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+        stats["process_threads"] = threading.active_count()
+    return stats
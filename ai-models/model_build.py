@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Model build pipeline
+Exports the downloaded checkpoint to ONNX with a KV cache, derives INT8 and INT4
+weight-only variants, measures each against the fp32 export on this CPU and records
+the results in a manifest the service reads to pick its model
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Written next to the model files
+MANIFEST_NAME = "model_manifest.json"
+MANIFEST_VERSION = 1
+
+# Variants in build order; fp32 is the reference the others are measured against
+VARIANT_FILES = {
+    "fp32": "{stem}.onnx",
+    "int8": "{stem}-int8.onnx",
+    "int4": "{stem}-q4.onnx"
+}
+
+# Accuracy gate: mean KL divergence from fp32 (nats per token) and share of positions
+# where the variant's top token is the fp32 one
+DEFAULT_GATE = {"max_kl": 0.15, "min_top1_agreement": 0.85}
+
+# CPU features that change which quantized kernels are fastest
+CPU_FEATURES = ("avx2", "avx512f", "avx512_vnni", "avx_vnni", "amx_int8", "asimddp", "i8mm", "sve")
+
+# Fixed evaluation prompts, covering both service languages
+EVAL_PROMPTS = [
+    "Comment obtenir une carte d'identité nationale ?",
+    "Quels documents sont nécessaires pour renouveler un passeport ?",
+    "Où déposer une demande d'acte de naissance ?",
+    "Combien de temps faut-il pour obtenir un permis de conduire ?",
+    "Comment créer une entreprise individuelle en ligne ?",
+    "كيف أحصل على شهادة السكنى؟",
+    "ما هي الوثائق المطلوبة لجواز السفر؟",
+    "أين أقدم طلب السجل العدلي؟"
+]
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cpu_features() -> List[str]:
+    """Relevant instruction set extensions of this CPU (empty when unknown)"""
+    try:
+        with open("/proc/cpuinfo", 'r') as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    flags = set(line.partition(":")[2].split())
+                    return [feature for feature in CPU_FEATURES if feature in flags]
+    except OSError:
+        pass
+    return []
+
+
+def host_key() -> str:
+    """
+    Identity of the hardware/runtime combination the latencies were measured on
+
+    Variants are ranked per host: INT4 with INT8 compute wins on VNNI/AMX CPUs, plain
+    INT8 or fp32 may be faster elsewhere.
+    """
+    import onnxruntime as ort
+    return "-".join([platform.machine(), "+".join(cpu_features()) or "baseline", f"ort{ort.__version__}"])
+
+
+def export_checkpoint(checkpoint_dir: str, output_path: str, opset: int = 17) -> str:
+    """
+    Export a Hugging Face causal LM checkpoint to a single ONNX file with KV cache
+    (past_key_values.N.key/value inputs, present.N.key/value outputs)
+
+    Requires optimum[exporters] (and torch), only on the machine building models.
+    """
+    try:
+        from optimum.exporters.onnx import main_export
+    except ImportError:
+        raise RuntimeError("Exporting needs optimum: pip install 'optimum[exporters]'")
+    import onnx
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        main_export(checkpoint_dir, output=tmp_dir, task="text-generation-with-past",
+                    opset=opset, device="cpu")
+        exported = os.path.join(tmp_dir, "model.onnx")
+        if not os.path.exists(exported):
+            raise RuntimeError(f"Export produced no model.onnx in {tmp_dir}")
+        # Re-saved as one self-contained file (external data is inlined)
+        onnx.save(onnx.load(exported), output_path)
+    logger.info(f"Exported {checkpoint_dir} to {output_path}")
+    return output_path
+
+
+def quantize_int8(input_path: str, output_path: str) -> str:
+    """Dynamic INT8: per-channel INT8 MatMul weights, activations quantized at run time"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(input_path, output_path, weight_type=QuantType.QInt8, per_channel=True,
+                     op_types_to_quantize=["MatMul"], extra_options={"MatMulConstBOnly": True})
+    return output_path
+
+
+def quantize_int4(input_path: str, output_path: str, block_size: int = 32,
+                  accuracy_level: Optional[int] = 4) -> str:
+    """
+    Block-wise INT4 weight-only quantization of the MatMul weights (MatMulNBits)
+
+    Args:
+        block_size: Weights sharing one scale along the input dimension
+        accuracy_level: Compute type of the kernel (4: INT8 activations, fastest on
+            CPUs with VNNI; 0/None: fp32 compute)
+    """
+    import onnx
+    try:
+        from onnxruntime.quantization.matmul_nbits_quantizer import MatMulNBitsQuantizer as Quantizer
+    except ImportError:
+        # onnxruntime < 1.20
+        from onnxruntime.quantization.matmul_4bits_quantizer import MatMul4BitsQuantizer as Quantizer
+
+    quantizer = Quantizer(onnx.load(input_path), block_size=block_size, is_symmetric=True,
+                          accuracy_level=accuracy_level)
+    quantizer.process()
+    quantizer.model.save_model_to_file(output_path)
+    return output_path
+
+
+def create_session(path: str, threads: Optional[int] = None):
+    """Inference session configured like the service's"""
+    import onnxruntime as ort
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.intra_op_num_threads = threads or 0
+    sess_options.inter_op_num_threads = 1
+    sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return ort.InferenceSession(path, sess_options, providers=['CPUExecutionProvider'])
+
+
+def log_softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+def run_forced(engine, prompt: List[int], max_new_tokens: int,
+               forced: Optional[List[int]] = None) -> Tuple[List[int], np.ndarray, float, float]:
+    """
+    Decode a prompt, greedily or along given tokens (teacher forcing)
+
+    Every step runs whatever the tokens are, so variants are timed on exactly the
+    same work as the reference.
+
+    Returns:
+        (tokens, log-probabilities [steps, vocab], prefill seconds, decode seconds)
+    """
+    start = time.perf_counter()
+    state, logits = engine.start(np.array([prompt], dtype=np.int64), max_new_tokens=max_new_tokens)
+    prefill = time.perf_counter() - start
+    tokens, steps = [], []
+    start = time.perf_counter()
+    for i in range(max_new_tokens):
+        steps.append(logits[0].astype(np.float32))
+        token = forced[i] if forced is not None else int(np.argmax(logits[0]))
+        tokens.append(token)
+        if i + 1 < max_new_tokens:
+            logits = engine.step(state, np.array([token], dtype=np.int64))
+    decode = time.perf_counter() - start
+    return tokens, log_softmax(np.stack(steps)), prefill, decode
+
+
+def evaluate(models_dir: str, manifest: Dict[str, Any], prompts: List[str] = EVAL_PROMPTS,
+             max_new_tokens: int = 32, threads: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Measure every variant against fp32 on this host
+
+    The fp32 model decodes each prompt greedily; the variants are run along the same
+    tokens, which gives their per-position distributions (KL divergence, top-1
+    agreement) and per-token latency on identical work.
+
+    Returns:
+        Evaluation record for manifest["evaluations"][host_key()]
+    """
+    import onnxruntime as ort
+    from generation import GenerationEngine
+    from tokenizer import load_tokenizer
+
+    tokenizer = load_tokenizer(models_dir)
+    encoded = [tokenizer.encode(prompt) for prompt in prompts]
+    gate = manifest["gate"]
+
+    def engine_for(variant):
+        session = create_session(os.path.join(models_dir, manifest["variants"][variant]["path"]), threads)
+        return GenerationEngine(session, eos_token_id=tokenizer.eos_token_id,
+                                pad_token_id=tokenizer.pad_token_id)
+
+    reference = []
+    engine = engine_for("fp32")
+    # One untimed pass so first-run allocations don't count against the reference
+    run_forced(engine, encoded[0], 2)
+    for prompt in encoded:
+        reference.append(run_forced(engine, prompt, max_new_tokens))
+
+    results = {}
+    for variant in manifest["variants"]:
+        if variant == "fp32":
+            _, _, prefill, decode = zip(*reference)
+            kl, agreement = 0.0, 1.0
+        else:
+            engine = engine_for(variant)
+            run_forced(engine, encoded[0], 2)
+            prefill, decode, kl_values, agreements = [], [], [], []
+            for prompt, (tokens, ref_logprobs, _, _) in zip(encoded, reference):
+                _, logprobs, prompt_time, decode_time = run_forced(engine, prompt, max_new_tokens, tokens)
+                prefill.append(prompt_time)
+                decode.append(decode_time)
+                kl_values.append(float((np.exp(ref_logprobs) * (ref_logprobs - logprobs)).sum(axis=-1).mean()))
+                agreements.append(float((logprobs.argmax(axis=-1) == ref_logprobs.argmax(axis=-1)).mean()))
+            kl, agreement = float(np.mean(kl_values)), float(np.mean(agreements))
+
+        steps = max(max_new_tokens - 1, 1)
+        results[variant] = {
+            "prefill_ms": round(1000 * float(np.median(prefill)), 3),
+            "ms_per_token": round(1000 * float(np.median(decode)) / steps, 3),
+            "kl": round(kl, 5),
+            "top1_agreement": round(agreement, 4),
+            "passed": kl <= gate["max_kl"] and agreement >= gate["min_top1_agreement"]
+        }
+        logger.info(f"{variant}: {results[variant]}")
+
+    passing = [variant for variant, result in results.items() if result["passed"]]
+    return {
+        "evaluated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"machine": platform.machine(), "cpu_features": cpu_features(),
+                 "cpu_count": os.cpu_count(), "onnxruntime": ort.__version__},
+        "threads": threads,
+        "prompts": len(prompts),
+        "max_new_tokens": max_new_tokens,
+        "results": results,
+        "selected": min(passing, key=lambda variant: results[variant]["ms_per_token"]) if passing else "fp32"
+    }
+
+
+def load_manifest(path: str) -> Optional[Dict[str, Any]]:
+    """Read a build manifest (None if missing or unreadable)"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable model manifest {path}: {e}")
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        logger.warning(f"Ignoring model manifest {path} of unknown version {manifest.get('version')}")
+        return None
+    return manifest
+
+
+def save_manifest(manifest: Dict[str, Any], path: str):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def select_variant(manifest: Dict[str, Any], host: str, variant: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Variant the service should load
+
+    A forced variant wins. Otherwise the choice made by this host's evaluation; a host
+    that was never evaluated gets the smallest variant that passed the accuracy gate
+    elsewhere (accuracy doesn't depend on the CPU, speed does).
+
+    Returns:
+        (variant name, reason)
+    """
+    variants = manifest["variants"]
+    if variant:
+        if variant not in variants:
+            raise ValueError(f"Model variant {variant!r} is not in the manifest ({', '.join(variants)})")
+        return variant, "configured"
+
+    evaluation = manifest.get("evaluations", {}).get(host)
+    if evaluation and evaluation["selected"] in variants:
+        return evaluation["selected"], f"fastest passing on {host}"
+
+    passing = {name for evaluation in manifest.get("evaluations", {}).values()
+               for name, result in evaluation["results"].items() if result["passed"] and name in variants}
+    if passing:
+        return min(passing, key=lambda name: variants[name]["size_bytes"]), "smallest passing (host not evaluated)"
+    return "fp32", "no evaluation"
+
+
+def build(models_dir: str, stem: str, checkpoint_dir: Optional[str] = None, source: Optional[str] = None,
+          block_size: int = 32, accuracy_level: Optional[int] = 4, gate: Optional[Dict[str, float]] = None,
+          evaluate_now: bool = True, threads: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Produce the fp32, INT8 and INT4 variants and their manifest
+
+    Args:
+        models_dir: Output directory (also where the service finds the manifest)
+        stem: File name stem of the variants
+        checkpoint_dir: Hugging Face checkpoint to export
+        source: Existing fp32 ONNX model to start from instead of exporting
+        block_size, accuracy_level: INT4 settings (see quantize_int4)
+        gate: Accuracy gate (DEFAULT_GATE)
+        evaluate_now: Also evaluate the variants on this host
+        threads: Intra-op threads during evaluation (default: all cores)
+
+    Returns:
+        The manifest written to models_dir
+    """
+    os.makedirs(models_dir, exist_ok=True)
+    paths = {variant: os.path.join(models_dir, name.format(stem=stem)) for variant, name in VARIANT_FILES.items()}
+    if source:
+        if os.path.abspath(source) != os.path.abspath(paths["fp32"]):
+            shutil.copyfile(source, paths["fp32"])
+    elif checkpoint_dir:
+        export_checkpoint(checkpoint_dir, paths["fp32"])
+    else:
+        raise ValueError("Either checkpoint_dir or source is needed")
+
+    steps = {
+        "int8": (lambda: quantize_int8(paths["fp32"], paths["int8"]), {"type": "dynamic_int8"}),
+        "int4": (lambda: quantize_int4(paths["fp32"], paths["int4"], block_size, accuracy_level),
+                 {"type": "blockwise_int4", "block_size": block_size, "accuracy_level": accuracy_level})
+    }
+    variants = {"fp32": {"path": os.path.basename(paths["fp32"]), "quantization": None}}
+    for variant, (quantize, quantization) in steps.items():
+        try:
+            quantize()
+        except Exception as e:
+            # A failed variant is left out, never replaced by a copy of another one
+            logger.error(f"{variant} quantization failed, variant skipped: {e}")
+            if os.path.exists(paths[variant]):
+                os.remove(paths[variant])
+            continue
+        variants[variant] = {"path": os.path.basename(paths[variant]), "quantization": quantization}
+    for variant, entry in variants.items():
+        path = os.path.join(models_dir, entry["path"])
+        entry["size_bytes"] = os.path.getsize(path)
+        entry["sha256"] = file_sha256(path)
+
+    manifest = {"version": MANIFEST_VERSION, "built_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "reference": "fp32", "variants": variants, "gate": dict(gate or DEFAULT_GATE),
+                "evaluations": {}}
+    if evaluate_now:
+        manifest["evaluations"][host_key()] = evaluate(models_dir, manifest, threads=threads)
+    save_manifest(manifest, os.path.join(models_dir, MANIFEST_NAME))
+    return manifest
+
+
+def main():
+    """Build variants, or (re-)evaluate them on the host that will serve them"""
+    parser = argparse.ArgumentParser(description="Export, quantize and evaluate the generation model")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Export and quantize, then evaluate on this host")
+    source = build_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--checkpoint", help="Hugging Face checkpoint directory to export")
+    source.add_argument("--source", help="Existing fp32 ONNX model with KV cache")
+    build_parser.add_argument("--models-dir", default="models")
+    build_parser.add_argument("--stem", default="smollm2-135m")
+    build_parser.add_argument("--block-size", type=int, default=32)
+    build_parser.add_argument("--accuracy-level", type=int, default=4)
+    build_parser.add_argument("--max-kl", type=float, default=DEFAULT_GATE["max_kl"])
+    build_parser.add_argument("--min-top1", type=float, default=DEFAULT_GATE["min_top1_agreement"])
+    build_parser.add_argument("--no-evaluate", action="store_true")
+    build_parser.add_argument("--threads", type=int, help="Intra-op threads while evaluating")
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="Measure the built variants on this host")
+    evaluate_parser.add_argument("--models-dir", default="models")
+    evaluate_parser.add_argument("--max-new-tokens", type=int, default=32)
+    evaluate_parser.add_argument("--threads", type=int, help="Intra-op threads (as the service runs)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "build":
+        manifest = build(args.models_dir, args.stem, checkpoint_dir=args.checkpoint, source=args.source,
+                         block_size=args.block_size, accuracy_level=args.accuracy_level,
+                         gate={"max_kl": args.max_kl, "min_top1_agreement": args.min_top1},
+                         evaluate_now=not args.no_evaluate, threads=args.threads)
+    else:
+        manifest_path = os.path.join(args.models_dir, MANIFEST_NAME)
+        manifest = load_manifest(manifest_path)
+        if manifest is None:
+            sys.exit(f"No model manifest in {args.models_dir}, run the build first")
+        manifest.setdefault("evaluations", {})[host_key()] = evaluate(
+            args.models_dir, manifest, max_new_tokens=args.max_new_tokens, threads=args.threads)
+        save_manifest(manifest, manifest_path)
+
+    variant, reason = select_variant(manifest, host_key())
+    json.dump({"selected": variant, "reason": reason, "path": manifest["variants"][variant]["path"],
+               "evaluation": manifest["evaluations"].get(host_key())}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
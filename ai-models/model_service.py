@@ -1,10 +1,35 @@
-import onnxruntime as ort
 import numpy as np
+import hashlib
 import json
+import os
+import platform
 import time
 import re
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+import asyncio
+import queue
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from knowledge_index import KnowledgeIndex, KnowledgeSnapshot, top_entries
+from faq_store import FaqStore
+from embedding_index import EmbeddingIndex, OnnxSentenceEncoder, questions_fingerprint
+from response_cache import ResponseCache
+from tokenizer import load_tokenizer
+from generation import GenerationEngine
+from sampling import LogitsProcessor, ScoredSelector
+from batching import BatchScheduler
+from conversation_cache import ConversationCache
+from semantic_cache import SemanticCache
+from cascade import CascadeTrace, CascadeStats, MODEL_STAGES, calibrate
+from metrics import Metrics, SlowRequestProfiler, process_stats
+from inference_pool import InferencePool, PooledEngine
+from model_build import MANIFEST_NAME, host_key, load_manifest, select_variant
+from session_store import DATA_SUFFIX, EXTERNAL_MIN_BYTES, open_session, release_session, session_stats
+
+# Bump when the shape of cached responses changes
+CACHE_SCHEMA_VERSION = "2"
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,116 +50,1465 @@ class LightweightAIModel:
             config_path: Path to the configuration file
         """
         self.model_path = model_path
+        self.model_variant = None
+        # sha256 of the selected variant from the build manifest
+        self.model_sha256 = None
         self.config_path = config_path
         self.session = None
+        self.engine = None
+        self.scheduler = None
+        self.pool = None
+        self.conversations = None
+        # Per-language KV state of the system prompt, computed once and shared read-only
+        self.prompt_prefixes: Dict[str, Tuple[Tuple[int, ...], Any]] = {}
+        self.prompt_prefix_stats = {"languages": {}, "requests": 0, "saved_prefill_ms": 0.0}
+        self.stats_lock = threading.Lock()
+        self.model_lock = threading.Lock()
+        self.model_error = None
+        self.startup_times: Dict[str, float] = {}
+        self.tokenizer = None
         self.config = {}
-        self.knowledge_base = {}
-        self.cache = {}
-        self.max_cache_size = 1000
+        # Served knowledge base snapshot, replaced as a whole on reload
+        self.kb: Optional[KnowledgeSnapshot] = None
+        self.faq_store = None
+        self.encoder = None
+        self.cache_kb_fingerprint = ""
+        self.kb_reload_lock = threading.Lock()
+        self.kb_watch_thread = None
+        self.kb_watch_stop = None
+        self.kb_reloads = {"reloads": 0, "failures": 0, "evicted": 0,
+                           "last_duration": None, "max_duration": 0.0}
+        self.cache = None
+        self.semantic_cache = None
+        # One model run at a time per process when not batching, so concurrent
+        # request threads don't multiply the intra-op threads
+        self.inference_slot = threading.Lock()
+        # Async front-end: bounded pool for model calls plus an admission counter
+        self.executor = None
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        # Optional larger model the cascade escalates to, loaded on first need
+        self.large_engine = None
+        self.large_model_error = None
+        self.large_model_lock = threading.Lock()
+        self.large_model_thread = None
+        self.large_model_slot = threading.Lock()
+        self.cascade_stats = None
+        self.metrics = None
+        self.profiler = None
         
+        start_time = time.perf_counter()
         self.load_config()
-        self.load_model()
-        self.load_knowledge_base()
+        self.max_cache_size = self.config.get("cache_size", 1000)
+        self.metrics, self.profiler = self.create_metrics()
+        # The variant is picked before the caches are versioned, so loading the model
+        # later (lazily or in the background) doesn't change their version
+        try:
+            self.select_model_variant()
+        except Exception as e:
+            logger.warning(f"Model variant selection deferred to model loading: {e}")
+        # Dense retrieval tokenizes while the knowledge base loads
+        self.timed("tokenizer", self.load_tokenizer)
+        self.timed("knowledge_base", self.load_knowledge_base)
+        self.cache = self.create_response_cache()
+        self.semantic_cache = self.create_semantic_cache()
+        self.cascade_stats = CascadeStats(trace_path=self.get_cascade_config()["trace_path"])
+        self.refresh_cache_version()
+        self.start_knowledge_base_watch()
+        
+        # The knowledge base answers right away; the model loads now, in the
+        # background, or on the first request that needs it
+        loading = self.get_model_loading()
+        if loading == "eager":
+            self.ensure_model(raise_errors=True)
+        elif loading == "background":
+            threading.Thread(target=self.ensure_model, name="model-loader", daemon=True).start()
+        self.startup_times["ready"] = time.perf_counter() - start_time
+        logger.info(f"Service ready in {self.startup_times['ready']:.3f}s (model loading: {loading})")
+    
+    def timed(self, phase: str, load, *args):
+        """Run a loading step and record its duration in startup_times"""
+        start_time = time.perf_counter()
+        result = load(*args)
+        self.startup_times[phase] = time.perf_counter() - start_time
+        return result
     
     def load_config(self):
         """Load configuration from JSON file"""
         try:
             with open(self.config_path, 'r', encoding='utf-8') as f:
-                self.config = json.load(f)
+                self.config = self.get_default_config()
+                self.config.update(json.load(f))
             logger.info(f"Configuration loaded from {self.config_path}")
         except FileNotFoundError:
             logger.warning(f"Config file {self.config_path} not found, using defaults")
             self.config = self.get_default_config()
+        # Pooled sequences keep their KV cache in the workers, where batches can't be repacked
+        if self.config.get("pool", {}).get("enabled") and self.config.get("batching", {}).get("enabled"):
+            raise ValueError("pool.enabled and batching.enabled cannot both be set: "
+                             "the inference pool does not support micro-batching")
     
     def get_default_config(self) -> Dict[str, Any]:
         """Get default configuration"""
         return {
             "model": {
                 "max_tokens": 512,
+                "max_new_tokens": 256,
+                "max_length": 2048,
+                "num_kv_heads": None,
+                "head_dim": None,
                 "temperature": 0.7,
                 "top_p": 0.9,
                 "top_k": 50,
-                "repetition_penalty": 1.1
+                "repetition_penalty": 1.1,
+                "do_sample": True,
+                "seed": None,
+                "intra_op_num_threads": None,
+                "inter_op_num_threads": 1,
+                "loading": "background",
+                "graph_cache_dir": "cache/graphs",
+                # "mmap": weights stay in external data files mapped read-only, one copy
+                # shared by every worker on the node; "prepacked": private prepacked
+                # copies per process (faster prefill, more memory)
+                "weights": "mmap",
+                # Build manifest listing quantized variants (default: model_manifest.json
+                # next to the model) and a variant to force instead of the measured choice
+                "manifest_path": None,
+                "variant": None,
+                "system_prompts": {
+                    "fr": ("Tu es Moussadar, l'assistant des services publics. Réponds en français, "
+                           "brièvement et précisément, en listant les étapes et les documents nécessaires. "
+                           "Si tu ne sais pas, oriente vers l'administration compétente."),
+                    "ar": ("أنت مُسَدِّر، مساعد الخدمات العمومية. أجب باللغة العربية بإيجاز ودقة، "
+                           "مع ذكر الخطوات والوثائق المطلوبة. إذا لم تكن متأكدًا، وجّه المستخدم إلى الإدارة المختصة.")
+                }
+            },
+            "retrieval": {
+                "mode": "lexical",
+                "top_k": 3,
+                "k1": 1.2,
+                "b": 0.75,
+                "keyword_weight": 0.5,
+                "min_confidence": 0.35,
+                "offline_min_confidence": 0.1,
+                "dense_weight": 0.5,
+                # The encoder ships in its own directory, with its tokenizer.json
+                "encoder_path": "models/encoder/model.onnx",
+                "max_length": 256,
+                "embeddings_path": "models/kb_embeddings.npy"
+            },
+            "knowledge_base": {
+                "source": "auto",
+                "database_path": "../shared/database/moussadar.db",
+                "watch_interval": 5
+            },
+            "conversation": {
+                "enabled": True,
+                "max_turns": 8,
+                "turn_stride": 4,
+                "context_tokens": 1024,
+                "max_bytes": 128 * 1024 * 1024,
+                "idle_timeout": 900
             },
             "languages": ["fr", "ar"],
+            "batching": {
+                "enabled": False,
+                "max_batch_size": 8,
+                "max_wait_ms": 10
+            },
+            "tokenizer": {
+                "cache_size": 4096
+            },
+            "pool": {
+                "enabled": False,
+                "workers": None,
+                "cores_per_worker": 2,
+                "slots": 4,
+                "slot_bytes": 8 * 1024 * 1024,
+                "health_interval": 5.0,
+                "ping_timeout": 10.0,
+                "call_timeout": 60.0
+            },
+            "async": {
+                "max_workers": 4,
+                "max_pending": 16,
+                "timeout": 10.0
+            },
+            "semantic_cache": {
+                "enabled": True,
+                "max_entries": 2000,
+                "max_bytes": 4 * 1024 * 1024,
+                "num_perm": 64,
+                "bands": 16,
+                "min_tokens": 2
+            },
+            "cascade": {
+                "stages": ["exact_cache", "semantic_cache", "knowledge_base", "model", "large_model"],
+                "budget_ms": 15000,
+                "thresholds": {
+                    "semantic_cache": 0.8,
+                    "knowledge_base": None,
+                    "model": 0.3,
+                    "large_model": 0.0
+                },
+                "calibration": {
+                    "knowledge_base": [1.0, 0.0],
+                    "model": [1.0, 0.0],
+                    "large_model": [1.0, 0.0]
+                },
+                "trace_path": None,
+                "large_model": {
+                    "path": None,
+                    "max_new_tokens": 256,
+                    "num_kv_heads": None,
+                    "head_dim": None
+                }
+            },
+            "metrics": {
+                "enabled": True,
+                "dir": "cache/metrics",
+                "flush_interval": 5.0,
+                "profile_slow_ms": None,
+                "profile_interval_ms": 10,
+                "profile_dir": "cache/profiles",
+                "profile_keep": 20
+            },
             "cache_size": 1000,
+            "cache": {
+                "max_bytes": 8 * 1024 * 1024,
+                "ttl": 3600,
+                "disk_path": "cache/responses",
+                "disk_size_limit": 256 * 1024 * 1024
+            },
             "offline_mode": True
         }
     
+    def get_retrieval_config(self) -> Dict[str, Any]:
+        """Get retrieval settings, falling back to defaults for missing keys"""
+        retrieval = dict(self.get_default_config()["retrieval"])
+        retrieval.update(self.config.get("retrieval", {}))
+        return retrieval
+    
+    def create_response_cache(self) -> ResponseCache:
+        """Create the two-tier response cache from the configuration"""
+        cache_config = dict(self.get_default_config()["cache"])
+        cache_config.update(self.config.get("cache", {}))
+        return ResponseCache(max_entries=self.max_cache_size,
+                             max_bytes=cache_config["max_bytes"],
+                             ttl=cache_config["ttl"],
+                             disk_path=cache_config["disk_path"],
+                             disk_size_limit=cache_config["disk_size_limit"])
+    
+    def create_semantic_cache(self) -> Optional[SemanticCache]:
+        """Near-duplicate answer cache from the configuration (per process, in memory)"""
+        semantic = dict(self.get_default_config()["semantic_cache"])
+        semantic.update(self.config.get("semantic_cache", {}))
+        if not semantic.pop("enabled"):
+            return None
+        return SemanticCache(self.normalize_for_matching, **semantic)
+    
+    def get_cascade_config(self) -> Dict[str, Any]:
+        """Get answer cascade settings, falling back to defaults for missing keys"""
+        defaults = self.get_default_config()["cascade"]
+        cascade = dict(defaults)
+        cascade.update(self.config.get("cascade", {}))
+        for section in ("thresholds", "calibration", "large_model"):
+            cascade[section] = dict(defaults[section], **self.config.get("cascade", {}).get(section, {}))
+        return cascade
+    
+    def get_stage_threshold(self, stage: str) -> float:
+        """Confidence at which a stage's answer ends the cascade"""
+        threshold = self.get_cascade_config()["thresholds"].get(stage)
+        if threshold is None and stage == "knowledge_base":
+            return self.get_retrieval_config()["min_confidence"]
+        return threshold or 0.0
+    
+    def calibrate_confidence(self, stage: str, confidence: float) -> float:
+        """Map a stage's raw score to a calibrated confidence"""
+        scale, bias = self.get_cascade_config()["calibration"].get(stage, (1.0, 0.0))
+        return calibrate(confidence, scale, bias)
+    
+    def create_metrics(self) -> Tuple[Metrics, Optional[SlowRequestProfiler]]:
+        """Stage histograms and counters, plus the slow request profiler when profile_slow_ms is set"""
+        metrics_config = dict(self.get_default_config()["metrics"])
+        metrics_config.update(self.config.get("metrics", {}))
+        metrics = Metrics(enabled=metrics_config["enabled"],
+                          directory=metrics_config["dir"],
+                          flush_interval=metrics_config["flush_interval"],
+                          gauges=self.get_metrics_gauges)
+        profiler = None
+        if metrics_config["enabled"] and metrics_config["profile_slow_ms"]:
+            profiler = SlowRequestProfiler(metrics_config["profile_slow_ms"] / 1000.0,
+                                           interval=metrics_config["profile_interval_ms"] / 1000.0,
+                                           directory=metrics_config["profile_dir"],
+                                           keep=metrics_config["profile_keep"])
+            profiler.start()
+        return metrics, profiler
+    
+    def get_metrics_gauges(self) -> Dict[str, float]:
+        """Point-in-time values of this process: memory, threads, KV state and cache occupancy"""
+        gauges = process_stats()
+        gauges["intra_op_threads"] = self.get_intra_op_threads()
+        gauges["inter_op_threads"] = self.get_model_config()["inter_op_num_threads"] or 0
+        gauges["model_loaded"] = 1 if self.engine is not None else 0
+        gauges["system_prompt_kv_bytes"] = sum(state.nbytes() for _, state in self.prompt_prefixes.values())
+        gauges["async_pending"] = self.pending
+        if self.conversations is not None:
+            gauges["conversation_kv_bytes"] = self.conversations.current_bytes
+        if self.scheduler is not None:
+            gauges["batch_queue"] = self.scheduler.queue.qsize()
+        for session in session_stats():
+            for key in ("private_bytes", "mapped_resident_bytes", "mapped_shared_bytes"):
+                gauges[f"session_{session['name']}_{key}"] = session[key]
+        caches = [("response_cache", self.cache.stats() if self.cache is not None else None),
+                  ("semantic_cache", self.semantic_cache.stats() if self.semantic_cache is not None else None)]
+        for name, stats in caches:
+            if stats is None:
+                continue
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    gauges[f"{name}_{key}"] = value
+        return gauges
+    
+    def render_metrics(self) -> str:
+        """Prometheus text exposition of every worker's metrics"""
+        return self.metrics.render()
+    
+    def get_cache_version(self) -> str:
+        """Version tag of everything a cached answer depends on: model variant or file, knowledge base, config"""
+        digest = hashlib.sha256(CACHE_SCHEMA_VERSION.encode('utf-8'))
+        if self.model_sha256:
+            digest.update(self.model_sha256.encode('utf-8'))
+        else:
+            digest.update(self.model_path.encode('utf-8'))
+            if os.path.exists(self.model_path):
+                stat = os.stat(self.model_path)
+                digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+        digest.update(self.cache_kb_fingerprint.encode('utf-8'))
+        digest.update(json.dumps(self.config, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()[:16]
+    
+    def refresh_cache_version(self):
+        """Invalidate cached answers if the model or knowledge base changed"""
+        version = self.get_cache_version()
+        if self.cache is not None:
+            self.cache.set_version(version)
+        if self.semantic_cache is not None:
+            self.semantic_cache.set_version(version)
+    
+    def get_model_config(self) -> Dict[str, Any]:
+        """Get model settings, falling back to defaults for missing keys"""
+        model_config = dict(self.get_default_config()["model"])
+        model_config.update(self.config.get("model", {}))
+        return model_config
+    
+    def load_tokenizer(self):
+        """Load the model's tokenizer from the models directory"""
+        cache_size = self.config.get("tokenizer", {}).get("cache_size", 4096)
+        self.tokenizer = load_tokenizer(os.path.dirname(self.model_path) or ".", cache_size)
+    
+    def get_intra_op_threads(self) -> int:
+        """
+        Intra-op threads for this process
+        
+        AI_INTRA_OP_THREADS (set by the gunicorn config from cores / workers) wins over
+        the configuration; 0 lets onnxruntime use every core.
+        """
+        threads = os.environ.get("AI_INTRA_OP_THREADS")
+        if threads:
+            return int(threads)
+        return self.get_model_config()["intra_op_num_threads"] or 0
+    
+    def get_model_loading(self) -> str:
+        """
+        When the generation model is loaded: eager, background or lazy
+        
+        AI_MODEL_LOADING wins over the configuration (the gunicorn config forces eager
+        so the session exists before workers are forked).
+        """
+        loading = os.environ.get("AI_MODEL_LOADING") or self.get_model_config()["loading"]
+        if loading not in ("eager", "background", "lazy"):
+            logger.warning(f"Unknown model loading mode '{loading}', using lazy")
+            loading = "lazy"
+        return loading
+    
+    def ensure_model(self, raise_errors: bool = False) -> bool:
+        """
+        Load the tokenizer and the session unless already done
+        
+        Concurrent callers wait for the one load in progress. A failed load is not
+        retried; callers get False and fall back to non-model answers.
+        """
+        if self.engine is not None:
+            return True
+        with self.model_lock:
+            if self.engine is None and self.model_error is None:
+                try:
+                    self.timed("model", self.load_model)
+                except Exception as e:
+                    self.model_error = str(e)
+                    if raise_errors:
+                        raise
+        return self.engine is not None
+    
+    def get_model_digest(self) -> str:
+        """
+        sha256 of the model file
+        
+        Memoized in the graph cache directory by size and mtime so unchanged models
+        are not re-read on every start.
+        """
+        stat = os.stat(self.model_path)
+        marker = f"{stat.st_size}:{stat.st_mtime_ns}"
+        cache_dir = self.get_model_config()["graph_cache_dir"]
+        digests_path = os.path.join(cache_dir, "digests.json")
+        model_key = os.path.abspath(self.model_path)
+        try:
+            with open(digests_path, 'r', encoding='utf-8') as f:
+                digests = json.load(f)
+        except (FileNotFoundError, ValueError):
+            digests = {}
+        
+        known = digests.get(model_key)
+        if known and known["stat"] == marker:
+            return known["sha256"]
+        
+        digest = hashlib.sha256()
+        with open(self.model_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digests[model_key] = {"stat": marker, "sha256": digest.hexdigest()}
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{digests_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(digests, f)
+        os.replace(tmp_path, digests_path)
+        return digests[model_key]["sha256"]
+    
+    def get_optimized_model_path(self, ort_version: str) -> Optional[str]:
+        """
+        Where the optimized graph of the current model is cached
+        
+        Keyed by model content, onnxruntime version and CPU architecture, since fully
+        optimized graphs may contain hardware specific fused kernels.
+        """
+        cache_dir = self.get_model_config()["graph_cache_dir"]
+        if not cache_dir:
+            return None
+        stem = os.path.splitext(os.path.basename(self.model_path))[0]
+        return os.path.join(cache_dir, f"{stem}-{self.get_model_digest()[:16]}"
+                                       f"-ort{ort_version}-{platform.machine()}.onnx")
+    
+    def create_session_options(self):
+        """Session options for the generation model"""
+        import onnxruntime as ort
+        
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.intra_op_num_threads = self.get_intra_op_threads()
+        sess_options.inter_op_num_threads = self.get_model_config()["inter_op_num_threads"] or 0
+        sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        return sess_options
+    
+    def create_session(self):
+        """
+        Create the inference session, reusing a cached optimized graph when possible
+        
+        The first start optimizes the source model and saves the result; later starts
+        load that graph with optimizations disabled. With memory-mapped weights the
+        graph is saved with its weights in an external data file next to it, and the
+        session is opened from that file.
+        """
+        import onnxruntime as ort
+        
+        # Use CPU execution provider for compatibility
+        providers = ['CPUExecutionProvider']
+        model_config = self.get_model_config()
+        weights = model_config["weights"]
+        
+        try:
+            optimized_path = self.get_optimized_model_path(ort.__version__)
+        except OSError as e:
+            logger.warning(f"Optimized graph cache unavailable: {e}")
+            optimized_path = None
+        
+        if optimized_path and os.path.exists(optimized_path):
+            sess_options = self.create_session_options()
+            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            try:
+                session = open_session(optimized_path, sess_options, weights=weights,
+                                       cache_dir=model_config["graph_cache_dir"], name="model")
+                logger.info(f"Reused optimized graph {optimized_path}")
+                return session, sess_options
+            except Exception as e:
+                logger.warning(f"Discarding unusable optimized graph {optimized_path}: {e}")
+                os.remove(optimized_path)
+        
+        sess_options = self.create_session_options()
+        tmp_path = None
+        if optimized_path:
+            os.makedirs(os.path.dirname(optimized_path), exist_ok=True)
+            tmp_path = f"{optimized_path}.{os.getpid()}.tmp"
+            sess_options.optimized_model_filepath = tmp_path
+            if weights == "mmap":
+                # Per-process data file name: the graph renamed into place references it
+                sess_options.add_session_config_entry(
+                    "session.optimized_model_external_initializers_file_name",
+                    f"{os.path.basename(optimized_path)}.{os.getpid()}{DATA_SUFFIX}")
+                sess_options.add_session_config_entry(
+                    "session.optimized_model_external_initializers_min_size_in_bytes", str(EXTERNAL_MIN_BYTES))
+        else:
+            return open_session(self.model_path, sess_options, weights=weights, name="model"), sess_options
+        session = ort.InferenceSession(self.model_path, sess_options, providers=providers)
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, optimized_path)
+            logger.info(f"Saved optimized graph to {optimized_path}")
+            if weights == "mmap":
+                # This session holds private copies of the weights; map the saved ones
+                del session
+                sess_options = self.create_session_options()
+                sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+                session = open_session(optimized_path, sess_options, weights=weights, name="model")
+        return session, sess_options
+    
+    def get_pool_config(self) -> Dict[str, Any]:
+        """Get inference pool settings, falling back to defaults for missing keys"""
+        pool_config = dict(self.get_default_config()["pool"])
+        pool_config.update(self.config.get("pool", {}))
+        return pool_config
+    
+    def select_model_variant(self):
+        """
+        Switch model_path to the variant the build manifest picks for this CPU
+        
+        The manifest (from model_build.py) lists the fp32, INT8 and INT4 builds with
+        their accuracy against fp32 and per-token latency measured per host; the
+        fastest variant passing the accuracy gate here is loaded. Without a manifest
+        model_path is used as given. The selection is made once.
+        """
+        if self.model_variant is not None:
+            return
+        model_config = self.get_model_config()
+        manifest_path = model_config["manifest_path"] or os.path.join(
+            os.path.dirname(self.model_path) or ".", MANIFEST_NAME)
+        manifest = load_manifest(manifest_path)
+        if manifest is None:
+            return
+        variant, reason = select_variant(manifest, host_key(), model_config["variant"])
+        entry = manifest["variants"][variant]
+        path = os.path.join(os.path.dirname(manifest_path), entry["path"])
+        if not os.path.exists(path) or os.path.getsize(path) != entry["size_bytes"]:
+            raise FileNotFoundError(f"Model variant {variant} missing or incomplete at {path}")
+        logger.info(f"Model variant {variant} selected from {manifest_path}: {reason}")
+        self.model_path = path
+        self.model_variant = variant
+        self.model_sha256 = entry.get("sha256")
+    
     def load_model(self):
         """Load the ONNX model"""
         try:
-            # Configure ONNX Runtime for minimal resource usage
-            sess_options = ort.SessionOptions()
-            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-            sess_options.optimized_model_filepath = "optimized_model.onnx"
+            self.select_model_variant()
+            if self.tokenizer is None:
+                self.timed("tokenizer", self.load_tokenizer)
+            
+            if self.get_pool_config()["enabled"]:
+                self.load_pool()
+                return
             
-            # Use CPU execution provider for compatibility
-            providers = ['CPUExecutionProvider']
+            # Configure ONNX Runtime for minimal resource usage
+            self.session, sess_options = self.create_session()
+            logger.info(f"Model loaded from {self.model_path} "
+                        f"({sess_options.intra_op_num_threads or 'all'} intra-op threads)")
             
-            self.session = ort.InferenceSession(self.model_path, sess_options, providers=providers)
-            logger.info(f"Model loaded from {self.model_path}")
+            model_config = self.get_model_config()
+            self.engine = GenerationEngine(self.session,
+                                           eos_token_id=self.tokenizer.eos_token_id,
+                                           pad_token_id=self.tokenizer.pad_token_id,
+                                           num_kv_heads=model_config["num_kv_heads"],
+                                           head_dim=model_config["head_dim"],
+                                           max_length=model_config["max_length"])
+            self.scheduler = self.create_scheduler()
+            self.conversations = self.create_conversation_cache()
+            self.timed("system_prompts", self.load_prompt_prefixes)
+            self.refresh_cache_version()
             
         except Exception as e:
             logger.error(f"Failed to load model: {e}")
             raise
     
+    def load_pool(self):
+        """
+        Shard inference over a pool of pinned worker processes
+        
+        Workers start on the first model request. Each pool worker decodes its own
+        sequences, so the micro-batching scheduler is not used; run the HTTP front
+        with a single gunicorn worker, the pool provides the parallelism.
+        """
+        import onnxruntime as ort
+        
+        model_config = self.get_model_config()
+        pool_config = self.get_pool_config()
+        try:
+            optimized_path = self.get_optimized_model_path(ort.__version__)
+        except OSError:
+            optimized_path = None
+        optimized = bool(optimized_path) and os.path.exists(optimized_path)
+        self.pool = InferencePool(optimized_path if optimized else self.model_path,
+                                  engine_options={
+                                      "eos_token_id": self.tokenizer.eos_token_id,
+                                      "pad_token_id": self.tokenizer.pad_token_id,
+                                      "num_kv_heads": model_config["num_kv_heads"],
+                                      "head_dim": model_config["head_dim"],
+                                      "max_length": model_config["max_length"]
+                                  },
+                                  num_workers=pool_config["workers"],
+                                  cores_per_worker=pool_config["cores_per_worker"],
+                                  slots=pool_config["slots"],
+                                  slot_bytes=pool_config["slot_bytes"],
+                                  health_interval=pool_config["health_interval"],
+                                  ping_timeout=pool_config["ping_timeout"],
+                                  call_timeout=pool_config["call_timeout"],
+                                  optimized=optimized,
+                                  weights=model_config["weights"],
+                                  cache_dir=model_config["graph_cache_dir"])
+        self.engine = PooledEngine(self.pool,
+                                   eos_token_id=self.tokenizer.eos_token_id,
+                                   pad_token_id=self.tokenizer.pad_token_id,
+                                   max_length=model_config["max_length"])
+        if self.config.get("batching", {}).get("enabled"):
+            logger.warning("Batching is not used with the inference pool")
+        # Let as many generations run as the pool has slots
+        self.inference_slot = threading.BoundedSemaphore(self.pool.num_workers * self.pool.slots)
+        logger.info(f"Inference pool configured: {self.pool.num_workers} workers")
+        self.refresh_cache_version()
+    
+    def create_scheduler(self) -> Optional[BatchScheduler]:
+        """Optional micro-batching: concurrent requests share forward passes"""
+        batching = self.config.get("batching", {})
+        if not batching.get("enabled") or self.engine is None or self.pool is not None:
+            return None
+        return BatchScheduler(self.engine,
+                              max_batch_size=batching.get("max_batch_size", 8),
+                              max_wait_ms=batching.get("max_wait_ms", 10),
+                              select_tokens=LogitsProcessor.from_config(self.get_model_config()))
+    
+    def get_conversation_config(self) -> Dict[str, Any]:
+        """Get conversation settings, falling back to defaults for missing keys"""
+        conversation = dict(self.get_default_config()["conversation"])
+        conversation.update(self.config.get("conversation", {}))
+        return conversation
+    
+    def create_conversation_cache(self) -> Optional[ConversationCache]:
+        """Prefix KV cache for multi-turn conversations (needs a local engine with a KV cache)"""
+        conversation = self.get_conversation_config()
+        if not conversation["enabled"] or self.engine is None or self.pool is not None or not self.engine.use_cache:
+            return None
+        conversations = ConversationCache(max_bytes=conversation["max_bytes"],
+                                          idle_timeout=conversation["idle_timeout"])
+        conversations.start()
+        return conversations
+    
+    def get_system_prompt_tokens(self, lang: str) -> List[int]:
+        """Token ids of the language's system turn (empty without a system prompt)"""
+        prompt = self.get_model_config()["system_prompts"].get(lang)
+        if not prompt:
+            return []
+        return self.tokenizer.encode(f"<|im_start|>system\n{prompt}<|im_end|>\n")
+    
+    def load_prompt_prefixes(self):
+        """
+        Run each language's system prompt through the model once
+        
+        Every model prompt starts with it, so requests start from this state and
+        only prefill what follows. The prefill time measured here is what each of
+        those requests saves.
+        """
+        self.prompt_prefixes = {}
+        if self.engine is None or self.pool is not None or not self.engine.use_cache:
+            return
+        for lang in self.config.get("languages", ["fr", "ar"]):
+            tokens = self.get_system_prompt_tokens(lang)
+            if not tokens:
+                continue
+            input_ids = np.array([tokens], dtype=np.int64)
+            timings = []
+            # The first pass includes one-off warm-up; keep the steady-state time
+            for _ in range(2):
+                start_time = time.perf_counter()
+                state, _ = self.engine.start(input_ids)
+                timings.append(time.perf_counter() - start_time)
+            self.prompt_prefixes[lang] = (tuple(tokens), self.engine.snapshot(state))
+            self.prompt_prefix_stats["languages"][lang] = {
+                "tokens": len(tokens),
+                "prefill_ms": round(1000 * min(timings), 3)
+            }
+        logger.info(f"System prompt prefixes ready: {self.prompt_prefix_stats['languages']}")
+    
+    def ensure_large_model(self) -> Optional[GenerationEngine]:
+        """
+        The cascade's larger model, once loaded
+        
+        The first call starts loading it in the background and returns None, so the
+        request that needs it first isn't held up by the load. A failed load is not
+        retried.
+        """
+        if self.large_engine is not None:
+            return self.large_engine
+        path = self.get_cascade_config()["large_model"]["path"]
+        if not path or self.large_model_error is not None:
+            return None
+        with self.large_model_lock:
+            if self.large_model_thread is None:
+                self.large_model_thread = threading.Thread(target=self.timed,
+                                                           args=("large_model", self.load_large_model, path),
+                                                           name="large-model-loader", daemon=True)
+                self.large_model_thread.start()
+        return None
+    
+    def load_large_model(self, path: str):
+        """Create the larger model's engine (it must share the small model's tokenizer)"""
+        try:
+            with self.model_lock:
+                if self.tokenizer is None:
+                    self.load_tokenizer()
+            large_config = self.get_cascade_config()["large_model"]
+            session = open_session(path, self.create_session_options(),
+                                   weights=self.get_model_config()["weights"],
+                                   cache_dir=self.get_model_config()["graph_cache_dir"], name="large_model")
+            self.large_engine = GenerationEngine(session,
+                                                 eos_token_id=self.tokenizer.eos_token_id,
+                                                 pad_token_id=self.tokenizer.pad_token_id,
+                                                 num_kv_heads=large_config["num_kv_heads"],
+                                                 head_dim=large_config["head_dim"],
+                                                 max_length=self.get_model_config()["max_length"])
+            logger.info(f"Large model loaded from {path}")
+        except Exception as e:
+            self.large_model_error = str(e)
+            logger.error(f"Failed to load large model: {e}")
+    
+    def after_fork(self):
+        """
+        Make a preloaded instance usable in a forked worker
+        
+        Knowledge base, indexes and tokenizer tables are inherited as-is (shared
+        copy-on-write). Threads and SQLite handles are not inherited, so the disk cache
+        is reopened and the scheduler recreated. onnxruntime's intra-op pool threads do
+        not survive fork either: with one thread per worker the inherited session (and
+        its weight pages) is kept, otherwise this worker builds its own session.
+        """
+        if self.pool is None:
+            self.inference_slot = threading.Lock()
+        self.model_lock = threading.Lock()
+        self.executor = None
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.metrics.reset()
+        self.metrics.start()
+        if self.profiler is not None:
+            self.profiler.reset()
+            self.profiler.start()
+        self.cascade_stats.reopen()
+        self.large_model_lock = threading.Lock()
+        self.large_model_slot = threading.Lock()
+        if self.large_engine is not None and self.get_intra_op_threads() != 1:
+            # Same as the main session: reload rather than use dead intra-op threads
+            self.large_engine = None
+        self.large_model_thread = None
+        if self.cache is not None:
+            self.cache.reopen()
+        if self.semantic_cache is not None:
+            self.semantic_cache.reopen()
+        if self.tokenizer is not None:
+            self.tokenizer.reopen()
+        if self.encoder is not None:
+            self.encoder.tokenizer.reopen()
+        self.kb_reload_lock = threading.Lock()
+        self.kb_watch_thread = None
+        self.start_knowledge_base_watch()
+        if self.session is not None and self.get_intra_op_threads() != 1:
+            self.load_model()
+        else:
+            self.scheduler = self.create_scheduler()
+            self.conversations = self.create_conversation_cache()
+    
+    def close(self):
+        """Drain queued generations and release the persistent cache"""
+        self.stop_knowledge_base_watch()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.scheduler is not None:
+            self.scheduler.close()
+        if self.conversations is not None:
+            self.conversations.close()
+        if self.pool is not None:
+            self.pool.close()
+        for session in (self.session, self.large_engine.session if self.large_engine is not None else None,
+                        self.encoder.session if self.encoder is not None else None):
+            if session is not None:
+                release_session(session)
+        if self.cache is not None:
+            self.cache.close()
+        self.cascade_stats.close()
+        self.metrics.close()
+    
+    def get_knowledge_base_config(self) -> Dict[str, Any]:
+        """Get knowledge base settings, falling back to defaults for missing keys"""
+        kb_config = dict(self.get_default_config()["knowledge_base"])
+        kb_config.update(self.config.get("knowledge_base", {}))
+        return kb_config
+    
     def load_knowledge_base(self):
         """Load the local knowledge base for offline responses"""
+        kb_config = self.get_knowledge_base_config()
+        source = kb_config["source"]
+        if source == "auto":
+            source = "sqlite" if os.path.exists(kb_config["database_path"]) else "json"
+        if source == "sqlite":
+            self.faq_store = FaqStore(kb_config["database_path"])
+        
+        try:
+            self.kb = self.build_knowledge_snapshot()
+        except Exception as e:
+            if self.faq_store is None:
+                raise
+            logger.warning(f"FAQ database unavailable, falling back to the JSON knowledge base: {e}")
+            self.faq_store = None
+            self.kb = self.build_knowledge_snapshot()
+        self.commit_knowledge_source(self.kb)
+        # Answers cached by earlier runs may predate this knowledge base; reloads
+        # from here on evict selectively instead
+        self.cache_kb_fingerprint = self.kb.fingerprint
+        self.refresh_cache_version()
+    
+    def get_knowledge_base_signature(self) -> Optional[tuple]:
+        """Stats of the knowledge base source files, to notice edits without reading them"""
+        if self.faq_store is not None:
+            # WAL mode writes land in the -wal file until checkpointed
+            paths = [self.faq_store.db_path, self.faq_store.db_path + "-wal"]
+        else:
+            paths = [self.config.get("knowledge_base_path", "knowledge_base.json")]
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+    
+    def read_knowledge_base(self, previous: Optional[KnowledgeSnapshot]):
+        """
+        Read the knowledge base source
+        
+        Returns:
+            (knowledge_base, fingerprint, source_sync), or None if nothing changed since
+            previous; source_sync is the FaqSync to commit once the snapshot is served
+        """
+        if self.faq_store is not None:
+            sync = self.faq_store.sync()
+            if previous is not None and not sync.changed and not sync.removed:
+                return None
+            logger.info(f"Knowledge base read from {self.faq_store.db_path}: {len(sync.entries)} FAQ entries "
+                        f"({len(sync.changed)} changed, {len(sync.removed)} removed)")
+            return sync.knowledge_base(), "faq:" + sync.fingerprint(), sync
+        
+        kb_path = self.config.get("knowledge_base_path", "knowledge_base.json")
         try:
-            kb_path = self.config.get("knowledge_base_path", "knowledge_base.json")
             with open(kb_path, 'r', encoding='utf-8') as f:
-                self.knowledge_base = json.load(f)
+                knowledge_base = json.load(f)
             logger.info(f"Knowledge base loaded from {kb_path}")
         except FileNotFoundError:
             logger.warning("Knowledge base not found, using empty base")
-            self.knowledge_base = {}
+            knowledge_base = {}
+        
+        fingerprint = hashlib.sha256(
+            json.dumps(knowledge_base, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+        if previous is None:
+            return knowledge_base, fingerprint, None
+        if fingerprint == previous.fingerprint:
+            return None
+        # Carry unchanged entries over as the same objects so their analysis is reused
+        unchanged = {json.dumps(entry, sort_keys=True, ensure_ascii=False): entry
+                     for entries in previous.knowledge_base.values() for entry in entries}
+        knowledge_base = {category: [unchanged.get(json.dumps(entry, sort_keys=True, ensure_ascii=False), entry)
+                                     for entry in entries]
+                          for category, entries in knowledge_base.items()}
+        return knowledge_base, fingerprint, None
+    
+    def build_knowledge_snapshot(self, previous: Optional[KnowledgeSnapshot] = None) -> Optional[KnowledgeSnapshot]:
+        """
+        Read the knowledge base and build its indexes, without touching the served snapshot
+        
+        Returns:
+            The new snapshot, or None if the source is unchanged
+        """
+        signature = self.get_knowledge_base_signature()
+        loaded = self.read_knowledge_base(previous)
+        if loaded is None:
+            return None
+        knowledge_base, fingerprint, source_sync = loaded
+        
+        # Compile keywords and BM25 statistics once so each request is matched in a single pass
+        retrieval = self.get_retrieval_config()
+        kb_index = KnowledgeIndex(knowledge_base, self.normalize_for_matching,
+                                  k1=retrieval["k1"], b=retrieval["b"],
+                                  previous=previous.index if previous is not None else None)
+        logger.info(f"Knowledge base indexed: {len(kb_index)} entries "
+                    f"({kb_index.reused} unchanged), {len(kb_index.keywords)} keywords")
+        
+        embeddings = None
+        if retrieval["mode"] in ("dense", "hybrid"):
+            embeddings = self.load_embedding_index(kb_index)
+        return KnowledgeSnapshot(knowledge_base, kb_index, embeddings, fingerprint, signature,
+                                 previous.generation + 1 if previous is not None else 1, source_sync)
+    
+    def commit_knowledge_source(self, snapshot: KnowledgeSnapshot):
+        """
+        Record in the source what a served snapshot was built from
+        
+        The FAQ store only advances its entries and watermark here, so a sync whose
+        snapshot failed to build is read again by the next reload.
+        """
+        if snapshot.source_sync is not None and self.faq_store is not None:
+            self.faq_store.commit(snapshot.source_sync)
+        snapshot.source_sync = None
+    
+    def reload_knowledge_base(self) -> Dict[str, Any]:
+        """
+        Rebuild the knowledge base indexes and swap them in
+        
+        The new snapshot is built while requests keep being answered from the current
+        one, then installed with a single reference assignment. Cached answers taken
+        from the knowledge base are evicted for the categories that changed only;
+        model answers are left to expire.
+        
+        Returns:
+            What the reload did
+        """
+        with self.kb_reload_lock:
+            start_time = time.perf_counter()
+            previous = self.kb
+            try:
+                snapshot = self.build_knowledge_snapshot(previous)
+            except Exception as e:
+                self.kb_reloads["failures"] += 1
+                logger.error(f"Knowledge base reload failed: {e}")
+                return {"reloaded": False, "error": str(e)}
+            
+            if snapshot is None:
+                # Source touched without a content change; it is current as of now
+                previous.signature = self.get_knowledge_base_signature()
+                return {"reloaded": False, "generation": previous.generation}
+            
+            self.kb = snapshot
+            self.commit_knowledge_source(snapshot)
+            categories = snapshot.changed_categories(previous)
+            tags = [self.get_cache_tag("knowledge_base", category) for category in categories]
+            evicted = 0
+            if self.cache is not None:
+                evicted = self.cache.evict_tags(tags)
+            if self.semantic_cache is not None:
+                evicted += self.semantic_cache.evict_tags(tags)
+            
+            duration = time.perf_counter() - start_time
+            self.kb_reloads["reloads"] += 1
+            self.kb_reloads["last_duration"] = duration
+            self.kb_reloads["max_duration"] = max(self.kb_reloads["max_duration"], duration)
+            self.kb_reloads["evicted"] += evicted
+            logger.info(f"Knowledge base generation {snapshot.generation} swapped in after {duration:.3f}s: "
+                        f"categories changed {categories}, {evicted} cached answers evicted")
+            return {
+                "reloaded": True,
+                "generation": snapshot.generation,
+                "entries": len(snapshot.index),
+                "changed_categories": categories,
+                "evicted": evicted,
+                "duration": duration
+            }
+    
+    def reload_knowledge_base_async(self) -> threading.Thread:
+        """Reload in a background thread"""
+        thread = threading.Thread(target=self.reload_knowledge_base, name="kb-reload", daemon=True)
+        thread.start()
+        return thread
+    
+    def start_knowledge_base_watch(self):
+        """Reload whenever the knowledge base file or FAQ database changes on disk"""
+        interval = self.get_knowledge_base_config()["watch_interval"]
+        if not interval or self.kb_watch_thread is not None:
+            return
+        stop = self.kb_watch_stop = threading.Event()
+        
+        def watch():
+            while not stop.wait(interval):
+                try:
+                    if self.get_knowledge_base_signature() != self.kb.signature:
+                        self.reload_knowledge_base()
+                except Exception as e:
+                    logger.warning(f"Knowledge base watch failed: {e}")
+        
+        self.kb_watch_thread = threading.Thread(target=watch, name="kb-watch", daemon=True)
+        self.kb_watch_thread.start()
+    
+    def stop_knowledge_base_watch(self):
+        """
+        Stop the file watcher, waiting for a reload in progress
+        
+        A preloading master calls this before forking: every worker runs its own
+        watcher (started in after_fork) over the snapshot it serves, and the master,
+        which serves nothing, would only reload for itself.
+        """
+        thread = self.kb_watch_thread
+        if thread is None:
+            return
+        self.kb_watch_stop.set()
+        thread.join()
+        self.kb_watch_thread = None
+    
+    def knowledge_base_stats(self) -> Dict[str, Any]:
+        """Served snapshot, reload timings and staleness"""
+        snapshot = self.kb
+        signature = self.get_knowledge_base_signature()
+        stale = 0.0
+        if signature != snapshot.signature:
+            # The source changed after the snapshot was read: stale since that edit
+            modified = max((stat[0] for stat in signature if stat is not None), default=0) / 1e9
+            stale = max(time.time() - modified, 0.0)
+        stats = dict(self.kb_reloads)
+        stats.update({
+            "source": self.faq_store.db_path if self.faq_store is not None
+            else self.config.get("knowledge_base_path", "knowledge_base.json"),
+            "entries": len(snapshot.index),
+            "generation": snapshot.generation,
+            "age": time.time() - snapshot.loaded_at,
+            "stale_seconds": stale
+        })
+        return stats
+    
+    def load_embedding_index(self, kb_index: KnowledgeIndex):
+        """Map the question embedding matrix, rebuilding it when the knowledge base changed"""
+        retrieval = self.get_retrieval_config()
+        encoder_path = retrieval["encoder_path"]
+        embeddings_path = retrieval["embeddings_path"]
+        try:
+            if self.encoder is None:
+                model_config = self.get_model_config()
+                self.encoder = OnnxSentenceEncoder(encoder_path, max_length=retrieval["max_length"],
+                                                   weights=model_config["weights"],
+                                                   cache_dir=model_config["graph_cache_dir"])
+            
+            entries = [entry for _, entry in kb_index.entries]
+            fingerprint = questions_fingerprint(EmbeddingIndex.entry_questions(entries), encoder_path,
+                                                self.encoder.tokenizer_path)
+            if EmbeddingIndex.is_current(embeddings_path, fingerprint):
+                return EmbeddingIndex(embeddings_path)
+            # Written to a temporary file and renamed: the matrix mapped by the
+            # previous snapshot stays readable
+            return EmbeddingIndex.build(self.encoder, entries, embeddings_path, fingerprint)
+        except Exception as e:
+            logger.warning(f"Dense retrieval unavailable, using lexical ranking only: {e}")
+            self.encoder = None
+            return None
+    
+    def get_cascade_stages(self, context_key: Optional[str]) -> List[str]:
+        """Stages a request goes through, in configured order"""
+        cascade = self.get_cascade_config()
+        stages = []
+        for stage in cascade["stages"]:
+            # Near-duplicates only stand in for answers that depend on the message alone
+            if stage == "semantic_cache" and (self.semantic_cache is None or context_key is not None):
+                continue
+            if stage == "large_model" and not cascade["large_model"]["path"]:
+                continue
+            stages.append(stage)
+        return stages
+    
+    def start_cascade(self, message: str, lang: str, context: Optional[List[Dict[str, str]]],
+                      budget: Optional[float] = None, profile: bool = True) -> Tuple[Dict[str, Any], CascadeTrace]:
+        """
+        Normalize a request and start its trace
+        
+        profile samples the calling thread for the slow request profiler; requests
+        that share their thread (the async front-end's event loop) pass False.
+        
+        Returns:
+            (request dictionary shared by the stages, trace)
+        """
+        if profile and self.profiler is not None:
+            self.profiler.begin()
+        with self.metrics.span("preprocess"):
+            processed_message = self.preprocess_message(message, lang)
+        context_key = self.get_context_key(context, lang)
+        if budget is None:
+            budget = self.get_cascade_config()["budget_ms"] / 1000.0
+        request = {
+            "message": processed_message,
+            "lang": lang,
+            "context": context,
+            "context_key": context_key,
+            "cache_key": self.cache.make_key(processed_message, lang, context_key),
+            "stages": self.get_cascade_stages(context_key)
+        }
+        return request, CascadeTrace(budget)
+    
+    def run_cheap_stage(self, stage: str, request: Dict[str, Any], trace: CascadeTrace) -> Optional[Dict[str, Any]]:
+        """
+        Try a cache or knowledge base stage
+        
+        Returns:
+            The answer if the stage is confident enough, else None (a weaker
+            knowledge base match is kept in the trace as a candidate)
+        """
+        start_time = time.perf_counter()
+        message, lang = request["message"], request["lang"]
+        if stage == "exact_cache":
+            response = self.cache.get(request["cache_key"])
+            elapsed = time.perf_counter() - start_time
+            if response is None:
+                trace.record(stage, elapsed, "miss")
+                return None
+            trace.record(stage, elapsed, "answered", 1.0)
+            logger.info(f"Cache hit for message: {message}")
+            return response
+        
+        if stage == "semantic_cache":
+            found = self.semantic_cache.get(message, lang, self.get_stage_threshold(stage))
+            elapsed = time.perf_counter() - start_time
+            if found is None:
+                trace.record(stage, elapsed, "miss")
+                return None
+            response, similarity = found
+            trace.record(stage, elapsed, "answered", similarity, similarity)
+            logger.info(f"Near-duplicate cache hit ({similarity:.2f}) for message: {message}")
+            # The same wording is an exact hit next time
+            self.cache.set(request["cache_key"], response,
+                           tag=self.get_cache_tag(response.get("source"), response.get("category")))
+            return response
+        
+        if stage == "knowledge_base":
+            # Matches down to the offline floor are kept as candidates in case nothing better comes
+            response = self.check_knowledge_base(
+                message, lang, min_confidence=self.get_retrieval_config()["offline_min_confidence"])
+            elapsed = time.perf_counter() - start_time
+            if response is None:
+                trace.record(stage, elapsed, "miss")
+                return None
+            return self.score_answer(stage, response, elapsed, trace)
+        
+        raise ValueError(f"Unknown cascade stage '{stage}'")
+    
+    def score_answer(self, stage: str, response: Dict[str, Any], elapsed: float,
+                     trace: CascadeTrace) -> Optional[Dict[str, Any]]:
+        """
+        Calibrate a knowledge base or model answer and compare it with the stage's threshold
+        
+        Returns:
+            The answer if confident enough, else None (it becomes a candidate)
+        """
+        if response.get("error"):
+            trace.record(stage, elapsed, "unavailable")
+            return None
+        if stage in MODEL_STAGES:
+            self.cascade_stats.observe_latency(stage, elapsed)
+        raw = response["confidence"]
+        confidence = self.calibrate_confidence(stage, raw)
+        response["confidence"] = round(confidence, 3)
+        if confidence >= self.get_stage_threshold(stage):
+            trace.record(stage, elapsed, "answered", confidence, raw)
+            return response
+        trace.record(stage, elapsed, "below_threshold", confidence, raw)
+        trace.offer(stage, response)
+        return None
+    
+    def fits_budget(self, stage: str, trace: CascadeTrace) -> bool:
+        """Whether a model stage can be expected to finish within the remaining budget"""
+        remaining = trace.remaining()
+        if remaining is None:
+            return True
+        expected = self.cascade_stats.expected_latency(stage)
+        if remaining > 0 and (expected is None or expected <= remaining):
+            return True
+        trace.record(stage, 0.0, "skipped")
+        trace.degraded = "deadline"
+        return False
+    
+    def run_model_stage(self, stage: str, request: Dict[str, Any], trace: CascadeTrace) -> Optional[Dict[str, Any]]:
+        """Answer with the small or the large model, blocking"""
+        if not self.fits_budget(stage, trace):
+            return None
+        generate = self.generate_ai_response if stage == "model" else self.generate_large_response
+        start_time = time.perf_counter()
+        response = generate(request["message"], request["lang"], request["context"])
+        return self.score_answer(stage, response, time.perf_counter() - start_time, trace)
+    
+    def finish_cascade(self, request: Dict[str, Any], trace: CascadeTrace,
+                       response: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Settle the answer: the confident one, else the best candidate, else the fallback
+        
+        New answers are postprocessed and cached unless a stage was skipped or cut
+        short, in which case a later request with more time may do better. The trace
+        summary is attached under "cascade" and folded into the cascade statistics.
+        """
+        lang = request["lang"]
+        if response is not None:
+            trace.answered_by, trace.confident = trace.stages[-1]["stage"], True
+        elif trace.best is not None:
+            response, trace.answered_by = trace.best, trace.best_stage
+        else:
+            response = self.get_fallback_response(request["message"], lang)
+        
+        if trace.answered_by not in ("exact_cache", "semantic_cache"):
+            with self.metrics.span("postprocess"):
+                response = self.postprocess_response(response, lang)
+            if trace.degraded and not trace.confident:
+                response["fallback_reason"] = trace.degraded
+            # Failures and degraded answers are not worth remembering
+            if not response.get("error") and not trace.degraded:
+                self.add_to_cache(request["cache_key"], response, request["message"], lang,
+                                  request["context_key"])
+        
+        response["cascade"] = summary = trace.summary()
+        self.cascade_stats.observe(trace, lang)
+        self.record_request_metrics(trace, response, summary["total_ms"] / 1000.0)
+        return response
+    
+    def record_request_metrics(self, trace: CascadeTrace, response: Dict[str, Any], elapsed: float):
+        """Stage durations, the answer's source and the slow request profile of a finished request"""
+        for stage in trace.stages:
+            if stage["outcome"] != "skipped":
+                self.metrics.observe(stage["stage"], stage["ms"] / 1000.0)
+        self.metrics.observe("request", elapsed)
+        if trace.answered_by in ("exact_cache", "semantic_cache"):
+            source = "cache"
+        else:
+            source = response.get("source", "error")
+        self.metrics.count("responses", source=source)
+        if trace.degraded:
+            self.metrics.count("degraded", reason=trace.degraded)
+        if self.profiler is not None:
+            path = self.profiler.end(elapsed, source)
+            if path:
+                logger.info(f"Slow request ({1000 * elapsed:.0f} ms) profiled to {path}")
     
     def generate_response(self, 
                          message: str, 
                          lang: str = "fr",
-                         context: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
+                         context: Optional[List[Dict[str, str]]] = None,
+                         budget: Optional[float] = None) -> Dict[str, Any]:
         """
         Generate a response to the user's message
         
+        Goes through the answer cascade (exact cache, near-duplicate cache, knowledge
+        base, model, larger model) and stops at the first confident answer. Model
+        stages whose expected latency exceeds what is left of the budget are skipped.
+        
         Args:
             message: User's input message
             lang: Language code ('fr' or 'ar')
             context: Optional conversation context
+            budget: Seconds allowed for the request (default from config)
             
         Returns:
             Dictionary containing response and metadata
         """
         try:
-            # Check cache first
-            cache_key = f"{message}_{lang}"
-            if cache_key in self.cache:
-                logger.info(f"Cache hit for key: {cache_key}")
-                return self.cache[cache_key]
+            request, trace = self.start_cascade(message, lang, context, budget)
+            response = None
+            for stage in request["stages"]:
+                if stage in MODEL_STAGES:
+                    response = self.run_model_stage(stage, request, trace)
+                else:
+                    response = self.run_cheap_stage(stage, request, trace)
+                if response is not None:
+                    break
+            return self.finish_cascade(request, trace, response)
             
-            # Preprocess message
-            processed_message = self.preprocess_message(message, lang)
-            
-            # Check knowledge base for exact matches
-            kb_response = self.check_knowledge_base(processed_message, lang)
-            if kb_response:
-                response = kb_response
-            else:
-                # Generate response using the model
-                response = self.generate_ai_response(processed_message, lang, context)
-            
-            # Postprocess response
-            final_response = self.postprocess_response(response, lang)
-            
-            # Cache the response
-            self.add_to_cache(cache_key, final_response)
+        except Exception as e:
+            logger.error(f"Error generating response: {e}")
+            self.metrics.count("responses", source="error")
+            return self.get_error_response(lang)
+    
+    def get_async_config(self) -> Dict[str, Any]:
+        """Get async front-end settings, falling back to defaults for missing keys"""
+        async_config = dict(self.get_default_config()["async"])
+        async_config.update(self.config.get("async", {}))
+        return async_config
+    
+    def get_executor(self) -> ThreadPoolExecutor:
+        """Bounded pool running model calls (onnxruntime releases the GIL while it runs)"""
+        if self.executor is None:
+            with self.pending_lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.get_async_config()["max_workers"],
+                                                       thread_name_prefix="inference")
+        return self.executor
+    
+    def release_pending(self):
+        """Free one admission slot of the async front-end"""
+        with self.pending_lock:
+            self.pending -= 1
+    
+    async def run_model_stage_async(self, stage: str, request: Dict[str, Any],
+                                    trace: CascadeTrace) -> Optional[Dict[str, Any]]:
+        """
+        Answer with a model on the bounded pool without blocking the event loop
+        
+        The stage is skipped when it can't be expected to meet the deadline or the
+        pool is saturated. If the deadline passes while generating, decoding is
+        stopped so the pool thread is freed.
+        """
+        if not self.fits_budget(stage, trace):
+            return None
+        
+        with self.pending_lock:
+            admitted = self.pending < self.get_async_config()["max_pending"]
+            if admitted:
+                self.pending += 1
+        if not admitted:
+            trace.record(stage, 0.0, "skipped")
+            trace.degraded = "overloaded"
+            return None
+        
+        loop = asyncio.get_running_loop()
+        stopped = threading.Event()
+        generate = self.generate_ai_response if stage == "model" else self.generate_large_response
+        
+        def run_model():
+            # The slot is held until the pool thread is really done, not just until we
+            # stop waiting, and freed here rather than from the event loop, which may
+            # be gone by then
+            try:
+                # Skip requests cancelled or timed out while queued for a pool thread
+                if stopped.is_set():
+                    return None
+                return generate(request["message"], request["lang"], request["context"], stopped.is_set)
+            finally:
+                self.release_pending()
+        
+        start_time = time.perf_counter()
+        try:
+            future = loop.run_in_executor(self.get_executor(), run_model)
+        except Exception:
+            self.release_pending()
+            raise
+        try:
+            response = await asyncio.wait_for(asyncio.shield(future), max(trace.remaining(), 0))
+        except asyncio.TimeoutError:
+            stopped.set()
+            trace.record(stage, time.perf_counter() - start_time, "deadline")
+            trace.degraded = "deadline"
+            return None
+        except asyncio.CancelledError:
+            stopped.set()
+            raise
+        # Queue wait included: it is part of what later requests must fit in their budget
+        return self.score_answer(stage, response, time.perf_counter() - start_time, trace)
+    
+    async def generate_response_async(self,
+                                      message: str,
+                                      lang: str = "fr",
+                                      context: Optional[List[Dict[str, str]]] = None,
+                                      timeout: Optional[float] = None,
+                                      is_disconnected=None) -> Dict[str, Any]:
+        """
+        Generate a response without blocking the event loop
+        
+        Same cascade as generate_response, with the timeout as budget. Cache and
+        knowledge base stages run inline; only model stages go to the bounded pool
+        (see run_model_stage_async). Without a confident answer, the best weaker one
+        or the fallback message is returned.
+        
+        Args:
+            message: User's input message
+            lang: Language code ('fr' or 'ar')
+            context: Optional conversation context
+            timeout: Seconds allowed for the whole request (default from config)
+            is_disconnected: Optional async callable; a disconnected client is
+                cancelled (asyncio.CancelledError) before reaching a model
             
-            return final_response
+        Returns:
+            Dictionary containing response and metadata
+        """
+        if timeout is None:
+            timeout = self.get_async_config()["timeout"]
+        try:
+            request, trace = self.start_cascade(message, lang, context, timeout, profile=False)
+            response = None
+            for stage in request["stages"]:
+                if stage in MODEL_STAGES:
+                    if is_disconnected is not None and await is_disconnected():
+                        raise asyncio.CancelledError()
+                    response = await self.run_model_stage_async(stage, request, trace)
+                else:
+                    response = self.run_cheap_stage(stage, request, trace)
+                if response is not None:
+                    break
+            return self.finish_cascade(request, trace, response)
             
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.error(f"Error generating response: {e}")
+            self.metrics.count("responses", source="error")
             return self.get_error_response(lang)
     
+    def generate_response_stream(self,
+                                 message: str,
+                                 lang: str = "fr",
+                                 context: Optional[List[Dict[str, str]]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Generate a response incrementally
+        
+        Cache and knowledge base stages run first and their answer is sent as a single
+        first chunk. Otherwise the small model's answer is streamed as it is decoded;
+        once tokens are out there is nothing to escalate, so the larger model is not
+        used here.
+        
+        Yields:
+            {"event": "token", "content": text} chunks, then
+            {"event": "done", "response": final response dictionary}
+        """
+        try:
+            request, trace = self.start_cascade(message, lang, context)
+            response = None
+            streamed = False
+            for stage in request["stages"]:
+                if stage == "large_model":
+                    continue
+                if stage != "model":
+                    response = self.run_cheap_stage(stage, request, trace)
+                elif self.fits_budget(stage, trace):
+                    start_time = time.perf_counter()
+                    chunks = []
+                    stream = self.stream_ai_response(request["message"], lang, context)
+                    while True:
+                        try:
+                            text = next(stream)
+                        except StopIteration as stop:
+                            answer = stop.value
+                            break
+                        chunks.append(text)
+                        yield {"event": "token", "content": text}
+                    response = self.score_answer(stage, answer, time.perf_counter() - start_time, trace)
+                    streamed = bool(chunks)
+                    if response is None and streamed:
+                        # Already sent: the streamed answer stands, confident or not
+                        trace.best, trace.best_stage = answer, stage
+                if response is not None or streamed:
+                    break
+            
+            final_response = self.finish_cascade(request, trace, response)
+            if not streamed:
+                yield {"event": "token", "content": final_response.get("content", "")}
+            yield {"event": "done", "response": final_response}
+            
+        except Exception as e:
+            logger.error(f"Error streaming response: {e}")
+            self.metrics.count("responses", source="error")
+            yield {"event": "done", "response": self.get_error_response(lang)}
+    
     def preprocess_message(self, message: str, lang: str) -> str:
         """Preprocess the input message"""
         # Basic normalization
@@ -162,88 +1536,386 @@ class LightweightAIModel:
         
         return text
     
-    def check_knowledge_base(self, message: str, lang: str) -> Optional[Dict[str, Any]]:
+    def normalize_for_matching(self, text: str) -> str:
+        """Normalize text for knowledge base matching, independently of the language"""
+        return self.normalize_arabic_text(self.preprocess_message(text, "fr"))
+    
+    def search_knowledge_base(self, message: str, top_k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Rank knowledge base entries for a message
+        
+        Returns:
+            Up to top_k hits, best first, each with entry, category, score and confidence
+        """
+        return self.search_knowledge_base_batch([message], top_k)[0]
+    
+    def search_knowledge_base_batch(self, messages: List[str],
+                                    top_k: Optional[int] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Rank knowledge base entries for several messages at once
+        
+        In dense and hybrid modes all messages are encoded together and scored
+        against the embedding matrix in a single matmul.
+        """
+        retrieval = self.get_retrieval_config()
+        top_k = top_k or retrieval["top_k"]
+        texts = [self.normalize_for_matching(message) for message in messages]
+        # One snapshot for the whole search, whatever a concurrent reload swaps in
+        snapshot, encoder = self.kb, self.encoder
+        
+        dense = None
+        if snapshot.embeddings is not None and encoder is not None and retrieval["mode"] in ("dense", "hybrid") and texts:
+            try:
+                dense = np.maximum(snapshot.embeddings.similarities(encoder.encode(texts)), 0.0)
+            except Exception as e:
+                logger.warning(f"Dense scoring failed, ranking lexically: {e}")
+        
+        results = []
+        for row, text in enumerate(texts):
+            scores, confidence = snapshot.index.score_entries(text, retrieval["keyword_weight"])
+            if dense is not None and len(confidence) == dense.shape[1]:
+                if retrieval["mode"] == "dense":
+                    scores = confidence = dense[row]
+                else:
+                    weight = retrieval["dense_weight"]
+                    confidence = (1.0 - weight) * confidence + weight * dense[row]
+            
+            hits = []
+            for entry_id in top_entries(confidence, top_k):
+                category, entry = snapshot.index.entries[entry_id]
+                hits.append({
+                    "entry": entry,
+                    "category": category,
+                    "score": float(scores[entry_id]),
+                    "confidence": float(confidence[entry_id])
+                })
+            results.append(hits)
+        return results
+    
+    def check_knowledge_base(self, message: str, lang: str,
+                             min_confidence: Optional[float] = None) -> Optional[Dict[str, Any]]:
         """Check if the message matches any knowledge base entries"""
-        # Simple keyword matching (can be improved with embeddings)
-        for category, entries in self.knowledge_base.items():
-            for entry in entries:
-                keywords = entry.get('keywords', [])
-                if any(keyword in message for keyword in keywords):
-                    return {
-                        "type": "text",
-                        "content": entry.get(f"answer_{lang}", entry.get("answer_fr", "Désolé, je n'ai pas de réponse.")),
-                        "confidence": 0.8,
-                        "source": "knowledge_base",
-                        "category": category
-                    }
-        return None
+        # BM25 ranking over questions, answers and keywords in both languages
+        if min_confidence is None:
+            min_confidence = self.get_retrieval_config()["min_confidence"]
+        
+        hits = self.search_knowledge_base(message)
+        if not hits or hits[0]["confidence"] < min_confidence:
+            return None
+        
+        best = hits[0]
+        entry = best["entry"]
+        return {
+            "type": "text",
+            "content": entry.get(f"answer_{lang}", entry.get("answer_fr", "Désolé, je n'ai pas de réponse.")),
+            "confidence": round(best["confidence"], 3),
+            "score": round(best["score"], 3),
+            "source": "knowledge_base",
+            "category": best["category"],
+            "suggestions": [hit["entry"].get(f"question_{lang}", hit["entry"].get("question_fr", ""))
+                            for hit in hits[1:] if hit["confidence"] >= min_confidence]
+        }
     
-    def generate_ai_response(self, message: str, lang: str, context: Optional[List[Dict[str, str]]]) -> Dict[str, Any]:
-        """Generate response using the AI model"""
+    def generate_ai_response(self, message: str, lang: str, context: Optional[List[Dict[str, str]]],
+                             stop_check=None) -> Dict[str, Any]:
+        """Generate response using the AI model (stop_check ends decoding early when it returns True)"""
+        if not self.ensure_model():
+            return self.get_fallback_response(message, lang)
         try:
             # Prepare input for the model
             model_input = self.prepare_model_input(message, lang, context)
             
-            # Run inference
+            # Decode token by token, reusing the KV cache between steps
+            model_config = self.get_model_config()
             start_time = time.time()
-            outputs = self.session.run(None, model_input)
-            inference_time = time.time() - start_time
+            if self.scheduler is not None:
+                result = self.scheduler.generate(model_input["input_ids"][0].tolist(),
+                                                 model_config["max_new_tokens"], stop_check,
+                                                 prefix=model_input["prefix"],
+                                                 on_prefill=model_input["on_prefill"])
+            else:
+                selector = ScoredSelector(LogitsProcessor.from_config(model_config))
+                with self.inference_slot:
+                    result = self.engine.generate(model_input["input_ids"],
+                                                  model_input["attention_mask"],
+                                                  max_new_tokens=model_config["max_new_tokens"],
+                                                  select_tokens=selector,
+                                                  stop_check=stop_check,
+                                                  prefix=model_input["prefix"],
+                                                  on_prefill=model_input["on_prefill"])
+                result["mean_logprob"] = selector.mean_logprob()
             
-            # Process model outputs
-            response_text = self.process_model_outputs(outputs, lang)
+            return self.get_model_answer(result, lang, "ai_model", time.time() - start_time)
             
+        except Exception as e:
+            logger.error(f"AI model inference failed: {e}")
+            return self.get_fallback_response(message, lang)
+    
+    def get_model_answer(self, result: Dict[str, Any], lang: str, source: str,
+                         inference_time: float) -> Dict[str, Any]:
+        """
+        Response dictionary of a generation result
+        
+        The raw confidence is the geometric-mean probability of the generated tokens;
+        the cascade calibrates it.
+        """
+        self.metrics.observe("model_prefill", result["prefill_time"])
+        self.metrics.observe("model_decode", result["decode_time"])
+        if "queue_wait" in result:
+            self.metrics.observe("model_queue", result["queue_wait"])
+        mean_logprob = result.get("mean_logprob")
+        with self.metrics.span("detokenize"):
+            content = self.process_model_outputs(result, lang)
+        return {
+            "type": "text",
+            "content": content,
+            "confidence": float(np.exp(mean_logprob)) if mean_logprob is not None else 0.0,
+            "source": source,
+            "inference_time": inference_time,
+            "generated_tokens": result["generated_tokens"],
+            "tokens_per_second": round(result["tokens_per_second"], 2)
+        }
+    
+    def generate_large_response(self, message: str, lang: str, context: Optional[List[Dict[str, str]]],
+                                stop_check=None) -> Dict[str, Any]:
+        """Generate with the cascade's larger model (fallback response while it is unavailable)"""
+        engine = self.ensure_large_model()
+        if engine is None:
+            return self.get_fallback_response(message, lang)
+        try:
+            with self.metrics.span("tokenize"):
+                tokens, _ = self.build_prompt(message, lang, context)
+            selector = ScoredSelector(LogitsProcessor.from_config(self.get_model_config()))
+            start_time = time.time()
+            with self.large_model_slot:
+                result = engine.generate(np.array([tokens], dtype=np.int64),
+                                         max_new_tokens=self.get_cascade_config()["large_model"]["max_new_tokens"],
+                                         select_tokens=selector,
+                                         stop_check=stop_check)
+            result["mean_logprob"] = selector.mean_logprob()
+            return self.get_model_answer(result, lang, "large_model", time.time() - start_time)
+        
+        except Exception as e:
+            logger.error(f"Large model inference failed: {e}")
+            return self.get_fallback_response(message, lang)
+    
+    def stream_ai_response(self, message: str, lang: str,
+                           context: Optional[List[Dict[str, str]]]):
+        """
+        Decode with the model, yielding text deltas as tokens arrive
+        
+        Returns (as the generator's return value) the response dictionary; fallback
+        responses carry their content there and yield nothing.
+        """
+        if not self.ensure_model():
+            return self.get_fallback_response(message, lang)
+        cancelled = threading.Event()
+        holds_slot = False
+        try:
+            model_input = self.prepare_model_input(message, lang, context)
+            model_config = self.get_model_config()
+            decoder = self.tokenizer.stream_decoder()
+            start_time = time.time()
+            generated = 0
+            parts = []
+            selector = None
+            
+            if self.scheduler is not None:
+                tokens: "queue.Queue[Optional[int]]" = queue.Queue()
+                future = self.scheduler.submit(model_input["input_ids"][0].tolist(),
+                                               model_config["max_new_tokens"],
+                                               stop_check=cancelled.is_set,
+                                               on_token=tokens.put,
+                                               prefix=model_input["prefix"],
+                                               on_prefill=model_input["on_prefill"])
+                future.add_done_callback(lambda _: tokens.put(None))
+                token_stream = iter(tokens.get, None)
+            else:
+                self.inference_slot.acquire()
+                holds_slot = True
+                selector = ScoredSelector(LogitsProcessor.from_config(model_config))
+                token_stream = (int(step[0]) for step in self.engine.iter_tokens(
+                    model_input["input_ids"], model_input["attention_mask"],
+                    max_new_tokens=model_config["max_new_tokens"],
+                    select_tokens=selector,
+                    prefix=model_input["prefix"], on_prefill=model_input["on_prefill"]))
+            
+            for token in token_stream:
+                if token == self.engine.eos_token_id:
+                    break
+                generated += 1
+                text = decoder.decode(token)
+                if text:
+                    parts.append(text)
+                    yield text
+            tail = decoder.flush()
+            if tail:
+                parts.append(tail)
+                yield tail
+            
+            inference_time = time.time() - start_time
+            if selector is not None:
+                mean_logprob = selector.mean_logprob()
+            else:
+                finished = future.done() and not future.cancelled() and future.exception() is None
+                mean_logprob = future.result()["mean_logprob"] if finished else None
             return {
                 "type": "text",
-                "content": response_text,
-                "confidence": 0.7,  # Placeholder confidence score
+                "content": "".join(parts),
+                "confidence": float(np.exp(mean_logprob)) if mean_logprob is not None else 0.0,
                 "source": "ai_model",
-                "inference_time": inference_time
+                "inference_time": inference_time,
+                "generated_tokens": generated,
+                "tokens_per_second": round(generated / inference_time, 2) if inference_time > 0 else 0.0
             }
-            
+        
         except Exception as e:
-            logger.error(f"AI model inference failed: {e}")
+            logger.error(f"AI model streaming failed: {e}")
             return self.get_fallback_response(message, lang)
+        finally:
+            # Stops the scheduled sequence if the consumer went away mid-stream
+            cancelled.set()
+            if holds_slot:
+                self.inference_slot.release()
+    
+    def select_turns(self, context: Optional[List[Dict[str, str]]], lang: str) -> List[Tuple[str, str]]:
+        """
+        Recent conversation turns to show the model, as (role, content)
+        
+        User turns are preprocessed like the current message. Past max_turns, the
+        oldest turns are dropped turn_stride at a time: the window then starts at the
+        same turn for several exchanges, which keeps the cached prefix usable.
+        """
+        conversation = self.get_conversation_config()
+        turns = []
+        for turn in context or []:
+            if not isinstance(turn, dict) or turn.get("role") not in ("user", "assistant"):
+                continue
+            content = turn.get("content")
+            if not isinstance(content, str) or not content.strip():
+                continue
+            if turn["role"] == "user":
+                content = self.preprocess_message(content, lang)
+            turns.append((turn["role"], content.strip()))
+        
+        limit = conversation["max_turns"]
+        stride = max(1, min(conversation["turn_stride"], limit))
+        if len(turns) <= limit:
+            return turns
+        return turns[-(-(len(turns) - limit) // stride) * stride:]
+    
+    def get_context_key(self, context: Optional[List[Dict[str, str]]], lang: str) -> Optional[str]:
+        """Digest of the turns a response depends on, for the response cache key"""
+        turns = self.select_turns(context, lang)
+        if not turns:
+            return None
+        return hashlib.sha256(json.dumps(turns, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+    
+    def tokenize_turn(self, role: str, content: str, lang: str) -> Tuple[List[int], List[int]]:
+        """(header, body) token ids of one ChatML turn, the content truncated to max_tokens"""
+        content = self.decode_tokens(self.tokenize(content, lang), lang)
+        return (self.tokenizer.encode(f"<|im_start|>{role}\n"),
+                self.tokenizer.encode(f"{content}<|im_end|>\n"))
+    
+    def build_prompt(self, message: str, lang: str,
+                     context: Optional[List[Dict[str, str]]]) -> Tuple[List[int], List[int]]:
+        """
+        Token ids of the conversation in the model's ChatML template
+        
+        Turns are encoded one by one, so a turn's prompt is an exact token prefix of
+        the next turn's: system prompt, history, user message, then the assistant
+        header the reply follows.
+        
+        Returns:
+            (tokens, boundaries), boundaries being the offsets where a cached prefix may
+            end: after the system prompt and after each past assistant header
+        """
+        conversation = self.get_conversation_config()
+        model_config = self.get_model_config()
+        header, body = self.tokenize_turn("user", message, lang)
+        current = header + body + self.tokenizer.encode("<|im_start|>assistant\n")
+        budget = min(conversation["context_tokens"],
+                     model_config["max_length"] - model_config["max_new_tokens"]) - len(current)
+        budget -= len(self.get_system_prompt_tokens(lang))
+        
+        turns = [(role, self.tokenize_turn(role, content, lang)) for role, content in self.select_turns(context, lang)]
+        stride = max(1, min(conversation["turn_stride"], conversation["max_turns"]))
+        start = 0
+        while start < len(turns) and sum(len(h) + len(b) for _, (h, b) in turns[start:]) > budget:
+            start += stride
+        
+        system = self.get_system_prompt_tokens(lang)
+        tokens, boundaries = list(system), [len(system)] if system else []
+        for role, (header, body) in turns[start:]:
+            tokens.extend(header)
+            if role == "assistant":
+                boundaries.append(len(tokens))
+            tokens.extend(body)
+        tokens.extend(current)
+        return tokens, boundaries
     
     def prepare_model_input(self, message: str, lang: str, context: Optional[List[Dict[str, str]]]) -> Dict[str, Any]:
-        """Prepare input for the ONNX model"""
-        # This is a simplified version - actual implementation would depend on the model architecture
+        """
+        Prepare input for the ONNX model
         
-        # Tokenize and encode the message
-        tokens = self.tokenize(message, lang)
+        With the conversation cache, the KV state of the longest cached earlier prompt
+        comes along as "prefix", and "on_prefill" stores this prompt's state for the
+        next turn. Failing that, the prefix is the language's shared system prompt state.
+        """
+        with self.metrics.span("tokenize"):
+            tokens, boundaries = self.build_prompt(message, lang, context)
         input_ids = np.array([tokens], dtype=np.int64)
         
         # Create attention mask
         attention_mask = np.ones_like(input_ids)
         
-        return {
+        model_input = {
             "input_ids": input_ids,
-            "attention_mask": attention_mask
+            "attention_mask": attention_mask,
+            "prefix": None,
+            "on_prefill": None
         }
+        conversations, engine = self.conversations, self.engine
+        parent = None
+        if conversations is not None:
+            found = conversations.lookup(tokens, boundaries)
+            if found is not None:
+                parent, model_input["prefix"] = found
+            
+            def remember(state, row):
+                conversations.store(tokens, engine.snapshot(state, row), replaces=parent)
+            model_input["on_prefill"] = remember
+        
+        # Otherwise start from the shared system prompt state
+        system = self.prompt_prefixes.get(lang)
+        if model_input["prefix"] is None and system is not None and tuple(tokens[:len(system[0])]) == system[0]:
+            model_input["prefix"] = system[1]
+            with self.stats_lock:
+                self.prompt_prefix_stats["requests"] += 1
+                self.prompt_prefix_stats["saved_prefill_ms"] += self.prompt_prefix_stats["languages"][lang]["prefill_ms"]
+        return model_input
+    
+    def tokenize_batch(self, texts: List[str], lang: str = "fr", padding_side: str = "right"):
+        """Tokenize several texts into padded (input_ids, attention_mask) int64 arrays"""
+        return self.tokenizer.encode_batch(texts, max_length=self.get_model_config()["max_tokens"],
+                                           padding_side=padding_side, truncation_side="right")
     
     def tokenize(self, text: str, lang: str) -> List[int]:
-        """Simple tokenization (replace with proper tokenizer)"""
-        # This is a placeholder - use actual tokenizer for the model
-        words = text.split()
-        # Simple word-to-id mapping (in practice, use proper vocab)
-        tokens = [hash(word) % 50000 for word in words]
-        return tokens[:self.config["model"]["max_tokens"]]
-    
-    def process_model_outputs(self, outputs: List[np.ndarray], lang: str) -> str:
-        """Process model outputs to get text response"""
-        # This is simplified - actual implementation depends on model architecture
-        output_ids = outputs[0]
-        
-        # Decode output IDs to text
-        response_tokens = output_ids[0].tolist()
+        """Tokenize text with the model vocabulary (deterministic across processes)"""
+        tokens = self.tokenizer.encode(text)
+        return tokens[:self.get_model_config()["max_tokens"]]
+    
+    def process_model_outputs(self, result: Dict[str, Any], lang: str) -> str:
+        """Process generation results to get text response"""
+        # Keep the first sequence up to (excluding) EOS
+        response_tokens = result["tokens"][0][:result["lengths"][0]].tolist()
         response_text = self.decode_tokens(response_tokens, lang)
         
         return response_text
     
     def decode_tokens(self, tokens: List[int], lang: str) -> str:
-        """Decode tokens back to text (placeholder)"""
-        # Simple decoding (replace with proper detokenizer)
-        words = [f"token_{token}" for token in tokens]
-        return " ".join(words)
+        """Decode tokens back to text"""
+        return self.tokenizer.decode(tokens)
     
     def get_fallback_response(self, message: str, lang: str) -> Dict[str, Any]:
         """Get a fallback response when AI fails"""
@@ -295,27 +1967,33 @@ class LightweightAIModel:
             "error": True
         }
     
-    def add_to_cache(self, key: str, response: Dict[str, Any]):
-        """Add response to cache with LRU eviction"""
-        if len(self.cache) >= self.max_cache_size:
-            # Remove oldest entry (simple FIFO)
-            oldest_key = next(iter(self.cache))
-            del self.cache[oldest_key]
-        
-        self.cache[key] = response
+    def get_cache_tag(self, source: str, category: Optional[str]) -> Optional[str]:
+        """Cache tag of answers taken from one knowledge base category"""
+        if source != "knowledge_base":
+            return None
+        return f"knowledge_base:{category}"
+    
+    def add_to_cache(self, key: str, response: Dict[str, Any], processed_message: Optional[str] = None,
+                     lang: str = "fr", context_key: Optional[str] = None):
+        """Add response to cache with LRU eviction (and to the near-duplicate cache when context-free)"""
+        tag = self.get_cache_tag(response.get("source"), response.get("category"))
+        self.cache.set(key, response, tag=tag)
+        if self.semantic_cache is not None and processed_message is not None and context_key is None:
+            self.semantic_cache.set(processed_message, lang, response, tag)
     
     def get_suggestions(self, category: Optional[str] = None, lang: str = "fr") -> List[str]:
         """Get AI suggestions for a category"""
         try:
             # Get popular queries from knowledge base
             suggestions = []
+            knowledge_base = self.kb.knowledge_base
             
-            if category and category in self.knowledge_base:
+            if category and category in knowledge_base:
                 suggestions = [entry.get(f"question_{lang}", entry.get("question_fr", "")) 
-                              for entry in self.knowledge_base[category][:5]]
+                              for entry in knowledge_base[category][:5]]
             else:
                 # Get general suggestions
-                for category_data in self.knowledge_base.values():
+                for category_data in knowledge_base.values():
                     suggestions.extend([entry.get(f"question_{lang}", entry.get("question_fr", "")) 
                                        for entry in category_data[:2]])
             
@@ -328,8 +2006,9 @@ class LightweightAIModel:
     def process_offline_request(self, message: str, lang: str = "fr") -> Dict[str, Any]:
         """Process request in offline mode using only local knowledge base"""
         try:
-            # Only use knowledge base, no AI model
-            kb_response = self.check_knowledge_base(message, lang)
+            # Only use knowledge base, no AI model: accept weaker matches than online
+            kb_response = self.check_knowledge_base(
+                message, lang, min_confidence=self.get_retrieval_config()["offline_min_confidence"])
             
             if kb_response:
                 kb_response["source"] = "offline_knowledge_base"
@@ -352,6 +2031,10 @@ class LightweightAIModel:
         except Exception as e:
             logger.error(f"Error processing offline request: {e}")
             return self.get_error_response(lang)
+    
+    async def process_offline_request_async(self, message: str, lang: str = "fr") -> Dict[str, Any]:
+        """Async counterpart of process_offline_request (knowledge base only, never waits on the model)"""
+        return self.process_offline_request(message, lang)
 
 # Global instance
 ai_model = None
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Bulk answer precomputation and offline answer packs
+Streams questions (JSONL files, knowledge base questions) through generate_response in
+a process pool, appends results as they complete, and compiles them into a versioned,
+gzip-compressed answer pack with a prebuilt lookup index that the PWA downloads once
+and queries offline
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Optional, Iterator, Iterable, Set
+
+logger = logging.getLogger(__name__)
+
+# Format of the compiled pack; the PWA refuses packs with a schema it does not know
+PACK_FORMAT = "moussadar-answer-pack"
+PACK_SCHEMA_VERSION = 2
+
+RESULTS_NAME = "results.jsonl"
+RUN_STATE_NAME = "run.json"
+PACK_MANIFEST_NAME = "manifest.json"
+
+# Fields tried, in order, for the question of an input record
+QUESTION_FIELDS = ("question", "message", "text", "title")
+
+# Order of the fields of each answer row in the pack
+ANSWER_FIELDS = ("type", "content", "source", "confidence")
+
+# Arabic diacritics and tatweel, dropped like LightweightAIModel.normalize_arabic_text
+ARABIC_DIACRITICS = {chr(c) for c in range(0x064B, 0x0660)} | {"\u0670", "\u0640"}
+ARABIC_FOLDING = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ة": "ه", "ي": "ى"})
+
+# Service instance of a pool worker
+worker_model = None
+
+
+def normalize_question(text: str) -> str:
+    """
+    Lookup form of a question
+
+    Lowercased, Arabic diacritics removed and letter variants folded, everything but
+    letters and digits turned into single spaces. answers.js in the frontend applies
+    the same rules to the user's question.
+    """
+    text = "".join(ch for ch in text.lower() if ch not in ARABIC_DIACRITICS).translate(ARABIC_FOLDING)
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in text).split())
+
+
+def input_key(question: str, lang: str, version: str) -> str:
+    """Identity of a result: the question, its language and the service version that answered"""
+    return hashlib.sha256(json.dumps([lang, question, version], ensure_ascii=False).encode('utf-8')).hexdigest()[:32]
+
+
+def read_jsonl_questions(path: str, default_lang: str, field: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Questions of a JSONL file, one object per line
+
+    The question is the first of `field` or QUESTION_FIELDS present; the language
+    comes from "lang" (default_lang otherwise) and the id from "id" or "request_id"
+    (path and line number otherwise). Lines without a question are skipped.
+    """
+    fields = (field,) if field else QUESTION_FIELDS
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning(f"{path}:{number}: not JSON, skipped")
+                continue
+            question = next((record[name] for name in fields
+                             if isinstance(record.get(name), str) and record[name].strip()), None)
+            if question is None:
+                continue
+            yield {
+                "id": str(record.get("id") or record.get("request_id") or f"{os.path.basename(path)}:{number}"),
+                "question": question.strip(),
+                "lang": record.get("lang") or default_lang
+            }
+
+
+def knowledge_base_questions(model) -> Iterator[Dict[str, Any]]:
+    """The French and Arabic question of every loaded knowledge base entry (JSON or database FAQ)"""
+    for category, entry in model.kb.index.entries:
+        for lang in model.config.get("languages", ["fr", "ar"]):
+            question = entry.get(f"question_{lang}")
+            if question:
+                yield {"id": f"faq:{category}:{entry.get('id')}:{lang}", "question": question, "lang": lang}
+
+
+def init_worker(model_path: str, config_path: str, threads: int):
+    """Pool initializer: load the service once per worker process"""
+    global worker_model
+    os.environ["AI_MODEL_LOADING"] = "eager"
+    os.environ.setdefault("AI_INTRA_OP_THREADS", str(threads))
+    from model_service import LightweightAIModel
+    worker_model = LightweightAIModel(model_path, config_path)
+
+
+def answer(record: Dict[str, Any], budget: Optional[float]) -> Dict[str, Any]:
+    """Answer one question in a pool worker"""
+    response = worker_model.generate_response(record["question"], record["lang"], budget=budget)
+    return {
+        "version": worker_model.get_cache_version(),
+        "answer": {name: response.get(name) for name in ANSWER_FIELDS},
+        "computed_at": time.time()
+    }
+
+
+def read_results(path: str) -> Iterator[Dict[str, Any]]:
+    """Records of a results file, skipping a line cut short by an interrupted run"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def precompute(questions: Iterable[Dict[str, Any]], version: str, workdir: str, model_path: str,
+               config_path: str, workers: int, max_in_flight: int, max_tasks_per_child: Optional[int],
+               budget: Optional[float]) -> Dict[str, Any]:
+    """
+    Answer the questions not answered yet by this service version
+
+    Questions are read lazily and at most max_in_flight are queued in the pool, so
+    memory stays bounded whatever the input size; workers are replaced after
+    max_tasks_per_child answers. Each answer is appended to the results file when it
+    completes, so an interrupted run loses nothing already answered.
+
+    Returns:
+        Counts of the run, plus the keys of every current question
+    """
+    results_path = os.path.join(workdir, RESULTS_NAME)
+    done = {record["key"] for record in read_results(results_path)}
+    current: List[str] = []
+    seen: Set[str] = set()
+    counts = Counter()
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    start_time = time.perf_counter()
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_worker, initargs=(model_path, config_path, threads),
+                                   max_tasks_per_child=max_tasks_per_child)
+    in_flight = {}
+
+    def collect(futures, out):
+        for future in futures:
+            record = in_flight.pop(future)
+            try:
+                record.update(future.result())
+            except BrokenProcessPool:
+                # A worker could not load the service or died: nothing more will be answered
+                raise
+            except Exception as e:
+                counts["failed"] += 1
+                logger.warning(f"Question {record['id']} failed: {e}")
+                continue
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            counts["computed"] += 1
+            if counts["computed"] % 100 == 0:
+                rate = counts["computed"] / (time.perf_counter() - start_time)
+                logger.info(f"{counts['computed']} answers computed ({rate:.1f}/s)")
+
+    try:
+        with open(results_path, 'a', encoding='utf-8') as out:
+            for question in questions:
+                key = input_key(question["question"], question["lang"], version)
+                if key in seen:
+                    counts["duplicates"] += 1
+                    continue
+                seen.add(key)
+                current.append(key)
+                if key in done:
+                    counts["reused"] += 1
+                    continue
+                while len(in_flight) >= max_in_flight:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(finished, out)
+                record = dict(question, key=key)
+                in_flight[executor.submit(answer, record, budget)] = record
+            while in_flight:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(finished, out)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    counts["questions"] = len(current)
+    return {"counts": dict(counts), "seconds": round(time.perf_counter() - start_time, 3), "keys": current}
+
+
+def build_pack(records: List[Dict[str, Any]], min_confidence: float) -> Dict[str, Any]:
+    """
+    Answer pack payload
+
+    answers are deduplicated rows of ANSWER_FIELDS; entries are one
+    [lang, answer row, weight, numbers] per question; exact maps "lang:normalized
+    question" to its entry; terms maps each question word to [idf, entries containing
+    it], with BM25's idf, weight is the idf total of an entry's words and numbers its
+    words holding digits. The PWA looks up exact first, then scores entries by the idf
+    they share with the question, skipping entries that mention other numbers.
+    """
+    answers, answer_rows, entries, exact = [], {}, [], {}
+    postings: Dict[str, List[int]] = {}
+    versions, languages = set(), set()
+    entry_terms = []
+    for record in records:
+        response = record["answer"]
+        if not response.get("content") or (response.get("confidence") or 0.0) < min_confidence:
+            continue
+        normalized = normalize_question(record["question"])
+        lookup_key = f"{record['lang']}:{normalized}"
+        if not normalized or lookup_key in exact:
+            continue
+        row = [response.get(name) for name in ANSWER_FIELDS]
+        row_key = json.dumps(row, ensure_ascii=False, sort_keys=True)
+        if row_key not in answer_rows:
+            answer_rows[row_key] = len(answers)
+            answers.append(row)
+        exact[lookup_key] = len(entries)
+        terms = sorted(set(normalized.split()))
+        for term in terms:
+            postings.setdefault(term, []).append(len(entries))
+        entries.append([record["lang"], answer_rows[row_key], 0.0,
+                        [term for term in terms if any(ch.isdecimal() for ch in term)]])
+        entry_terms.append(terms)
+        versions.add(record["version"])
+        languages.add(record["lang"])
+
+    count = len(entries)
+    idf = {term: round(math.log(1.0 + (count - len(ids) + 0.5) / (len(ids) + 0.5)), 4)
+           for term, ids in postings.items()}
+    for entry, terms in zip(entries, entry_terms):
+        entry[2] = round(sum(idf[term] for term in terms), 4)
+    return {
+        "format": PACK_FORMAT,
+        "schema": PACK_SCHEMA_VERSION,
+        "model_versions": sorted(versions),
+        "languages": sorted(languages),
+        "answer_fields": list(ANSWER_FIELDS),
+        "answers": answers,
+        "entries": entries,
+        "exact": exact,
+        "terms": {term: [idf[term], ids] for term, ids in sorted(postings.items())}
+    }
+
+
+def compile_pack(workdir: str, output_dir: str, min_confidence: float = 0.0) -> Dict[str, Any]:
+    """
+    Compile the current results into the answer pack served to the PWA
+
+    Keeps the latest result of each question of the last run (every result when no
+    run is recorded) and compacts the results file to them. The pack is named after
+    its content hash, so clients only download it again when answers changed; the
+    manifest points to it, and the pack it replaces is kept for clients midway
+    through a download.
+
+    Returns:
+        The manifest
+    """
+    results_path = os.path.join(workdir, RESULTS_NAME)
+    try:
+        with open(os.path.join(workdir, RUN_STATE_NAME), 'r', encoding='utf-8') as f:
+            keys = json.load(f)["keys"]
+    except FileNotFoundError:
+        keys = None
+
+    latest = {}
+    for record in read_results(results_path):
+        if keys is None:
+            latest[(record["lang"], record["question"])] = record
+        else:
+            latest[record["key"]] = record
+    if keys is not None:
+        records = [latest[key] for key in keys if key in latest]
+    else:
+        records = list(latest.values())
+
+    tmp_path = f"{results_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, results_path)
+
+    pack = build_pack(records, min_confidence)
+    payload = json.dumps(pack, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+    version = hashlib.sha256(payload).hexdigest()[:16]
+    # mtime 0: the same answers give byte-identical files
+    compressed = gzip.compress(payload, compresslevel=9, mtime=0)
+    pack_name = f"answers-{version}.json.gz"
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, PACK_MANIFEST_NAME)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    except (FileNotFoundError, ValueError):
+        previous = {}
+    if previous.get("version") == version and os.path.exists(os.path.join(output_dir, pack_name)):
+        logger.info(f"Answer pack {version} unchanged")
+        return previous
+
+    tmp_path = os.path.join(output_dir, f"{pack_name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(compressed)
+    os.replace(tmp_path, os.path.join(output_dir, pack_name))
+    manifest = {
+        "format": PACK_FORMAT,
+        "schema": PACK_SCHEMA_VERSION,
+        "version": version,
+        "file": pack_name,
+        "bytes": len(compressed),
+        "uncompressed_bytes": len(payload),
+        "sha256": hashlib.sha256(compressed).hexdigest(),
+        "questions": len(pack["entries"]),
+        "answers": len(pack["answers"]),
+        "languages": pack["languages"],
+        "model_versions": pack["model_versions"],
+        "created_at": time.time()
+    }
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+    keep = {pack_name, previous.get("file")}
+    for path in glob.glob(os.path.join(output_dir, "answers-*.json.gz")):
+        if os.path.basename(path) not in keep:
+            os.remove(path)
+    logger.info(f"Answer pack {version}: {manifest['questions']} questions, {manifest['answers']} answers, "
+                f"{len(compressed) / 1024:.1f} KiB ({len(payload) / 1024:.1f} KiB uncompressed)")
+    return manifest
+
+
+def run(args) -> Dict[str, Any]:
+    """Precompute the answers of every input question, then compile the pack"""
+    # The front process only reads the knowledge base and the service version
+    os.environ["AI_MODEL_LOADING"] = "lazy"
+    from model_service import LightweightAIModel
+
+    service = LightweightAIModel(args.model_path, args.config)
+    try:
+        # Workers load the variant the build manifest selects; the version must name it
+        service.select_model_variant()
+        version = service.get_cache_version()
+
+        def questions():
+            for path in args.input:
+                yield from read_jsonl_questions(path, args.lang, args.field)
+            if args.knowledge_base:
+                yield from knowledge_base_questions(service)
+
+        os.makedirs(args.workdir, exist_ok=True)
+        workers = args.workers or max(1, (os.cpu_count() or 1) // 2)
+        report = precompute(questions(), version, args.workdir, args.model_path, args.config,
+                            workers=workers, max_in_flight=args.max_in_flight or 2 * workers,
+                            max_tasks_per_child=args.max_tasks_per_child, budget=args.budget)
+    finally:
+        service.close()
+
+    state_path = os.path.join(args.workdir, RUN_STATE_NAME)
+    tmp_path = f"{state_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": version, "finished_at": time.time(), "keys": report.pop("keys")}, f)
+    os.replace(tmp_path, state_path)
+    logger.info(f"Precomputation done in {report['seconds']}s: {report['counts']}")
+    report["manifest"] = compile_pack(args.workdir, args.output, args.min_confidence)
+    return report
+
+
+def main():
+    """Precompute answers and/or compile the offline answer pack"""
+    parser = argparse.ArgumentParser(description="Precompute answers and build the PWA's offline answer pack")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Answer new or changed questions, then compile the pack")
+    run_parser.add_argument("--input", action="append", default=[], help="JSONL file of questions (repeatable)")
+    run_parser.add_argument("--knowledge-base", action="store_true",
+                            help="Also answer every knowledge base question (JSON or database FAQ)")
+    run_parser.add_argument("--field", help=f"Question field of the input records (default: first of {QUESTION_FIELDS})")
+    run_parser.add_argument("--lang", default="fr", help="Language of input records without a lang field")
+    run_parser.add_argument("--model-path", default="models/smollm2-135m-q4.onnx")
+    run_parser.add_argument("--config", default="config.json")
+    run_parser.add_argument("--workers", type=int, help="Worker processes (default: half the CPUs)")
+    run_parser.add_argument("--max-in-flight", type=int, help="Questions queued in the pool (default: 2 per worker)")
+    run_parser.add_argument("--max-tasks-per-child", type=int, default=1000,
+                            help="Answers before a worker process is replaced")
+    run_parser.add_argument("--budget", type=float, help="Seconds allowed per question (default from config)")
+    for subparser in (run_parser, subparsers.add_parser("compile", help="Compile the pack from existing results")):
+        subparser.add_argument("--workdir", default="cache/precompute", help="Results and run state")
+        subparser.add_argument("--output", default="../frontend/public/answer-pack",
+                               help="Directory of the pack and its manifest")
+        subparser.add_argument("--min-confidence", type=float, default=0.0,
+                               help="Leave weaker answers out of the pack")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "run":
+        if not args.input and not args.knowledge_base:
+            parser.error("nothing to answer: give --input and/or --knowledge-base")
+        report = run(args)
+    else:
+        report = compile_pack(args.workdir, args.output, args.min_confidence)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Two-tier response cache for the lightweight AI service
+In-process LRU with per-entry TTL and a byte budget, backed by a persistent diskcache store
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import diskcache
+except ImportError:  # pragma: no cover - optional dependency
+    diskcache = None
+
+# Disk key remembering which version the persistent entries belong to
+VERSION_KEY = "__cache_version__"
+
+
+class ResponseCache:
+    """
+    LRU + TTL response cache
+
+    Responses are stored serialized, which gives exact byte accounting and hands every
+    caller its own copy. Memory misses fall through to the disk tier, which is shared by
+    all worker processes on the host and survives restarts; disk hits are promoted.
+    """
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 8 * 1024 * 1024,
+                 ttl: Optional[float] = 3600, disk_path: Optional[str] = None,
+                 disk_size_limit: int = 256 * 1024 * 1024):
+        """
+        Initialize the cache
+
+        Args:
+            max_entries: Maximum number of in-process entries
+            max_bytes: Maximum serialized size of in-process entries
+            ttl: Seconds before an entry expires (None for no expiry)
+            disk_path: Directory of the persistent tier (None to disable it)
+            disk_size_limit: Size limit of the persistent tier in bytes
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version = ""
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "sets": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "tag_evictions": 0
+        }
+
+        self.disk_path = disk_path
+        self.disk_size_limit = disk_size_limit
+        self.disk = None
+        if disk_path:
+            if diskcache is None:
+                logger.warning("diskcache not installed, persistent response cache disabled")
+            else:
+                self.open_disk()
+                if self.disk is not None:
+                    logger.info(f"Persistent response cache at {disk_path}")
+
+    def open_disk(self):
+        """Open the persistent tier"""
+        try:
+            # The tag index makes evict_tags() a lookup instead of a scan
+            self.disk = diskcache.Cache(self.disk_path, size_limit=self.disk_size_limit, tag_index=True)
+        except Exception as e:
+            logger.warning(f"Persistent response cache unavailable: {e}")
+            self.disk = None
+
+    def reopen(self):
+        """
+        Reset process-local state after fork
+
+        SQLite connections must not be shared between processes, so the persistent tier
+        is reopened; the in-process entries inherited from the parent stay valid.
+        """
+        self.lock = threading.Lock()
+        if self.disk is not None:
+            self.open_disk()
+
+    def close(self):
+        """Close the persistent tier"""
+        if self.disk is not None:
+            self.disk.close()
+
+    def make_key(self, processed_message: str, lang: str, context: Optional[str] = None) -> str:
+        """Build a cache key from the preprocessed message, language, conversation digest and current version"""
+        if context:
+            # lang comes from a fixed set, so "fr+<digest>" never collides with a plain key
+            return f"{self.version}:{lang}+{context}:{processed_message}"
+        return f"{self.version}:{lang}:{processed_message}"
+
+    def set_version(self, version: str):
+        """
+        Switch to a new model/knowledge base version
+
+        In-process entries are dropped; the persistent tier is cleared once by the
+        first process that notices the change.
+        """
+        if version == self.version:
+            return
+        with self.lock:
+            if self.entries:
+                self.counters["invalidations"] += len(self.entries)
+            self.entries.clear()
+            self.current_bytes = 0
+            self.version = version
+
+        if self.disk is not None:
+            try:
+                if self.disk.get(VERSION_KEY) != version:
+                    self.disk.clear()
+                    self.disk.set(VERSION_KEY, version)
+            except Exception as e:
+                logger.warning(f"Failed to reset persistent response cache: {e}")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of the cached response, refreshing its recency"""
+        now = time.monotonic()
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None:
+                expires_at, payload, _ = item
+                if expires_at is not None and expires_at <= now:
+                    self._remove(key)
+                    self.counters["expirations"] += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return json.loads(payload)
+
+        payload, disk_expires_at, tag = None, None, None
+        if self.disk is not None:
+            try:
+                # The tag comes along so promoted entries stay evictable
+                payload, disk_expires_at, tag = self.disk.get(key, expire_time=True, tag=True)
+            except Exception as e:
+                logger.warning(f"Persistent response cache read failed: {e}")
+
+        if payload is None:
+            with self.lock:
+                self.counters["misses"] += 1
+            return None
+
+        # A promoted entry expires when its disk copy does, not a full TTL later
+        expires_at = now + (disk_expires_at - time.time()) if disk_expires_at is not None else None
+        with self.lock:
+            self.counters["disk_hits"] += 1
+            self._store(key, payload, expires_at, tag)
+        return json.loads(payload)
+
+    def set(self, key: str, response: Dict[str, Any], tag: Optional[str] = None):
+        """
+        Cache a response in both tiers
+
+        Args:
+            key: Key from make_key()
+            response: Response dictionary
+            tag: Group the entry can later be dropped with by evict_tags()
+        """
+        payload = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.counters["sets"] += 1
+            self._store(key, payload, expires_at, tag)
+
+        if self.disk is not None:
+            try:
+                self.disk.set(key, payload, expire=self.ttl, tag=tag)
+            except Exception as e:
+                logger.warning(f"Persistent response cache write failed: {e}")
+
+    def evict_tags(self, tags: List[str]) -> int:
+        """
+        Drop the entries carrying any of the given tags from both tiers
+
+        Returns:
+            Number of answers removed (one held by both tiers counts once)
+        """
+        tags = set(tags)
+        if not tags:
+            return 0
+        with self.lock:
+            keys = [key for key, (_, _, tag) in self.entries.items() if tag in tags]
+            for key in keys:
+                self._remove(key)
+        removed = len(keys)
+
+        if self.disk is not None:
+            try:
+                # Memory entries are promoted from or written through to the disk tier
+                removed = max(removed, sum(self.disk.evict(tag) for tag in tags))
+            except Exception as e:
+                logger.warning(f"Failed to evict from persistent response cache: {e}")
+
+        with self.lock:
+            self.counters["tag_evictions"] += removed
+        return removed
+
+    def clear(self):
+        """Drop every entry from both tiers"""
+        with self.lock:
+            self.counters["invalidations"] += len(self.entries)
+            self.entries.clear()
+            self.current_bytes = 0
+        if self.disk is not None:
+            self.disk.clear()
+            self.disk.set(VERSION_KEY, self.version)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters and occupancy of the cache"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.current_bytes
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        if self.disk is not None:
+            stats["disk_entries"] = len(self.disk)
+        return stats
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def _store(self, key: str, payload: bytes, expires_at: Optional[float], tag: Optional[str] = None):
+        """Insert or replace an entry expiring at expires_at (monotonic clock) and evict down to the budgets (lock held)"""
+        if key in self.entries:
+            self._remove(key)
+        if len(payload) > self.max_bytes:
+            return
+
+        self.entries[key] = (expires_at, payload, tag)
+        self.current_bytes += len(payload)
+
+        while len(self.entries) > self.max_entries or self.current_bytes > self.max_bytes:
+            _, (_, evicted, _) = self.entries.popitem(last=False)
+            self.current_bytes -= len(evicted)
+            self.counters["evictions"] += 1
+
+    def _remove(self, key: str):
+        """Remove an entry (lock held)"""
+        _, payload, _ = self.entries.pop(key)
+        self.current_bytes -= len(payload)
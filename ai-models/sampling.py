@@ -0,0 +1,167 @@
+"""
+Logits processing and token selection for the generation path
+Every stage works on the whole [batch, vocab] logits array at once; nothing loops over the vocabulary
+"""
+
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+
+class LogitsProcessor:
+    """
+    Repetition penalty -> top-k -> temperature -> top-p -> sample (or greedy)
+
+    Top-k uses argpartition so only the k best logits are ever sorted; top-p then runs
+    a cumulative sum over that k-sized slice instead of the full vocabulary.
+    Instances are callable and plug into GenerationEngine as select_tokens.
+    """
+
+    def __init__(self, temperature: float = 0.7, top_p: float = 0.9, top_k: int = 50,
+                 repetition_penalty: float = 1.1, do_sample: bool = True,
+                 seed: Optional[int] = None):
+        """
+        Initialize the processor
+
+        Args:
+            temperature: Softmax temperature; 0 means greedy
+            top_p: Nucleus mass kept among the top-k candidates (1.0 disables)
+            top_k: Candidates kept per row (0 disables)
+            repetition_penalty: CTRL-style penalty on already seen tokens (1.0 disables)
+            do_sample: Sample from the distribution instead of taking the argmax
+            seed: Seed for reproducible sampling
+        """
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.do_sample = do_sample and temperature > 0
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def from_config(cls, model_config: Dict[str, Any], seed: Optional[int] = None) -> "LogitsProcessor":
+        """Build a processor from the 'model' section of the service configuration"""
+        return cls(temperature=model_config.get("temperature", 0.7),
+                   top_p=model_config.get("top_p", 0.9),
+                   top_k=model_config.get("top_k", 50),
+                   repetition_penalty=model_config.get("repetition_penalty", 1.1),
+                   do_sample=model_config.get("do_sample", True),
+                   seed=model_config.get("seed") if seed is None else seed)
+
+    def apply_repetition_penalty(self, logits: np.ndarray, previous_ids: np.ndarray,
+                                 previous_mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Penalize tokens already present in each row (in place)
+
+        Gathers the logits of previous tokens, rescales them and scatters them back.
+        Duplicate ids read the same original value, so repeated writes agree.
+        """
+        if self.repetition_penalty == 1.0 or previous_ids.size == 0:
+            return logits
+        rows = np.broadcast_to(np.arange(len(logits))[:, None], previous_ids.shape)
+        if previous_mask is not None:
+            valid = previous_mask.astype(bool)
+            rows, previous_ids = rows[valid], previous_ids[valid]
+        seen = logits[rows, previous_ids]
+        logits[rows, previous_ids] = np.where(seen > 0, seen / self.repetition_penalty,
+                                              seen * self.repetition_penalty)
+        return logits
+
+    def select(self, logits: np.ndarray, previous_ids: Optional[np.ndarray] = None,
+               previous_mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Pick the next token of every row
+
+        Args:
+            logits: Array of shape [batch, vocab]
+            previous_ids: Tokens seen so far, [batch, n]
+            previous_mask: Which of previous_ids are real tokens, [batch, n]
+
+        Returns:
+            Token ids, shape [batch]
+        """
+        logits = np.array(logits, dtype=np.float32)
+        if previous_ids is not None:
+            self.apply_repetition_penalty(logits, previous_ids, previous_mask)
+
+        if not self.do_sample:
+            return np.argmax(logits, axis=-1).astype(np.int64)
+
+        batch_size, vocab_size = logits.shape
+        k = vocab_size if self.top_k <= 0 else min(self.top_k, vocab_size)
+        if k < vocab_size:
+            candidates = np.argpartition(-logits, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(vocab_size), (batch_size, vocab_size))
+        candidate_logits = np.take_along_axis(logits, candidates, axis=1) / self.temperature
+
+        # Sort only the k-sized slice, best first
+        order = np.argsort(-candidate_logits, axis=1)
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        candidate_logits = np.take_along_axis(candidate_logits, order, axis=1)
+
+        probs = np.exp(candidate_logits - candidate_logits[:, :1])
+        probs /= probs.sum(axis=1, keepdims=True)
+
+        if self.top_p < 1.0:
+            # Keep the smallest prefix whose mass reaches top_p (the best token always stays)
+            cumulative = np.cumsum(probs, axis=1)
+            probs = np.where(cumulative - probs < self.top_p, probs, 0.0)
+
+        # Inverse-CDF sampling for all rows at once
+        cumulative = np.cumsum(probs, axis=1)
+        draws = self.rng.random(batch_size) * cumulative[:, -1]
+        choice = np.minimum((cumulative < draws[:, None]).sum(axis=1), k - 1)
+        return candidates[np.arange(batch_size), choice].astype(np.int64)
+
+    def __call__(self, logits: np.ndarray, state) -> np.ndarray:
+        """GenerationEngine hook: select from logits given the decode state history"""
+        return self.select(logits,
+                           state.input_ids[:, :state.length],
+                           state.attention_mask[:, :state.length])
+
+
+def token_logprobs(logits: np.ndarray, tokens: np.ndarray) -> np.ndarray:
+    """Log-probability of each row's chosen token under the unprocessed model distribution"""
+    logits = np.asarray(logits, dtype=np.float32)
+    peak = logits.max(axis=-1)
+    log_norm = peak + np.log(np.exp(logits - peak[:, None]).sum(axis=-1))
+    return logits[np.arange(len(logits)), tokens] - log_norm
+
+
+class ScoredSelector:
+    """
+    Token selector that also accumulates the log-probability of what it picks
+
+    exp(mean log-probability) of a sequence is its geometric-mean token probability,
+    the confidence signal of model answers. Scores come from the raw logits, before
+    penalties and temperature, so they don't depend on the sampling settings. Rows
+    are scored until decoding stops; the engine stops single sequences at EOS.
+    """
+
+    def __init__(self, select_tokens=None):
+        """
+        Initialize the selector
+
+        Args:
+            select_tokens: Wrapped selector, e.g. a LogitsProcessor (greedy by default)
+        """
+        self.select_tokens = select_tokens
+        self.total = None
+        self.count = 0
+
+    def __call__(self, logits: np.ndarray, state) -> np.ndarray:
+        if self.select_tokens is None:
+            tokens = np.argmax(logits, axis=-1).astype(np.int64)
+        else:
+            tokens = np.asarray(self.select_tokens(logits, state), dtype=np.int64)
+        scores = token_logprobs(logits, tokens)
+        self.total = scores if self.total is None else self.total + scores
+        self.count += 1
+        return tokens
+
+    def mean_logprob(self, row: int = 0) -> Optional[float]:
+        """Mean log-probability of a row's tokens (None before the first step)"""
+        if self.total is None:
+            return None
+        return float(self.total[row]) / self.count
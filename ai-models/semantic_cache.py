@@ -0,0 +1,255 @@
+"""
+Near-duplicate response cache
+Finds answers cached for rephrasings of a message (same words, other order or filler)
+with MinHash signatures over the message's token set and LSH banding
+"""
+
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Callable, FrozenSet, Tuple
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Mersenne prime for the universal hash family; token hashes and coefficients stay
+# below it so a * x + b fits in 64 bits
+MERSENNE_PRIME = (1 << 31) - 1
+
+# Every word, numbers and single characters included: "2 pages" and "5 pages" ask
+# different questions (the knowledge index's pattern drops both)
+SIGNATURE_PATTERN = re.compile(r'\w+')
+
+# Function words that rephrasings add or drop without changing the question
+STOPWORDS = frozenset((
+    "le", "la", "les", "un", "une", "des", "de", "du", "et", "ou", "au", "aux", "en",
+    "je", "me", "mon", "ma", "mes", "est", "sont", "pour", "par", "sur", "dans", "avec",
+    "ce", "ces", "cette", "se", "il", "vous", "nous", "qu", "que", "qui", "quoi", "faut",
+    "svp", "stp", "l", "d", "j", "s", "c", "n", "m", "t", "y",
+    "في", "من", "على", "الى", "عن", "مع", "هل", "ما", "او", "ان"
+))
+
+
+class SemanticEntry:
+    """One cached answer and the token set it was given for"""
+
+    __slots__ = ("tokens", "bands", "payload", "tag")
+
+    def __init__(self, tokens: FrozenSet[str], bands: Tuple[int, ...], payload: bytes, tag: Optional[str]):
+        self.tokens = tokens
+        self.bands = bands
+        self.payload = payload
+        self.tag = tag
+
+
+class SemanticPartition:
+    """LRU of entries for one language plus its LSH buckets"""
+
+    def __init__(self):
+        self.entries: "OrderedDict[int, SemanticEntry]" = OrderedDict()
+        self.buckets: Dict[Tuple[int, int], set] = {}
+        self.current_bytes = 0
+        self.next_id = 0
+
+
+class SemanticCache:
+    """
+    MinHash/LSH near-duplicate cache, partitioned by language
+
+    A message's signature is the MinHash of its normalized token set (stopwords
+    dropped). Signatures are cut into bands; entries sharing a band with the
+    message are candidates, and a candidate is a hit when the exact Jaccard
+    similarity of the token sets reaches the threshold and both mention the same
+    numbers. Each language partition is bounded by entry count and payload bytes.
+    """
+
+    def __init__(self, normalize: Callable[[str], str], threshold: float = 0.8,
+                 max_entries: int = 2000, max_bytes: int = 4 * 1024 * 1024,
+                 num_perm: int = 64, bands: int = 16, min_tokens: int = 2, seed: int = 1):
+        """
+        Initialize the cache
+
+        Args:
+            normalize: Text normalization shared with the knowledge base index
+            threshold: Default minimum Jaccard similarity of token sets for a hit
+            max_entries: Maximum entries per language
+            max_bytes: Maximum serialized answer bytes per language
+            num_perm: MinHash signature length
+            bands: LSH bands (num_perm must be a multiple)
+            min_tokens: Messages with fewer distinct tokens are not matched
+            seed: Seed of the hash family
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.normalize = normalize
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.min_tokens = min_tokens
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.version = ""
+        self.partitions: Dict[str, SemanticPartition] = {}
+        self.lock = threading.Lock()
+        self.counters = {
+            "lookups": 0,
+            "hits": 0,
+            "sets": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "model_calls_avoided": 0,
+            "similarity_total": 0.0
+        }
+
+    def reopen(self):
+        """Reset the lock after fork; inherited entries stay valid"""
+        self.lock = threading.Lock()
+
+    def token_set(self, message: str) -> FrozenSet[str]:
+        """Distinct content tokens of a message"""
+        return frozenset(token for token in SIGNATURE_PATTERN.findall(self.normalize(message))
+                         if token not in STOPWORDS)
+
+    @staticmethod
+    def numbers(tokens: FrozenSet[str]) -> FrozenSet[str]:
+        """Tokens holding digits: fees, counts, years, form numbers"""
+        return frozenset(token for token in tokens if any(ch.isdigit() for ch in token))
+
+    def signature(self, tokens: FrozenSet[str]) -> Tuple[int, ...]:
+        """Band hashes of the MinHash signature"""
+        hashes = np.fromiter((int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(),
+                                             'little') % MERSENNE_PRIME for token in tokens),
+                             dtype=np.uint64, count=len(tokens))
+        minhash = ((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME).min(axis=0)
+        return tuple(hash(row.tobytes()) for row in minhash.reshape(self.bands, self.rows))
+
+    def set_version(self, version: str):
+        """Drop every entry when the model, knowledge base or config version changes"""
+        with self.lock:
+            if version == self.version:
+                return
+            self.counters["invalidations"] += sum(len(p.entries) for p in self.partitions.values())
+            self.partitions = {}
+            self.version = version
+
+    def get(self, message: str, lang: str,
+            threshold: Optional[float] = None) -> Optional[Tuple[Dict[str, Any], float]]:
+        """
+        Find the answer cached for the most similar earlier message
+
+        Args:
+            message: Preprocessed message
+            lang: Language partition
+            threshold: Minimum similarity for this lookup (default: the cache's)
+
+        Returns:
+            (copy of the response, similarity), or None
+        """
+        if threshold is None:
+            threshold = self.threshold
+        tokens = self.token_set(message)
+        if len(tokens) < self.min_tokens:
+            return None
+        bands = self.signature(tokens)
+        with self.lock:
+            self.counters["lookups"] += 1
+            partition = self.partitions.get(lang)
+            if partition is None:
+                return None
+            candidates = set()
+            for band, value in enumerate(bands):
+                candidates.update(partition.buckets.get((band, value), ()))
+
+            best, best_similarity = None, 0.0
+            numbers = self.numbers(tokens)
+            for entry_id in candidates:
+                entry = partition.entries[entry_id]
+                # However similar the wording, other numbers make it another question
+                if self.numbers(entry.tokens) != numbers:
+                    continue
+                similarity = len(tokens & entry.tokens) / len(tokens | entry.tokens)
+                if similarity > best_similarity:
+                    best, best_similarity = entry_id, similarity
+            if best is None or best_similarity < threshold:
+                return None
+
+            partition.entries.move_to_end(best)
+            response = json.loads(partition.entries[best].payload)
+            self.counters["hits"] += 1
+            self.counters["similarity_total"] += best_similarity
+            if response.get("source") == "ai_model":
+                self.counters["model_calls_avoided"] += 1
+        return response, best_similarity
+
+    def set(self, message: str, lang: str, response: Dict[str, Any], tag: Optional[str] = None):
+        """Remember an answer for a message (and its near-duplicates)"""
+        tokens = self.token_set(message)
+        if len(tokens) < self.min_tokens:
+            return
+        bands = self.signature(tokens)
+        payload = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        if len(payload) > self.max_bytes:
+            return
+        with self.lock:
+            self.counters["sets"] += 1
+            partition = self.partitions.setdefault(lang, SemanticPartition())
+            # A near-identical entry is replaced rather than stored twice
+            for band, value in enumerate(bands):
+                for entry_id in list(partition.buckets.get((band, value), ())):
+                    if partition.entries[entry_id].tokens == tokens:
+                        self._remove(partition, entry_id)
+
+            entry_id = partition.next_id
+            partition.next_id += 1
+            partition.entries[entry_id] = SemanticEntry(tokens, bands, payload, tag)
+            partition.current_bytes += len(payload)
+            for band, value in enumerate(bands):
+                partition.buckets.setdefault((band, value), set()).add(entry_id)
+
+            while len(partition.entries) > self.max_entries or partition.current_bytes > self.max_bytes:
+                self._remove(partition, next(iter(partition.entries)))
+                self.counters["evictions"] += 1
+
+    def evict_tags(self, tags: List[str]) -> int:
+        """
+        Drop the entries carrying any of the given tags
+
+        Returns:
+            Number of entries removed
+        """
+        tags = set(tags)
+        removed = 0
+        with self.lock:
+            for partition in self.partitions.values():
+                for entry_id in [i for i, entry in partition.entries.items() if entry.tag in tags]:
+                    self._remove(partition, entry_id)
+                    removed += 1
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rate, avoided model calls and occupancy per language"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["languages"] = {lang: {"entries": len(p.entries), "bytes": p.current_bytes}
+                                  for lang, p in self.partitions.items()}
+        similarity_total = stats.pop("similarity_total")
+        stats["hit_ratio"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+        stats["mean_similarity"] = similarity_total / stats["hits"] if stats["hits"] else 0.0
+        return stats
+
+    def _remove(self, partition: SemanticPartition, entry_id: int):
+        """Remove an entry and its bucket postings (lock held)"""
+        entry = partition.entries.pop(entry_id)
+        partition.current_bytes -= len(entry.payload)
+        for band, value in enumerate(entry.bands):
+            bucket = partition.buckets[(band, value)]
+            bucket.discard(entry_id)
+            if not bucket:
+                del partition.buckets[(band, value)]
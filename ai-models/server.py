@@ -0,0 +1,229 @@
+"""
+HTTP front for the AI model service
+The Node backend proxies /api/ai requests here
+"""
+
+import hmac
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Any
+
+from flask import Flask, Response, request, jsonify, stream_with_context
+import logging
+
+from model_service import get_ai_model
+from session_store import session_stats
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+SUPPORTED_LANGUAGES = ("fr", "ar")
+MAX_MESSAGE_LENGTH = 1000
+MAX_BATCH_SIZE = 32
+STARTED_AT = time.time()
+# Admin routes require this bearer token; without it they only answer local callers
+ADMIN_TOKEN = os.environ.get("AI_ADMIN_TOKEN")
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def success(data: Any):
+    """Wrap a payload in the backend's response envelope"""
+    return jsonify({"success": True, "data": data})
+
+
+def failure(error: str, status: int):
+    """Error envelope with an HTTP status"""
+    return jsonify({"success": False, "error": error}), status
+
+
+def timestamp() -> str:
+    """Current UTC time in ISO 8601"""
+    return datetime.now(timezone.utc).isoformat()
+
+
+def parse_chat_request(payload: Dict[str, Any] = None):
+    """
+    Validate a chat payload
+
+    Returns:
+        (message, lang, context) or raises ValueError
+    """
+    if payload is None:
+        payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        raise ValueError("each request must be an object")
+    message = payload.get("message")
+    lang = payload.get("lang") or "fr"
+    context = payload.get("context")
+    if not isinstance(message, str) or not 1 <= len(message) <= MAX_MESSAGE_LENGTH:
+        raise ValueError(f"message must be a string of 1 to {MAX_MESSAGE_LENGTH} characters")
+    if lang not in SUPPORTED_LANGUAGES:
+        raise ValueError(f"lang must be one of {', '.join(SUPPORTED_LANGUAGES)}")
+    if context is not None and not (
+            isinstance(context, list) and
+            all(isinstance(turn, dict) and turn.get("role") in ("user", "assistant") and
+                isinstance(turn.get("content"), str) for turn in context)):
+        raise ValueError("context must be a list of {role: user|assistant, content} messages")
+    return message, lang, context
+
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    """Answer one message: cache, knowledge base, then the model"""
+    try:
+        message, lang, context = parse_chat_request()
+    except ValueError as e:
+        return failure(str(e), 400)
+
+    response = get_ai_model().generate_response(message, lang, context)
+    return success({"response": response, "timestamp": timestamp()})
+
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """
+    Answer several messages in one call
+
+    Messages are submitted concurrently so that, with batching enabled, the ones that
+    reach the model share forward passes.
+    """
+    payload = request.get_json(silent=True) or {}
+    items = payload.get("requests")
+    if not isinstance(items, list) or not 1 <= len(items) <= MAX_BATCH_SIZE:
+        return failure(f"requests must be a list of 1 to {MAX_BATCH_SIZE} chat requests", 400)
+    try:
+        parsed = [parse_chat_request(item) for item in items]
+    except ValueError as e:
+        return failure(str(e), 400)
+
+    model = get_ai_model()
+    concurrency = model.scheduler.max_batch_size if model.scheduler is not None else 1
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(parsed))) as executor:
+        responses = list(executor.map(lambda args: model.generate_response(*args), parsed))
+    return success({"responses": responses, "timestamp": timestamp()})
+
+
+@app.route("/suggestions", methods=["GET"])
+def suggestions():
+    """Popular questions, optionally for one category"""
+    lang = request.args.get("lang", "fr")
+    if lang not in SUPPORTED_LANGUAGES:
+        return failure(f"lang must be one of {', '.join(SUPPORTED_LANGUAGES)}", 400)
+    return success(get_ai_model().get_suggestions(request.args.get("category"), lang))
+
+
+@app.route("/offline", methods=["POST"])
+def offline():
+    """Knowledge base only answer, as served to offline clients"""
+    try:
+        message, lang, _ = parse_chat_request()
+    except ValueError as e:
+        return failure(str(e), 400)
+
+    response = get_ai_model().process_offline_request(message, lang)
+    return success({"response": response, "timestamp": timestamp()})
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Liveness plus what this worker has loaded"""
+    model = get_ai_model()
+    return jsonify({
+        "status": "healthy",
+        "pid": os.getpid(),
+        "uptime": time.time() - STARTED_AT,
+        "model_loaded": model.engine is not None,
+        "model_error": model.model_error,
+        "model_variant": model.model_variant,
+        "startup": model.startup_times,
+        "knowledge_base": model.knowledge_base_stats(),
+        "cache": model.cache.stats() if model.cache is not None else None,
+        "semantic_cache": model.semantic_cache.stats() if model.semantic_cache is not None else None,
+        "cascade": model.cascade_stats.stats(),
+        "batching": model.scheduler.stats() if model.scheduler is not None else None,
+        "conversations": model.conversations.stats() if model.conversations is not None else None,
+        "system_prompts": model.prompt_prefix_stats,
+        "pool": model.pool.stats() if model.pool is not None else None,
+        "sessions": session_stats(),
+        "timestamp": timestamp()
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus scrape endpoint: stage latencies, answer sources, memory and threads of every worker"""
+    return Response(get_ai_model().render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def is_admin() -> bool:
+    """Whether the caller may use admin routes"""
+    if ADMIN_TOKEN:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        return hmac.compare_digest(supplied, ADMIN_TOKEN)
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+
+@app.route("/admin/knowledge-base/reload", methods=["POST"])
+def reload_knowledge_base():
+    """
+    Rebuild the knowledge base from its source and swap it in
+
+    Answers keep being served from the current snapshot meanwhile. With {"wait": false}
+    the reload runs in the background and the call returns at once. Each gunicorn worker
+    holds its own snapshot: this reloads the worker that got the call, the file watcher
+    catches up the others.
+    """
+    if not is_admin():
+        return failure("forbidden", 403)
+    payload = request.get_json(silent=True) or {}
+    model = get_ai_model()
+    if payload.get("wait", True) is False:
+        model.reload_knowledge_base_async()
+        return jsonify({"success": True, "data": {"reloading": True}}), 202
+    result = model.reload_knowledge_base()
+    if "error" in result:
+        return failure(result["error"], 500)
+    return success(result)
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """Stream a response as server-sent events: token chunks, then the final response"""
+    try:
+        message, lang, context = parse_chat_request()
+    except ValueError as e:
+        return failure(str(e), 400)
+
+    model = get_ai_model()
+
+    def events():
+        # Closing the response (client gone) closes this generator, which stops decoding
+        for event in model.generate_response_stream(message, lang, context):
+            if event["event"] == "token":
+                yield sse_event("token", {"content": event["content"]})
+            else:
+                yield sse_event("done", event["response"])
+
+    return Response(stream_with_context(events()),
+                    mimetype="text/event-stream",
+                    headers={
+                        "Cache-Control": "no-cache, no-transform",
+                        "X-Accel-Buffering": "no"
+                    })
+
+
+if __name__ == "__main__":
+    # Development server; production runs under gunicorn -c gunicorn.conf.py server:app
+    get_ai_model()
+    app.run(host=os.environ.get("AI_SERVICE_HOST", "0.0.0.0"),
+            port=int(os.environ.get("AI_SERVICE_PORT", 5000)),
+            threaded=True)
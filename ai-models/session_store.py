@@ -0,0 +1,317 @@
+"""
+Shared onnxruntime sessions with memory-mapped weights
+Models are stored with their weights as page-aligned ONNX external data, which
+onnxruntime maps read-only instead of copying; sessions of the same model in one
+process are shared, and per-session resident and shared memory is reported
+"""
+
+import hashlib
+import mmap
+import os
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Weight handling modes:
+#   mmap: weights stay in the external data file, mapped read-only. Pages come from
+#         the page cache, so every session and worker process on the node shares one
+#         copy; prepacking is disabled since packed weights would be private copies.
+#   prepacked: weights are copied into the session and prepacked for the CPU kernels
+#         (fastest prefill, one private copy per process).
+WEIGHT_MODES = ("mmap", "prepacked")
+
+# Offsets of external tensors are aligned to the largest allocation granularity
+# (64 KiB on Windows) so onnxruntime can map them on every platform
+ALIGNMENT = 64 * 1024
+
+# Smaller tensors stay inline in the graph
+EXTERNAL_MIN_BYTES = 1024
+
+DATA_SUFFIX = ".data"
+
+
+def external_data_files(path: str, min_bytes: int = EXTERNAL_MIN_BYTES) -> Optional[List[str]]:
+    """
+    Data files of a model whose weights are all mappable external data
+
+    Returns:
+        Absolute paths of the external data files, or None when a tensor of at least
+        min_bytes is stored inline or at an offset onnxruntime cannot map
+    """
+    import onnx
+
+    model = onnx.load(path, load_external_data=False)
+    directory = os.path.dirname(os.path.abspath(path))
+    files = set()
+    for tensor in model.graph.initializer:
+        if tensor.data_location == onnx.TensorProto.EXTERNAL:
+            info = {entry.key: entry.value for entry in tensor.external_data}
+            if int(info.get("offset", 0)) % mmap.ALLOCATIONGRANULARITY:
+                return None
+            files.add(os.path.join(directory, info["location"]))
+        elif tensor.ByteSize() >= min_bytes:
+            return None
+    return sorted(files)
+
+
+def externalize(source: str, destination: str, min_bytes: int = EXTERNAL_MIN_BYTES) -> str:
+    """
+    Write a copy of a model with its weights moved to an aligned external data file
+
+    The data file is named after the destination and this process, so concurrent
+    writers never share one; the graph is written last and renamed into place.
+
+    Returns:
+        The destination path
+    """
+    import onnx
+    from onnx import numpy_helper
+    from onnx.external_data_helper import set_external_data
+
+    model = onnx.load(source)
+    data_name = f"{os.path.basename(destination)}.{os.getpid()}{DATA_SUFFIX}"
+    data_path = os.path.join(os.path.dirname(destination) or ".", data_name)
+    offset = 0
+    with open(data_path, 'wb') as f:
+        for tensor in model.graph.initializer:
+            if not tensor.HasField("raw_data"):
+                if tensor.ByteSize() < min_bytes:
+                    continue
+                tensor.CopyFrom(numpy_helper.from_array(numpy_helper.to_array(tensor), tensor.name))
+            if len(tensor.raw_data) < min_bytes:
+                continue
+            padding = -offset % ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+            length = len(tensor.raw_data)
+            f.write(tensor.raw_data)
+            # set_external_data reads raw_data, so it is cleared afterwards
+            set_external_data(tensor, data_name, offset=offset, length=length)
+            tensor.data_location = onnx.TensorProto.EXTERNAL
+            tensor.ClearField("raw_data")
+            offset += length
+        f.flush()
+        os.fsync(f.fileno())
+
+    tmp_path = f"{destination}.{os.getpid()}.tmp"
+    onnx.save(model, tmp_path)
+    os.replace(tmp_path, destination)
+    logger.info(f"Weights of {source} externalized to {data_path} ({offset / 2**20:.1f} MiB)")
+    return destination
+
+
+def mappable_path(path: str, cache_dir: Optional[str]) -> Optional[str]:
+    """
+    A version of the model whose weights onnxruntime can map
+
+    The model itself when its weights already are aligned external data, else an
+    externalized copy in cache_dir (written on first use, keyed by path, size and
+    mtime). None when neither is possible.
+    """
+    try:
+        if external_data_files(path) is not None:
+            return path
+    except ImportError:
+        logger.warning("onnx is not installed: model weights cannot be externalized")
+        return None
+    if not cache_dir:
+        return None
+    stat = os.stat(path)
+    key = hashlib.sha256(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    stem = os.path.splitext(os.path.basename(path))[0]
+    destination = os.path.join(cache_dir, f"{stem}-{key[:16]}-mmap.onnx")
+    if not os.path.exists(destination):
+        os.makedirs(cache_dir, exist_ok=True)
+        externalize(path, destination)
+    return destination
+
+
+def anonymous_bytes() -> int:
+    """Private anonymous (heap) memory of this process"""
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def mapped_files() -> Dict[str, Dict[str, int]]:
+    """Resident, proportional, shared and private bytes of every file mapped by this process"""
+    files = {}
+    current = None
+    try:
+        with open("/proc/self/smaps", 'r') as f:
+            for line in f:
+                parts = line.split()
+                if not parts:
+                    continue
+                if "-" in parts[0] and not parts[0].endswith(":"):
+                    current = None
+                    if len(parts) >= 6 and parts[5].startswith("/"):
+                        current = files.setdefault(" ".join(parts[5:]), {"resident": 0, "proportional": 0,
+                                                              "shared": 0, "private": 0})
+                    continue
+                if current is None or len(parts) != 3:
+                    continue
+                value = int(parts[1]) * 1024
+                if parts[0] == "Rss:":
+                    current["resident"] += value
+                elif parts[0] == "Pss:":
+                    current["proportional"] += value
+                elif parts[0] in ("Shared_Clean:", "Shared_Dirty:"):
+                    current["shared"] += value
+                elif parts[0] in ("Private_Clean:", "Private_Dirty:"):
+                    current["private"] += value
+    except OSError:
+        pass
+    return files
+
+
+class SessionStore:
+    """
+    Process-wide registry of onnxruntime sessions
+
+    Sessions are shared by model file and session options: a model opened by several
+    components of one process is loaded once (onnxruntime sessions may be run from
+    several threads). Entries are counted per user and dropped on the last release.
+    After a fork only single-threaded sessions stay shareable: the intra-op thread
+    pool of the others did not survive it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+    def open(self, path: str, sess_options, weights: str = "mmap", cache_dir: Optional[str] = None,
+             name: Optional[str] = None):
+        """
+        Get a session of a model, loading it unless an identical one is open
+
+        Args:
+            path: ONNX model
+            sess_options: onnxruntime SessionOptions (a session config entry is added in mmap mode)
+            weights: One of WEIGHT_MODES
+            cache_dir: Where externalized copies of models with inline weights go;
+                without it such models are loaded with private weights
+            name: Label in the memory report (default: the model file name)
+        """
+        import onnxruntime as ort
+
+        if weights not in WEIGHT_MODES:
+            raise ValueError(f"Unknown weights mode {weights!r}, expected one of {WEIGHT_MODES}")
+        data_files = []
+        mode = weights
+        if weights == "mmap":
+            mapped = mappable_path(path, cache_dir)
+            if mapped is None:
+                logger.info(f"{path} has inline weights and no cache directory: loading a private copy")
+                mode = "private"
+            else:
+                path = mapped
+                data_files = external_data_files(path)
+                # Prepacked weights would be private copies of the mapped ones
+                sess_options.add_session_config_entry("session.disable_prepacking", "1")
+
+        stat = os.stat(path)
+        key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns, mode,
+               int(sess_options.graph_optimization_level), sess_options.intra_op_num_threads,
+               sess_options.inter_op_num_threads, int(sess_options.execution_mode))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry["users"] += 1
+                logger.info(f"Sharing the open session of {path} ({entry['users']} users)")
+                return entry["session"]
+
+            # Loads are serialized so the heap growth measured belongs to this session
+            before = anonymous_bytes()
+            start_time = time.perf_counter()
+            session = ort.InferenceSession(path, sess_options, providers=['CPUExecutionProvider'])
+            self.entries[key] = {
+                "session": session,
+                "name": name or os.path.basename(path),
+                "path": path,
+                "weights": mode,
+                "data_files": data_files,
+                "users": 1,
+                "intra_op_threads": sess_options.intra_op_num_threads,
+                "load_seconds": time.perf_counter() - start_time,
+                "private_bytes": max(anonymous_bytes() - before, 0)
+            }
+        return session
+
+    def after_fork(self):
+        """In a forked child, drop inherited sessions that used an intra-op thread pool"""
+        # A load running in another thread at fork time may have held the lock
+        self.lock = threading.Lock()
+        self.entries = {key: entry for key, entry in self.entries.items() if entry["intra_op_threads"] == 1}
+
+    def release(self, session):
+        """Drop one user of a session; the last release forgets it"""
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry["session"] is session:
+                    entry["users"] -= 1
+                    if entry["users"] <= 0:
+                        del self.entries[key]
+                    return
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        Memory of each open session
+
+        private_bytes is the heap growth while the session loaded (weight copies,
+        prepacked weights, graph); the mapped_* figures describe the pages of its
+        external data files: resident here, shared with other processes, and the
+        proportional share charged to this process.
+        """
+        files = mapped_files()
+        with self.lock:
+            entries = list(self.entries.values())
+        report = []
+        for entry in entries:
+            mapped = {"resident": 0, "proportional": 0, "shared": 0, "private": 0}
+            for data_file in entry["data_files"]:
+                for field, value in files.get(data_file, {}).items():
+                    mapped[field] += value
+            report.append({
+                "name": entry["name"],
+                "path": entry["path"],
+                "weights": entry["weights"],
+                "users": entry["users"],
+                "load_seconds": round(entry["load_seconds"], 3),
+                "private_bytes": entry["private_bytes"],
+                "mapped_resident_bytes": mapped["resident"],
+                "mapped_shared_bytes": mapped["shared"],
+                "mapped_private_bytes": mapped["private"],
+                "mapped_proportional_bytes": mapped["proportional"]
+            })
+        return report
+
+
+_store = SessionStore()
+
+
+def open_session(path: str, sess_options, weights: str = "mmap", cache_dir: Optional[str] = None,
+                 name: Optional[str] = None):
+    """Get a session from the process-wide store (see SessionStore.open)"""
+    return _store.open(path, sess_options, weights=weights, cache_dir=cache_dir, name=name)
+
+
+def release_session(session):
+    """Release a session obtained from open_session"""
+    _store.release(session)
+
+
+def session_stats() -> List[Dict[str, Any]]:
+    """Memory report of the sessions open in this process"""
+    return _store.stats()
@@ -0,0 +1,32 @@
+"""
+Shared fixtures for the AI service tests
+The service modules live next to this directory and import each other by name
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory):
+    """A small randomly initialized decoder with the exported model's inputs and outputs"""
+    from tiny_model import build_tiny_decoder
+    return build_tiny_decoder(str(tmp_path_factory.mktemp("models") / "tiny.onnx"), hidden_size=32, num_layers=1)
+
+
+@pytest.fixture(scope="session")
+def tiny_engine(tiny_model_path):
+    """Generation engine over the tiny model"""
+    import onnxruntime as ort
+    from generation import GenerationEngine
+    from tokenizer import ByteTokenizer
+
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = 1
+    session = ort.InferenceSession(tiny_model_path, sess_options, providers=['CPUExecutionProvider'])
+    tokenizer = ByteTokenizer()
+    return GenerationEngine(session, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id)
@@ -0,0 +1,129 @@
+"""Admission control of the async front-end"""
+
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+
+class BlockingModel:
+    """Stands in for generate_ai_response: answers once released, or stops when asked"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = []
+        self.stopped = []
+
+    def __call__(self, message, lang, context, stop_check=None):
+        self.started.append(message)
+        while not self.release.wait(0.005):
+            if stop_check is not None and stop_check():
+                self.stopped.append(message)
+                break
+        return {"type": "text", "content": f"Réponse à {message}", "confidence": 0.9, "source": "ai_model"}
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    from model_service import LightweightAIModel
+
+    (tmp_path / "knowledge_base.json").write_text("{}")
+    config = {
+        "model": {"loading": "lazy", "graph_cache_dir": None},
+        "knowledge_base": {"source": "json", "watch_interval": 0},
+        "knowledge_base_path": str(tmp_path / "knowledge_base.json"),
+        "conversation": {"enabled": False},
+        "cache": {"disk_path": None},
+        "metrics": {"dir": None},
+        "async": {"max_workers": 1, "max_pending": 2, "timeout": 5.0},
+        "cascade": {"stages": ["model"], "thresholds": {"model": 0.0}}
+    }
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    service = LightweightAIModel(str(tmp_path / "model.onnx"), str(tmp_path / "config.json"))
+    model = BlockingModel()
+    monkeypatch.setattr(service, "generate_ai_response", model)
+    yield service, model
+    model.release.set()
+    service.close()
+
+
+async def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.005)
+
+
+def test_requests_past_max_pending_are_refused(service):
+    service, model = service
+
+    async def scenario():
+        admitted = [asyncio.create_task(service.generate_response_async(f"question {i}", "fr"))
+                    for i in range(2)]
+        await wait_until(lambda: service.pending == 2 and model.started)
+        # One pool thread: the second request waits in the executor queue
+        assert model.started == ["question 0"]
+
+        started = time.perf_counter()
+        refused = await service.generate_response_async("question 2", "fr")
+        assert time.perf_counter() - started < 1.0
+        model.release.set()
+        return refused, await asyncio.gather(*admitted)
+
+    refused, answered = asyncio.run(scenario())
+    assert refused["fallback_reason"] == "overloaded"
+    assert refused["cascade"]["stages"][0]["outcome"] == "skipped"
+    assert [response["content"] for response in answered] == ["Réponse à question 0.", "Réponse à question 1."]
+    assert model.started == ["question 0", "question 1"]
+    assert service.pending == 0
+    assert service.get_executor()._max_workers == 1
+
+
+def test_slots_are_freed_for_later_requests(service):
+    service, model = service
+    model.release.set()
+
+    async def scenario():
+        return [await service.generate_response_async(f"question {i}", "fr") for i in range(5)]
+
+    responses = asyncio.run(scenario())
+    assert all(response["source"] == "ai_model" for response in responses)
+    assert "fallback_reason" not in responses[-1]
+    assert service.pending == 0
+
+
+def test_deadline_stops_decoding_and_keeps_the_slot_until_done(service):
+    service, model = service
+
+    async def scenario():
+        started = time.perf_counter()
+        response = await service.generate_response_async("question lente", "fr", timeout=0.2)
+        return response, time.perf_counter() - started
+
+    response, elapsed = asyncio.run(scenario())
+    assert response["fallback_reason"] == "deadline"
+    assert elapsed < 1.0
+    deadline = time.monotonic() + 5
+    while service.pending and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert model.stopped == ["question lente"]
+    assert service.pending == 0
+
+
+def test_queued_request_past_its_deadline_is_not_run(service):
+    service, model = service
+
+    async def scenario():
+        first = asyncio.create_task(service.generate_response_async("question 0", "fr"))
+        await wait_until(lambda: model.started)
+        late = await service.generate_response_async("question 1", "fr", timeout=0.1)
+        model.release.set()
+        await first
+        await wait_until(lambda: service.pending == 0)
+        return late
+
+    late = asyncio.run(scenario())
+    assert late["fallback_reason"] == "deadline"
+    assert model.started == ["question 0"]
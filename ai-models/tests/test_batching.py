@@ -0,0 +1,67 @@
+"""Continuous batching scheduler"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from batching import BatchScheduler
+from generation import GenerationEngine
+
+
+class FailingEngine:
+    """Engine whose prefill always fails"""
+
+    eos_token_id = 0
+    pad_token_id = 0
+    max_length = 2048
+
+    def start(self, *args, **kwargs):
+        raise RuntimeError("prefill failed")
+
+
+def test_batched_generation_matches_sequential(tiny_engine):
+    prompts = [[10, 11, 12], [20, 21], [30, 31, 32, 33, 34], [40]]
+    expected = []
+    for prompt in prompts:
+        result = tiny_engine.generate(np.array([prompt]), max_new_tokens=6)
+        expected.append(result["tokens"][0, :result["lengths"][0]].tolist())
+
+    scheduler = BatchScheduler(tiny_engine, max_batch_size=4, max_wait_ms=50)
+    try:
+        with ThreadPoolExecutor(len(prompts)) as executor:
+            results = list(executor.map(lambda prompt: scheduler.generate(prompt, 6), prompts))
+    finally:
+        scheduler.close()
+
+    assert [result["tokens"][0].tolist() for result in results] == expected
+    assert scheduler.counters["completed"] == len(prompts)
+
+
+def test_failed_prefill_fails_joining_requests():
+    scheduler = BatchScheduler(FailingEngine(), max_batch_size=4, max_wait_ms=20)
+    try:
+        futures = [scheduler.submit([1, 2, 3], 4) for _ in range(3)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="prefill failed"):
+                future.result(timeout=3)
+    finally:
+        scheduler.close()
+    assert scheduler.counters["failed"] == 3
+
+
+def test_budget_is_clamped_to_max_length(tiny_engine):
+    engine = GenerationEngine(tiny_engine.session, tiny_engine.eos_token_id, tiny_engine.pad_token_id,
+                              max_length=12)
+    prompt = [50, 51, 52, 53, 54, 55, 56, 57]
+    expected = engine.generate(np.array([prompt]), max_new_tokens=20)
+    assert expected["tokens"].shape[1] <= 12 - len(prompt)
+
+    scheduler = BatchScheduler(engine, max_batch_size=2, max_wait_ms=5)
+    try:
+        result = scheduler.generate(prompt, 20)
+        assert result["tokens"][0].tolist() == expected["tokens"][0, :expected["lengths"][0]].tolist()
+        with pytest.raises(ValueError, match="max_length"):
+            scheduler.submit(list(range(20, 32)), 4)
+    finally:
+        scheduler.close()
@@ -0,0 +1,195 @@
+"""Answer cascade: calibration, stage order, budget and early exit"""
+
+import json
+import math
+
+import numpy as np
+import pytest
+
+from cascade import CascadeStats, CascadeTrace, calibrate
+
+
+def test_identity_calibration_keeps_the_score():
+    for p in (0.01, 0.3, 0.5, 0.9, 0.999):
+        assert calibrate(p) == pytest.approx(p)
+    # Scale alone never moves the midpoint
+    assert calibrate(0.5, 3.0, 0.0) == pytest.approx(0.5)
+    assert calibrate(0.5, 1.0, 1.0) == pytest.approx(1.0 / (1.0 + math.exp(-1.0)))
+
+
+def test_calibration_is_monotonic_and_bounded():
+    scores = [0.0, 0.05, 0.2, 0.5, 0.8, 0.95, 1.0]
+    for scale, bias in ((1.0, 0.0), (0.5, -1.0), (2.5, 0.7)):
+        calibrated = [calibrate(p, scale, bias) for p in scores]
+        assert calibrated == sorted(calibrated)
+        assert all(0.0 < c < 1.0 for c in calibrated)
+
+
+def test_platt_fit_recovers_scale_and_bias():
+    """Logistic regression on logit(raw) gives back the parameters calibrate takes"""
+    rng = np.random.default_rng(0)
+    scale, bias = 1.8, -0.6
+    raw = rng.uniform(0.02, 0.98, size=20000)
+    right = rng.random(raw.size) < np.array([calibrate(p, scale, bias) for p in raw])
+
+    features = np.stack([np.log(raw / (1.0 - raw)), np.ones_like(raw)], axis=1)
+    weights = np.zeros(2)
+    for _ in range(25):
+        predicted = 1.0 / (1.0 + np.exp(-features @ weights))
+        hessian = features.T @ (features * (predicted * (1.0 - predicted))[:, None])
+        weights += np.linalg.solve(hessian, features.T @ (right - predicted))
+
+    assert weights == pytest.approx([scale, bias], abs=0.1)
+    # The fitted mapping matches the observed accuracy per raw score bin
+    for low in (0.1, 0.4, 0.7):
+        in_bin = (raw >= low) & (raw < low + 0.1)
+        expected = np.mean([calibrate(p, *weights) for p in raw[in_bin]])
+        assert right[in_bin].mean() == pytest.approx(expected, abs=0.03)
+
+
+def test_trace_keeps_the_most_confident_candidate():
+    trace = CascadeTrace()
+    assert trace.remaining() is None
+    trace.offer("knowledge_base", {"content": "a", "confidence": 0.4})
+    trace.offer("model", {"content": "b", "confidence": 0.2})
+    assert (trace.best_stage, trace.best["content"]) == ("knowledge_base", "a")
+    trace.offer("large_model", {"content": "c", "confidence": 0.6})
+    assert (trace.best_stage, trace.best["content"]) == ("large_model", "c")
+
+    trace.record("model", 0.0123456, "below_threshold", 0.123456, 0.2)
+    assert trace.summary()["stages"] == [{"stage": "model", "ms": 12.346, "outcome": "below_threshold",
+                                          "confidence": 0.1235, "raw": 0.2}]
+    assert 0.0 < CascadeTrace(10.0).remaining() <= 10.0
+
+
+def test_expected_latency_is_a_moving_average():
+    stats = CascadeStats(smoothing=0.5)
+    assert stats.expected_latency("model") is None
+    stats.observe_latency("model", 2.0)
+    assert stats.expected_latency("model") == 2.0
+    stats.observe_latency("model", 4.0)
+    assert stats.expected_latency("model") == pytest.approx(3.0)
+
+
+@pytest.fixture
+def make_service(tmp_path):
+    from model_service import LightweightAIModel
+
+    services = []
+
+    def make(cascade):
+        (tmp_path / "knowledge_base.json").write_text("{}")
+        config = {
+            "model": {"loading": "lazy", "graph_cache_dir": None},
+            "knowledge_base": {"source": "json", "watch_interval": 0},
+            "knowledge_base_path": str(tmp_path / "knowledge_base.json"),
+            "conversation": {"enabled": False},
+            "cache": {"disk_path": None},
+            "metrics": {"dir": None},
+            "cascade": cascade
+        }
+        (tmp_path / "config.json").write_text(json.dumps(config))
+        services.append(LightweightAIModel(str(tmp_path / "model.onnx"), str(tmp_path / "config.json")))
+        return services[-1]
+
+    yield make
+    for service in services:
+        service.close()
+
+
+def test_stages_follow_the_configured_order(make_service):
+    service = make_service({"stages": ["knowledge_base", "exact_cache", "semantic_cache", "model",
+                                       "large_model"]})
+    assert service.semantic_cache is not None
+    # No large model configured
+    assert service.get_cascade_stages(None) == ["knowledge_base", "exact_cache", "semantic_cache", "model"]
+    # Near-duplicates don't stand in for answers that depend on the conversation
+    assert service.get_cascade_stages("context") == ["knowledge_base", "exact_cache", "model"]
+
+    service.config["cascade"]["large_model"] = {"path": "large.onnx"}
+    assert service.get_cascade_stages(None)[-2:] == ["model", "large_model"]
+
+
+def test_model_stage_must_fit_the_remaining_budget(make_service, monkeypatch):
+    service = make_service({})
+    assert service.fits_budget("model", CascadeTrace())
+    # Never ran: no estimate, so only an exhausted budget skips it
+    assert service.fits_budget("model", CascadeTrace(1.0))
+
+    service.cascade_stats.observe_latency("model", 0.5)
+    assert service.fits_budget("model", CascadeTrace(1.0))
+    trace = CascadeTrace(0.2)
+    assert not service.fits_budget("model", trace)
+    assert trace.degraded == "deadline"
+    assert trace.stages == [{"stage": "model", "ms": 0.0, "outcome": "skipped", "confidence": None, "raw": None}]
+
+    exhausted = CascadeTrace(1.0)
+    monkeypatch.setattr(exhausted, "deadline", exhausted.started)
+    service.cascade_stats.latency.clear()
+    assert not service.fits_budget("model", exhausted)
+
+
+class StubKnowledgeBase:
+    """Stands in for check_knowledge_base with a fixed raw score"""
+
+    def __init__(self, confidence):
+        self.confidence = confidence
+        self.calls = 0
+
+    def __call__(self, message, lang, min_confidence=None):
+        self.calls += 1
+        return {"type": "text", "content": "Au guichet de la préfecture", "confidence": self.confidence,
+                "source": "knowledge_base"}
+
+
+class StubModel:
+    def __init__(self, confidence):
+        self.confidence = confidence
+        self.calls = 0
+
+    def __call__(self, message, lang, context, stop_check=None):
+        self.calls += 1
+        return {"type": "text", "content": "Réponse du modèle", "confidence": self.confidence,
+                "source": "ai_model"}
+
+
+def test_confident_cheap_stage_ends_the_cascade(make_service, monkeypatch):
+    service = make_service({"stages": ["exact_cache", "knowledge_base", "model"],
+                            "thresholds": {"knowledge_base": 0.5},
+                            "calibration": {"knowledge_base": [1.0, 1.0]}})
+    knowledge_base, model = StubKnowledgeBase(0.4), StubModel(0.9)
+    monkeypatch.setattr(service, "check_knowledge_base", knowledge_base)
+    monkeypatch.setattr(service, "generate_ai_response", model)
+
+    # 0.4 raw is above 0.5 once calibrated with a +1 bias
+    response = service.generate_response("Comment renouveler mon passeport ?", "fr")
+    assert response["source"] == "knowledge_base"
+    assert response["confidence"] == round(calibrate(0.4, 1.0, 1.0), 3)
+    assert response["cascade"]["stage"] == "knowledge_base"
+    assert response["cascade"]["confident"] is True
+    assert [stage["outcome"] for stage in response["cascade"]["stages"]] == ["miss", "answered"]
+    assert model.calls == 0
+
+    again = service.generate_response("Comment renouveler mon passeport ?", "fr")
+    assert again["cascade"]["stage"] == "exact_cache"
+    assert knowledge_base.calls == 1
+
+
+def test_weak_answers_escalate_and_the_best_one_is_kept(make_service, monkeypatch):
+    service = make_service({"stages": ["knowledge_base", "model"],
+                            "thresholds": {"knowledge_base": 0.8, "model": 0.5}})
+    monkeypatch.setattr(service, "check_knowledge_base", StubKnowledgeBase(0.45))
+    model = StubModel(0.3)
+    monkeypatch.setattr(service, "generate_ai_response", model)
+
+    response = service.generate_response("Comment renouveler mon passeport ?", "fr")
+    assert model.calls == 1
+    assert response["source"] == "knowledge_base"
+    assert response["cascade"]["stage"] == "knowledge_base"
+    assert response["cascade"]["confident"] is False
+    assert [stage["outcome"] for stage in response["cascade"]["stages"]] == ["below_threshold"] * 2
+
+    model.confidence = 0.6
+    response = service.generate_response("Quels sont les horaires ?", "fr")
+    assert response["source"] == "ai_model"
+    assert response["cascade"]["confident"] is True
@@ -0,0 +1,51 @@
+"""Per-conversation prefix KV cache"""
+
+from conversation_cache import ConversationCache
+from generation import DecodeState
+
+
+def state(capacity=16):
+    return DecodeState(1, capacity)
+
+
+def test_longest_cached_prefix_is_reused():
+    cache = ConversationCache(idle_timeout=None)
+    cache.store([1, 2, 3], state())
+    cache.store([1, 2, 3, 4, 5], state())
+
+    assert cache.lookup([1, 2, 3, 4, 5, 6, 7], boundaries=[3, 5]) is not None
+    assert cache.stats()["reused_tokens"] == 5
+    # A prompt is never its own prefix: something must be left to run
+    assert cache.lookup([1, 2, 3], boundaries=[3]) is None
+    assert cache.lookup([9, 2, 3, 4], boundaries=[3]) is None
+
+
+def test_extended_conversation_replaces_its_prefix():
+    cache = ConversationCache(idle_timeout=None)
+    cache.store([1, 2], state())
+    key, _ = cache.lookup([1, 2, 3, 4], boundaries=[2])
+    cache.store([1, 2, 3, 4], state(), replaces=key)
+    assert len(cache) == 1
+    assert cache.lookup([1, 2, 9], boundaries=[2]) is None
+
+
+def test_byte_budget_evicts_least_recent():
+    size = state().nbytes()
+    cache = ConversationCache(max_bytes=2 * size, idle_timeout=None)
+    cache.store([1], state())
+    cache.store([2], state())
+    cache.lookup([1, 5], boundaries=[1])
+    cache.store([3], state())
+    assert cache.lookup([2, 5], boundaries=[1]) is None
+    assert cache.lookup([1, 5], boundaries=[1]) is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_idle_conversations_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("conversation_cache.time.monotonic", lambda: now[0])
+    cache = ConversationCache(idle_timeout=60)
+    cache.store([1, 2], state())
+    now[0] += 61
+    assert cache.lookup([1, 2, 3], boundaries=[2]) is None
+    assert cache.stats()["expirations"] == 1
@@ -0,0 +1,255 @@
+"""Resumable chunked downloads against a local Range server"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import download_model
+from download_model import ChunkedDownload, DownloadError, build_manifest
+
+CHUNK_SIZE = 1024
+
+
+class FileServer:
+    """
+    One file over HTTP with Range, ETag and If-Range support
+
+    faults maps a chunk's start offset to the failures its next requests get, in
+    order: "503", "drop" (headers, half the bytes, then the connection closes) or
+    "corrupt" (the range with its first byte flipped).
+    """
+
+    def __init__(self, content, ranges=True):
+        self.content = content
+        self.etag = '"v1"'
+        self.ranges = ranges
+        self.faults = {}
+        self.requested = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/model.bin"
+
+    def replace(self, content, etag):
+        with self.lock:
+            self.content, self.etag = content, etag
+
+    def fetched(self):
+        """Start offsets of the chunk requests served, probes excluded"""
+        with self.lock:
+            return sorted(start for start, end in self.requested if end > start)
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with server.lock:
+                    content, etag = server.content, server.etag
+                match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+                if_range = self.headers.get("If-Range")
+                if not server.ranges or match is None or (if_range and if_range != etag):
+                    self.send(200, content, etag)
+                    return
+                start, end = int(match.group(1)), min(int(match.group(2)), len(content) - 1)
+                with server.lock:
+                    server.requested.append((start, end))
+                    fault = server.faults.get(start, []).pop(0) if server.faults.get(start) else None
+                body = content[start:end + 1]
+                if fault == "503":
+                    self.send(503, b"busy", etag)
+                elif fault == "corrupt":
+                    self.send(206, bytes([body[0] ^ 0xFF]) + body[1:], etag, (start, end, len(content)))
+                elif fault == "drop":
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body[:len(body) // 2])
+                    self.wfile.flush()
+                    self.close_connection = True
+                else:
+                    self.send(206, body, etag, (start, end, len(content)))
+
+            def send(self, status, body, etag, content_range=None):
+                self.send_response(status)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                if content_range:
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(*content_range))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def payload(size, seed=0):
+    return bytes((i * 31 + seed) % 251 for i in range(size))
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    """Retries happen immediately"""
+    monkeypatch.setattr(download_model.random, "random", lambda: -0.5)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(content, ranges=True):
+        servers.append(FileServer(content, ranges))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def manifest_entry(tmp_path, content):
+    source = tmp_path / "source.bin"
+    source.write_bytes(content)
+    return build_manifest([str(source)], chunk_size=CHUNK_SIZE)["files"]["source.bin"]
+
+
+def download(server, destination, expected=None, retries=3):
+    return ChunkedDownload(server.url, destination, expected, chunk_size=CHUNK_SIZE,
+                           workers=3, retries=retries, timeout=(5, 5)).run()
+
+
+def test_parallel_download(tmp_path, serve):
+    content = payload(10 * CHUNK_SIZE + 123)
+    server = serve(content)
+    destination = tmp_path / "model.bin"
+
+    digest = download(server, destination, manifest_entry(tmp_path, content))
+    assert destination.read_bytes() == content
+    assert digest == hashlib.sha256(content).hexdigest()
+    assert server.fetched() == [index * CHUNK_SIZE for index in range(11)]
+    assert not os.path.exists(f"{destination}.part")
+    assert not os.path.exists(f"{destination}.part.json")
+
+
+@pytest.mark.parametrize("fault", ["503", "drop", "corrupt"])
+def test_failed_chunk_is_fetched_again(tmp_path, serve, fault):
+    content = payload(6 * CHUNK_SIZE)
+    server = serve(content)
+    server.faults[2 * CHUNK_SIZE] = [fault, fault]
+    destination = tmp_path / "model.bin"
+
+    download(server, destination, manifest_entry(tmp_path, content))
+    assert destination.read_bytes() == content
+    # Only the failing chunk was requested again
+    assert server.fetched().count(2 * CHUNK_SIZE) == 3
+    assert len(server.fetched()) == 8
+
+
+def test_chunk_giving_up_fails_the_download(tmp_path, serve):
+    server = serve(payload(4 * CHUNK_SIZE))
+    server.faults[CHUNK_SIZE] = ["503"] * 3
+    destination = tmp_path / "model.bin"
+
+    with pytest.raises(DownloadError):
+        download(server, destination)
+    assert not destination.exists()
+
+
+def test_resume_fetches_missing_chunks_only(tmp_path, serve):
+    content = payload(8 * CHUNK_SIZE)
+    server = serve(content)
+    server.faults[5 * CHUNK_SIZE] = ["503"]
+    destination = tmp_path / "model.bin"
+    expected = manifest_entry(tmp_path, content)
+
+    with pytest.raises(DownloadError):
+        download(server, destination, expected, retries=1)
+    with open(f"{destination}.part.json", 'r', encoding='utf-8') as f:
+        done = json.load(f)["done"]
+    assert 5 not in done
+
+    server.requested.clear()
+    download(server, destination, expected)
+    assert destination.read_bytes() == content
+    assert server.fetched() == [index * CHUNK_SIZE for index in range(8) if index not in done]
+
+
+def test_changed_file_restarts_the_download(tmp_path, serve):
+    server = serve(payload(6 * CHUNK_SIZE))
+    server.faults[3 * CHUNK_SIZE] = ["503"]
+    destination = tmp_path / "model.bin"
+    with pytest.raises(DownloadError):
+        download(server, destination, retries=1)
+
+    # Chunks of the old version are not reused with the new one
+    content = payload(6 * CHUNK_SIZE, seed=7)
+    server.replace(content, '"v2"')
+    server.requested.clear()
+    download(server, destination)
+    assert destination.read_bytes() == content
+    assert server.fetched() == [index * CHUNK_SIZE for index in range(6)]
+
+
+def test_file_changed_midway_is_refused(tmp_path, serve):
+    server = serve(payload(4 * CHUNK_SIZE))
+    destination = tmp_path / "model.bin"
+    transfer = ChunkedDownload(server.url, destination, chunk_size=CHUNK_SIZE, workers=1, retries=3)
+    original_probe = transfer.probe
+
+    def probe():
+        found = original_probe()
+        server.replace(payload(4 * CHUNK_SIZE, seed=3), '"v2"')
+        return found
+
+    transfer.probe = probe
+    # If-Range makes the server answer with the whole new file
+    with pytest.raises(DownloadError, match="changed"):
+        transfer.run()
+    assert not destination.exists()
+
+
+def test_whole_file_mismatch_discards_the_download(tmp_path, serve):
+    content = payload(5 * CHUNK_SIZE)
+    server = serve(content)
+    destination = tmp_path / "model.bin"
+    expected = {"size": len(content), "sha256": hashlib.sha256(b"other").hexdigest()}
+
+    with pytest.raises(DownloadError, match="does not match"):
+        download(server, destination, expected)
+    assert not destination.exists()
+    assert not os.path.exists(f"{destination}.part")
+    assert not os.path.exists(f"{destination}.part.json")
+
+
+def test_size_mismatch_is_refused_before_downloading(tmp_path, serve):
+    content = payload(3 * CHUNK_SIZE)
+    server = serve(content)
+    with pytest.raises(DownloadError):
+        download(server, tmp_path / "model.bin", {"size": len(content) + 1})
+    assert server.fetched() == []
+
+
+def test_server_without_ranges_gets_one_stream(tmp_path, serve):
+    content = payload(5 * CHUNK_SIZE + 17)
+    server = serve(content, ranges=False)
+    destination = tmp_path / "model.bin"
+
+    digest = download(server, destination, manifest_entry(tmp_path, content))
+    assert destination.read_bytes() == content
+    assert digest == hashlib.sha256(content).hexdigest()
+    assert server.fetched() == []
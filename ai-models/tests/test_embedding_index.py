@@ -0,0 +1,104 @@
+"""Question embedding matrix"""
+
+import json
+
+import numpy as np
+import pytest
+
+from embedding_index import EmbeddingIndex, OnnxSentenceEncoder, normalize_rows, questions_fingerprint
+from tiny_model import build_tiny_encoder
+
+ENTRIES = [
+    {"question_fr": "passeport", "question_ar": "جواز"},
+    {"question_fr": "naissance", "question_ar": ""},
+    {"question_fr": "permis", "question_ar": "رخصة"}
+]
+
+
+class FixedEncoder:
+    """One known vector per text"""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.calls = []
+
+    def encode(self, texts, batch_size=32):
+        self.calls.append(list(texts))
+        return normalize_rows(np.array([self.vectors[text] for text in texts], dtype=np.float32))
+
+
+@pytest.fixture
+def encoder_path(tmp_path):
+    (tmp_path / "encoder").mkdir()
+    return build_tiny_encoder(str(tmp_path / "encoder" / "model.onnx"))
+
+
+def test_build_lays_out_one_row_per_language(tmp_path):
+    encoder = FixedEncoder({"passeport": [1, 0, 0], "جواز": [0, 1, 0], "naissance": [0, 0, 1],
+                            "permis": [1, 1, 0], "رخصة": [1, 0, 1]})
+    path = str(tmp_path / "kb_embeddings.npy")
+
+    index = EmbeddingIndex.build(encoder, ENTRIES, path, "f1")
+    # Empty questions are not encoded and keep a zero row
+    assert encoder.calls == [["passeport", "جواز", "naissance", "permis", "رخصة"]]
+    assert index.matrix.shape == (6, 3) and index.num_entries == 3
+    assert not index.matrix[3].any()
+    assert EmbeddingIndex.is_current(path, "f1")
+    assert not EmbeddingIndex.is_current(path, "f2")
+    with open(EmbeddingIndex.metadata_path(path), 'r', encoding='utf-8') as f:
+        assert json.load(f)["shape"] == [6, 3]
+
+
+def test_similarities_take_the_best_language(tmp_path):
+    encoder = FixedEncoder({"passeport": [1, 0, 0], "جواز": [0, 1, 0], "naissance": [0, 0, 1],
+                            "permis": [1, 1, 0], "رخصة": [0, 0, -1]})
+    index = EmbeddingIndex.build(encoder, ENTRIES, str(tmp_path / "kb_embeddings.npy"), "f")
+
+    queries = normalize_rows(np.array([[0, 1, 0], [0, 0, 1]], dtype=np.float32))
+    similarities = index.similarities(queries)
+    assert similarities.shape == (2, 3)
+    np.testing.assert_allclose(similarities[0], [1.0, 0.0, np.sqrt(0.5)], atol=1e-6)
+    np.testing.assert_allclose(similarities[1], [0.0, 1.0, 0.0], atol=1e-6)
+
+    ids, scores = index.search(queries, top_k=2)
+    assert ids.tolist() == [[0, 2], [1, 0]]
+    np.testing.assert_allclose(scores[:, 0], [1.0, 1.0], atol=1e-6)
+
+
+def test_missing_matrix_is_not_current(tmp_path):
+    path = str(tmp_path / "kb_embeddings.npy")
+    assert not EmbeddingIndex.is_current(path, "f")
+    with open(EmbeddingIndex.metadata_path(path), 'w', encoding='utf-8') as f:
+        json.dump({"fingerprint": "f"}, f)
+    assert not EmbeddingIndex.is_current(path, "f")
+
+
+def test_encoder_uses_its_own_tokenizer(encoder_path):
+    encoder = OnnxSentenceEncoder(encoder_path)
+    assert encoder.tokenizer_path.endswith("encoder/tokenizer.json")
+    vectors = encoder.encode(["passeport", "permis de conduire", "passeport"])
+    assert vectors.shape == (3, 16)
+    np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0, atol=1e-6)
+    np.testing.assert_allclose(vectors[0], vectors[2], atol=1e-6)
+
+
+def test_encoder_without_tokenizer_is_refused(tmp_path, encoder_path):
+    (tmp_path / "encoder" / "tokenizer.json").unlink()
+    with pytest.raises(FileNotFoundError):
+        OnnxSentenceEncoder(encoder_path)
+
+
+def test_fingerprint_follows_questions_and_tokenizer(tmp_path, encoder_path):
+    questions = EmbeddingIndex.entry_questions(ENTRIES)
+    fingerprint = questions_fingerprint(questions, encoder_path)
+    assert questions_fingerprint(questions, encoder_path) == fingerprint
+    assert questions_fingerprint(questions[:-1] + ["autre"], encoder_path) != fingerprint
+
+    # A new vocabulary of the same size invalidates the matrix
+    tokenizer_path = tmp_path / "encoder" / "tokenizer.json"
+    data = json.loads(tokenizer_path.read_text(encoding='utf-8'))
+    vocab = data["model"]["vocab"]
+    first, second = list(vocab)[:2]
+    vocab[first], vocab[second] = vocab[second], vocab[first]
+    tokenizer_path.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    assert questions_fingerprint(questions, encoder_path) != fingerprint
@@ -0,0 +1,99 @@
+"""Incremental FAQ sync"""
+
+import json
+import sqlite3
+
+import pytest
+
+import model_service
+from faq_store import FaqStore
+
+SCHEMA = """
+CREATE TABLE faq (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  question_fr TEXT NOT NULL, question_ar TEXT NOT NULL,
+  answer_fr TEXT NOT NULL, answer_ar TEXT NOT NULL,
+  category TEXT, tags TEXT, updated_at DATETIME
+)
+"""
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "faq.db")
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    add(conn, "Comment renouveler le passeport ?", "passeport", "2024-01-01 10:00:00")
+    add(conn, "Délai de l'acte de naissance ?", "etat_civil", "2024-01-01 10:00:00")
+    yield path, conn
+    conn.close()
+
+
+def add(conn, question, category, updated_at):
+    conn.execute("INSERT INTO faq (question_fr, question_ar, answer_fr, answer_ar, category, tags, updated_at) "
+                 "VALUES (?, '', ?, '', ?, ?, ?)", (question, f"Réponse: {question}", category, category, updated_at))
+
+
+def test_sync_is_applied_on_commit_only(db):
+    path, conn = db
+    store = FaqStore(path)
+    sync = store.sync()
+    assert sorted(sync.changed) == [1, 2]
+    assert len(store) == 0 and store.last_updated == ""
+
+    store.commit(sync)
+    assert len(store) == 2
+    assert store.last_updated == "2024-01-01 10:00:00"
+    assert store.fingerprint() == sync.fingerprint()
+    assert sorted(store.knowledge_base()) == ["etat_civil", "passeport"]
+
+
+def test_uncommitted_changes_are_read_again(db):
+    path, conn = db
+    store = FaqStore(path)
+    store.commit(store.sync())
+
+    conn.execute("UPDATE faq SET answer_fr = 'Nouveau', updated_at = '2024-02-01 09:00:00' WHERE id = 1")
+    conn.execute("DELETE FROM faq WHERE id = 2")
+    first = store.sync()
+    assert (first.changed, first.removed) == ([1], [2])
+    # The snapshot built from it was never served: the next sync sees the same changes
+    second = store.sync()
+    assert (second.changed, second.removed) == ([1], [2])
+    store.commit(second)
+    assert store.get(1).answer_fr == "Nouveau"
+    assert store.sync().changed == []
+
+
+def test_failed_reload_keeps_the_changes_for_the_next_one(db, tmp_path, monkeypatch):
+    path, conn = db
+    config = {
+        "model": {"loading": "lazy", "graph_cache_dir": None},
+        "knowledge_base": {"source": "sqlite", "database_path": path, "watch_interval": 0},
+        "conversation": {"enabled": False},
+        "cache": {"disk_path": None},
+        "metrics": {"dir": None}
+    }
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    service = model_service.LightweightAIModel(str(tmp_path / "model.onnx"), str(tmp_path / "config.json"))
+    try:
+        add(conn, "Prix de la carte grise ?", "carte_grise", "2024-03-01 08:00:00")
+        index_class = model_service.KnowledgeIndex
+
+        def failing_index(*args, **kwargs):
+            raise MemoryError("index build failed")
+
+        monkeypatch.setattr(model_service, "KnowledgeIndex", failing_index)
+        assert service.reload_knowledge_base()["reloaded"] is False
+        assert len(service.kb.index) == 2
+        assert service.faq_store.last_updated == "2024-01-01 10:00:00"
+
+        monkeypatch.setattr(model_service, "KnowledgeIndex", index_class)
+        result = service.reload_knowledge_base()
+        assert result["reloaded"] is True
+        assert result["changed_categories"] == ["carte_grise"]
+        assert len(service.kb.index) == 3
+        assert service.faq_store.last_updated == "2024-03-01 08:00:00"
+    finally:
+        service.close()
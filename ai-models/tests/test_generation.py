@@ -0,0 +1,121 @@
+"""Incremental decoding with bound, double-buffered KV"""
+
+import numpy as np
+import pytest
+
+
+def full_logits(engine, input_ids, attention_mask=None):
+    """Last-position logits of a plain session.run over the whole sequence, no cache reuse"""
+    input_ids = np.asarray(input_ids, dtype=np.int64)
+    if attention_mask is None:
+        attention_mask = np.ones_like(input_ids)
+    batch_size = input_ids.shape[0]
+    feeds = {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "position_ids": np.maximum(np.cumsum(attention_mask, axis=1) - 1, 0)
+    }
+    for name in engine.past_names:
+        feeds[name] = np.zeros((batch_size, engine.num_kv_heads, 0, engine.head_dim), dtype=engine.kv_dtype)
+    return engine.session.run([engine.logits_name], feeds)[0][:, -1, :]
+
+
+def reference_greedy(engine, prompt, max_new_tokens):
+    tokens = list(prompt)
+    generated = []
+    for _ in range(max_new_tokens):
+        next_token = int(np.argmax(full_logits(engine, [tokens])[0]))
+        generated.append(next_token)
+        if next_token == engine.eos_token_id:
+            break
+        tokens.append(next_token)
+    return generated
+
+
+PROMPTS = [[20, 31, 42, 53, 64, 75], [90, 12], [100, 101, 102, 103]]
+
+
+def left_pad(engine, prompts):
+    width = max(len(prompt) for prompt in prompts)
+    input_ids = np.full((len(prompts), width), engine.pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(prompts), width), dtype=np.int64)
+    for row, prompt in enumerate(prompts):
+        input_ids[row, width - len(prompt):] = prompt
+        attention_mask[row, width - len(prompt):] = 1
+    return input_ids, attention_mask
+
+
+def test_greedy_matches_full_recompute(tiny_engine):
+    result = tiny_engine.generate(np.array([PROMPTS[0]]), max_new_tokens=8)
+    generated = result["tokens"][0][:result["lengths"][0]].tolist()
+    expected = reference_greedy(tiny_engine, PROMPTS[0], 8)
+    assert generated == [token for token in expected if token != tiny_engine.eos_token_id]
+
+
+def test_padded_batch_matches_single_prompts(tiny_engine):
+    input_ids, attention_mask = left_pad(tiny_engine, PROMPTS)
+    batch = tiny_engine.generate(input_ids, attention_mask, max_new_tokens=6)
+    for row, prompt in enumerate(PROMPTS):
+        single = tiny_engine.generate(np.array([prompt]), max_new_tokens=6)
+        length = single["lengths"][0]
+        assert batch["lengths"][row] == length
+        assert batch["tokens"][row][:length].tolist() == single["tokens"][0][:length].tolist()
+
+
+def test_steps_alternate_between_the_two_buffers(tiny_engine):
+    state, logits = tiny_engine.start(np.array([PROMPTS[0]]), max_new_tokens=4)
+    buffers = [[buffer.ctypes.data for buffer in pair] for pair in state.buffers]
+    first = state.current
+    for _ in range(3):
+        logits = tiny_engine.step(state, np.argmax(logits, axis=-1))
+        assert all(past.ctypes.data == pair[state.current] for past, pair in zip(state.past, buffers))
+    assert state.current != first
+    # Nothing was reallocated along the way
+    assert [[buffer.ctypes.data for buffer in pair] for pair in state.buffers] == buffers
+    assert state.length == len(PROMPTS[0]) + 3
+
+
+def test_state_capacity_is_enforced(tiny_engine):
+    state, logits = tiny_engine.start(np.array([PROMPTS[1]]), max_new_tokens=1)
+    tiny_engine.step(state, np.argmax(logits, axis=-1))
+    with pytest.raises(ValueError, match="capacity"):
+        tiny_engine.step(state, np.argmax(logits, axis=-1))
+
+
+def test_snapshot_prefix_gives_the_full_prefill_logits(tiny_engine):
+    system, question = PROMPTS[0], [77, 88, 99]
+    # Prefilled inside a left-padded batch: the snapshot drops the padding
+    state, _ = tiny_engine.start(*left_pad(tiny_engine, [system + [1, 2, 3], system]))
+    assert state.attention_mask[1, 0] == 0
+    prefix = tiny_engine.snapshot(state, row=1)
+    assert prefix.length == len(system)
+    assert prefix.input_ids[0].tolist() == system
+
+    full_state, full = tiny_engine.start(np.array([system + question]), max_new_tokens=2)
+    reused_state, reused = tiny_engine.start(np.array([system + question]), max_new_tokens=2, prefix=prefix)
+    np.testing.assert_allclose(reused, full, atol=1e-4)
+    for past, expected in zip(reused_state.past, full_state.past):
+        np.testing.assert_allclose(past, expected, atol=1e-4)
+    # Decoding goes on from the same positions
+    token = np.argmax(full, axis=-1)
+    np.testing.assert_allclose(tiny_engine.step(reused_state, token), tiny_engine.step(full_state, token),
+                               atol=1e-4)
+
+
+def test_repack_keeps_every_row_decoding_as_before(tiny_engine):
+    first, first_logits = tiny_engine.start(*left_pad(tiny_engine, PROMPTS[:2]), max_new_tokens=4)
+    second, second_logits = tiny_engine.start(np.array([PROMPTS[2]]), max_new_tokens=4)
+    first_tokens = np.argmax(first_logits, axis=-1)
+    second_tokens = np.argmax(second_logits, axis=-1)
+
+    # Row 1 of the first batch finished; row 0 goes on with the new sequence
+    merged = tiny_engine.repack([(first, np.array([0])), (second, np.array([0]))], extra_capacity=2)
+    assert merged.batch_size == 2
+    assert merged.length == max(len(PROMPTS[0]), len(PROMPTS[2]))
+    np.testing.assert_array_equal(merged.next_positions, [len(PROMPTS[0]), len(PROMPTS[2])])
+
+    logits = tiny_engine.step(merged, np.array([first_tokens[0], second_tokens[0]]))
+    expected_first = tiny_engine.step(first, first_tokens)[0]
+    expected_second = tiny_engine.step(second, second_tokens)[0]
+    np.testing.assert_allclose(logits[0], expected_first, atol=1e-4)
+    np.testing.assert_allclose(logits[1], expected_second, atol=1e-4)
@@ -0,0 +1,70 @@
+"""Multi-process inference pool"""
+
+import json
+import os
+import signal
+
+import numpy as np
+import pytest
+
+from inference_pool import InferencePool, PooledEngine, WorkerCrashed
+from tokenizer import ByteTokenizer
+
+
+@pytest.fixture
+def pool(tiny_model_path):
+    tokenizer = ByteTokenizer()
+    pool = InferencePool(tiny_model_path, {"eos_token_id": tokenizer.eos_token_id,
+                                           "pad_token_id": tokenizer.pad_token_id},
+                         num_workers=1, cores_per_worker=1, slots=2, slot_bytes=1024 * 1024,
+                         health_interval=3600, call_timeout=2.0, weights="prepacked")
+    yield pool
+    pool.close()
+
+
+def prompt():
+    return np.array([[72, 101, 108, 108, 111]], dtype=np.int64)
+
+
+def test_pooled_generation_matches_local(pool, tiny_engine):
+    engine = PooledEngine(pool, eos_token_id=tiny_engine.eos_token_id, pad_token_id=tiny_engine.pad_token_id)
+    pooled = engine.generate(prompt(), max_new_tokens=6)
+    local = tiny_engine.generate(prompt(), max_new_tokens=6)
+    assert np.array_equal(pooled["tokens"], local["tokens"])
+    # No local KV cache to snapshot or repack
+    assert not hasattr(engine, "repack") and not hasattr(engine, "snapshot")
+
+
+def test_pool_with_batching_is_refused(tmp_path):
+    from model_service import LightweightAIModel
+
+    config = {"pool": {"enabled": True}, "batching": {"enabled": True}}
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    with pytest.raises(ValueError, match="micro-batching"):
+        LightweightAIModel(str(tmp_path / "model.onnx"), str(tmp_path / "config.json"))
+
+
+def test_calls_for_a_replaced_worker_are_refused(pool):
+    handle, _ = pool.start_sequence(prompt(), np.ones_like(prompt()), 4)
+    worker, generation, _ = handle
+    pool.restart(worker, "test")
+    assert worker.generation == generation + 1
+    future = pool.call(worker, generation, "ping", None, None)
+    with pytest.raises(WorkerCrashed):
+        future.result(timeout=1)
+    assert not worker.pending
+    with pytest.raises(WorkerCrashed):
+        pool.step(handle, np.array([[1]], dtype=np.int64))
+
+
+def test_stuck_worker_times_out_and_restarts(pool):
+    handle, _ = pool.start_sequence(prompt(), np.ones_like(prompt()), 4)
+    worker, generation, _ = handle
+    os.kill(worker.process.pid, signal.SIGSTOP)
+    with pytest.raises(WorkerCrashed):
+        pool.step(handle, np.array([[1]], dtype=np.int64))
+    assert worker.generation == generation + 1 and worker.healthy
+    assert worker.restarts == 1
+    # The replacement serves new sequences
+    _, logits = pool.start_sequence(prompt(), np.ones_like(prompt()), 4)
+    assert logits.shape[0] == 1
@@ -0,0 +1,85 @@
+"""Keyword automaton and BM25 ranking"""
+
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from knowledge_index import BM25Index, KeywordAutomaton, KnowledgeIndex
+
+KNOWLEDGE_BASE = {
+    "passeport": [{
+        "question_fr": "Comment renouveler mon passeport ?",
+        "answer_fr": "Déposez le formulaire et deux photos.",
+        "keywords": ["passeport", "renouveler"]
+    }],
+    "naissance": [{
+        "question_fr": "Comment obtenir un acte de naissance ?",
+        "answer_fr": "Demandez-le à la commune du lieu de naissance.",
+        "keywords": ["acte de naissance"]
+    }, {
+        "question_fr": "Délai pour un acte de naissance ?",
+        "answer_fr": "Le délai est de deux jours.",
+        "keywords": ["délai"]
+    }]
+}
+
+
+@pytest.fixture
+def index():
+    return KnowledgeIndex(KNOWLEDGE_BASE, str.lower)
+
+
+def test_bm25_matches_reference_formula():
+    documents = [Counter({"carte": 1, "grise": 1}), Counter({"carte": 2, "identite": 1}), Counter({"permis": 1})]
+    bm25 = BM25Index(documents, k1=1.2, b=0.75)
+    scores, max_score = bm25.score(["carte", "identite"])
+
+    lengths = np.array([2.0, 3.0, 1.0])
+    avg = lengths.mean()
+
+    def expected(doc):
+        total = 0.0
+        for term in ("carte", "identite"):
+            tf = documents[doc][term]
+            df = sum(term in d for d in documents)
+            idf = np.log(1 + (3 - df + 0.5) / (df + 0.5))
+            total += idf * tf * 2.2 / (tf + 1.2 * (1 - 0.75 + 0.75 * lengths[doc] / avg))
+        return total
+
+    assert scores == pytest.approx([expected(0), expected(1), 0.0], rel=1e-5)
+    assert max_score > scores.max()
+
+
+def test_unknown_terms_score_nothing():
+    bm25 = BM25Index([Counter({"carte": 1})])
+    scores, max_score = bm25.score(["inconnu"])
+    assert scores.tolist() == [0.0]
+    assert max_score > 0
+
+
+def test_automaton_finds_overlapping_keywords():
+    automaton = KeywordAutomaton(["acte", "acte de naissance", "naissance"])
+    found = sorted(automaton.find("un acte de naissance"))
+    assert found == [(7, 0), (20, 1), (20, 2)]
+
+
+def test_search_ranks_the_matching_entry_first(index):
+    entry_id, _, confidence = index.search("renouveler passeport")[0]
+    assert index.entries[entry_id][0] == "passeport"
+    assert 0 < confidence <= 1
+
+    best = index.search("délai acte de naissance")[0][0]
+    assert index.entries[best][1]["keywords"] == ["délai"]
+
+
+def test_stopword_queries_get_low_confidence(index):
+    results = index.search("comment")
+    assert all(confidence < 0.5 for _, _, confidence in results)
+
+
+def test_unchanged_entries_reuse_their_analysis(index):
+    knowledge_base = dict(KNOWLEDGE_BASE, autre=[{"question_fr": "Autre question", "keywords": []}])
+    updated = KnowledgeIndex(knowledge_base, str.lower, previous=index)
+    assert updated.reused == 3
+    assert len(updated) == 4
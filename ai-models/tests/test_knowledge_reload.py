@@ -0,0 +1,97 @@
+"""Knowledge base hot reload"""
+
+import json
+import time
+
+import pytest
+
+
+def knowledge_base(passport_answer):
+    return {
+        "passeport": [{"question_fr": "Comment renouveler mon passeport ?", "question_ar": "كيف أجدد جواز السفر؟",
+                       "answer_fr": passport_answer, "answer_ar": "في الشباك", "keywords": ["passeport"]}],
+        "naissance": [{"question_fr": "Où demander un acte de naissance ?", "question_ar": "أين أطلب عقد الازدياد؟",
+                       "answer_fr": "À la commune de naissance.", "answer_ar": "في الجماعة",
+                       "keywords": ["naissance"]}]
+    }
+
+
+@pytest.fixture
+def make_service(tmp_path):
+    from model_service import LightweightAIModel
+
+    services = []
+
+    def make(watch_interval=0):
+        (tmp_path / "knowledge_base.json").write_text(
+            json.dumps(knowledge_base("Au guichet de la préfecture."), ensure_ascii=False))
+        config = {
+            "model": {"loading": "lazy", "graph_cache_dir": None},
+            "knowledge_base": {"source": "json", "watch_interval": watch_interval},
+            "knowledge_base_path": str(tmp_path / "knowledge_base.json"),
+            "conversation": {"enabled": False},
+            "cache": {"disk_path": str(tmp_path / "responses")},
+            "metrics": {"dir": None}
+        }
+        (tmp_path / "config.json").write_text(json.dumps(config))
+        services.append(LightweightAIModel(str(tmp_path / "model.onnx"), str(tmp_path / "config.json")))
+        return services[-1]
+
+    yield make
+    for service in services:
+        service.close()
+
+
+def edit_passport_answer(tmp_path, answer):
+    (tmp_path / "knowledge_base.json").write_text(json.dumps(knowledge_base(answer), ensure_ascii=False))
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_reload_evicts_stale_cached_answers(tmp_path, make_service):
+    service = make_service()
+    passport, birth = "Comment renouveler mon passeport ?", "Où demander un acte de naissance ?"
+    assert service.generate_response(passport, "fr")["content"] == "Au guichet de la préfecture."
+    service.generate_response(birth, "fr")
+    assert service.generate_response(passport, "fr")["cascade"]["stage"] == "exact_cache"
+
+    edit_passport_answer(tmp_path, "Sur rendez-vous en ligne.")
+    result = service.reload_knowledge_base()
+    assert result["changed_categories"] == ["passeport"]
+    assert result["evicted"] >= 1
+
+    response = service.generate_response(passport, "fr")
+    assert response["content"] == "Sur rendez-vous en ligne."
+    assert response["cascade"]["stage"] == "knowledge_base"
+    # Near-duplicates of the stale question are gone too
+    assert service.generate_response("comment renouveler mon passeport", "fr")["content"] == "Sur rendez-vous en ligne."
+    # Answers of unchanged categories stay cached
+    assert service.generate_response(birth, "fr")["cascade"]["stage"] == "exact_cache"
+
+
+def test_watcher_reloads_until_stopped(tmp_path, make_service):
+    service = make_service(watch_interval=0.02)
+    passport = "Comment renouveler mon passeport ?"
+    service.generate_response(passport, "fr")
+
+    edit_passport_answer(tmp_path, "Sur rendez-vous en ligne.")
+    # Counted once the stale answers are evicted, after the swap
+    wait_for(lambda: service.kb_reloads["reloads"] == 1)
+    assert service.generate_response(passport, "fr")["content"] == "Sur rendez-vous en ligne."
+
+    # What a preloading master does before forking its workers
+    service.stop_knowledge_base_watch()
+    assert service.kb_watch_thread is None
+    edit_passport_answer(tmp_path, "Au consulat, sur rendez-vous.")
+    time.sleep(0.1)
+    assert service.kb_reloads["reloads"] == 1
+
+    # Each worker then watches for itself
+    service.after_fork()
+    wait_for(lambda: service.kb_reloads["reloads"] == 2)
+    assert service.generate_response(passport, "fr")["content"] == "Au consulat, sur rendez-vous."
@@ -0,0 +1,131 @@
+"""Latency histograms and metrics merged across workers"""
+
+import json
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from metrics import LatencyHistogram, Metrics, render_prometheus
+
+
+@pytest.mark.parametrize("bits", [3, 6])
+def test_every_value_lies_in_its_bucket(bits):
+    histogram = LatencyHistogram(bits)
+    values = list(range(4096)) + [2 ** k + d for k in range(12, 40, 3) for d in (-1, 0, 1)]
+    for value in values:
+        lower, upper = histogram.bounds(histogram.index(value))
+        assert lower <= value < upper
+        assert upper - lower <= max(1, 2 / 2 ** bits * value)
+    # Buckets are contiguous and in value order
+    for index in range(histogram.index(2 ** 20)):
+        assert histogram.bounds(index)[1] == histogram.bounds(index + 1)[0]
+
+
+@pytest.mark.parametrize("bits", [4, 6])
+def test_quantiles_are_within_the_relative_bucket_width(bits):
+    rng = np.random.default_rng(bits)
+    # Microsecond values from a few microseconds to tens of seconds
+    values = np.exp(rng.uniform(np.log(5), np.log(3e7), size=5000)).astype(np.int64)
+    histogram = LatencyHistogram(bits)
+    for value in values:
+        histogram.record((value + 0.5) / 1e6)
+    assert histogram.count == len(values)
+    assert histogram.max == values.max()
+
+    ordered = np.sort(values)
+    for q in (0.01, 0.25, 0.5, 0.9, 0.99, 0.999):
+        exact = ordered[int(np.ceil(q * len(values))) - 1]
+        estimate = histogram.quantile(q) * 1e6
+        assert abs(estimate - exact) <= 2 / 2 ** bits * exact + 1
+    # Never past the largest value recorded
+    assert histogram.quantile(1.0) * 1e6 <= values.max()
+    assert LatencyHistogram(bits).quantile(0.5) == 0.0
+
+
+def test_merged_histograms_equal_one_histogram_of_everything():
+    rng = np.random.default_rng(0)
+    parts = [rng.exponential(0.05, size=size) for size in (300, 1, 1200)]
+    merged, whole = LatencyHistogram(), LatencyHistogram()
+    for part in parts:
+        histogram = LatencyHistogram()
+        for seconds in part:
+            histogram.record(seconds)
+            whole.record(seconds)
+        # Through the snapshot format, as between workers
+        merged.merge(LatencyHistogram.from_dict(json.loads(json.dumps(histogram.to_dict()))))
+    assert merged.counts == whole.counts
+    assert (merged.count, merged.max) == (whole.count, whole.max)
+    assert merged.total == pytest.approx(whole.total)
+    for q in (0.5, 0.9, 0.99):
+        assert merged.quantile(q) == whole.quantile(q)
+
+
+def worker_snapshot(pid, durations, responses):
+    """Snapshot of another worker, as its flush thread would write it"""
+    worker = Metrics(gauges=lambda: {"process_threads": 3})
+    for seconds in durations:
+        worker.observe("model", seconds)
+    worker.count("responses", responses, source="ai_model")
+    return dict(worker.snapshot(), pid=pid)
+
+
+@pytest.fixture
+def processes():
+    """A live and an exited process whose pids stand for other workers"""
+    live = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    yield live.pid, exited.pid
+    live.kill()
+    live.wait()
+
+
+def test_collect_merges_live_workers_and_drops_exited_ones(tmp_path, processes):
+    live, exited = processes
+    metrics = Metrics(directory=str(tmp_path), flush_interval=60)
+    metrics.observe("model", 0.2)
+    metrics.count("responses", 2, source="ai_model")
+    metrics.count("responses", source="cache")
+    metrics.start()
+    try:
+        for pid, durations in ((live, [0.4, 0.6]), (exited, [9.0])):
+            (tmp_path / f"{pid}.json").write_text(json.dumps(worker_snapshot(pid, durations, 5)))
+        (tmp_path / "unrelated.txt").write_text("")
+
+        snapshots = metrics.collect()
+        assert sorted(snapshot["pid"] for snapshot in snapshots) == sorted([metrics.snapshot()["pid"], live])
+        assert not (tmp_path / f"{exited}.json").exists()
+        assert (tmp_path / f"{live}.json").exists()
+
+        text = metrics.render()
+        assert 'moussadar_ai_stage_duration_seconds_count{stage="model"} 3' in text
+        assert 'moussadar_ai_stage_duration_seconds_bucket{stage="model",le="0.5"} 2' in text
+        assert 'moussadar_ai_stage_duration_seconds_bucket{stage="model",le="+Inf"} 3' in text
+        assert 'moussadar_ai_responses_total{source="ai_model"} 7' in text
+        assert 'moussadar_ai_responses_total{source="cache"} 1' in text
+        assert f'moussadar_ai_process_threads{{pid="{live}"}} 3' in text
+        assert "moussadar_ai_workers 2" in text
+    finally:
+        metrics.close()
+    assert not (tmp_path / f"{metrics.snapshot()['pid']}.json").exists()
+
+
+def test_unreadable_snapshot_is_skipped(tmp_path, processes):
+    live, _ = processes
+    metrics = Metrics(directory=str(tmp_path), flush_interval=60)
+    metrics.start()
+    try:
+        (tmp_path / f"{live}.json").write_text("{")
+        assert len(metrics.collect()) == 1
+    finally:
+        metrics.close()
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    with metrics.span("model"):
+        metrics.count("responses", source="cache")
+    assert metrics.histograms == {} and metrics.counters == {}
+    assert "moussadar_ai_workers 1" in render_prometheus(metrics.collect())
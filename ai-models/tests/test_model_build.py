@@ -0,0 +1,118 @@
+"""Variant evaluation and selection of the model build"""
+
+import json
+import shutil
+
+import pytest
+
+import model_build
+from model_build import MANIFEST_NAME, MANIFEST_VERSION, DEFAULT_GATE, evaluate, file_sha256, select_variant
+
+
+@pytest.fixture(scope="module")
+def models_dir(tmp_path_factory, tiny_model_path):
+    """
+    Variants standing in for the quantized builds: int8 computes exactly what fp32
+    does, int4 is another random model (far from fp32 in KL)
+    """
+    from tiny_model import build_tiny_decoder
+
+    directory = tmp_path_factory.mktemp("variants")
+    shutil.copy(tiny_model_path, directory / "tiny.onnx")
+    shutil.copy(tiny_model_path, directory / "tiny-int8.onnx")
+    build_tiny_decoder(str(directory / "tiny-q4.onnx"), hidden_size=16, num_layers=1, seed=1)
+    return directory
+
+
+def make_manifest(models_dir):
+    variants = {}
+    for variant, name in model_build.VARIANT_FILES.items():
+        path = models_dir / name.format(stem="tiny")
+        variants[variant] = {"path": path.name, "quantization": None, "size_bytes": path.stat().st_size,
+                             "sha256": file_sha256(str(path))}
+    return {"version": MANIFEST_VERSION, "reference": "fp32", "variants": variants,
+            "gate": dict(DEFAULT_GATE), "evaluations": {}}
+
+
+@pytest.fixture
+def slow_fp32(monkeypatch):
+    """Makes the fp32 variant decode slower than the others, as quantized kernels would"""
+    create_session, run_forced = model_build.create_session, model_build.run_forced
+    slow = set()
+
+    def create(path, threads=None):
+        session = create_session(path, threads)
+        if path.endswith("tiny.onnx"):
+            slow.add(id(session))
+        return session
+
+    def timed(engine, prompt, max_new_tokens, forced=None):
+        tokens, logprobs, prefill, decode = run_forced(engine, prompt, max_new_tokens, forced)
+        if id(engine.session) in slow:
+            decode += 0.01 * max_new_tokens
+        return tokens, logprobs, prefill, decode
+
+    monkeypatch.setattr(model_build, "create_session", create)
+    monkeypatch.setattr(model_build, "run_forced", timed)
+
+
+@pytest.fixture
+def evaluation(models_dir, slow_fp32):
+    return evaluate(str(models_dir), make_manifest(models_dir), max_new_tokens=8, threads=1)
+
+
+def test_evaluation_gates_on_kl_and_picks_the_fastest(evaluation):
+    results = evaluation["results"]
+    assert results["fp32"]["kl"] == 0.0 and results["fp32"]["top1_agreement"] == 1.0
+    # Same outputs as the reference
+    assert results["int8"]["kl"] == pytest.approx(0.0, abs=1e-4)
+    assert results["int8"]["top1_agreement"] == 1.0
+    assert results["int8"]["passed"]
+    assert results["int4"]["kl"] > DEFAULT_GATE["max_kl"]
+    assert not results["int4"]["passed"]
+
+    # int4 is the fastest but fails the gate
+    assert results["int4"]["ms_per_token"] < results["fp32"]["ms_per_token"]
+    assert results["int8"]["ms_per_token"] < results["fp32"]["ms_per_token"]
+    assert evaluation["selected"] == "int8"
+
+
+def test_selection_by_host(models_dir, evaluation):
+    manifest = make_manifest(models_dir)
+    # Sizes as quantization leaves them
+    for variant, ratio in (("int8", 4), ("int4", 8)):
+        manifest["variants"][variant]["size_bytes"] = manifest["variants"]["fp32"]["size_bytes"] // ratio
+    assert select_variant(manifest, "x86_64-avx2") == ("fp32", "no evaluation")
+
+    manifest["evaluations"]["x86_64-avx2"] = evaluation
+    assert select_variant(manifest, "x86_64-avx2")[0] == "int8"
+    # Elsewhere, the smallest variant that passed: int4 is smaller but failed
+    assert select_variant(manifest, "aarch64-asimddp") == ("int8", "smallest passing (host not evaluated)")
+    assert select_variant(manifest, "x86_64-avx2", "int4") == ("int4", "configured")
+    with pytest.raises(ValueError):
+        select_variant(manifest, "x86_64-avx2", "int2")
+
+
+def test_service_loads_the_selected_variant(tmp_path, models_dir, evaluation):
+    from model_service import LightweightAIModel
+
+    manifest = make_manifest(models_dir)
+    manifest["evaluations"][model_build.host_key()] = evaluation
+    model_build.save_manifest(manifest, str(models_dir / MANIFEST_NAME))
+    (tmp_path / "knowledge_base.json").write_text("{}")
+    config = {
+        "model": {"loading": "lazy", "graph_cache_dir": None},
+        "knowledge_base": {"source": "json", "watch_interval": 0},
+        "knowledge_base_path": str(tmp_path / "knowledge_base.json"),
+        "conversation": {"enabled": False},
+        "cache": {"disk_path": None},
+        "metrics": {"dir": None}
+    }
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    service = LightweightAIModel(str(models_dir / "tiny.onnx"), str(tmp_path / "config.json"))
+    try:
+        assert service.model_variant == "int8"
+        assert service.model_path == str(models_dir / "tiny-int8.onnx")
+        assert service.model_sha256 == manifest["variants"]["int8"]["sha256"]
+    finally:
+        service.close()
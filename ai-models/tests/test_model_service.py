@@ -0,0 +1,71 @@
+"""Service-level cache versioning"""
+
+import json
+import os
+import shutil
+
+import pytest
+
+from model_build import MANIFEST_NAME, MANIFEST_VERSION, file_sha256
+
+
+@pytest.fixture
+def variant_dir(tmp_path, tiny_model_path):
+    """Models directory whose manifest points to a variant of the tiny model"""
+    models = tmp_path / "models"
+    models.mkdir()
+    variant = models / "tiny-int8.onnx"
+    shutil.copy(tiny_model_path, variant)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "variants": {"int8": {"path": variant.name, "size_bytes": os.path.getsize(variant),
+                              "sha256": file_sha256(str(variant))}}
+    }
+    (models / MANIFEST_NAME).write_text(json.dumps(manifest))
+    return models
+
+
+def make_service(tmp_path, models, loading):
+    from model_service import LightweightAIModel
+
+    config = {
+        "model": {"loading": loading, "graph_cache_dir": None, "variant": "int8", "max_new_tokens": 4},
+        "knowledge_base": {"source": "json", "watch_interval": 0},
+        "knowledge_base_path": str(tmp_path / "knowledge_base.json"),
+        "conversation": {"enabled": False},
+        "cache": {"disk_path": str(tmp_path / "responses")},
+        "metrics": {"dir": None}
+    }
+    (tmp_path / "knowledge_base.json").write_text("{}")
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(config))
+    return LightweightAIModel(str(models / "model.onnx"), str(config_path))
+
+
+def test_lazy_model_load_keeps_the_cache_version(tmp_path, variant_dir):
+    service = make_service(tmp_path, variant_dir, "lazy")
+    try:
+        version = service.cache.version
+        key = service.cache.make_key("bonjour", "fr")
+        service.cache.set(key, {"type": "text", "content": "ok", "source": "ai_model"})
+
+        service.ensure_model(raise_errors=True)
+        assert service.model_variant == "int8"
+        assert service.cache.version == version
+        # The persistent tier was not cleared by the load
+        assert service.cache.disk.get(key) is not None
+    finally:
+        service.close()
+
+
+def test_version_follows_the_variant_digest(tmp_path, variant_dir):
+    service = make_service(tmp_path, variant_dir, "lazy")
+    version = service.cache.version
+    service.close()
+
+    # Same variant bytes at another path: same answers, same version
+    moved = tmp_path / "moved"
+    shutil.copytree(variant_dir, moved)
+    service = make_service(tmp_path, moved, "lazy")
+    assert service.cache.version == version
+    service.close()
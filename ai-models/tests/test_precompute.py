@@ -0,0 +1,94 @@
+"""Offline answer pack"""
+
+import gzip
+import json
+import os
+
+import pytest
+
+from precompute import (normalize_question, input_key, build_pack, compile_pack,
+                        RESULTS_NAME, RUN_STATE_NAME, PACK_MANIFEST_NAME)
+
+
+def record(question, content, lang="fr", confidence=0.9, version="v1"):
+    return {
+        "question": question,
+        "lang": lang,
+        "version": version,
+        "key": input_key(question, lang, version),
+        "answer": {"type": "text", "content": content, "source": "ai_model", "confidence": confidence}
+    }
+
+
+def write_results(workdir, records, keys=None):
+    with open(os.path.join(workdir, RESULTS_NAME), 'w', encoding='utf-8') as f:
+        for item in records:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    if keys is not None:
+        with open(os.path.join(workdir, RUN_STATE_NAME), 'w', encoding='utf-8') as f:
+            json.dump({"keys": keys}, f)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Comment renouveler mon Passeport ?", "comment renouveler mon passeport"),
+    ("Frais:  5 pages / 2024", "frais 5 pages 2024"),
+    ("هَلْ أُريد بطاقة؟", "هل ارىد بطاقه"),
+])
+def test_normalize_question(text, expected):
+    assert normalize_question(text) == expected
+
+
+def test_build_pack_entries():
+    pack = build_pack([
+        record("Prix de 5 pages ?", "10 DH"),
+        record("prix de 5 pages", "duplicate"),
+        record("Prix de 2 pages", "10 DH"),
+        record("Horaires du bureau", "8h-16h", lang="ar"),
+        record("Question incertaine", "?", confidence=0.1),
+    ], min_confidence=0.5)
+
+    assert len(pack["entries"]) == 3
+    # Same answer, one row
+    assert len(pack["answers"]) == 2
+    entry = pack["entries"][pack["exact"]["fr:prix de 5 pages"]]
+    assert entry[0] == "fr"
+    assert pack["answers"][entry[1]][1] == "10 DH"
+    assert entry[3] == ["5"]
+    assert pack["entries"][pack["exact"]["fr:prix de 2 pages"]][3] == ["2"]
+    assert pack["entries"][pack["exact"]["ar:horaires du bureau"]][3] == []
+    # Rarer words weigh more
+    assert pack["terms"]["5"][0] > pack["terms"]["prix"][0]
+    assert "fr:question incertaine" not in pack["exact"]
+
+
+def test_compile_pack_keeps_the_last_run(tmp_path):
+    workdir, output = str(tmp_path / "work"), str(tmp_path / "pack")
+    os.makedirs(workdir)
+    old = record("Ancienne question", "old", version="v0")
+    first = record("Comment renouveler mon passeport", "first")
+    latest = dict(first, answer=dict(first["answer"], content="latest"))
+    write_results(workdir, [old, first, latest], keys=[first["key"]])
+
+    manifest = compile_pack(workdir, output)
+    assert manifest["questions"] == 1
+    with gzip.open(os.path.join(output, manifest["file"]), 'rt', encoding='utf-8') as f:
+        pack = json.load(f)
+    assert [row[1] for row in pack["answers"]] == ["latest"]
+    # Results are compacted to the kept records
+    with open(os.path.join(workdir, RESULTS_NAME), 'r', encoding='utf-8') as f:
+        assert len(f.readlines()) == 1
+
+
+def test_compile_pack_is_stable(tmp_path):
+    workdir, output = str(tmp_path / "work"), str(tmp_path / "pack")
+    os.makedirs(workdir)
+    write_results(workdir, [record("Horaires du bureau", "8h-16h")])
+
+    manifest = compile_pack(workdir, output)
+    assert compile_pack(workdir, output) == manifest
+
+    write_results(workdir, [record("Horaires du bureau", "9h-17h")])
+    changed = compile_pack(workdir, output)
+    assert changed["version"] != manifest["version"]
+    # The replaced pack stays for clients midway through a download
+    assert sorted(os.listdir(output)) == sorted([PACK_MANIFEST_NAME, manifest["file"], changed["file"]])
@@ -0,0 +1,55 @@
+"""Shared system prompt KV prefix"""
+
+import json
+import shutil
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="module")
+def service(tmp_path_factory, tiny_model_path):
+    from model_service import LightweightAIModel
+
+    workdir = tmp_path_factory.mktemp("prefix")
+    shutil.copy(tiny_model_path, workdir / "model.onnx")
+    (workdir / "knowledge_base.json").write_text("{}")
+    config = {
+        "model": {"loading": "eager", "graph_cache_dir": None, "do_sample": False, "max_new_tokens": 6},
+        "knowledge_base": {"source": "json", "watch_interval": 0},
+        "knowledge_base_path": str(workdir / "knowledge_base.json"),
+        "conversation": {"enabled": False},
+        "cache": {"disk_path": None},
+        "metrics": {"dir": None}
+    }
+    (workdir / "config.json").write_text(json.dumps(config))
+    service = LightweightAIModel(str(workdir / "model.onnx"), str(workdir / "config.json"))
+    yield service
+    service.close()
+
+
+@pytest.mark.parametrize("lang, message", [("fr", "Quels sont les horaires ?"), ("ar", "ما هي أوقات العمل؟")])
+def test_prefix_gives_the_full_prefill_logits(service, lang, message):
+    requests = service.prompt_prefix_stats["requests"]
+    model_input = service.prepare_model_input(message, lang, None)
+    system_tokens, system_state = service.prompt_prefixes[lang]
+    assert model_input["prefix"] is system_state
+    assert service.prompt_prefix_stats["requests"] == requests + 1
+    assert len(model_input["input_ids"][0]) > len(system_tokens)
+
+    engine = service.engine
+    shared = [past.copy() for past in system_state.past]
+    full_state, full = engine.start(model_input["input_ids"], model_input["attention_mask"], max_new_tokens=4)
+    state, logits = engine.start(model_input["input_ids"], model_input["attention_mask"], max_new_tokens=4,
+                                 prefix=model_input["prefix"])
+    np.testing.assert_allclose(logits, full, atol=1e-4)
+    for past, expected in zip(state.past, full_state.past):
+        np.testing.assert_allclose(past, expected, atol=1e-4)
+    # The shared state is read, never written
+    assert system_state.length == len(system_tokens)
+    for past, before in zip(system_state.past, shared):
+        np.testing.assert_array_equal(past, before)
+
+    with_prefix = engine.generate(model_input["input_ids"], max_new_tokens=6, prefix=model_input["prefix"])
+    without = engine.generate(model_input["input_ids"], max_new_tokens=6)
+    np.testing.assert_array_equal(with_prefix["tokens"], without["tokens"])
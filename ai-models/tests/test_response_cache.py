@@ -0,0 +1,105 @@
+"""Two-tier response cache"""
+
+import time
+
+import pytest
+
+from response_cache import ResponseCache
+
+
+def answer(text):
+    return {"type": "text", "content": text, "source": "ai_model"}
+
+
+@pytest.fixture
+def disk_cache(tmp_path):
+    cache = ResponseCache(ttl=60, disk_path=str(tmp_path / "responses"))
+    cache.set_version("v1")
+    yield cache
+    cache.close()
+
+
+def test_lru_eviction_by_entries():
+    cache = ResponseCache(max_entries=2)
+    for name in "abc":
+        cache.set(name, answer(name))
+    assert cache.get("a") is None
+    assert cache.get("c")["content"] == "c"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lru_eviction_by_bytes():
+    cache = ResponseCache(max_entries=100, max_bytes=200)
+    for i in range(5):
+        cache.set(str(i), answer("x" * 40))
+    assert cache.stats()["bytes"] <= 200
+    assert cache.get("0") is None
+    assert cache.get("4") is not None
+
+
+def test_callers_get_copies():
+    cache = ResponseCache()
+    cache.set("k", answer("original"))
+    cache.get("k")["content"] = "changed"
+    assert cache.get("k")["content"] == "original"
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("response_cache.time.monotonic", lambda: now[0])
+    cache = ResponseCache(ttl=10)
+    cache.set("k", answer("ok"))
+    now[0] += 9
+    assert cache.get("k") is not None
+    now[0] += 2
+    assert cache.get("k") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_disk_tier_is_shared_and_promoted(tmp_path, disk_cache):
+    disk_cache.set(disk_cache.make_key("bonjour", "fr"), answer("ok"), tag="kb:passeport")
+
+    other = ResponseCache(ttl=60, disk_path=str(tmp_path / "responses"))
+    other.set_version("v1")
+    key = other.make_key("bonjour", "fr")
+    assert other.get(key)["content"] == "ok"
+    assert other.stats()["disk_hits"] == 1
+    assert key in other
+    # The promoted entry keeps its tag
+    assert other.evict_tags(["kb:passeport"]) == 1
+    assert other.get(key) is None
+    other.close()
+
+
+def test_version_change_clears_both_tiers(disk_cache):
+    key = disk_cache.make_key("bonjour", "fr")
+    disk_cache.set(key, answer("ok"))
+    disk_cache.set_version("v2")
+    assert disk_cache.get(key) is None
+    assert disk_cache.get(disk_cache.make_key("bonjour", "fr")) is None
+    # Only the version marker is left on disk
+    assert disk_cache.stats()["disk_entries"] == 1
+
+
+def test_context_keys_differ_from_plain_keys():
+    cache = ResponseCache()
+    assert cache.make_key("oui", "fr") != cache.make_key("oui", "fr", context="abc")
+
+
+def test_promoted_entry_keeps_its_disk_expiry(tmp_path, monkeypatch):
+    path = str(tmp_path / "responses")
+    writer = ResponseCache(ttl=60, disk_path=path)
+    writer.set_version("v1")
+    writer.set("k", answer("ok"))
+    writer.close()
+
+    # Another process reads it 50 of its 60 seconds later
+    wall = time.time() + 50
+    monkeypatch.setattr("response_cache.time.time", lambda: wall)
+    monkeypatch.setattr("response_cache.time.monotonic", lambda: 1000.0)
+    reader = ResponseCache(ttl=60, disk_path=path)
+    reader.set_version("v1")
+    assert reader.get("k") is not None
+    expires_at = reader.entries["k"][0]
+    assert expires_at - 1000.0 == pytest.approx(10, abs=1)
+    reader.close()
@@ -0,0 +1,101 @@
+"""Dense and hybrid knowledge base retrieval in the service"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from tiny_model import build_tiny_encoder
+
+KNOWLEDGE_BASE = {
+    "passeport": [{"question_fr": "Comment renouveler mon passeport ?", "question_ar": "كيف أجدد جواز السفر؟",
+                   "answer_fr": "Au guichet", "answer_ar": "في الشباك", "keywords": ["passeport"]}],
+    "naissance": [{"question_fr": "Où demander un acte de naissance ?", "question_ar": "أين أطلب عقد الازدياد؟",
+                   "answer_fr": "En ligne", "answer_ar": "عبر الإنترنت", "keywords": ["naissance"]}]
+}
+
+
+@pytest.fixture
+def models(tmp_path, tiny_model_path):
+    models = tmp_path / "models"
+    models.mkdir()
+    shutil.copy(tiny_model_path, models / "model.onnx")
+    (models / "encoder").mkdir()
+    build_tiny_encoder(str(models / "encoder" / "model.onnx"))
+    (tmp_path / "knowledge_base.json").write_text(json.dumps(KNOWLEDGE_BASE, ensure_ascii=False))
+    return models
+
+
+def make_service(tmp_path, models, loading, mode):
+    from model_service import LightweightAIModel
+
+    config = {
+        "model": {"loading": loading, "graph_cache_dir": None, "max_new_tokens": 4},
+        "knowledge_base": {"source": "json", "watch_interval": 0},
+        "knowledge_base_path": str(tmp_path / "knowledge_base.json"),
+        "retrieval": {"mode": mode, "encoder_path": str(models / "encoder" / "model.onnx"),
+                      "embeddings_path": str(models / "kb_embeddings.npy")},
+        "conversation": {"enabled": False},
+        "cache": {"disk_path": None},
+        "metrics": {"dir": None}
+    }
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(config))
+    return LightweightAIModel(str(models / "model.onnx"), str(config_path))
+
+
+@pytest.mark.parametrize("mode", ["dense", "hybrid"])
+@pytest.mark.parametrize("loading", ["lazy", "background"])
+def test_dense_retrieval_before_and_after_the_matrix_exists(tmp_path, models, loading, mode):
+    # The first service builds the matrix, the second maps it
+    for built in (False, True):
+        assert os.path.exists(models / "kb_embeddings.npy") == built
+        service = make_service(tmp_path, models, loading, mode)
+        try:
+            assert service.kb.embeddings is not None
+            hits = service.search_knowledge_base("Où demander un acte de naissance ?")
+            assert hits[0]["category"] == "naissance"
+            if mode == "dense":
+                assert hits[0]["confidence"] > 0.9
+            response = service.generate_response("Comment renouveler mon passeport ?", "fr")
+            assert response["source"] == "knowledge_base"
+            assert response["content"].startswith("Au guichet")
+        finally:
+            service.close()
+
+
+def test_encoder_failure_falls_back_to_lexical_ranking(tmp_path, models):
+    service = make_service(tmp_path, models, "lazy", "dense")
+    try:
+        def fail(texts, batch_size=32):
+            raise RuntimeError("encoder session lost")
+
+        service.encoder.encode = fail
+        hits = service.search_knowledge_base("Comment renouveler mon passeport ?")
+        assert hits[0]["category"] == "passeport"
+        assert hits[0]["score"] > 0
+    finally:
+        service.close()
+
+
+def test_hybrid_scores_blend_lexical_and_dense(tmp_path, models):
+    service = make_service(tmp_path, models, "lazy", "hybrid")
+    try:
+        retrieval = service.get_retrieval_config()
+        message = "renouveler passeport"
+        text = service.normalize_for_matching(message)
+        scores, lexical = service.kb.index.score_entries(text, retrieval["keyword_weight"])
+        dense = np.maximum(service.kb.embeddings.similarities(service.encoder.encode([text]))[0], 0.0)
+        expected = (1.0 - retrieval["dense_weight"]) * lexical + retrieval["dense_weight"] * dense
+
+        hits = service.search_knowledge_base(message, top_k=2)
+        for hit in hits:
+            entry_id = next(i for i, (_, entry) in enumerate(service.kb.index.entries) if entry is hit["entry"])
+            assert hit["confidence"] == pytest.approx(expected[entry_id])
+            # The BM25 score is reported as is
+            assert hit["score"] == pytest.approx(scores[entry_id])
+        assert [hit["confidence"] for hit in hits] == pytest.approx(sorted(expected, reverse=True))
+    finally:
+        service.close()
@@ -0,0 +1,62 @@
+"""Logits processing and token selection"""
+
+import numpy as np
+import pytest
+
+from sampling import LogitsProcessor, ScoredSelector, token_logprobs
+
+
+def test_greedy_takes_the_argmax():
+    logits = np.array([[0.1, 2.0, 0.5], [3.0, 1.0, 0.0]])
+    processor = LogitsProcessor(do_sample=False, repetition_penalty=1.0)
+    assert processor.select(logits).tolist() == [1, 0]
+
+
+def test_repetition_penalty_divides_positive_and_multiplies_negative():
+    processor = LogitsProcessor(repetition_penalty=2.0)
+    logits = np.array([[4.0, -1.0, 1.0]], dtype=np.float32)
+    processor.apply_repetition_penalty(logits, np.array([[0, 1, 1]]))
+    assert logits.tolist() == [[2.0, -2.0, 1.0]]
+
+
+def test_repetition_penalty_ignores_masked_tokens():
+    processor = LogitsProcessor(repetition_penalty=2.0)
+    logits = np.array([[4.0, 4.0]], dtype=np.float32)
+    processor.apply_repetition_penalty(logits, np.array([[0, 1]]), np.array([[1, 0]]))
+    assert logits.tolist() == [[2.0, 4.0]]
+
+
+def test_top_k_limits_the_candidates():
+    processor = LogitsProcessor(temperature=1.0, top_k=2, top_p=1.0, repetition_penalty=1.0, seed=0)
+    logits = np.tile(np.array([[1.0, 5.0, 0.0, 4.9]]), (500, 1))
+    assert set(processor.select(logits).tolist()) == {1, 3}
+
+
+def test_top_p_keeps_the_smallest_nucleus():
+    processor = LogitsProcessor(temperature=1.0, top_k=0, top_p=0.5, repetition_penalty=1.0, seed=0)
+    # The best token alone holds more than half the mass
+    logits = np.tile(np.log(np.array([[0.6, 0.3, 0.1]])), (500, 1))
+    assert set(processor.select(logits).tolist()) == {0}
+
+
+def test_sampling_follows_the_distribution():
+    processor = LogitsProcessor(temperature=1.0, top_k=0, top_p=1.0, repetition_penalty=1.0, seed=1)
+    logits = np.tile(np.log(np.array([[0.7, 0.2, 0.1]])), (20000, 1))
+    counts = np.bincount(processor.select(logits), minlength=3) / 20000
+    assert counts == pytest.approx([0.7, 0.2, 0.1], abs=0.02)
+
+
+def test_seed_makes_sampling_reproducible():
+    logits = np.random.default_rng(0).normal(size=(8, 50))
+    first = LogitsProcessor(seed=3).select(logits)
+    assert LogitsProcessor(seed=3).select(logits).tolist() == first.tolist()
+
+
+def test_scored_selector_averages_raw_logprobs():
+    selector = ScoredSelector()
+    assert selector.mean_logprob() is None
+    steps = [np.log(np.array([[0.5, 0.25, 0.25]])), np.log(np.array([[0.1, 0.8, 0.1]]))]
+    chosen = [selector(logits, None)[0] for logits in steps]
+    assert chosen == [0, 1]
+    assert selector.mean_logprob() == pytest.approx((np.log(0.5) + np.log(0.8)) / 2, rel=1e-5)
+    assert token_logprobs(steps[0], np.array([1]))[0] == pytest.approx(np.log(0.25), rel=1e-5)
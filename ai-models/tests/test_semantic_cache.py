@@ -0,0 +1,54 @@
+"""Near-duplicate response cache"""
+
+import pytest
+
+from semantic_cache import SemanticCache
+
+
+@pytest.fixture
+def cache():
+    cache = SemanticCache(str.lower, threshold=0.8)
+    cache.set_version("v1")
+    return cache
+
+
+def answer(text):
+    return {"type": "text", "content": text, "source": "ai_model"}
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("Comment renouveler mon passeport ?", "passeport: comment le renouveler"),
+    ("Quels documents pour une carte grise", "carte grise, quels documents svp"),
+    ("Où déposer la demande d'acte de naissance", "déposer demande acte naissance où"),
+])
+def test_paraphrases_hit(cache, stored, asked):
+    cache.set(stored, "fr", answer("ok"))
+    hit = cache.get(asked, "fr")
+    assert hit is not None
+    assert hit[0]["content"] == "ok"
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("quel est le tarif du timbre pour 5 pages", "quel est le tarif du timbre pour 2 pages"),
+    ("délai de traitement du formulaire cerfa 12100 pour une demande urgente de passeport biométrique",
+     "délai de traitement du formulaire cerfa 12101 pour une demande urgente de passeport biométrique"),
+    ("inscription scolaire 2024", "inscription scolaire 2025"),
+    ("tarif passeport mineur", "tarif passeport mineur 15 ans"),
+])
+def test_number_only_differences_miss(cache, stored, asked):
+    cache.set(stored, "fr", answer("stored"))
+    assert cache.get(asked, "fr") is None
+    # The stored question itself still hits
+    assert cache.get(stored, "fr") is not None
+
+
+def test_single_character_tokens_count(cache):
+    cache.set("permis catégorie b", "fr", answer("b"))
+    assert cache.get("permis catégorie a", "fr") is None
+
+
+def test_languages_and_versions_are_separate(cache):
+    cache.set("comment renouveler mon passeport", "fr", answer("fr"))
+    assert cache.get("comment renouveler mon passeport", "ar") is None
+    cache.set_version("v2")
+    assert cache.get("comment renouveler mon passeport", "fr") is None
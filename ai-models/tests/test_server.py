@@ -0,0 +1,151 @@
+"""Streaming chat endpoint"""
+
+import json
+import math
+import shutil
+import time
+
+import pytest
+
+import server
+
+KNOWLEDGE_BASE = {
+    "passeport": [{"question_fr": "Comment renouveler mon passeport ?", "question_ar": "كيف أجدد جواز السفر؟",
+                   "answer_fr": "Au guichet de la préfecture", "answer_ar": "في شباك العمالة",
+                   "keywords": ["passeport"]}]
+}
+
+
+@pytest.fixture(params=[False, True], ids=["single", "batching"])
+def service(request, tmp_path, tiny_model_path, monkeypatch):
+    from model_service import LightweightAIModel
+
+    shutil.copy(tiny_model_path, tmp_path / "model.onnx")
+    (tmp_path / "knowledge_base.json").write_text(json.dumps(KNOWLEDGE_BASE, ensure_ascii=False))
+    config = {
+        "model": {"loading": "eager", "graph_cache_dir": None, "do_sample": False, "seed": 0,
+                  "max_new_tokens": 48},
+        "knowledge_base": {"source": "json", "watch_interval": 0},
+        "knowledge_base_path": str(tmp_path / "knowledge_base.json"),
+        "conversation": {"enabled": False},
+        "cache": {"disk_path": None},
+        "metrics": {"dir": None},
+        "batching": {"enabled": request.param, "max_batch_size": 4, "max_wait_ms": 1},
+        "cascade": {"stages": ["knowledge_base", "model"], "thresholds": {"model": 0.0}}
+    }
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    service = LightweightAIModel(str(tmp_path / "model.onnx"), str(tmp_path / "config.json"))
+    monkeypatch.setattr(server, "get_ai_model", lambda: service)
+    yield service
+    service.close()
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+def parse_events(body):
+    """(event, data) pairs of a server-sent event stream"""
+    events = []
+    for block in body.split("\n\n"):
+        if not block:
+            continue
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_model_answer_is_streamed_as_events(service, client):
+    response = client.post("/chat/stream", json={"message": "Quels sont les horaires ?", "lang": "fr"})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache, no-transform"
+    assert response.headers["X-Accel-Buffering"] == "no"
+
+    events = parse_events(response.get_data(as_text=True))
+    assert [event for event, _ in events[:-1]] == ["token"] * (len(events) - 1)
+    event, final = events[-1]
+    assert event == "done"
+    assert final["source"] == "ai_model"
+    # The final response carries the postprocessed text of the streamed chunks
+    streamed = {"content": "".join(data["content"] for _, data in events[:-1])}
+    assert service.postprocess_response(streamed, "fr")["content"] == final["content"]
+    assert final["generated_tokens"] > 0
+
+
+def test_cheap_stage_answer_is_one_chunk(service, client):
+    response = client.post("/chat/stream", json={"message": "Comment renouveler mon passeport ?"})
+    events = parse_events(response.get_data(as_text=True))
+    assert [event for event, _ in events] == ["token", "done"]
+    assert events[1][1]["source"] == "knowledge_base"
+    assert events[0][1]["content"] == events[1][1]["content"]
+
+
+def test_invalid_request_is_refused(service, client):
+    response = client.post("/chat/stream", json={"message": "", "lang": "fr"})
+    assert response.status_code == 400
+    assert response.get_json()["success"] is False
+
+
+def test_disconnect_stops_decoding(service, client, monkeypatch):
+    # Slow steps so the sequence is still decoding when the client goes away
+    step, steps = service.engine.step, []
+
+    def slow_step(*args):
+        steps.append(time.sleep(0.01))
+        return step(*args)
+
+    monkeypatch.setattr(service.engine, "step", slow_step)
+    futures = []
+    if service.scheduler is not None:
+        submit = service.scheduler.submit
+
+        def spy(*args, **kwargs):
+            futures.append(submit(*args, **kwargs))
+            return futures[-1]
+
+        monkeypatch.setattr(service.scheduler, "submit", spy)
+
+    response = client.post("/chat/stream", json={"message": "Quels sont les horaires ?"}, buffered=False)
+    chunks = iter(response.response)
+    assert next(chunks).startswith(b"event: token")
+    response.close()
+
+    if futures:
+        result = futures[0].result(timeout=5)
+        assert result["finish_reason"] == ["stopped"]
+        assert result["generated_tokens"] < service.get_model_config()["max_new_tokens"]
+    taken = len(steps)
+    time.sleep(0.05)
+    assert len(steps) == taken < service.get_model_config()["max_new_tokens"]
+    # The single-stream path gave its inference slot back
+    assert service.inference_slot.acquire(blocking=False)
+    service.inference_slot.release()
+
+
+def test_confidence_comes_from_the_mean_logprob(service, monkeypatch):
+    results = []
+    if service.scheduler is not None:
+        submit = service.scheduler.submit
+
+        def spy(*args, **kwargs):
+            future = submit(*args, **kwargs)
+            results.append(future)
+            return future
+
+        monkeypatch.setattr(service.scheduler, "submit", spy)
+
+    stream = service.stream_ai_response("quels sont les horaires", "fr", None)
+    chunks = []
+    while True:
+        try:
+            chunks.append(next(stream))
+        except StopIteration as stop:
+            answer = stop.value
+            break
+
+    assert answer["content"] == "".join(chunks)
+    assert 0.0 < answer["confidence"] <= 1.0
+    if results:
+        assert answer["confidence"] == pytest.approx(math.exp(results[0].result()["mean_logprob"]))
@@ -0,0 +1,156 @@
+"""Shared sessions and memory-mapped weights"""
+
+import mmap
+import os
+import shutil
+import threading
+
+import numpy as np
+import onnxruntime as ort
+import pytest
+
+from generation import GenerationEngine
+from session_store import ALIGNMENT, SessionStore, external_data_files, externalize, mappable_path
+
+
+def session_options(threads=1):
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = threads
+    return sess_options
+
+
+@pytest.fixture
+def model_path(tmp_path, tiny_model_path):
+    """A private copy, so tests can touch the file"""
+    shutil.copy(tiny_model_path, tmp_path / "tiny.onnx")
+    return str(tmp_path / "tiny.onnx")
+
+
+def run(session, tokens=(1, 2, 3)):
+    """Prefill logits of the tiny decoder for a short prompt"""
+    engine = GenerationEngine(session, eos_token_id=0, pad_token_id=0)
+    return engine.start(np.array([tokens], dtype=np.int64), max_new_tokens=1)[1]
+
+
+def test_externalized_weights_are_aligned_and_equivalent(tmp_path, model_path):
+    assert external_data_files(model_path) is None
+    destination = externalize(model_path, str(tmp_path / "mapped.onnx"))
+    data_files = external_data_files(destination)
+    assert data_files == [str(tmp_path / f"mapped.onnx.{os.getpid()}.data")]
+    assert ALIGNMENT % mmap.ALLOCATIONGRANULARITY == 0
+    assert os.path.getsize(destination) < os.path.getsize(model_path) < os.path.getsize(data_files[0])
+
+    original = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    mapped = ort.InferenceSession(destination, providers=['CPUExecutionProvider'])
+    np.testing.assert_array_equal(run(mapped), run(original))
+
+
+def test_mappable_copy_is_written_once_per_model_version(tmp_path, model_path):
+    cache_dir = str(tmp_path / "cache")
+    assert mappable_path(model_path, None) is None
+    mapped = mappable_path(model_path, cache_dir)
+    assert os.path.dirname(mapped) == cache_dir
+    written = os.stat(mapped).st_mtime_ns
+    assert mappable_path(model_path, cache_dir) == mapped
+    assert os.stat(mapped).st_mtime_ns == written
+    # An already mappable model is used as it is
+    assert mappable_path(mapped, cache_dir) == mapped
+
+    # A new version of the model gets its own copy
+    stat = os.stat(model_path)
+    os.utime(model_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert mappable_path(model_path, cache_dir) != mapped
+
+
+def test_sessions_are_shared_and_counted_per_user(tmp_path, model_path):
+    store = SessionStore()
+    cache_dir = str(tmp_path / "cache")
+    first_options = session_options()
+    first = store.open(model_path, first_options, cache_dir=cache_dir, name="model")
+    assert first_options.get_session_config_entry("session.disable_prepacking") == "1"
+    assert store.open(model_path, session_options(), cache_dir=cache_dir) is first
+    # Other options, other session
+    other = store.open(model_path, session_options(threads=2), cache_dir=cache_dir)
+    assert other is not first
+
+    report = {entry["name"]: entry for entry in store.stats()}
+    assert report["model"]["users"] == 2
+    assert report["model"]["weights"] == "mmap"
+    assert report["model"]["path"].startswith(cache_dir)
+    assert all(entry["mapped_resident_bytes"] >= 0 for entry in report.values())
+
+    store.release(first)
+    assert store.open(model_path, session_options(), cache_dir=cache_dir) is first
+    store.release(first)
+    store.release(first)
+    assert [entry["users"] for entry in store.stats()] == [1]
+    # Released for good: the next open loads it again
+    assert store.open(model_path, session_options(), cache_dir=cache_dir) is not first
+    # Releasing an unknown session is harmless
+    store.release(object())
+
+
+def test_weight_modes(model_path):
+    store = SessionStore()
+    store.open(model_path, session_options(), name="private")
+    store.open(model_path, session_options(threads=2), weights="prepacked", name="prepacked")
+    report = {entry["name"]: entry for entry in store.stats()}
+    # Inline weights and no cache directory: nothing to map
+    assert report["private"]["weights"] == "private"
+    assert report["prepacked"]["weights"] == "prepacked"
+    assert report["private"]["mapped_resident_bytes"] == 0
+    with pytest.raises(ValueError):
+        store.open(model_path, session_options(), weights="fp16")
+
+
+def test_a_changed_model_is_not_shared(model_path):
+    store = SessionStore()
+    first = store.open(model_path, session_options(), weights="prepacked")
+    stat = os.stat(model_path)
+    os.utime(model_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert store.open(model_path, session_options(), weights="prepacked") is not first
+    assert len(store.stats()) == 2
+
+
+def test_concurrent_opens_load_once(tmp_path, model_path):
+    store = SessionStore()
+    cache_dir = str(tmp_path / "cache")
+    mappable_path(model_path, cache_dir)
+    barrier = threading.Barrier(8)
+    sessions, outputs = [], []
+
+    def user():
+        barrier.wait()
+        session = store.open(model_path, session_options(), cache_dir=cache_dir)
+        sessions.append(session)
+        outputs.append(run(session))
+
+    threads = [threading.Thread(target=user) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(session) for session in sessions}) == 1
+    assert [entry["users"] for entry in store.stats()] == [8]
+    for output in outputs[1:]:
+        np.testing.assert_array_equal(output, outputs[0])
+
+    threads = [threading.Thread(target=store.release, args=(session,)) for session in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.stats() == []
+
+
+def test_fork_keeps_only_single_threaded_sessions(model_path):
+    store = SessionStore()
+    single = store.open(model_path, session_options(), weights="prepacked")
+    store.open(model_path, session_options(threads=2), weights="prepacked")
+    # What the registered at-fork hook does in the child
+    store.after_fork()
+    assert [entry["users"] for entry in store.stats()] == [1]
+    assert store.open(model_path, session_options(), weights="prepacked") is single
+    assert store.lock.acquire(blocking=False)
+    store.lock.release()
@@ -0,0 +1,39 @@
+"""Tokenizer caches"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tokenizer import ByteTokenizer, LRUCache
+
+
+def test_lru_cache_evicts_least_recent():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_lru_cache_is_thread_safe():
+    cache = LRUCache(64)
+
+    def hammer(worker):
+        for i in range(5000):
+            key = (worker * 7 + i) % 200
+            if cache.get(key) is None:
+                cache.put(key, key)
+        return True
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert all(executor.map(hammer, range(8)))
+    assert len(cache) == 64
+    assert cache.hits + cache.misses == 8 * 5000
+
+
+def test_concurrent_encoding_matches_sequential():
+    tokenizer = ByteTokenizer(cache_size=8)
+    texts = [f"demande {i % 20} de passeport" for i in range(400)]
+    expected = [tokenizer.encode(text) for text in texts]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(executor.map(tokenizer.encode, texts)) == expected
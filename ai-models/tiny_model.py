@@ -0,0 +1,201 @@
+"""
+Tiny decoder model for offline development and benchmarks
+Builds a small causal transformer with random weights and the input/output layout of
+the exported SmolLM2 model (past_key_values.* inputs, present.* outputs), so the
+generation engine, scheduler and service run end to end without downloading anything.
+A tiny sentence encoder does the same for dense retrieval.
+"""
+
+import json
+import os
+from typing import Optional
+
+import numpy as np
+
+from tokenizer import ByteTokenizer, DEFAULT_SPECIAL_TOKENS, bytes_to_unicode
+
+
+def build_tiny_decoder(path: str, vocab_size: Optional[int] = None, hidden_size: int = 64,
+                       num_heads: int = 4, num_layers: int = 2, max_positions: int = 2048,
+                       seed: int = 0) -> str:
+    """
+    Write a randomly initialized decoder-only ONNX model
+
+    Each layer is multi-head attention over the KV cache (past_key_values inputs
+    concatenated with the new keys and values) followed by a ReLU MLP, both residual.
+    Weights come from a seeded generator, so the same arguments give the same file.
+
+    Args:
+        path: Destination .onnx file
+        vocab_size: Output vocabulary (default: the byte-level fallback tokenizer's)
+        hidden_size: Model width
+        num_heads: Attention heads (KV heads too); must divide hidden_size
+        num_layers: Decoder layers
+        max_positions: Longest sequence the position embedding covers
+        seed: Weight initialization seed
+
+    Returns:
+        The path written
+    """
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    if hidden_size % num_heads:
+        raise ValueError("hidden_size must be a multiple of num_heads")
+    if vocab_size is None:
+        vocab_size = ByteTokenizer().vocab_size
+    head_dim = hidden_size // num_heads
+    rng = np.random.default_rng(seed)
+    nodes, initializers = [], []
+
+    def weight(name, shape, scale):
+        initializers.append(numpy_helper.from_array(
+            (rng.standard_normal(shape) * scale).astype(np.float32), name))
+        return name
+
+    def const(name, value, dtype=np.int64):
+        initializers.append(numpy_helper.from_array(np.array(value, dtype=dtype), name))
+        return name
+
+    def node(op, inputs, outputs, **attrs):
+        nodes.append(helper.make_node(op, inputs, outputs, **attrs))
+        return outputs[0]
+
+    weight("embed", (vocab_size, hidden_size), 1.0)
+    weight("pos_embed", (max_positions, hidden_size), 0.1)
+    const("shape_bshd", [0, 0, num_heads, head_dim])
+    const("shape_bse", [0, 0, hidden_size])
+    const("zero", 0)
+    const("one", 1)
+    const("axes0", [0])
+    const("axes1", [1])
+    const("axes01", [0, 1])
+    const("axes12", [1, 2])
+    const("neg_inf", -1e9, np.float32)
+    const("scale", 1.0 / np.sqrt(head_dim), np.float32)
+
+    x = node("Gather", ["embed", "input_ids"], ["token_embeddings"])
+    positions = node("Gather", ["pos_embed", "position_ids"], ["position_embeddings"])
+    x = node("Add", [x, positions], ["hidden_0"])
+
+    # Query i of the new tokens sits at absolute position past_len + i and may attend
+    # to key j when j <= past_len + i and the attention mask keeps j
+    node("Shape", ["input_ids"], ["ids_shape"])
+    node("Gather", ["ids_shape", "one"], ["seq_len"], axis=0)
+    node("Shape", ["attention_mask"], ["mask_shape"])
+    node("Gather", ["mask_shape", "one"], ["total_len"], axis=0)
+    node("Sub", ["total_len", "seq_len"], ["past_len"])
+    node("Range", ["past_len", "total_len", "one"], ["query_positions"])
+    node("Range", ["zero", "total_len", "one"], ["key_positions"])
+    node("Unsqueeze", ["query_positions", "axes1"], ["query_column"])
+    node("Unsqueeze", ["key_positions", "axes0"], ["key_row"])
+    node("LessOrEqual", ["key_row", "query_column"], ["causal"])
+    node("Unsqueeze", ["causal", "axes01"], ["causal_4d"])
+    node("Cast", ["attention_mask"], ["mask_bool"], to=TensorProto.BOOL)
+    node("Unsqueeze", ["mask_bool", "axes12"], ["mask_4d"])
+    node("And", ["causal_4d", "mask_4d"], ["allowed"])
+
+    inputs = [
+        helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "sequence"]),
+        helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch", "total_sequence"]),
+        helper.make_tensor_value_info("position_ids", TensorProto.INT64, ["batch", "sequence"])
+    ]
+    outputs = [helper.make_tensor_value_info("logits", TensorProto.FLOAT, ["batch", "sequence", vocab_size])]
+
+    for layer in range(num_layers):
+        past_key, past_value = f"past_key_values.{layer}.key", f"past_key_values.{layer}.value"
+        present_key, present_value = f"present.{layer}.key", f"present.{layer}.value"
+        for name in (past_key, past_value):
+            inputs.append(helper.make_tensor_value_info(
+                name, TensorProto.FLOAT, ["batch", num_heads, "past_sequence", head_dim]))
+        for name in (present_key, present_value):
+            outputs.append(helper.make_tensor_value_info(
+                name, TensorProto.FLOAT, ["batch", num_heads, "total_sequence", head_dim]))
+
+        heads = {}
+        for projection in ("q", "k", "v"):
+            w = weight(f"layer{layer}.w{projection}", (hidden_size, hidden_size), 1.0 / np.sqrt(hidden_size))
+            h = node("MatMul", [x, w], [f"layer{layer}.{projection}"])
+            h = node("Reshape", [h, "shape_bshd"], [f"layer{layer}.{projection}_heads"])
+            heads[projection] = node("Transpose", [h], [f"layer{layer}.{projection}_bhsd"], perm=[0, 2, 1, 3])
+        node("Concat", [past_key, heads["k"]], [present_key], axis=2)
+        node("Concat", [past_value, heads["v"]], [present_value], axis=2)
+
+        keys_t = node("Transpose", [present_key], [f"layer{layer}.keys_t"], perm=[0, 1, 3, 2])
+        scores = node("MatMul", [heads["q"], keys_t], [f"layer{layer}.scores"])
+        scores = node("Mul", [scores, "scale"], [f"layer{layer}.scaled"])
+        scores = node("Where", ["allowed", scores, "neg_inf"], [f"layer{layer}.masked"])
+        probs = node("Softmax", [scores], [f"layer{layer}.probs"], axis=-1)
+        attention = node("MatMul", [probs, present_value], [f"layer{layer}.attention"])
+        attention = node("Transpose", [attention], [f"layer{layer}.attention_bshd"], perm=[0, 2, 1, 3])
+        attention = node("Reshape", [attention, "shape_bse"], [f"layer{layer}.attention_merged"])
+        wo = weight(f"layer{layer}.wo", (hidden_size, hidden_size), 1.0 / np.sqrt(hidden_size))
+        attention = node("MatMul", [attention, wo], [f"layer{layer}.attention_out"])
+        x = node("Add", [x, attention], [f"layer{layer}.residual_attention"])
+
+        w1 = weight(f"layer{layer}.w1", (hidden_size, 4 * hidden_size), 1.0 / np.sqrt(hidden_size))
+        w2 = weight(f"layer{layer}.w2", (4 * hidden_size, hidden_size), 1.0 / np.sqrt(4 * hidden_size))
+        h = node("MatMul", [x, w1], [f"layer{layer}.mlp_in"])
+        h = node("Relu", [h], [f"layer{layer}.mlp_act"])
+        h = node("MatMul", [h, w2], [f"layer{layer}.mlp_out"])
+        x = node("Add", [x, h], [f"layer{layer}.residual_mlp"])
+
+    weight("lm_head", (hidden_size, vocab_size), 1.0 / np.sqrt(hidden_size))
+    node("MatMul", [x, "lm_head"], ["logits"])
+
+    graph = helper.make_graph(nodes, "tiny_decoder", inputs, outputs, initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)],
+                              producer_name="moussadar-tiny-decoder")
+    # Loadable by older onnxruntime releases than the installed onnx targets by default
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+    return path
+
+
+def build_tiny_encoder(path: str, hidden_size: int = 16, seed: int = 0) -> str:
+    """
+    Write a randomly initialized sentence encoder ONNX model and its tokenizer.json
+
+    The token states are a plain embedding lookup ([batch, sequence, hidden]), which
+    OnnxSentenceEncoder mean-pools like a transformer encoder's last hidden state.
+    The tokenizer is byte-level BPE without merges, written next to the model as the
+    encoder expects.
+
+    Args:
+        path: Destination .onnx file
+        hidden_size: Embedding width
+        seed: Weight initialization seed
+
+    Returns:
+        The path written
+    """
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    special_tokens = {token: i for i, token in enumerate(DEFAULT_SPECIAL_TOKENS)}
+    vocab = {char: len(special_tokens) + byte for byte, char in bytes_to_unicode().items()}
+    vocab_size = len(special_tokens) + len(vocab)
+    with open(os.path.join(os.path.dirname(path) or ".", "tokenizer.json"), 'w', encoding='utf-8') as f:
+        json.dump({
+            "model": {"type": "BPE", "vocab": vocab, "merges": []},
+            "added_tokens": [{"id": i, "content": token, "special": True} for token, i in special_tokens.items()]
+        }, f, ensure_ascii=False)
+
+    rng = np.random.default_rng(seed)
+    embed = numpy_helper.from_array(rng.standard_normal((vocab_size, hidden_size)).astype(np.float32), "embed")
+
+    graph = helper.make_graph(
+        [helper.make_node("Gather", ["embed", "input_ids"], ["last_hidden_state"])],
+        "tiny_encoder",
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "sequence"]),
+         helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch", "sequence"])],
+        [helper.make_tensor_value_info("last_hidden_state", TensorProto.FLOAT,
+                                       ["batch", "sequence", hidden_size])],
+        [embed])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)],
+                              producer_name="moussadar-tiny-encoder")
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+    return path
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+Deterministic tokenizers for the lightweight AI service
+Loads the model's byte-level BPE vocabulary and encodes/decodes whole batches in one call
+"""
+
+import argparse
+import codecs
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import regex
+except ImportError:  # pragma: no cover - optional dependency
+    regex = None
+
+# GPT-2 style pre-tokenization; digits are split one by one like the SmolLM2 tokenizer
+if regex is not None:
+    PRETOKENIZE_PATTERN = regex.compile(
+        r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+else:
+    PRETOKENIZE_PATTERN = re.compile(
+        r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""")
+
+# Special tokens used by the ChatML prompt format
+DEFAULT_SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>"]
+
+
+def bytes_to_unicode() -> Dict[int, str]:
+    """Reversible byte -> printable character table used by byte-level BPE"""
+    printable = (list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1))
+                 + list(range(ord("®"), ord("ÿ") + 1)))
+    chars = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            chars.append(256 + extra)
+            extra += 1
+    return dict(zip(printable, (chr(c) for c in chars)))
+
+
+class LRUCache:
+    """
+    Minimal bounded mapping with least-recently-used eviction
+
+    Shared by the request threads of a process: a lookup reorders the mapping, so
+    every access holds the lock.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.data: "OrderedDict[Any, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def reopen(self):
+        """Reset the lock after fork; inherited entries stay valid"""
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+class BaseTokenizer:
+    """
+    Shared batch encoding/decoding on top of a per-text encode()
+    Subclasses provide encode_fragment() and the id -> bytes table
+    """
+
+    def __init__(self, special_tokens: Dict[str, int], eos_token: str, pad_token: Optional[str],
+                 cache_size: int = 4096):
+        self.special_tokens = special_tokens
+        self.special_ids = np.zeros(0, dtype=np.int64)
+        self.eos_token_id = special_tokens.get(eos_token, 0)
+        self.pad_token_id = special_tokens.get(pad_token, self.eos_token_id) if pad_token else self.eos_token_id
+        self.fragment_cache = LRUCache(cache_size)
+        self.id_bytes = np.empty(0, dtype=object)
+
+        if special_tokens:
+            pattern = "|".join(re.escape(token) for token in sorted(special_tokens, key=len, reverse=True))
+            self.special_pattern = re.compile(f"({pattern})")
+            self.special_ids = np.array(sorted(special_tokens.values()), dtype=np.int64)
+        else:
+            self.special_pattern = None
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.id_bytes)
+
+    def encode_fragment(self, text: str) -> List[int]:
+        raise NotImplementedError
+
+    def encode(self, text: str) -> List[int]:
+        """Encode one string; special tokens in the text map to their ids"""
+        cached = self.fragment_cache.get(text)
+        if cached is not None:
+            return list(cached)
+
+        if self.special_pattern is None:
+            ids = self.encode_fragment(text)
+        else:
+            ids = []
+            for part in self.special_pattern.split(text):
+                if not part:
+                    continue
+                special_id = self.special_tokens.get(part)
+                if special_id is not None:
+                    ids.append(special_id)
+                else:
+                    ids.extend(self.encode_fragment(part))
+
+        self.fragment_cache.put(text, tuple(ids))
+        return ids
+
+    def encode_batch(self, texts: List[str], max_length: Optional[int] = None,
+                     padding_side: str = "right",
+                     truncation_side: str = "left") -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Encode a batch of strings into padded arrays
+
+        Args:
+            texts: Strings to encode
+            max_length: Optional cap on tokens per row
+            padding_side: 'right' for encoders, 'left' for batched generation
+            truncation_side: Which end to drop when a row exceeds max_length
+
+        Returns:
+            (input_ids, attention_mask), both int64 of shape [len(texts), width]
+        """
+        rows = [self.encode(text) for text in texts]
+        if max_length is not None:
+            rows = [row[-max_length:] if truncation_side == "left" else row[:max_length]
+                    for row in rows]
+
+        lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+        width = max(int(lengths.max()) if len(rows) else 0, 1)
+        flat = np.fromiter((token for row in rows for token in row), dtype=np.int64, count=int(lengths.sum()))
+
+        # Scatter all tokens at once using a [rows, width] position mask
+        positions = np.arange(width)
+        if padding_side == "left":
+            attention_mask = positions[None, :] >= (width - lengths)[:, None]
+        else:
+            attention_mask = positions[None, :] < lengths[:, None]
+        input_ids = np.full((len(rows), width), self.pad_token_id, dtype=np.int64)
+        input_ids[attention_mask] = flat
+        return input_ids, attention_mask.astype(np.int64)
+
+    def decode(self, ids, skip_special_tokens: bool = True) -> str:
+        """Decode a sequence of ids back to text"""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if skip_special_tokens and len(self.special_ids):
+            ids = ids[~np.isin(ids, self.special_ids)]
+        ids = ids[(ids >= 0) & (ids < self.vocab_size)]
+        return b"".join(self.id_bytes[ids]).decode('utf-8', errors='replace')
+
+    def decode_batch(self, input_ids: np.ndarray, attention_mask: Optional[np.ndarray] = None,
+                     skip_special_tokens: bool = True) -> List[str]:
+        """Decode a [batch, width] id array, ignoring padded positions"""
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        if attention_mask is None:
+            return [self.decode(row, skip_special_tokens) for row in input_ids]
+        mask = np.asarray(attention_mask).astype(bool)
+        return [self.decode(row[row_mask], skip_special_tokens) for row, row_mask in zip(input_ids, mask)]
+
+    def stream_decoder(self, skip_special_tokens: bool = True) -> "StreamDecoder":
+        """Create an incremental decoder for token-by-token output"""
+        return StreamDecoder(self, skip_special_tokens)
+
+    def reopen(self):
+        """Reset the cache locks after fork"""
+        self.fragment_cache.reopen()
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Fragment cache occupancy and hit counts"""
+        return {
+            "entries": len(self.fragment_cache),
+            "hits": self.fragment_cache.hits,
+            "misses": self.fragment_cache.misses
+        }
+
+
+class BPETokenizer(BaseTokenizer):
+    """
+    Byte-level BPE tokenizer (GPT-2 / SmolLM2 family)
+    Merges are applied per pre-tokenized word, with a word cache in front
+    """
+
+    def __init__(self, vocab: Dict[str, int], merges: List[Tuple[str, str]],
+                 special_tokens: Dict[str, int], eos_token: str = "<|endoftext|>",
+                 pad_token: Optional[str] = None, cache_size: int = 4096):
+        """
+        Initialize the tokenizer
+
+        Args:
+            vocab: Token string (byte-level alphabet) -> id
+            merges: Ordered merge rules
+            special_tokens: Special token string -> id
+            eos_token: End-of-sequence token
+            pad_token: Padding token (defaults to eos)
+            cache_size: Size of the encoded fragment cache
+        """
+        super().__init__(special_tokens, eos_token, pad_token, cache_size)
+        self.vocab = vocab
+        self.merge_ranks = {pair: rank for rank, pair in enumerate(merges)}
+        self.byte_encoder = bytes_to_unicode()
+        self.byte_decoder = {char: byte for byte, char in self.byte_encoder.items()}
+        self.word_cache = LRUCache(cache_size * 4)
+        self.unk_token_id = vocab.get("<unk>")
+
+        size = max(list(vocab.values()) + list(special_tokens.values())) + 1
+        self.id_bytes = np.empty(size, dtype=object)
+        self.id_bytes[:] = b""
+        for token, token_id in vocab.items():
+            self.id_bytes[token_id] = bytes(self.byte_decoder.get(char, 0) for char in token)
+        for token, token_id in special_tokens.items():
+            self.id_bytes[token_id] = token.encode('utf-8')
+
+    def reopen(self):
+        super().reopen()
+        self.word_cache.reopen()
+
+    @classmethod
+    def from_file(cls, path: str, cache_size: int = 4096) -> "BPETokenizer":
+        """Load a Hugging Face tokenizer.json (plus tokenizer_config.json if present)"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        model = data["model"]
+        if model.get("type", "BPE") != "BPE":
+            raise ValueError(f"Unsupported tokenizer model type: {model.get('type')}")
+
+        merges = [tuple(m.split(" ", 1)) if isinstance(m, str) else tuple(m) for m in model["merges"]]
+        special_tokens = {t["content"]: t["id"] for t in data.get("added_tokens", []) if t.get("special")}
+
+        eos_token, pad_token = "<|endoftext|>", None
+        config_path = os.path.join(os.path.dirname(path), "tokenizer_config.json")
+        if os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                tokenizer_config = json.load(f)
+            eos_token = token_content(tokenizer_config.get("eos_token")) or eos_token
+            pad_token = token_content(tokenizer_config.get("pad_token"))
+
+        return cls(model["vocab"], merges, special_tokens, eos_token, pad_token, cache_size)
+
+    def bpe(self, word: str) -> Tuple[str, ...]:
+        """Apply merges to one pre-tokenized word (already in the byte-level alphabet)"""
+        cached = self.word_cache.get(word)
+        if cached is not None:
+            return cached
+
+        parts = list(word)
+        ranks = self.merge_ranks
+        while len(parts) > 1:
+            best_rank, best_index = None, -1
+            for i in range(len(parts) - 1):
+                rank = ranks.get((parts[i], parts[i + 1]))
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best_rank, best_index = rank, i
+            if best_rank is None:
+                break
+            first, second = parts[best_index], parts[best_index + 1]
+            merged, i = [], 0
+            while i < len(parts):
+                if i < len(parts) - 1 and parts[i] == first and parts[i + 1] == second:
+                    merged.append(first + second)
+                    i += 2
+                else:
+                    merged.append(parts[i])
+                    i += 1
+            parts = merged
+
+        result = tuple(parts)
+        self.word_cache.put(word, result)
+        return result
+
+    def encode_fragment(self, text: str) -> List[int]:
+        """Encode text containing no special tokens"""
+        ids = []
+        vocab, byte_encoder = self.vocab, self.byte_encoder
+        for word in PRETOKENIZE_PATTERN.findall(text):
+            mapped = "".join(byte_encoder[byte] for byte in word.encode('utf-8'))
+            for token in self.bpe(mapped):
+                token_id = vocab.get(token)
+                if token_id is None:
+                    # Unknown merge result: fall back to single byte tokens
+                    ids.extend(vocab.get(char, self.unk_token_id or 0) for char in token)
+                else:
+                    ids.append(token_id)
+        return ids
+
+
+class ByteTokenizer(BaseTokenizer):
+    """
+    Fallback tokenizer used when no vocabulary ships with the model
+    Special tokens take the first ids, then one id per UTF-8 byte
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        special_tokens = {token: i for i, token in enumerate(DEFAULT_SPECIAL_TOKENS)}
+        super().__init__(special_tokens, "<|endoftext|>", None, cache_size)
+        self.offset = len(special_tokens)
+        self.id_bytes = np.empty(self.offset + 256, dtype=object)
+        for token, token_id in special_tokens.items():
+            self.id_bytes[token_id] = token.encode('utf-8')
+        for byte in range(256):
+            self.id_bytes[self.offset + byte] = bytes([byte])
+
+    def encode_fragment(self, text: str) -> List[int]:
+        return (np.frombuffer(text.encode('utf-8'), dtype=np.uint8).astype(np.int64) + self.offset).tolist()
+
+
+class StreamDecoder:
+    """
+    Turns a stream of token ids into text deltas
+    Bytes of a character split across tokens are held back until the character is complete
+    """
+
+    def __init__(self, tokenizer: BaseTokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip = set(tokenizer.special_tokens.values()) if skip_special_tokens else set()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def decode(self, token_ids) -> str:
+        """Feed new token ids, return the text they complete"""
+        data = b"".join(self.tokenizer.id_bytes[token_id] for token_id in np.atleast_1d(token_ids)
+                        if token_id not in self.skip and 0 <= token_id < self.tokenizer.vocab_size)
+        return self.decoder.decode(data)
+
+    def flush(self) -> str:
+        """Return whatever is left once the stream ends"""
+        return self.decoder.decode(b"", final=True)
+
+
+def token_content(token: Any) -> Optional[str]:
+    """tokenizer_config.json stores tokens either as strings or as AddedToken dicts"""
+    if isinstance(token, dict):
+        return token.get("content")
+    return token
+
+
+def load_tokenizer(models_dir: str, cache_size: int = 4096) -> BaseTokenizer:
+    """
+    Load the tokenizer shipped next to the model
+
+    Looks for tokenizer.json in models_dir (or its 'original' download folder),
+    falling back to the byte tokenizer so ids stay deterministic either way.
+    """
+    for candidate in (os.path.join(models_dir, "tokenizer.json"),
+                      os.path.join(models_dir, "original", "tokenizer.json")):
+        if os.path.exists(candidate):
+            try:
+                tokenizer = BPETokenizer.from_file(candidate, cache_size)
+                logger.info(f"Tokenizer loaded from {candidate} ({tokenizer.vocab_size} tokens)")
+                return tokenizer
+            except Exception as e:
+                logger.error(f"Failed to load tokenizer from {candidate}: {e}")
+
+    logger.warning(f"No tokenizer found in {models_dir}, using byte-level fallback")
+    return ByteTokenizer(cache_size)
+
+
+def benchmark(tokenizer: BaseTokenizer, texts: List[str], batch_size: int = 32,
+              repeat: int = 5) -> Dict[str, Any]:
+    """
+    Measure batch encode/decode throughput
+
+    The first pass runs with cold caches, later passes hit the fragment cache.
+    """
+    def run_encode():
+        start = time.perf_counter()
+        encoded = [tokenizer.encode_batch(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+        return time.perf_counter() - start, encoded
+
+    tokenizer.fragment_cache.clear()
+    if hasattr(tokenizer, "word_cache"):
+        tokenizer.word_cache.clear()
+    cold_time, encoded = run_encode()
+    num_tokens = int(sum(mask.sum() for _, mask in encoded))
+
+    warm_times = [run_encode()[0] for _ in range(repeat)]
+
+    start = time.perf_counter()
+    for input_ids, attention_mask in encoded:
+        tokenizer.decode_batch(input_ids, attention_mask)
+    decode_time = time.perf_counter() - start
+
+    warm_time = min(warm_times) if warm_times else cold_time
+    return {
+        "texts": len(texts),
+        "tokens": num_tokens,
+        "encode_cold_tokens_per_sec": num_tokens / cold_time if cold_time else 0.0,
+        "encode_warm_tokens_per_sec": num_tokens / warm_time if warm_time else 0.0,
+        "decode_tokens_per_sec": num_tokens / decode_time if decode_time else 0.0,
+        "cache": tokenizer.cache_stats()
+    }
+
+
+def main():
+    """Tokenizer throughput benchmark"""
+    parser = argparse.ArgumentParser(description="Benchmark the service tokenizer")
+    parser.add_argument("--models-dir", default="models", help="Directory containing tokenizer.json")
+    parser.add_argument("--texts", help="Text file, one sample per line (defaults to built-in samples)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.texts:
+        with open(args.texts, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        samples = [
+            "Comment obtenir une carte d'identité ?",
+            "Quels documents sont nécessaires pour un passeport ?",
+            "كيفية الحصول على بطاقة هوية؟",
+            "ما هي المستندات المطلوبة لجواز السفر؟",
+            "Où déposer une demande d'acte de naissance en 2024 ?"
+        ]
+        texts = [f"{sample} ({i})" for i in range(200) for sample in samples]
+
+    tokenizer = load_tokenizer(args.models_dir)
+    json.dump(benchmark(tokenizer, texts, args.batch_size, args.repeat), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
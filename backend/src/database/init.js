@@ -137,6 +137,16 @@ const createTables = () => {
     )
   `)
 
+  // The AI service syncs the FAQ by updated_at; bump it on content edits only,
+  // not on view/helpful counters
+  db.exec(`
+    CREATE TRIGGER IF NOT EXISTS faq_touch
+    AFTER UPDATE OF question_fr, question_ar, answer_fr, answer_ar, category, tags ON faq
+    BEGIN
+      UPDATE faq SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+    END
+  `)
+
   // Cache table
   db.exec(`
     CREATE TABLE IF NOT EXISTS cache (
@@ -1,13 +1,36 @@
 import express from 'express'
+import { Readable } from 'stream'
 import { body, validationResult } from 'express-validator'
 import db from '../database/db.js'
 
 const router = express.Router()
 
-// Simple AI response endpoint (mock implementation)
+const AI_SERVICE_URL = process.env.AI_SERVICE_URL || 'http://localhost:5000'
+const AI_SERVICE_TIMEOUT = parseInt(process.env.AI_SERVICE_TIMEOUT || '30000', 10)
+
+// Ask the AI model service; null when it is unreachable or failing
+async function askAiService(path, payload) {
+  try {
+    const upstream = await fetch(`${AI_SERVICE_URL}${path}`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(payload),
+      signal: AbortSignal.timeout(AI_SERVICE_TIMEOUT)
+    })
+    if (!upstream.ok) return null
+    const { data } = await upstream.json()
+    return data
+  } catch (error) {
+    console.warn('AI service unavailable, answering locally:', error.message)
+    return null
+  }
+}
+
+// AI response endpoint: the model service first, local FAQ/keyword answers as fallback
 router.post('/chat', [
   body('message').isString().isLength({ min: 1, max: 1000 }),
-  body('lang').optional().isIn(['fr', 'ar']).default('fr')
+  body('lang').optional().isIn(['fr', 'ar']).default('fr'),
+  body('context').optional().isArray()
 ], async (req, res) => {
   try {
     // Check validation
@@ -19,9 +42,17 @@ router.post('/chat', [
       })
     }
 
-    const { message, lang = 'fr' } = req.body
+    const { message, lang = 'fr', context } = req.body
+
+    const aiData = await askAiService('/chat', { message, lang, context })
+    if (aiData) {
+      return res.json({
+        success: true,
+        data: aiData
+      })
+    }
     
-    // Simple keyword-based responses (replace with actual AI model)
+    // Simple keyword-based responses when the model service is down
     const lowerMessage = message.toLowerCase()
     
     let response = {
@@ -84,9 +115,6 @@ router.post('/chat', [
         : ['المستندات الإدارية', 'الإجراءات عبر الإنترنت', 'الاتصال بخدمة']
     }
 
-    // Simulate processing time
-    await new Promise(resolve => setTimeout(resolve, 1000))
-
     res.json({
       success: true,
       data: {
@@ -103,6 +131,75 @@ router.post('/chat', [
   }
 })
 
+// Streaming AI response (server-sent events proxied from the AI service)
+router.post('/chat/stream', [
+  body('message').isString().isLength({ min: 1, max: 1000 }),
+  body('lang').optional().isIn(['fr', 'ar']).default('fr'),
+  body('context').optional().isArray()
+], async (req, res) => {
+  const errors = validationResult(req)
+  if (!errors.isEmpty()) {
+    return res.status(400).json({
+      success: false,
+      errors: errors.array()
+    })
+  }
+
+  const { message, lang = 'fr', context } = req.body
+
+  // Stop generation upstream as soon as the client goes away
+  const controller = new AbortController()
+  res.on('close', () => controller.abort())
+  // The timeout covers the wait for the response headers, not the stream itself
+  let timedOut = false
+  const headersTimer = setTimeout(() => {
+    timedOut = true
+    controller.abort()
+  }, AI_SERVICE_TIMEOUT)
+
+  try {
+    const upstream = await fetch(`${AI_SERVICE_URL}/chat/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
+      body: JSON.stringify({ message, lang, context }),
+      signal: controller.signal
+    })
+    clearTimeout(headersTimer)
+
+    if (!upstream.ok || !upstream.body) {
+      return res.status(502).json({
+        success: false,
+        error: 'AI service unavailable'
+      })
+    }
+
+    // no-transform keeps the compression middleware from buffering the stream
+    res.status(200).set({
+      'Content-Type': 'text/event-stream',
+      'Cache-Control': 'no-cache, no-transform',
+      Connection: 'keep-alive',
+      'X-Accel-Buffering': 'no'
+    })
+    res.flushHeaders()
+
+    Readable.fromWeb(upstream.body)
+      .on('error', () => res.end())
+      .pipe(res)
+  } catch (error) {
+    clearTimeout(headersTimer)
+    if (controller.signal.aborted && !timedOut) return
+    console.error('AI stream error:', timedOut ? 'timed out' : error)
+    if (!res.headersSent) {
+      res.status(502).json({
+        success: false,
+        error: 'AI service unavailable'
+      })
+    } else {
+      res.end()
+    }
+  }
+})
+
 // Get AI suggestions
 router.get('/suggestions', (req, res) => {
   try {
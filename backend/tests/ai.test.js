@@ -0,0 +1,99 @@
+import http from 'http'
+import { jest } from '@jest/globals'
+import express from 'express'
+import request from 'supertest'
+
+// No FAQ match: the local answers come from the keyword rules
+jest.unstable_mockModule('../src/database/db.js', () => ({
+  default: {
+    prepare: () => ({ all: () => [], run: () => ({ changes: 0 }) })
+  }
+}))
+
+const AI_SERVICE_TIMEOUT = 200
+
+let upstream
+let mode
+let app
+
+beforeAll(async () => {
+  upstream = http.createServer((req, res) => {
+    if (mode === 'hang') return
+    if (mode === 'error') {
+      res.writeHead(500)
+      return res.end()
+    }
+    if (req.url === '/chat/stream') {
+      res.writeHead(200, { 'Content-Type': 'text/event-stream' })
+      res.write('event: token\ndata: {"content": "Bon"}\n\n')
+      return res.end('event: done\ndata: {"content": "Bonjour."}\n\n')
+    }
+    res.writeHead(200, { 'Content-Type': 'application/json' })
+    res.end(JSON.stringify({ success: true, data: { response: { content: 'Bonjour.', source: 'ai_model' } } }))
+  })
+  await new Promise(resolve => upstream.listen(0, '127.0.0.1', resolve))
+  process.env.AI_SERVICE_URL = `http://127.0.0.1:${upstream.address().port}`
+  process.env.AI_SERVICE_TIMEOUT = String(AI_SERVICE_TIMEOUT)
+
+  const { default: aiRoutes } = await import('../src/routes/ai.js')
+  app = express()
+  app.use(express.json())
+  app.use('/api/ai', aiRoutes)
+})
+
+afterAll(() => {
+  upstream.closeAllConnections()
+  upstream.close()
+})
+
+const ask = (path, message = 'Carte d\'identité ?') =>
+  request(app).post(`/api/ai${path}`).send({ message, lang: 'fr' })
+
+const expectLocalAnswer = (res) => {
+  expect(res.status).toBe(200)
+  expect(res.body.success).toBe(true)
+  expect(res.body.data.response.content).toMatch(/carte d'identité/)
+}
+
+describe('AI routes', () => {
+  test('answers from the AI service when it is up', async () => {
+    mode = 'ok'
+    const res = await ask('/chat')
+    expect(res.body.data.response).toEqual({ content: 'Bonjour.', source: 'ai_model' })
+
+    const stream = await ask('/chat/stream')
+    expect(stream.status).toBe(200)
+    expect(stream.headers['content-type']).toMatch(/text\/event-stream/)
+    expect(stream.text).toContain('event: done')
+  })
+
+  test('answers locally when the AI service times out', async () => {
+    mode = 'hang'
+    const started = Date.now()
+    expectLocalAnswer(await ask('/chat'))
+    expect(Date.now() - started).toBeLessThan(AI_SERVICE_TIMEOUT + 2000)
+  })
+
+  test('answers locally when the AI service fails', async () => {
+    mode = 'error'
+    expectLocalAnswer(await ask('/chat'))
+  })
+
+  test('stream reports the AI service as unavailable when it times out or fails', async () => {
+    for (mode of ['hang', 'error']) {
+      const res = await ask('/chat/stream')
+      expect(res.status).toBe(502)
+      expect(res.body).toEqual({ success: false, error: 'AI service unavailable' })
+    }
+  })
+
+  test('falls back when the AI service is down', async () => {
+    upstream.closeAllConnections()
+    await new Promise(resolve => upstream.close(resolve))
+
+    expectLocalAnswer(await ask('/chat'))
+    const res = await ask('/chat/stream')
+    expect(res.status).toBe(502)
+    expect(res.body.success).toBe(false)
+  })
+})
@@ -0,0 +1,149 @@
+import { defineStore } from 'pinia'
+import { ref, computed } from 'vue'
+
+// Answer pack compiled by ai-models/precompute.py
+const PACK_URL = '/answer-pack/'
+const PACK_FORMAT = 'moussadar-answer-pack'
+const PACK_SCHEMA = 2
+const CACHE_NAME = 'moussadar-answer-pack'
+
+// Share of the question's word weight an entry must match to be used
+const MIN_SCORE = 0.6
+
+const ARABIC_DIACRITICS = /[\u064B-\u065F\u0670\u0640]/g
+
+// Same rules as normalize_question in precompute.py
+export const normalizeQuestion = (text) =>
+  text
+    .toLowerCase()
+    .replace(ARABIC_DIACRITICS, '')
+    .replace(/[أإآ]/g, 'ا')
+    .replace(/ة/g, 'ه')
+    .replace(/ي/g, 'ى')
+    .replace(/[^\p{L}\p{N}]+/gu, ' ')
+    .trim()
+
+export const useAnswerPackStore = defineStore('answers', () => {
+  // State
+  const pack = ref(null)
+  const manifest = ref(JSON.parse(localStorage.getItem('answerPackManifest') || 'null'))
+  const syncing = ref(false)
+
+  // Getters
+  const isAvailable = computed(() => pack.value !== null)
+  const questionCount = computed(() => (manifest.value ? manifest.value.questions : 0))
+
+  const readPack = async (response) => {
+    const stream = response.body.pipeThrough(new DecompressionStream('gzip'))
+    const data = await new Response(stream).json()
+    if (data.format !== PACK_FORMAT || data.schema !== PACK_SCHEMA) {
+      throw new Error(`Unsupported answer pack ${data.format} v${data.schema}`)
+    }
+    // Weight of question words the pack has never seen
+    data.maxIdf = Math.max(0, ...Object.values(data.terms).map(([idf]) => idf))
+    return data
+  }
+
+  // Actions
+  const load = async () => {
+    if (pack.value || !manifest.value || !('caches' in window)) return
+    try {
+      const cache = await caches.open(CACHE_NAME)
+      const response = await cache.match(PACK_URL + manifest.value.file)
+      if (response) {
+        pack.value = await readPack(response)
+      }
+    } catch (error) {
+      console.error('Failed to read the answer pack:', error)
+    }
+  }
+
+  // Download the pack once per version; the previous one is dropped from the cache
+  const sync = async () => {
+    if (syncing.value || !navigator.onLine || !('caches' in window)) return
+    syncing.value = true
+    try {
+      const latest = await (await fetch(PACK_URL + 'manifest.json', { cache: 'no-cache' })).json()
+      if (latest.format !== PACK_FORMAT || latest.schema !== PACK_SCHEMA) return
+      const cache = await caches.open(CACHE_NAME)
+      const url = PACK_URL + latest.file
+      if (!(await cache.match(url))) {
+        const response = await fetch(url)
+        if (!response.ok) throw new Error(`Answer pack download failed: ${response.status}`)
+        await cache.put(url, response)
+        for (const request of await cache.keys()) {
+          if (!request.url.endsWith(latest.file)) await cache.delete(request)
+        }
+      }
+      if (!manifest.value || manifest.value.version !== latest.version) pack.value = null
+      manifest.value = latest
+      localStorage.setItem('answerPackManifest', JSON.stringify(latest))
+      await load()
+    } catch (error) {
+      console.error('Failed to sync the answer pack:', error)
+    } finally {
+      syncing.value = false
+    }
+  }
+
+  // Precomputed answer to a question, or null
+  const lookup = async (question, lang) => {
+    await load()
+    const data = pack.value
+    if (!data) return null
+    const normalized = normalizeQuestion(question)
+    const toAnswer = (entryIndex) => {
+      const row = data.answers[data.entries[entryIndex][1]]
+      return Object.fromEntries(data.answer_fields.map((field, i) => [field, row[i]]))
+    }
+
+    const exact = data.exact[`${lang}:${normalized}`]
+    if (exact !== undefined) return toAnswer(exact)
+
+    // Entries sharing the most idf weight with the question, relative to both sizes;
+    // an entry with other numbers (fees, counts, years) answers another question
+    const terms = [...new Set(normalized.split(' ').filter(Boolean))]
+    const numbers = terms.filter((term) => /\p{Nd}/u.test(term)).sort().join(' ')
+    const scores = new Map()
+    let questionWeight = 0
+    for (const term of terms) {
+      const posting = data.terms[term]
+      if (!posting) {
+        questionWeight += data.maxIdf
+        continue
+      }
+      const [idf, entries] = posting
+      questionWeight += idf
+      for (const entry of entries) {
+        if (data.entries[entry][0] === lang) scores.set(entry, (scores.get(entry) || 0) + idf)
+      }
+    }
+    let best = null
+    let bestScore = MIN_SCORE
+    for (const [entry, shared] of scores) {
+      if (data.entries[entry][3].join(' ') !== numbers) continue
+      const score = (2 * shared) / (questionWeight + data.entries[entry][2])
+      if (score >= bestScore) {
+        best = entry
+        bestScore = score
+      }
+    }
+    return best === null ? null : toAnswer(best)
+  }
+
+  return {
+    // State
+    pack,
+    manifest,
+    syncing,
+
+    // Getters
+    isAvailable,
+    questionCount,
+
+    // Actions
+    load,
+    sync,
+    lookup
+  }
+})
@@ -35,6 +35,8 @@ export default defineConfig({
       },
       workbox: {
         globPatterns: ['**/*.{js,css,html,ico,png,svg,json,vue,txt,woff2}'],
+        // The answer pack has its own versioned download (src/stores/answers.js)
+        globIgnores: ['answer-pack/**'],
         runtimeCaching: [
           {
             urlPattern: /^https:\/\/api\.moussadar\.com\/.*/i,